@@ -9,5 +9,10 @@ enable_utc = True
 worker_enable_remote_control = False
 task_routes = {
     'etd-alma-drs-holding-service.tasks.add_holdings':
-        {'queue': os.getenv("CONSUME_QUEUE_NAME")}
+        {'queue': os.getenv("CONSUME_QUEUE_NAME")},
+    'etd-alma-drs-holding-service.tasks.resolve_mms_ids':
+        {'queue': os.getenv("CONSUME_QUEUE_NAME")},
+    'etd-alma-drs-holding-service.tasks.verify_holding':
+        {'queue': os.getenv("ALMA_VERIFY_QUEUE_NAME",
+                            "etd_alma_drs_holding_verify")}
 }
@@ -1,18 +1,83 @@
+import atexit
 import logging
-from logging.handlers import TimedRotatingFileHandler
+from logging.handlers import (QueueHandler, QueueListener,
+                              TimedRotatingFileHandler)
 import os
+import queue
 import socket
+import threading
+import time
 from datetime import datetime
 
 LOG_FILE_BACKUP_COUNT = int(os.getenv('LOG_FILE_BACKUP_COUNT', '30'))
 LOG_ROTATION = "midnight"
+# log records queued for the writer thread, more are dropped
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+# how long a WARNING or worse record waits for room on a full queue
+LOG_QUEUE_BLOCK_SECS = float(os.getenv('LOG_QUEUE_BLOCK_SECS', '5'))
+# at most how often the count of dropped records is logged
+LOG_DROP_REPORT_SECS = float(os.getenv('LOG_DROP_REPORT_SECS', '60'))
 
 container_id = socket.gethostname()
 timestamp = datetime.today().strftime('%Y-%m-%d')
 
+_listener = None
+_listener_pid = None
+_logger_lock = threading.Lock()
 
-def configure_logger():  # pragma: no cover
-    log_level = os.getenv("APP_LOG_LEVEL", "WARNING")
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    Puts records on a bounded queue for the writer thread. When the queue
+    is full, a WARNING or worse record waits up to block_secs for room,
+    and a lower one is dropped at once instead of blocking the task.
+    Dropped records are counted, and the count is logged through the
+    queue at most every report_secs.
+    """
+
+    def __init__(self, log_queue, block_secs=LOG_QUEUE_BLOCK_SECS,
+                 report_secs=LOG_DROP_REPORT_SECS, clock=time.monotonic):
+        super().__init__(log_queue)
+        self.block_secs = block_secs
+        self.report_secs = report_secs
+        self.clock = clock
+        self.dropped = 0
+        self.unreported = 0
+        self.reported_at = clock()
+
+    def enqueue(self, record):
+        # handle() holds the handler lock, so the counts need no other
+        try:
+            if record.levelno >= logging.WARNING:
+                self.queue.put(record, timeout=self.block_secs)
+            else:
+                self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            self.unreported += 1
+            return
+        if self.clock() - self.reported_at >= self.report_secs:
+            self.report_drops()
+
+    def report_drops(self, block_secs=0):
+        """
+        Logs the count of the records dropped since the last report.
+        """
+        self.reported_at = self.clock()
+        if not self.unreported:
+            return
+        count, self.unreported = self.unreported, 0
+        record = logging.LogRecord(
+            'etd_alma_drs_holding', logging.WARNING, __file__, 0,
+            "%d log records were dropped, the log queue was full",
+            (count,), None)
+        try:
+            self.queue.put(record, timeout=block_secs)
+        except queue.Full:
+            self.unreported += count
+
+
+def build_handlers():  # pragma: no cover, writes to the console and disk
     log_file_path = os.getenv("LOGFILE_PATH",
                               "/home/etdadm/logs/etd")
     formatter = logging.Formatter(
@@ -21,9 +86,7 @@ def configure_logger():  # pragma: no cover
 
     console_handler = logging.StreamHandler()
     console_handler.setFormatter(formatter)
-
-    logger = logging.getLogger('etd_alma_drs_holding')
-    logger.addHandler(console_handler)
+    handlers = [console_handler]
     # Defaults to console logging
     if os.getenv("CONSOLE_LOGGING_ONLY", "true") == "false":
         file_handler = TimedRotatingFileHandler(
@@ -32,6 +95,60 @@ def configure_logger():  # pragma: no cover
             backupCount=LOG_FILE_BACKUP_COUNT
         )
         file_handler.setFormatter(formatter)
-        logger.addHandler(file_handler)
+        handlers.append(file_handler)
+    return handlers
+
+
+def configure_logger(handlers=None):
+    """
+    Sets up the etd_alma_drs_holding logger once per process. Records go
+    through a bounded queue to a listener thread that writes them to the
+    console, and to a file unless CONSOLE_LOGGING_ONLY, so the tasks do
+    not wait on log I/O. Calling it again only updates the level.
+
+    Args:
+        handlers (list): The handlers the listener writes to, defaults
+            to build_handlers().
+    """
+    global _listener, _listener_pid
+    logger = logging.getLogger('etd_alma_drs_holding')
+    logger.setLevel(os.getenv("APP_LOG_LEVEL", "WARNING"))
+    with _logger_lock:
+        if _listener is not None and _listener_pid == os.getpid():
+            return logger
+        # A forked process inherits the handler but not the thread
+        for handler in list(logger.handlers):
+            if isinstance(handler, DroppingQueueHandler):
+                logger.removeHandler(handler)
+        log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+        _listener = QueueListener(
+            log_queue, *(handlers or build_handlers()),
+            respect_handler_level=True)
+        _listener.start()
+        _listener_pid = os.getpid()
+        logger.addHandler(DroppingQueueHandler(log_queue))
+    return logger
+
+
+def stop_logger():
+    """
+    Writes the queued records and stops the listener thread of this
+    process.
+    """
+    global _listener, _listener_pid
+    logger = logging.getLogger('etd_alma_drs_holding')
+    with _logger_lock:
+        if _listener is None or _listener_pid != os.getpid():
+            return
+        for handler in list(logger.handlers):
+            if isinstance(handler, DroppingQueueHandler):
+                logger.removeHandler(handler)
+                # The listener is still writing, so this is written too
+                with handler.lock:
+                    handler.report_drops(handler.block_secs)
+        _listener.stop()
+        _listener = None
+        _listener_pid = None
+
 
-    logger.setLevel(log_level)
+atexit.register(stop_logger)
@@ -0,0 +1,217 @@
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+"""
+Cache for the Alma id lookups that almost never change: proquest id to
+mms id (the SRU search) and mms id to DRS holding id (the holdings list).
+L1 is an LRU with a TTL in each worker process, L2 is a mongo collection
+shared by every worker. An entry is dropped from both levels when Alma
+says the holding it points to does not exist.
+"""
+
+# on/off
+ALMA_ID_CACHE = os.getenv('ALMA_ID_CACHE', 'off')
+ALMA_ID_CACHE_SIZE = int(os.getenv('ALMA_ID_CACHE_SIZE', 1000))
+ALMA_ID_CACHE_TTL_SECS = float(os.getenv('ALMA_ID_CACHE_TTL_SECS', 86400))
+# mongo/off
+ALMA_ID_CACHE_L2 = os.getenv('ALMA_ID_CACHE_L2', 'mongo')
+ALMA_ID_CACHE_COLLECTION = os.getenv('ALMA_ID_CACHE_COLLECTION',
+                                     'alma_id_cache')
+
+MMS_ID = "mms_id"
+HOLDING_ID = "holding_id"
+
+
+class LRUCache():
+    """
+    Least recently used cache whose entries expire after ttl seconds.
+    """
+
+    def __init__(self, max_size=ALMA_ID_CACHE_SIZE,
+                 ttl=ALMA_ID_CACHE_TTL_SECS, clock=time.monotonic):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires <= self.clock():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (value, self.clock() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class MongoCacheStore():
+    """
+    Cache entries in a mongo collection, one document per key with an
+    expires_at date. ensure_indexes() adds a TTL index so mongo removes
+    expired documents, get() ignores them until it does.
+    """
+
+    def __init__(self, collection=None, ttl=ALMA_ID_CACHE_TTL_SECS):
+        self.collection = collection
+        self.ttl = ttl
+
+    def __collection(self):
+        if self.collection is None:  # pragma: no cover, needs mongo
+            import etd.mongo_util as mongo_util
+            db = mongo_util.get_client()[os.getenv("MONGO_DB")]
+            self.collection = db[ALMA_ID_CACHE_COLLECTION]
+        return self.collection
+
+    def get(self, key):
+        doc = self.__collection().find_one(
+            {'_id': key, 'expires_at': {'$gt': datetime.utcnow()}})
+        if doc is None:
+            return None
+        return doc['value']
+
+    def set(self, key, value):
+        expires_at = datetime.utcnow() + timedelta(seconds=self.ttl)
+        self.__collection().update_one(
+            {'_id': key},
+            {'$set': {'value': value, 'expires_at': expires_at}},
+            upsert=True)
+
+    def delete(self, key):
+        self.__collection().delete_one({'_id': key})
+
+    def ensure_indexes(self):
+        self.__collection().create_index('expires_at', expireAfterSeconds=0,
+                                         name='expires_at_ttl')
+
+
+class AlmaIdCache():
+
+    logger = logging.getLogger('etd_alma_drs_holding')
+
+    def __init__(self, l1=None, l2=None):
+        """
+        Args:
+            l1 (LRUCache): The in-process cache.
+            l2 (MongoCacheStore): The shared store, None for L1 only.
+        """
+        self.l1 = l1 if l1 is not None else LRUCache()
+        self.l2 = l2
+        self.lock = threading.Lock()
+        self.l1_hits = 0
+        self.l2_hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, kind, key):
+        """
+        Returns the cached value for key, or None.
+
+        Args:
+            kind (str): MMS_ID for a proquest id, HOLDING_ID for an mms id.
+        """
+        cache_key = f'{kind}:{key}'
+        value = self.l1.get(cache_key)
+        if value is not None:
+            self.__count('l1_hits')
+            return value
+        if self.l2 is not None:
+            try:
+                value = self.l2.get(cache_key)
+            except Exception as e:
+                self.logger.warning(f"Error reading {cache_key} from the "
+                                    f"alma id cache: {e}")
+            if value is not None:
+                self.l1.set(cache_key, value)
+                self.__count('l2_hits')
+                return value
+        self.__count('misses')
+        return None
+
+    def set(self, kind, key, value):
+        cache_key = f'{kind}:{key}'
+        self.l1.set(cache_key, value)
+        if self.l2 is not None:
+            try:
+                self.l2.set(cache_key, value)
+            except Exception as e:
+                self.logger.warning(f"Error writing {cache_key} to the "
+                                    f"alma id cache: {e}")
+
+    def invalidate(self, kind, key):
+        cache_key = f'{kind}:{key}'
+        self.logger.info(f"Invalidating {cache_key} in the alma id cache")
+        self.__count('invalidations')
+        self.l1.delete(cache_key)
+        if self.l2 is not None:
+            try:
+                self.l2.delete(cache_key)
+            except Exception as e:
+                self.logger.warning(f"Error deleting {cache_key} from the "
+                                    f"alma id cache: {e}")
+
+    def stats(self):
+        with self.lock:
+            lookups = self.l1_hits + self.l2_hits + self.misses
+            return {'l1_hits': self.l1_hits,
+                    'l2_hits': self.l2_hits,
+                    'misses': self.misses,
+                    'invalidations': self.invalidations,
+                    'hit_ratio': ((self.l1_hits + self.l2_hits) / lookups
+                                  if lookups else 0.0)}
+
+    def __count(self, counter):
+        with self.lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+
+def holding_not_found(response):
+    """
+    Returns True if an Alma holding GET or PUT failed because the bib or
+    holding does not exist, which means a cached id is stale.
+    """
+    if response.status_code not in (400, 404):
+        return False
+    text = response.text.lower()
+    return 'not found' in text or 'not valid' in text
+
+
+_cache = None
+_cache_pid = None
+_cache_lock = threading.Lock()
+
+
+def get_alma_id_cache():
+    """
+    Returns this process's AlmaIdCache, or None if the cache is off.
+    """
+    global _cache, _cache_pid
+    if ALMA_ID_CACHE != "on":
+        return None
+    with _cache_lock:
+        if _cache is None or _cache_pid != os.getpid():
+            l2 = MongoCacheStore() if ALMA_ID_CACHE_L2 == "mongo" else None
+            _cache = AlmaIdCache(l2=l2)
+            _cache_pid = os.getpid()
+        return _cache
@@ -0,0 +1,136 @@
+import os
+import logging
+import threading
+import requests
+from urllib.parse import quote
+from requests.adapters import HTTPAdapter
+from etd.rate_limiter import get_rate_limiter
+
+"""
+Shared client for the Alma APIs. Every call in a worker process goes
+through one pooled keep-alive requests.Session, so the TLS connection to
+the Alma gateway is reused across calls and records. The API key is sent
+in the Authorization header so it never appears in URLs or logs. Every
+call takes a token from the shared Alma rate limiter first.
+"""
+
+ALMA_API_KEY = os.getenv('ALMA_API_KEY')
+ALMA_API_BASE = os.getenv('ALMA_API_BASE')
+ALMA_SRU_MARCXML_BASE = os.getenv('ALMA_SRU_MARCXML_BASE')
+ALMA_GET_BIB_BASE = "/almaws/v1/bibs/"
+ALMA_GET_HOLDINGS_PATH = "/holdings"
+ALMA_HTTP_POOL_SIZE = int(os.getenv('ALMA_HTTP_POOL_SIZE', 10))
+ALMA_HTTP_TIMEOUT = float(os.getenv('ALMA_HTTP_TIMEOUT', 60))
+
+
+class AlmaClient():
+
+    logger = logging.getLogger('etd_alma_drs_holding')
+
+    def __init__(self, api_base=ALMA_API_BASE, api_key=ALMA_API_KEY,
+                 sru_base=ALMA_SRU_MARCXML_BASE,
+                 pool_size=ALMA_HTTP_POOL_SIZE, timeout=ALMA_HTTP_TIMEOUT,
+                 limiter=None):
+        """
+        Args:
+            api_base (str): Base url of the Alma API gateway.
+            api_key (str): The Alma API key.
+            sru_base (str): Alma SRU marcxml search url, the proquest id
+                is appended to it.
+            pool_size (int): Connections kept alive per host.
+            timeout (float): Connect and read timeout in seconds.
+            limiter (RateLimiter): Defaults to the process's limiter.
+        """
+        self.api_base = api_base
+        self.api_key = api_key
+        self.sru_base = sru_base
+        self.timeout = timeout
+        self.limiter = limiter or get_rate_limiter()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def sru_url(self, pqid):
+        return self.sru_base + pqid
+
+    def sru_search_url(self, pqids, start_record=1, maximum_records=50):
+        """
+        Returns an SRU url that ORs the search the sru base does for one
+        proquest id over all of pqids.
+        """
+        prefix, sep, index = self.sru_base.rpartition('query=')
+        if not sep:
+            raise ValueError("The SRU base url has no query parameter")
+        cql = " or ".join(f"{index}{pqid}" for pqid in pqids)
+        return f"{prefix}query={quote(cql)}" \
+               f"&startRecord={start_record}" \
+               f"&maximumRecords={maximum_records}"
+
+    def holdings_url(self, mms_id):
+        return self.api_base + ALMA_GET_BIB_BASE + mms_id + \
+            ALMA_GET_HOLDINGS_PATH
+
+    def holding_url(self, mms_id, holding_id):
+        return self.holdings_url(mms_id) + "/" + holding_id
+
+    def api_headers(self, headers=None):
+        api_headers = {'Authorization': f'apikey {self.api_key}'}
+        if headers:
+            api_headers.update(headers)
+        return api_headers
+
+    def sru_get(self, pqid):
+        """
+        Runs the SRU search for a proquest id. SRU does not take the key.
+        """
+        url = self.sru_url(pqid)
+        return self.__send('GET', url)
+
+    def sru_search(self, pqids, start_record=1, maximum_records=50):
+        """
+        Runs one SRU search for several proquest ids.
+        """
+        return self.__send('GET', self.sru_search_url(pqids, start_record,
+                                                      maximum_records))
+
+    def get(self, url, headers=None):
+        return self.__send('GET', url, headers=self.api_headers(headers))
+
+    def put(self, url, data, headers=None):
+        return self.__send('PUT', url, data=data,
+                           headers=self.api_headers(headers))
+
+    def __send(self, method, url, **kwargs):
+        self.limiter.acquire()
+        self.logger.debug("%s %s", method, url)
+        r = self.session.request(method, url, timeout=self.timeout,
+                                 **kwargs)
+        if r.status_code == 429:
+            retry_after = r.headers.get('Retry-After', '')
+            if retry_after.isdigit():
+                self.limiter.throttle(int(retry_after))
+            else:
+                self.limiter.throttle()
+        return r
+
+    def close(self):
+        self.session.close()
+
+
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+
+def get_alma_client():
+    """
+    Returns this process's AlmaClient, creating it on first use.
+    """
+    global _client, _client_pid
+    with _client_lock:
+        if _client is None or _client_pid != os.getpid():
+            _client = AlmaClient()
+            _client_pid = os.getpid()
+        return _client
@@ -0,0 +1,58 @@
+import os
+import tempfile
+
+"""
+Serializes MARCXML records into the collection files sent to the Alma
+dropbox. A collection is written to a spooled buffer that stays in
+memory up to COLLECTION_SPOOL_MAX_BYTES and moves to an anonymous
+temporary file past that, so it is uploaded with putfo and nothing is
+left in the working directory when an upload fails.
+"""
+
+# collections larger than this are spooled to a temporary file
+COLLECTION_SPOOL_MAX_BYTES = int(os.getenv('COLLECTION_SPOOL_MAX_BYTES',
+                                           8 * 1024 * 1024))
+
+XML_DECLARATION = '<?xml version="1.0" encoding="UTF-8"?>\n'
+# To wrap the xml records in a collection
+COLLECTION_START = """
+<collection xmlns="http://www.loc.gov/MARC21/slim"
+    xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"
+    xsi:schemaLocation="http://www.loc.gov/MARC21/slim http://www.loc.gov/standards/marcxml/schema/MARC21slim.xsd">
+"""  # noqa: E501
+COLLECTION_END = "</collection>"
+
+
+def write_collection(out, records):
+    """
+    Writes records to a binary file as one UTF-8 collection document.
+
+    Args:
+        out (file): The binary file to write to.
+        records (iterable): The MARCXML record strings.
+
+    Returns:
+        int: The number of records written.
+    """
+    out.write(f'{XML_DECLARATION}{COLLECTION_START}\n'.encode('utf-8'))
+    count = 0
+    for record in records:
+        out.write(record.encode('utf-8'))
+        count += 1
+    out.write(f'{COLLECTION_END}\n'.encode('utf-8'))
+    return count
+
+
+def spool_collection(records, max_bytes=COLLECTION_SPOOL_MAX_BYTES):
+    """
+    Returns the collection of records in a spooled temporary file,
+    rewound for upload. Closing it frees the buffer or removes the file.
+    """
+    out = tempfile.SpooledTemporaryFile(max_size=max_bytes, mode='w+b')
+    try:
+        write_collection(out, records)
+        out.seek(0)
+    except BaseException:
+        out.close()
+        raise
+    return out
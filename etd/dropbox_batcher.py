@@ -0,0 +1,316 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+
+"""
+Gathers DASH holding records written by many add_holdings tasks into
+shared Alma dropbox collections, one per collection key (school/instance).
+A collection is handed to a flush function when it reaches the size limit,
+when its time window ends, or when the worker shuts down. Records of a
+failed flush are put back for the next one, up to
+DROPBOX_BATCH_MAX_ATTEMPTS flushes. Records already uploaded, records
+out of attempts and the ones a shutdown flush gives up on are handed to
+on_drop.
+
+A record is added once, a copy that arrives while it is pending or being
+flushed, like a redelivered message, is ignored. With a PendingJournal,
+each record is also written to disk before add returns and removed once
+it is delivered or kept by on_drop, so the records of a worker that died
+can be replayed.
+"""
+
+DROPBOX_BATCH_MODE = os.getenv('DROPBOX_BATCH_MODE', 'off')
+DROPBOX_BATCH_SIZE = int(os.getenv('DROPBOX_BATCH_SIZE', 100))
+DROPBOX_BATCH_WINDOW_SECS = float(os.getenv('DROPBOX_BATCH_WINDOW_SECS', 60))
+# flushes a record is part of before it is given up on
+DROPBOX_BATCH_MAX_ATTEMPTS = int(os.getenv('DROPBOX_BATCH_MAX_ATTEMPTS', 3))
+
+
+class PendingJournal():
+    """
+    One json file per pending record in a directory, holding its batch key
+    and record. A file is written under a temporary name and renamed, so
+    it always holds a whole record.
+    """
+
+    logger = logging.getLogger('etd_alma_drs_holding')
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def add(self, entry_id, key, record):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.__path(entry_id)
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'key': key, 'record': record}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    def touch(self, entry_id):
+        """
+        Marks a record as still held by a live worker.
+        """
+        try:
+            os.utime(self.__path(entry_id))
+        except FileNotFoundError:
+            pass
+
+    def remove(self, entry_id):
+        try:
+            os.remove(self.__path(entry_id))
+        except FileNotFoundError:
+            pass
+
+    def claim(self, stale_secs):
+        """
+        Takes the records that have not been touched for stale_secs, so
+        the worker that added them is gone. A claimed file is renamed, so
+        only one caller gets it, and must be released with done() once
+        its record is handled. A claim that is not released becomes stale
+        in turn.
+
+        Returns:
+            list: (claim, key, record) of each record.
+        """
+        if not os.path.isdir(self.directory):
+            return []
+        claimed = []
+        now = time.time()
+        for name in sorted(os.listdir(self.directory)):
+            base, _, suffix = name.partition('.')
+            if suffix != 'json' and not suffix.startswith('claimed'):
+                continue
+            path = os.path.join(self.directory, name)
+            claim = os.path.join(self.directory,
+                                 f'{base}.claimed-{os.getpid()}')
+            try:
+                if now - os.path.getmtime(path) < stale_secs:
+                    continue
+                os.rename(path, claim)
+                os.utime(claim)
+                with open(claim) as f:
+                    doc = json.load(f)
+            except FileNotFoundError:
+                # claimed by someone else
+                continue
+            except ValueError:
+                self.logger.error(f"Unreadable pending record {claim}")
+                continue
+            claimed.append((claim, doc['key'], doc['record']))
+        return claimed
+
+    def done(self, claim):
+        os.remove(claim)
+
+    def __path(self, entry_id):
+        digest = hashlib.sha1(json.dumps(entry_id).encode()).hexdigest()
+        return os.path.join(self.directory, f'{digest}.json')
+
+
+class DropboxBatcher():
+
+    # names the batches in log messages
+    label = "dropbox collection"
+    logger = logging.getLogger('etd_alma_drs_holding')
+
+    def __init__(self, flush_fn, max_records=DROPBOX_BATCH_SIZE,
+                 window_secs=DROPBOX_BATCH_WINDOW_SECS, on_drop=None,
+                 max_attempts=DROPBOX_BATCH_MAX_ATTEMPTS, journal=None,
+                 to_record=None):
+        """
+        Args:
+            flush_fn (callable): Called as flush_fn(key, entries), returns
+                True if the collection was delivered.
+            max_records (int): Flush a collection once it holds this many
+                records.
+            window_secs (float): Flush a collection this many seconds after
+                its first record arrived. 0 disables the time window.
+            on_drop (callable): Called as on_drop(key, entries) with the
+                records a flush gives up on, so they can be kept.
+            max_attempts (int): Failed flushes a record is part of before
+                it is handed to on_drop.
+            journal (PendingJournal): Where pending records are kept on
+                disk, None to keep them in memory only.
+            to_record (callable): Turns an entry into the json record
+                written to the journal, defaults to the entry itself.
+        """
+        self.flush_fn = flush_fn
+        self.on_drop = on_drop
+        self.max_records = max_records
+        self.window_secs = window_secs
+        self.max_attempts = max_attempts
+        self.journal = journal
+        self.to_record = to_record or (lambda entry: entry)
+        self.pending = {}
+        # failed flushes of each pending or flushing record, by entry_id
+        self.attempts = {}
+        self.timers = {}
+        self.lock = threading.RLock()
+
+    def entry_id(self, entry):
+        """
+        Identifies a record, DASH records by (pqid, batch).
+        """
+        if isinstance(entry, dict) and 'pqid' in entry:
+            return [entry['pqid'], entry.get('batch')]
+        return id(entry)
+
+    def add(self, key, entry):
+        """
+        Adds a record to the collection for key, flushing it if it is full.
+        With a journal, the record is on disk when add returns.
+
+        Returns:
+            bool: False if the record was already pending or being
+                flushed, and was not added again.
+        """
+        entry_id = self.entry_id(entry)
+        with self.lock:
+            if self.__id_key(entry_id) in self.attempts:
+                self.logger.info(f"{entry_id} is already in {self.label} "
+                                 f"{key}, not adding it again")
+                return False
+            self.attempts[self.__id_key(entry_id)] = 0
+        if self.journal is not None:
+            try:
+                self.journal.add(entry_id, key, self.to_record(entry))
+            except Exception:
+                with self.lock:
+                    self.attempts.pop(self.__id_key(entry_id), None)
+                raise
+        with self.lock:
+            entries = self.pending.setdefault(key, [])
+            entries.append(entry)
+            full = len(entries) >= self.max_records
+            if not full:
+                self.__start_timer(key)
+        if full:
+            self.flush(key)
+        return True
+
+    def pending_count(self, key=None):
+        with self.lock:
+            if key is not None:
+                return len(self.pending.get(key, []))
+            return sum(len(entries) for entries in self.pending.values())
+
+    def flush(self, key, requeue=True):
+        """
+        Hands the collection for key to the flush function.
+
+        Args:
+            key: The collection key.
+            requeue (bool): Put the records back in the collection if the
+                flush fails, so the next flush retries them. Records
+                marked uploaded are never put back, they would be sent
+                to Alma twice, nor are records out of attempts.
+
+        Returns:
+            bool: True if the collection was delivered or was empty.
+        """
+        with self.lock:
+            timer = self.timers.pop(key, None)
+            entries = self.pending.pop(key, [])
+        if timer is not None:
+            timer.cancel()
+        if not entries:
+            return True
+
+        try:
+            sent = self.flush_fn(key, entries)
+        except Exception:
+            self.logger.error(f"Error flushing {self.label} {key}",
+                              exc_info=True)
+            sent = False
+
+        if sent:
+            self.__forget(entries, True)
+            return sent
+
+        uploaded = [entry for entry in entries if self.uploaded(entry)]
+        retry, spent = [], []
+        for entry in entries:
+            if self.uploaded(entry):
+                continue
+            id_key = self.__id_key(self.entry_id(entry))
+            with self.lock:
+                attempts = self.attempts.get(id_key, 0) + 1
+                self.attempts[id_key] = attempts
+            if requeue and attempts < self.max_attempts:
+                retry.append(entry)
+            else:
+                spent.append(entry)
+        if uploaded:
+            self.__drop(key, uploaded, "were uploaded but their status was "
+                                       "not updated")
+        if spent:
+            self.__drop(key, spent, "were not sent, their status was not "
+                                    "updated")
+        if retry:
+            if self.journal is not None:
+                for entry in retry:
+                    self.journal.touch(self.entry_id(entry))
+            with self.lock:
+                self.pending[key] = retry + self.pending.get(key, [])
+                self.__start_timer(key)
+        return sent
+
+    def flush_all(self, requeue=False):
+        """
+        Flushes every pending collection. Used on worker shutdown.
+        """
+        with self.lock:
+            keys = list(self.pending.keys())
+        sent = True
+        for key in keys:
+            sent = self.flush(key, requeue) and sent
+        return sent
+
+    @staticmethod
+    def uploaded(entry):
+        """
+        True if the record reached the dropbox, set by the flush function.
+        """
+        return isinstance(entry, dict) and bool(entry.get('uploaded'))
+
+    @staticmethod
+    def __id_key(entry_id):
+        return json.dumps(entry_id)
+
+    def __forget(self, entries, handled):
+        """
+        Stops tracking records. Their journal files are removed if they
+        were delivered or kept, otherwise they are left to be replayed.
+        """
+        for entry in entries:
+            entry_id = self.entry_id(entry)
+            with self.lock:
+                self.attempts.pop(self.__id_key(entry_id), None)
+            if handled and self.journal is not None:
+                self.journal.remove(entry_id)
+
+    def __drop(self, key, entries, reason):
+        self.logger.error(f"{len(entries)} records for {self.label} {key} "
+                          f"{reason}")
+        kept = False
+        if self.on_drop is not None:
+            try:
+                self.on_drop(key, entries)
+                kept = True
+            except Exception:
+                self.logger.error(f"Unable to keep the records dropped from "
+                                  f"{self.label} {key}", exc_info=True)
+        self.__forget(entries, kept)
+
+    def __start_timer(self, key):
+        if self.window_secs <= 0 or key in self.timers:
+            return
+        timer = threading.Timer(self.window_secs, self.flush, args=(key,))
+        timer.daemon = True
+        self.timers[key] = timer
+        timer.start()
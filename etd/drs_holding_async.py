@@ -0,0 +1,309 @@
+import os
+import asyncio
+import functools
+import logging
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from opentelemetry.trace import Status
+from opentelemetry.trace import StatusCode
+from etd.alma_client import AlmaClient
+from etd.alma_cache import get_alma_id_cache, holding_not_found
+import etd.alma_cache as alma_cache
+from etd.holding_confirm import get_confirm_strategy
+import etd.telemetry as telemetry
+import etd.holding_xml as holding_xml
+import etd.mongo_util as mongo_util
+
+"""
+Asyncio variant of the non-DASH DRSHoldingByAPI pipeline. Many proquest
+ids are driven concurrently in one process, up to a concurrency cap, with
+the same SRU lookup, holding selection, 852$z transform, Alma id cache
+and ALMA_CONFIRM_MODE confirm steps as the sync pipeline. Blocking mongo
+and cache calls run on an executor, off the event loop.
+"""
+
+ALMA_ASYNC_CONCURRENCY = int(os.getenv('ALMA_ASYNC_CONCURRENCY', 8))
+
+tracer = telemetry.get_tracer(__name__)
+
+
+class AsyncAlmaClient():
+    """
+    Awaitable wrapper around AlmaClient. The blocking calls on the pooled
+    session run on a bounded executor, so at most `concurrency` requests
+    are in flight and connections are reused between them.
+    """
+
+    def __init__(self, client=None, concurrency=ALMA_ASYNC_CONCURRENCY):
+        self.client = client or AlmaClient(pool_size=concurrency)
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+
+    async def __call(self, fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor, functools.partial(fn, *args, **kwargs))
+
+    async def sru_get(self, pqid):
+        return await self.__call(self.client.sru_get, pqid)
+
+    async def get(self, url, headers=None):
+        return await self.__call(self.client.get, url, headers)
+
+    async def put(self, url, data, headers=None):
+        return await self.__call(self.client.put, url, data, headers)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+
+class RecordError(Exception):
+    """
+    A step of the pipeline failed for a record, the message says which.
+    """
+
+
+class AsyncDRSHoldingPipeline():
+
+    logger = logging.getLogger('etd_alma_drs_holding')
+
+    def __init__(self, alma=None, concurrency=ALMA_ASYNC_CONCURRENCY,
+                 mongoutil=None, resolver=None, confirm_strategy=None,
+                 id_cache=None):
+        """
+        Args:
+            alma (AsyncAlmaClient): The Alma client to use.
+            concurrency (int): Records processed at the same time.
+            mongoutil (MongoUtil): If set, records that carry a
+                directory_id get the DRS_HOLDING_API status once confirmed.
+            resolver (SRUBatchResolver): If set, the mms ids of all the
+                records are looked up in bulk before they are processed.
+            confirm_strategy (ConfirmStrategy): Confirms each update,
+                defaults to the ALMA_CONFIRM_MODE one.
+            id_cache (AlmaIdCache): Cached mms and holding ids, defaults
+                to this process's cache, None if ALMA_ID_CACHE is off.
+        """
+        self.alma = alma or AsyncAlmaClient(concurrency=concurrency)
+        self.concurrency = concurrency
+        self.mongoutil = mongoutil
+        self.resolver = resolver
+        self.confirm_strategy = confirm_strategy or get_confirm_strategy()
+        self.id_cache = id_cache if id_cache is not None \
+            else get_alma_id_cache()
+        # records per outcome: updated, noop, failed
+        self.outcomes = Counter()
+
+    async def process_record(self, pqid, object_urn, mms_id=None):
+        """
+        Updates the DRS holding for one proquest id. The SRU search is
+        skipped if the mms id is given or cached.
+
+        Returns:
+            bool: True if the holding was updated and confirmed.
+        """
+        with tracer.start_as_current_span("async_process_record_for_alma") \
+                as current_span:
+            current_span.set_attribute("identifier", pqid)
+            try:
+                mms_id, holding_id, cached = await self.__get_ids(pqid,
+                                                                  mms_id)
+                holding_url = self.alma.client.holding_url(mms_id,
+                                                           holding_id)
+                r = await self.alma.get(holding_url)
+                if holding_not_found(r) and cached:
+                    # The cached ids were stale, look them up in Alma again
+                    await self.__invalidate_ids(pqid, mms_id)
+                    mms_id, holding_id, _ = await self.__get_ids(pqid)
+                    holding_url = self.alma.client.holding_url(mms_id,
+                                                               holding_id)
+                    r = await self.alma.get(holding_url)
+                if r.status_code != 200:
+                    if holding_not_found(r):
+                        await self.__invalidate_ids(pqid, mms_id)
+                    raise RecordError(f"HTTP error {r.status_code} "
+                                      f"getting DRS holding")
+                if holding_xml.holding_is_current(r.content, object_urn):
+                    current_span.set_attribute("outcome", "noop")
+                    self.outcomes["noop"] += 1
+                    self.logger.debug('%s DRS holding already has the urn',
+                                      pqid)
+                    return True
+                holding = holding_xml.set_holding_urn(r.content, object_urn)
+
+                r = await self.alma.put(
+                    holding_url, holding_xml.holding_to_bytes(holding),
+                    {'Content-Type': 'application/xml'})
+                if r.status_code != 200:
+                    if holding_not_found(r):
+                        await self.__invalidate_ids(pqid, mms_id)
+                    raise RecordError(f"Error {r.status_code} submitting "
+                                      f"new DRS holding")
+
+                confirmed, latency = await self.__confirm(
+                    pqid, mms_id, holding_id, object_urn, r.content)
+                current_span.set_attribute("confirm_mode",
+                                           self.confirm_strategy.mode)
+                current_span.set_attribute("confirm_latency_secs", latency)
+                if not confirmed:
+                    raise RecordError("Error confirming DRS holding update")
+            except RecordError as e:
+                return self.__fail(current_span, pqid, str(e))
+            except Exception as e:
+                current_span.record_exception(e)
+                return self.__fail(current_span, pqid,
+                                   f"Error processing record for alma: {e}")
+            current_span.set_attribute("outcome", "updated")
+            self.outcomes["updated"] += 1
+            current_span.add_event(f'{pqid} DRS holding was updated')
+            self.logger.debug('%s DRS holding was updated', pqid)
+            return True
+
+    async def process_records(self, records):
+        """
+        Processes records concurrently, at most self.concurrency at a time.
+
+        Args:
+            records (list): Dicts with pqid, object_urn and, optionally,
+                directory_id.
+
+        Returns:
+            dict: proquest id to True/False outcome.
+        """
+        semaphore = asyncio.Semaphore(self.concurrency)
+        mms_ids = {}
+        if self.resolver is not None:
+            # Records the bulk search missed still get their own search
+            loop = asyncio.get_running_loop()
+            mms_ids, _ = await loop.run_in_executor(
+                self.alma.executor, self.resolver.resolve,
+                [record['pqid'] for record in records])
+
+        async def bounded(record):
+            async with semaphore:
+                sent = await self.process_record(
+                    record['pqid'], record['object_urn'],
+                    mms_ids.get(record['pqid']))
+            if sent:
+                await self.__update_status(record)
+            return sent
+
+        outcomes = await asyncio.gather(*[bounded(record)
+                                          for record in records])
+        return {record['pqid']: sent
+                for record, sent in zip(records, outcomes)}
+
+    def run(self, records):
+        """
+        Sync entry point, runs process_records on a new event loop.
+        """
+        return asyncio.run(self.process_records(records))
+
+    async def __get_ids(self, pqid, mms_id=None):
+        """
+        Looks up the mms and holding ids in the cache, then in Alma.
+
+        Returns:
+            tuple: (mms id, holding id, True if an id came from the cache)
+        """
+        cached = False
+        if mms_id is None and self.id_cache is not None:
+            mms_id = await self.__blocking(self.id_cache.get,
+                                           alma_cache.MMS_ID, pqid)
+            cached = mms_id is not None
+        if mms_id is None:
+            r = await self.alma.sru_get(pqid)
+            if r.status_code != 200:
+                raise RecordError(f"HTTP error {r.status_code} "
+                                  f"getting mms id")
+            mms_id = holding_xml.parse_mms_id(r.content)
+            if not mms_id:
+                raise RecordError("Error getting mms id")
+            await self.__cache_set(alma_cache.MMS_ID, pqid, mms_id)
+
+        holding_id = None
+        if self.id_cache is not None:
+            holding_id = await self.__blocking(self.id_cache.get,
+                                               alma_cache.HOLDING_ID, mms_id)
+            cached = cached or holding_id is not None
+        if holding_id is None:
+            r = await self.alma.get(self.alma.client.holdings_url(mms_id))
+            if r.status_code != 200:
+                raise RecordError(f"HTTP error {r.status_code} "
+                                  f"getting DRS holdings list")
+            holding_id = holding_xml.parse_drs_holding_id(r.content)
+            if not holding_id:
+                raise RecordError("DRS holding id not found")
+            await self.__cache_set(alma_cache.HOLDING_ID, mms_id,
+                                   holding_id)
+        return mms_id, holding_id, cached
+
+    async def __cache_set(self, kind, key, value):
+        if self.id_cache is not None:
+            await self.__blocking(self.id_cache.set, kind, key, value)
+
+    async def __invalidate_ids(self, pqid, mms_id):
+        """
+        Drops the cached ids that led to a holding Alma does not have.
+        """
+        if self.id_cache is None:
+            return
+        await self.__blocking(self.id_cache.invalidate, alma_cache.MMS_ID,
+                              pqid)
+        await self.__blocking(self.id_cache.invalidate,
+                              alma_cache.HOLDING_ID, mms_id)
+
+    async def __confirm(self, pqid, mms_id, holding_id, object_urn,
+                        put_response):
+        """
+        Confirms the update with the configured strategy, see
+        etd.holding_confirm. A read-back runs on the Alma executor with
+        the other requests.
+        """
+        holding_url = self.alma.client.holding_url(mms_id, holding_id)
+
+        def read_back():
+            r = self.alma.client.get(holding_url)
+            if r.status_code != 200:
+                self.logger.error(f"HTTP error {r.status_code} getting "
+                                  f"updated DRS holding for pqid: {pqid}")
+                return False
+            return holding_xml.holding_urn_statement(r.content) == \
+                holding_xml.expected_urn_statement(object_urn)
+
+        record = {'pqid': pqid, 'mms_id': mms_id,
+                  'holding_id': holding_id, 'object_urn': object_urn}
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.alma.executor, self.confirm_strategy.confirm, object_urn,
+            put_response, read_back, record)
+
+    async def __update_status(self, record):
+        if (self.mongoutil is None or
+                record.get(mongo_util.FIELD_DIRECTORY_ID) is None):
+            return
+        query = {mongo_util.FIELD_PQ_ID: record['pqid'],
+                 mongo_util.FIELD_DIRECTORY_ID:
+                     record[mongo_util.FIELD_DIRECTORY_ID]}
+        try:
+            # the record's last write, not left in the buffer
+            await self.__blocking(self.mongoutil.update_status, query,
+                                  mongo_util.DRS_HOLDING_API_STATUS,
+                                  durable=True)
+        except Exception as e:
+            self.logger.error(f"Error updating the status of pqid: "
+                              f"{record['pqid']}: {e}")
+
+    async def __blocking(self, fn, *args, **kwargs):
+        """
+        Runs a blocking mongo or cache call on the default executor, so
+        it does not hold up the event loop or take an Alma slot.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            None, functools.partial(fn, *args, **kwargs))
+
+    def __fail(self, current_span, pqid, message):
+        self.outcomes["failed"] += 1
+        self.logger.error(f"{message} for pqid: {pqid}")
+        current_span.set_status(Status(StatusCode.ERROR))
+        current_span.add_event(f"{message} for pqid: {pqid}")
+        return False
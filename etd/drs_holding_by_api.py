@@ -3,24 +3,26 @@ import os
 from opentelemetry import trace
 from opentelemetry.trace import Status
 from opentelemetry.trace import StatusCode
-from opentelemetry.sdk.resources import Resource
-from opentelemetry.sdk.trace import TracerProvider
-from opentelemetry.sdk.trace.export import BatchSpanProcessor
-from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import (
-    OTLPSpanExporter)
-from opentelemetry.sdk.resources import SERVICE_NAME
+import etd.telemetry as telemetry
 from etd.mongo_util import MongoUtil
+from etd.record_context import load_record_context
 import etd.mongo_util as mongo_util
 
 import sys
 from lxml import etree
 import logging
 from . import configure_logger
-import requests
+from etd.alma_client import get_alma_client
+from etd.alma_cache import get_alma_id_cache, holding_not_found
+import etd.alma_cache as alma_cache
+from etd.holding_confirm import get_confirm_strategy
+from etd.task_retry import is_transient_error, is_transient_status
+from etd.holding_xml import SUBFIELD_Z_BASE
+import etd.holding_xml as holding_xml
 from datetime import datetime
-import time
+from collections import Counter
 from lib.notify import notify
-import lxml.etree as ET
+from etd.job_monitor import get_notifier
 import shutil
 import traceback
 
@@ -34,38 +36,26 @@ sys.path.append(confDir)
 sys.path.append(libDir)
 
 
-# tracing setup
-JAEGER_NAME = os.getenv('JAEGER_NAME')
-JAEGER_SERVICE_NAME = os.getenv('JAEGER_SERVICE_NAME')
 notify.logDir = os.getenv("LOGFILE_PATH", "/home/etdadm/logs/etd")
 
-resource = Resource(attributes={SERVICE_NAME: JAEGER_SERVICE_NAME})
-provider = TracerProvider(resource=resource)
-otlp_exporter = OTLPSpanExporter(endpoint=JAEGER_NAME, insecure=True)
-span_processor = BatchSpanProcessor(otlp_exporter)
-provider.add_span_processor(span_processor)
-trace.set_tracer_provider(provider)
-tracer = trace.get_tracer(__name__)
-
-# Alma API keys
-ALMA_API_KEY = os.getenv('ALMA_API_KEY')
-ALMA_API_BASE = os.getenv('ALMA_API_BASE')
-ALMA_SRU_BASE = os.getenv('ALMA_SRU_BASE')
-ALMA_SRU_MARCXML_BASE = os.getenv('ALMA_SRU_MARCXML_BASE')
-ALMA_GET_BIB_BASE = "/almaws/v1/bibs/"
-ALMA_GET_HOLDINGS_PATH = "/holdings"
-SUBFIELD_Z_BASE = "Preservation master, "
+# tracing setup, the provider is created on the first span
+tracer = telemetry.get_tracer(__name__)
+
 FEATURE_FLAGS = "feature_flags"
 ALMA_FEATURE_FORCE_UPDATE_FLAG = "alma_feature_force_update_flag"
 ALMA_FEATURE_VERBOSE_FLAG = "alma_feature_verbose_flag"
 INTEGRATION_TEST = os.getenv('MONGO_DB_COLLECTION_ITEST', 'integration_test')
 data_dir = os.getenv('DATA_DIR', './')
 
-notifyJM = False
 jobCode = 'drsholding2alma'
 instance = os.getenv('INSTANCE', '')
-DELAY_SECS = int(os.getenv('DELAY_SECS', 60))
-MAX_RETRIES = int(os.getenv('MAX_RETRIES', 3))
+# Records per outcome (updated, noop, failed) in this process
+outcome_counts = Counter()
+# on: responses are parsed from memory and passed between the steps,
+# the xml artifacts are only written if the record fails
+ALMA_HOLDING_IN_MEMORY = os.getenv('ALMA_HOLDING_IN_MEMORY', 'off')
+# on: always write the xml artifacts, even in memory mode
+ALMA_HOLDING_DEBUG_ARTIFACTS = os.getenv('ALMA_HOLDING_DEBUG_ARTIFACTS', 'off')
 
 """
 This the worker class for the etd alma service.
@@ -76,31 +66,55 @@ class DRSHoldingByAPI():
     logger = logging.getLogger('etd_alma_drs_holding')
 
     
-    @tracer.start_as_current_span("init_drs_holding_by_api")
     def __init__(self, pqid, object_urn, unittesting=False,
                  integration_test=False,
                  alt_output_dir=None,
-                 test_collection=None):
+                 test_collection=None,
+                 record_context=None,
+                 in_memory=None,
+                 mms_id=None):
         """
          This method initializes the class and creates a working directory 
-         for xml files.
+         for xml files. A record_context loaded by the task saves the
+         mongo lookups for this record, and an mms_id resolved for its
+         batch saves the SRU search. In memory mode the working
+         directory is only created if artifacts have to be written.
         """
         configure_logger()
         self.pqid = pqid
         self.mmsid = None
+        # Resolved for the batch, used by the first get_mms_id
+        self.resolved_mmsid = mms_id
         self.holding_id = None
         self.object_urn = object_urn
         self.unittesting = unittesting
         self.integration_test = integration_test
-        self.namespace_mapping = {'srw':
-                                  'http://www.loc.gov/zing/srw/',
-                                  'marc': 'http://www.loc.gov/MARC21/slim',
-                                  'mods': 'http://www.loc.gov/mods/v3'}
+        self.record_context = record_context
+        self.alma_client = get_alma_client()
+        self.id_cache = get_alma_id_cache()
+        self.cached_ids = False
+        self.stale_ids = False
+        if in_memory is None:
+            in_memory = ALMA_HOLDING_IN_MEMORY == "on"
+        self.in_memory = in_memory
+        self.artifacts = {}
+        self.holding_record = None
+        self.updated_holding = None
+        self.put_response = None
+        self.outcome = None
+        # The Job Monitor notifier of this record, set when it is sent
+        self.notifyJM = None
+        # Set when the record failed for a reason that may pass, the
+        # task reschedules it instead of giving up
+        self.retryable = False
+        self.confirm_strategy = get_confirm_strategy()
+        self.namespace_mapping = holding_xml.NAMESPACE_MAPPING
         self.output_dir = f'{data_dir}/out/proquest{self.pqid}-holdings'
         if alt_output_dir is not None:  # pragma: no cover
             self.output_dir = alt_output_dir 
-        os.makedirs(self.output_dir, exist_ok=True)
-        if not os.path.exists(self.output_dir):
+        if not self.in_memory:
+            self.__make_output_dir()
+        if not self.in_memory and not os.path.exists(self.output_dir):
             if (not self.unittesting): # pragma: no cover
                 current_span = trace.get_current_span()
                 current_span.set_status(Status(StatusCode.ERROR))
@@ -125,27 +139,40 @@ class DRSHoldingByAPI():
             current_span.add_event("Getting mms id via proquest id")
             current_span.set_attribute("identifier", pqid)
         self.logger.debug("Getting mms id via proquest id")
-
-        r = requests.get(ALMA_SRU_MARCXML_BASE + pqid)
-        self.logger.debug(ALMA_SRU_MARCXML_BASE + pqid)
-        sru_file = f'{self.output_dir}/sru.xml'
+        if self.resolved_mmsid is not None:
+            # Like a cached id, a stale one is looked up again
+            mms_id, self.resolved_mmsid = self.resolved_mmsid, None
+            self.logger.debug("Resolved mms id %s for pqid %s", mms_id, pqid)
+            self.mmsid = mms_id
+            self.cached_ids = True
+            return mms_id
+        if self.id_cache is not None:
+            mms_id = self.id_cache.get(alma_cache.MMS_ID, pqid)
+            if mms_id is not None:
+                self.logger.debug("Cached mms id %s for pqid %s", mms_id, pqid)
+                self.mmsid = mms_id
+                self.cached_ids = True
+                return mms_id
+
+        r = self.alma_client.sru_get(pqid)
         if r.status_code == 200:
-            with open(sru_file, 'wb') as f:
-                f.write(r.content)
+            self.__save_artifact('sru.xml', r.content)
         else:
             self.logger.error("HTTP error " + str(r.status_code) +
                               " getting DRS holding for pqid: " +
                               str(self.pqid))
             self.logger.error(r.text)
+            self.__note_transient(r)
             return False
 
-        mmsid_xpath = "//srw:searchRetrieveResponse/srw:records/srw:record/" \
-                      "srw:recordIdentifier"
-
-        doc = ET.parse(sru_file)
-        mms_id = doc.xpath(mmsid_xpath,
-                           namespaces=self.namespace_mapping)[0].text
+        mms_id = holding_xml.parse_mms_id(r.content)
+        if mms_id is None:
+            self.logger.error("Xpath error (recordIdentifier not found) " +
+                              "getting mms id for pqid: " + str(self.pqid))
+            return False
         self.mmsid = mms_id
+        if self.id_cache is not None:
+            self.id_cache.set(alma_cache.MMS_ID, pqid, mms_id)
 
         return mms_id
 
@@ -168,41 +195,34 @@ class DRSHoldingByAPI():
             current_span.add_event("Getting drs holdings by mms id")
             current_span.set_attribute("mms_id", mms_id)
         self.logger.debug("Getting drs holdings by mms id")
-        self.logger.debug(ALMA_API_BASE + ALMA_GET_BIB_BASE + mms_id
-                         + ALMA_GET_HOLDINGS_PATH + "?apikey=" + ALMA_API_KEY)
-
-        r = requests.get(ALMA_API_BASE + ALMA_GET_BIB_BASE + mms_id
-                         + ALMA_GET_HOLDINGS_PATH + "?apikey=" + ALMA_API_KEY)
-        holdings_file = f'{self.output_dir}/holdings.xml'
+        if self.id_cache is not None:
+            holding_id = self.id_cache.get(alma_cache.HOLDING_ID, mms_id)
+            if holding_id is not None:
+                self.logger.debug("Cached holding id %s for mms id %s", holding_id, mms_id)
+                self.holding_id = holding_id
+                self.cached_ids = True
+                return holding_id
+        r = self.alma_client.get(self.alma_client.holdings_url(mms_id))
         if r.status_code == 200:
-            with open(holdings_file, 'wb') as f:
-                f.write(r.content)
+            self.__save_artifact('holdings.xml', r.content)
         else:
-            self.logger.error("HTTP error {r.status_code}" +
+            self.logger.error(f"HTTP error {r.status_code}" +
                               " getting DRS holdings list " +
                               " for pqid: " + str(self.pqid))
             self.logger.error(r.text)
+            self.__note_transient(r)
             return False
 
-        # in case there are multiple holdings, loop through the holdings.xml file
+        # in case there are multiple holdings, loop through the holdings list
         # and find the one where library code is a 3-letter code and location code = "NET"
-        doc = ET.parse(holdings_file)
-        library_xpath = "//library"
-        loc_xpath = "//location"
-        holding_id_xpath = "//holding_id"
-        holdings = doc.xpath("//holding")
-        for holding in holdings:
-            library_code = holding.xpath(library_xpath)[0].text
-            location_code = holding.xpath(loc_xpath)[0].text
-            holding_id = holding.xpath(holding_id_xpath)[0].text
-            if (len(library_code) == 3 and location_code == "NET"):
-                self.holding_id = holding_id
-                break
+        self.holding_id = holding_xml.parse_drs_holding_id(r.content)
         if self.holding_id is None:
             self.logger.error("Xpath error (holding id not found) " +
                               " getting DRS holdings id for pqid: " +
                               self.pqid)
             return False
+        if self.id_cache is not None:
+            self.id_cache.set(alma_cache.HOLDING_ID, mms_id, self.holding_id)
         return self.holding_id
 
 
@@ -221,35 +241,36 @@ class DRSHoldingByAPI():
             current_span.set_attribute("mms_id", mms_id)
 
         self.logger.debug("Get drs holding")
-        self.logger.debug(ALMA_API_BASE + ALMA_GET_BIB_BASE + mms_id +
-                         ALMA_GET_HOLDINGS_PATH + "/" + holding_id +
-                         "?apikey=" + ALMA_API_KEY)
-
-        r = requests.get(ALMA_API_BASE + ALMA_GET_BIB_BASE + mms_id +
-                         ALMA_GET_HOLDINGS_PATH + "/" + holding_id +
-                         "?apikey=" + ALMA_API_KEY)
-        holding_file = f'{self.output_dir}/holding.xml'
+        r = self.alma_client.get(self.alma_client.holding_url(mms_id, holding_id))
         if r.status_code == 200:
-            with open(holding_file, 'wb') as f:
-                f.write(r.content)
+            self.holding_record = r.content
+            self.__save_artifact('holding.xml', r.content)
         else:
             self.logger.error("HTTP error " + str(r.status_code) + 
                               " getting DRS holding file for pqid: " +
                               str(self.pqid))
             self.logger.error(r.text)
+            self.__note_transient(r)
+            if holding_not_found(r):
+                self.__invalidate_ids(mms_id)
             return False
         # return the xml holding
         return r.content
 
  
     @tracer.start_as_current_span("transform_drs_holding")
-    def transform_drs_holding(self, batchOutDir, urn, verbose=False):
+    def transform_drs_holding(self, batchOutDir, urn, verbose=False,
+                              holding=None):
         """
-        Transforms the marcxml for the DRS holding.
+        Transforms the marcxml for the DRS holding. The result is kept in
+        self.updated_holding, and written to updated_holding.xml unless
+        running in memory.
 
         Args:
             batchOutDir (str): The batch output directory.
             urn (str): The urn to added to the transformed holding record.
+            holding: The holding record as bytes or an element, read from
+                holding.xml in batchOutDir if not given.
 
         Returns:
             bool: True if the marcxml was transformed, False otherwise.
@@ -260,23 +281,14 @@ class DRSHoldingByAPI():
         self.logger.debug("Transforming drs holding")
 
         updated_holding = f'{batchOutDir}/updated_holding.xml'
-        holding_file = f'{batchOutDir}/holding.xml'
-        # Load existing holding file and swap in urn
-        marcXmlTree = etree.parse(holding_file)
-        rootRecord = marcXmlTree.getroot()
+        # Load existing holding and swap in urn
+        if holding is None:
+            holding = etree.parse(f'{batchOutDir}/holding.xml')
+        rootRecord = holding_xml.to_root(holding)
 
         try:
-            for child in rootRecord.iter('subfield'):
-
-                # datafield/subfields
-                if child.tag == 'subfield':
-                    parent = child.getparent()
-                    if parent.tag == 'datafield':
-                        # Datafield 852
-                        if parent.attrib['tag'] == '852':
-                            if child.attrib['code'] == 'z':
-                                childText = f'{SUBFIELD_Z_BASE}{urn}'
-                                child.text = childText
+            # Datafield 852 subfield z
+            holding_xml.set_holding_urn(rootRecord, urn)
         except Exception as e:  # pragma: no cover
             self.logger.error("Error transforming DRS holding for pqid: " +
                               self.pqid, exc_info=True)
@@ -287,11 +299,14 @@ class DRSHoldingByAPI():
             return False
 
         try:
+            self.updated_holding = holding_xml.holding_to_bytes(rootRecord)
             # Write xml record out in batch directory
-            with open(updated_holding, 'w') as UpdatedRecordOut:  # pragma: no cover
-                UpdatedRecordOut.write('<?xml version="1.0" encoding="UTF-8"?>\n')
-                updated_holding_xml = etree.tostring(rootRecord, encoding='unicode')
-                UpdatedRecordOut.write(updated_holding_xml)
+            if self.__write_artifacts():
+                with open(updated_holding, 'wb') as UpdatedRecordOut:
+                    UpdatedRecordOut.write(self.updated_holding)
+                self.logger.debug('Wrote %s', updated_holding)
+            else:
+                self.artifacts['updated_holding.xml'] = self.updated_holding
         except Exception as e:  # pragma: no cover
             self.logger.error("Error writing DRS holding for pqid: " + self.pqid, exc_info=True)
             if (not self.unittesting):  # pragma: no cover
@@ -299,18 +314,17 @@ class DRSHoldingByAPI():
                 current_span.add_event("Error writing drs holding for pqid: " + self.pqid)  # pragma: no cover
                 return False  # pragma: no cover
 
-        self.logger.debug(f'Wrote {updated_holding}')
-
         # And then return it to be collected with other processed records
         return True
     
 
     @tracer.start_as_current_span("upload_new_drs_holding")
-    def upload_new_drs_holding(self, pqid, mms_id, holding_id, filename):  # pragma: no cover, this is covered in the int test # noqa
+    def upload_new_drs_holding(self, pqid, mms_id, holding_id, filename=None, data=None):  # pragma: no cover, this is covered in the int test # noqa
         """
         This method uploads the new drs holding to alma.
 
-        Args: proquest id, mms id, holding id, filename
+        Args: proquest id, mms id, holding id, filename, or the holding
+            bytes as data
         Returns: True if the new drs holding is uploaded to alma,
             False otherwise.
         """
@@ -318,16 +332,15 @@ class DRSHoldingByAPI():
         if (not self.unittesting):
             current_span.add_event("Submitting drs holding")
         self.logger.debug("Submitting drs holding")
-        self.logger.debug(ALMA_API_BASE + ALMA_GET_BIB_BASE +
-                          mms_id + "/holdings/" + holding_id)
-
-        headers = {'Content-Type': 'application/xml',
-                   'X-API-Key': ALMA_API_KEY}
-        data = open(filename, 'rb').read()
-        r = requests.put(ALMA_API_BASE + ALMA_GET_BIB_BASE +
-                          mms_id + "/holdings/" + holding_id,
-                          data=data, headers=headers)
+
+        headers = {'Content-Type': 'application/xml'}
+        if data is None:
+            with open(filename, 'rb') as f:
+                data = f.read()
+        r = self.alma_client.put(self.alma_client.holding_url(mms_id, holding_id),
+                                 data=data, headers=headers)
         if r.status_code == 200:
+            self.put_response = r.content
             self.logger.info("Successfully submitted new DRS holding for pqid: " +
                               pqid + " status code: " + str(r.status_code))
             return True
@@ -335,6 +348,9 @@ class DRSHoldingByAPI():
             self.logger.error("Error submitting new DRS holding for pqid: " +
                               pqid + " status code: " + str(r.status_code))
             self.logger.error(r.text)
+            self.__note_transient(r)
+            if holding_not_found(r):
+                self.__invalidate_ids(mms_id)
             return False
 
 
@@ -353,31 +369,50 @@ class DRSHoldingByAPI():
             current_span.add_event("Confirming drs holding")
             current_span.set_attribute("identifier", pqid)
         self.logger.debug("Confirming new drs holding")
-        r = requests.get(ALMA_API_BASE + ALMA_GET_BIB_BASE + mms_id +
-                         ALMA_GET_HOLDINGS_PATH + "/" + holding_id +
-                         "?apikey=" + ALMA_API_KEY)
-        sru_file = f'{self.output_dir}/src_marc.xml'
+        r = self.alma_client.get(self.alma_client.holding_url(mms_id, holding_id))
         if r.status_code == 200:  
-            with open(sru_file, 'wb') as f:
-                f.write(r.content)
+            self.__save_artifact('src_marc.xml', r.content)
         else:
             self.logger.error("HTTP error " + str(r.status_code) +
                               " getting updated DRS holding for pqid: " +
                              str(self.pqid))
             self.logger.error(r.text)
+            self.__note_transient(r)
             return False
 
-        urn_xpath = "//record/datafield[@tag='852']" \
-                      "/subfield[@code='z']"
-        doc = ET.parse(sru_file)
-        urn_statement = doc.xpath(urn_xpath,
-                           namespaces=self.namespace_mapping)[0].text
-        self.logger.debug("URN statement: " + urn_statement)
+        urn_statement = holding_xml.holding_urn_statement(r.content)
+        self.logger.debug("URN statement: %s", urn_statement)
         expected_statement = f'{SUBFIELD_Z_BASE}{urn}'
-        self.logger.debug("exp statement: " + expected_statement)
+        self.logger.debug("exp statement: %s", expected_statement)
         return urn_statement == expected_statement
 
 
+    @tracer.start_as_current_span("confirm_holding_update")
+    def confirm_holding_update(self, pqid, mms_id, holding_id, urn):
+        """
+        Confirms the uploaded holding with the configured strategy,
+        see etd.holding_confirm.
+
+        Args: proquest id, mms id, holding id, urn
+        Returns: True if the holding update is confirmed, False otherwise.
+        """
+        current_span = trace.get_current_span()
+        record = {'pqid': pqid, 'mms_id': mms_id,
+                  'holding_id': holding_id, 'object_urn': urn}
+        confirmed, latency = self.confirm_strategy.confirm(
+            urn, self.put_response,
+            lambda: self.confirm_new_drs_holding(pqid, mms_id,
+                                                 holding_id, urn),
+            record)
+        self.logger.debug("%s confirm for pqid %s took %.3fs",
+                          self.confirm_strategy.mode, pqid, latency)
+        if (not self.unittesting):  # pragma: no cover
+            current_span.set_attribute("confirm_mode",
+                                       self.confirm_strategy.mode)
+            current_span.set_attribute("confirm_latency_secs", latency)
+        return confirmed
+
+
     @tracer.start_as_current_span("send_to_alma")
     def send_to_alma(self, message):  # pragma: no cover
         """
@@ -429,45 +464,49 @@ class DRSHoldingByAPI():
 		    bool: True if the DRS holding was sent, False otherwise.
 	    """
         current_span = trace.get_current_span()
-        global notifyJM
         drsHoldingSent = False
 
 	    # Create a notify object, this will also set-up logging and
         # logFile  = f'{logDir}/{jobCode}.{yymmdd}.log'
-        notifyJM = notify('monitor', jobCode, None)
+        self.notifyJM = get_notifier(jobCode)
 
         # Let the Job Monitor know that the job has started
-        notifyJM.log('pass', 'Update ETD Alma DRS Holding Record', verbose)
-        notifyJM.report('start')
+        self.notifyJM.log('pass', 'Update ETD Alma DRS Holding Record', verbose)
+        self.notifyJM.report('start')
         if (not self.unittesting):
             current_span.add_event("Sending drs holding to alma dropbox")
-        self.logger.debug(f'{self.pqid} DRS holding was sent to Alma')
+        self.logger.debug('%s DRS holding was sent to Alma', self.pqid)
 
         # Check to see if this was already processed by looking in Mongo
         # Do not re-run a processed batch unless forced #- test
         if (not integration_test):
             if ((not force) and self.__record_already_processed()):
-                notifyJM.log('fail', f'Holding record {self.pqid} has already been created. Use force flag to re-run.', True)
+                self.notifyJM.log('fail', f'Holding record {self.pqid} has already been created. Use force flag to re-run.', True)
                 current_span.set_status(Status(StatusCode.ERROR))
                 current_span.add_event(f'Holding record {self.pqid} has already been created. Use force flag to re-run.')
                 return False
 
         processing_retval = self.process_record_for_alma(verbose)
+        outcome = self.outcome if processing_retval else "failed"
+        outcome_counts[outcome] += 1
+        current_span.set_attribute("outcome", outcome)
         if (not processing_retval):
+            self.dump_artifacts()
             return False
         
-        # delete the output directory
-        shutil.rmtree(f'{data_dir}/out/proquest{self.pqid}-holdings', ignore_errors=True)
+        # delete the output directory, in memory mode nothing was written
+        if not self.in_memory:
+            shutil.rmtree(f'{data_dir}/out/proquest{self.pqid}-holdings', ignore_errors=True)
 
         if (not self.unittesting):
             current_span.add_event(f'{self.pqid} DRS holding was updated & sent to Alma')
-            mongo_record_for_pqid = self.___get_record_from_mongo()
-            batch = mongo_record_for_pqid[mongo_util.FIELD_DIRECTORY_ID].strip()
+            batch = self.___get_record_from_mongo().directory_id
             try:
                 query = {mongo_util.FIELD_PQ_ID: self.pqid,
                          mongo_util.FIELD_DIRECTORY_ID: batch}
+                # the record's last write, not left in the buffer
                 self.mongoutil.update_status(
-                    query, mongo_util.DRS_HOLDING_API_STATUS)
+                    query, mongo_util.DRS_HOLDING_API_STATUS, durable=True)
                 current_span.add_event(f'Status for Proquest id {self.pqid} in {batch} updated in mongo')
             except Exception as e:  # pragma: no cover
                 self.logger.error(f"Error updating status for {self.pqid}: {e}")
@@ -476,26 +515,32 @@ class DRSHoldingByAPI():
                 current_span.record_exception(e)
                 self.mongoutil.close_connection()
                 return False
-        self.logger.debug(f'{self.pqid} DRS holding was updated & sent to Alma')
-        notifyJM.log('pass', f'{self.pqid} DRS holding was updated & sent to Alma', verbose)
-        notifyJM.report('complete')
+        drsHoldingSent = True
+        self.logger.debug('%s DRS holding was updated & sent to Alma', self.pqid)
+        self.notifyJM.log('pass', f'{self.pqid} DRS holding was updated & sent to Alma', verbose)
+        self.notifyJM.report('complete')
         if (not self.unittesting):
             current_span.add_event("completed")
         return drsHoldingSent
 
     @tracer.start_as_current_span("send_holding_to_alma_worker")
-    def process_record_for_alma(self, verbose=False, retry_count=0): # pragma: no cover
+    def process_record_for_alma(self, verbose=False): # pragma: no cover
         """
-        Process a record for Alma.
+        Process a record for Alma. An exception, or an Alma error that
+        may pass, sets self.retryable instead of retrying here, so the
+        task can be rescheduled without holding the worker.
 
         Args:
             verbose (bool): Flag indicating whether to log verbose output. Default is False.
-            retry_count (int): Number of retries for processing. Default is 0.
 
         Returns:
             bool: True if the record was processed successfully, False otherwise.
         """
         current_span = trace.get_current_span()
+        if self.notifyJM is None:
+            self.notifyJM = get_notifier(jobCode)
+        limiter = self.alma_client.limiter
+        waited_before = limiter.stats()['wait_secs_total']
         try:
             if self.pqid is None:
                 raise Exception("PQID is None")
@@ -505,132 +550,158 @@ class DRSHoldingByAPI():
             if not mms_id:
                 self.logger.error("Error getting mms id for pqid: " +
                                   self.pqid)
-                notifyJM.log('fail', f'Error getting mms id for pqid: {self.pqid}')
+                self.notifyJM.log('fail', f'Error getting mms id for pqid: {self.pqid}')
                 return False
             holding_id = self.get_drs_holding_id_by_mms_id(mms_id)
             if not holding_id:
                 self.logger.error("Error getting mms id for pqid: " +
                                   self.pqid)
-                notifyJM.log('fail', f'Error uploading drs holding for pqid: {self.pqid}')
+                self.notifyJM.log('fail', f'Error uploading drs holding for pqid: {self.pqid}')
                 if (not self.unittesting):
                     current_span.set_status(Status(StatusCode.ERROR))
                     current_span.add_event("Error getting mms id for pqid: " + self.pqid)
                 return False
             holding_record = self.get_drs_holding(mms_id, holding_id)
+            if not holding_record and self.stale_ids:
+                # The cached ids were stale, look them up in Alma again
+                self.stale_ids = False
+                mms_id = self.get_mms_id(self.pqid)
+                holding_id = mms_id and self.get_drs_holding_id_by_mms_id(mms_id)
+                if holding_id:
+                    holding_record = self.get_drs_holding(mms_id, holding_id)
             if not holding_record:
                 self.logger.error("Error getting drs holding for pqid: " +
                                   self.pqid)
-                notifyJM.log('fail', f'Error getting drs holding for pqid: {self.pqid}')
+                self.notifyJM.log('fail', f'Error getting drs holding for pqid: {self.pqid}')
                 if (not self.unittesting):
                     current_span.set_status(Status(StatusCode.ERROR))
                     current_span.add_event("Error getting drs holding for pqid: " + self.pqid)
                 return False
-            transformed = self.transform_drs_holding(self.output_dir, self.object_urn)
+            if holding_xml.holding_is_current(holding_record, self.object_urn):
+                # Already carries the urn, e.g. a force re-run or a redelivered
+                # message, so there is nothing to PUT or confirm
+                self.outcome = "noop"
+                self.logger.info(f"DRS holding for pqid {self.pqid} already has "
+                                 f"the urn, skipping the update")
+                self.notifyJM.log('pass', f'DRS holding for pqid {self.pqid} is already up to date', verbose)
+                if (not self.unittesting):
+                    current_span.add_event(f"DRS holding for pqid {self.pqid} is already up to date")
+                return True
+            transformed = self.transform_drs_holding(self.output_dir, self.object_urn,
+                                                     holding=self.holding_record)
             if not transformed:
                 self.logger.error("Error transforming drs holding record for pqid: " +
                                   self.pqid)
-                notifyJM.log('fail', f'Error transforming drs holding record for pqid: {self.pqid}', verbose)
+                self.notifyJM.log('fail', f'Error transforming drs holding record for pqid: {self.pqid}', verbose)
                 if (not self.unittesting):
                     current_span.set_status(Status(StatusCode.ERROR))
                     current_span.add_event("Error transforming drs holding for pqid: " + self.pqid)
                 return False
-            notifyJM.log('pass', f'Wrote updated_holding for pqid: {self.pqid}', verbose)
+            self.notifyJM.log('pass', f'Wrote updated_holding for pqid: {self.pqid}', verbose)
             uploaded = self.upload_new_drs_holding(self.pqid, mms_id, holding_id,
-                                                   f'{self.output_dir}/updated_holding.xml')
+                                                   data=self.updated_holding)
             if not uploaded:
                 self.logger.error("Error uploading drs holding for pqid: " +
                                   self.pqid)
-                notifyJM.log('fail', f'Error uploading drs holding for pqid: {self.pqid}')
+                self.notifyJM.log('fail', f'Error uploading drs holding for pqid: {self.pqid}')
                 if (not self.unittesting):
                     current_span.set_status(Status(StatusCode.ERROR))
                     current_span.add_event("Error uploading drs holding for pqid: " + self.pqid)
                 return False
-            notifyJM.log('pass', f'Uploaded updated holding for pqid: {self.pqid}', verbose)
-            drsHoldingSent = self.confirm_new_drs_holding(self.pqid, mms_id,
-                                                          holding_id, self.object_urn)
+            self.notifyJM.log('pass', f'Uploaded updated holding for pqid: {self.pqid}', verbose)
+            drsHoldingSent = self.confirm_holding_update(self.pqid, mms_id,
+                                                         holding_id, self.object_urn)
             if not drsHoldingSent:
                 self.logger.error("Error confirming drs holding update for pqid: " +
                                   self.pqid)
                 if (not self.unittesting):
                     current_span.set_status(Status(StatusCode.ERROR))
                     current_span.add_event("Error confirming drs holding update for pqid: " + self.pqid)
-                    notifyJM.log('fail', f'Error confirming drs holding update for pqid: {self.pqid}')
+                    self.notifyJM.log('fail', f'Error confirming drs holding update for pqid: {self.pqid}')
                 return False
-            notifyJM.log('pass', f'Confirmed upload of updated holding for pqid: {self.pqid}', verbose)
+            self.outcome = "updated"
+            self.notifyJM.log('pass', f'Confirmed upload of updated holding for pqid: {self.pqid}', verbose)
         except Exception as e:
             exception_msg = traceback.format_exc()
             self.logger.error("Error processing record for alma: " + str(e))
             self.logger.error(exception_msg)
             current_span.set_status(Status(StatusCode.ERROR))
             current_span.add_event("Error processing record for alma: " + str(e))
-            # Keep retrying if we haven't reached our max retries number
-            if retry_count < MAX_RETRIES:
-                self.logger.info(f"Retry number {retry_count} Alma processing for {self.pqid}")
-                time.sleep(DELAY_SECS)
-                return self.process_record_for_alma(verbose, retry_count + 1)
+            # Only a transport error may pass, anything else fails now
+            if is_transient_error(e):
+                self.retryable = True
             return False
+        finally:
+            current_span.set_attribute(
+                "alma_rate_limit_wait_secs",
+                limiter.stats()['wait_secs_total'] - waited_before)
         return True
 
-    @tracer.start_as_current_span("send_holding_to_alma_worker")
+    def dump_artifacts(self):
+        """
+        Writes the xml kept in memory for this record to the output
+        directory, so a failed record can be looked at.
+        """
+        if not self.artifacts:
+            return
+        self.__make_output_dir()
+        for name, content in self.artifacts.items():
+            with open(f'{self.output_dir}/{name}', 'wb') as f:
+                f.write(content)
+        self.logger.info(f'Wrote {len(self.artifacts)} artifacts for pqid '
+                         f'{self.pqid} to {self.output_dir}')
+        self.artifacts = {}
+
+    def __invalidate_ids(self, mms_id):
+        """
+        Drops the cached ids that led to a holding Alma does not have.
+        """
+        if self.id_cache is None:
+            return
+        self.id_cache.invalidate(alma_cache.MMS_ID, self.pqid)
+        self.id_cache.invalidate(alma_cache.HOLDING_ID, mms_id)
+        self.stale_ids = self.cached_ids
+        self.cached_ids = False
+
+    def __note_transient(self, r):
+        if is_transient_status(r.status_code):
+            self.retryable = True
+
+    def __write_artifacts(self):
+        return (not self.in_memory or
+                ALMA_HOLDING_DEBUG_ARTIFACTS == "on")
+
+    def __save_artifact(self, name, content):
+        if self.__write_artifacts():
+            self.__make_output_dir()
+            with open(f'{self.output_dir}/{name}', 'wb') as f:
+                f.write(content)
+        else:
+            self.artifacts[name] = content
+
+    def __make_output_dir(self):
+        os.makedirs(self.output_dir, exist_ok=True)
+
     def __record_already_processed(self): # pragma: no cover, not using for unit tests
         current_span = trace.get_current_span()
         current_span.add_event("Verifying if DRS holding exists")
-        query = {mongo_util.FIELD_SUBMISSION_STATUS:
-                 mongo_util.DRS_HOLDING_API_STATUS,
-				 mongo_util.FIELD_PQ_ID: self.pqid}
-        fields = {mongo_util.FIELD_PQ_ID: 1,
-                  mongo_util.FIELD_SCHOOL_ALMA_DROPBOX: 1,
-                  mongo_util.FIELD_SUBMISSION_STATUS: 1,
-                  mongo_util.FIELD_DIRECTORY_ID: 1}
-        self.logger.info("Starting poll for alma DRS holding")
-        matching_records = []
+        record_context = self.__get_record_context()
+        return record_context.already_processed(
+            mongo_util.DRS_HOLDING_API_STATUS)
 
-        try:
-            matching_records = self.mongoutil.query_records(query, fields)
-            self.logger.info(f"Found {len(matching_records)} \
-                             matching records")
-            self.logger.debug(f"Matching records: {matching_records}")
-        except Exception as e:  # pragma: no cover
-            self.logger.error(f"Error querying records: {e}")
-            current_span.set_status(Status(StatusCode.ERROR))
-            current_span.add_event("Unable to query mongo for DRS holdings")
-            current_span.record_exception(e)
-            raise e
-        record_list = list(matching_records)
-        return len(record_list) > 0
+    def __get_record_context(self): # pragma: no cover, not using for unit tests
+        # Loaded once per task, unless the task passed one in
+        if self.record_context is None:
+            self.record_context = load_record_context(
+                self.mongoutil, self.pqid, self.object_urn)
+        return self.record_context
 
-    @tracer.start_as_current_span("send_holding_to_alma_worker")
     def ___get_record_from_mongo(self): # pragma: no cover, not using for unit tests
         current_span = trace.get_current_span()
-        current_span.add_event("Getting data from mongo exists")
-        query = {mongo_util.FIELD_SUBMISSION_STATUS:
-                 mongo_util.ALMA_STATUS,
-				 mongo_util.FIELD_PQ_ID: self.pqid}
-        fields = {mongo_util.FIELD_PQ_ID: 1,
-                  mongo_util.FIELD_SCHOOL_ALMA_DROPBOX: 1,
-                  mongo_util.FIELD_SUBMISSION_STATUS: 1,
-                  mongo_util.FIELD_DIRECTORY_ID: 1}
-        self.logger.info("Getting data from mongo exists")
-        matching_records = []
-
-        try:
-            matching_records = self.mongoutil.query_records(query, fields)
-            self.logger.info(f"Found {len(matching_records)} \
-                             matching records")
-            self.logger.debug(f"Matching records: {matching_records}")
-        except Exception as e:  # pragma: no cover
-            self.logger.error(f"Error querying records: {e}")
-            current_span.set_status(Status(StatusCode.ERROR))
-            current_span.add_event("Unable to query mongo for DRS holdings")
-            current_span.record_exception(e)
-            raise e
-        record_list = list(matching_records)
-        if len(record_list) > 1:
-            self.logger.warn(f"Found {len(record_list)} for {self.pqid}")
-        if (len(record_list) == 0):
+        record_context = self.__get_record_context()
+        if not record_context.found:
             self.logger.error(f"Unable to find record for {self.pqid}")
             current_span.set_status(Status(StatusCode.ERROR))
             current_span.add_event("Unable to find record in mongo")
-            current_span.record_exception(e)
             raise Exception(f"Unable to find record for {self.pqid}")
-        return record_list[0]
\ No newline at end of file
+        return record_context
@@ -3,18 +3,14 @@ import os
 from opentelemetry import trace
 from opentelemetry.trace import Status
 from opentelemetry.trace import StatusCode
-from opentelemetry.sdk.resources import Resource
-from opentelemetry.sdk.trace import TracerProvider
-from opentelemetry.sdk.trace.export import BatchSpanProcessor
-from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import (
-        OTLPSpanExporter)
-from opentelemetry.sdk.resources import SERVICE_NAME
+from . import telemetry
 
 import sys
 import re
-from lxml import etree
 import logging
+from collections import Counter
 from etd.mongo_util import MongoUtil
+from etd.record_context import load_record_context
 import etd.mongo_util as mongo_util
 from . import configure_logger
 
@@ -28,37 +24,46 @@ sys.path.append(confDir)
 sys.path.append(libDir)
 from .etds2alma_tables import schools
 from lib.ltstools import get_date_time_stamp
-from .xfer_files import xfer_files
+from .sftp_pool import sftp_pool
+from .dropbox_batcher import DropboxBatcher, PendingJournal, DROPBOX_BATCH_MODE, DROPBOX_BATCH_WINDOW_SECS
 from lib.notify import notify
+from .job_monitor import get_notifier, SpillFile
+from . import mets_xml
+from . import marcxml_template
+from . import collection_writer
 
-# tracing setup
-JAEGER_NAME = os.getenv('JAEGER_NAME')
-JAEGER_SERVICE_NAME = os.getenv('JAEGER_SERVICE_NAME')
 notify.logDir = os.getenv("LOGFILE_PATH", "/home/etdadm/logs/etd")
 
-resource = Resource(attributes={SERVICE_NAME: JAEGER_SERVICE_NAME})
-provider = TracerProvider(resource=resource)
-otlp_exporter = OTLPSpanExporter(endpoint=JAEGER_NAME, insecure=True)
-span_processor = BatchSpanProcessor(otlp_exporter)
-provider.add_span_processor(span_processor)
-trace.set_tracer_provider(provider)
-tracer = trace.get_tracer(__name__)
+# tracing setup, the provider is created on the first span
+tracer = telemetry.get_tracer(__name__)
 
 almaMarcxmlTemplate = os.getenv('ALMA_MARCXML_DRSHOLDING_TEMPLATE',
 								"./templates/" \
 								"alma_marcxml_drsholding_template.xml")
 dropboxUser = os.getenv('DROPBOX_USER')
 dropboxServer = os.getenv('DROPBOX_SERVER')
+dropboxPort = int(os.getenv('DROPBOX_PORT', 22))
 privateKey = os.getenv('PRIVATE_KEY_PATH')
 dataDir = os.getenv('DATA_DIR')
-notifyJM = False
+# on/off, also writes each record to {dataDir}/out/<batch> for debugging
+MARCXML_BATCH_COPY = os.getenv('MARCXML_BATCH_COPY', 'on')
+# Where the dropbox batcher keeps the records it holds, across restarts
+DROPBOX_STATE_DIR = os.getenv('DROPBOX_STATE_DIR',
+                              os.path.join(dataDir or notify.logDir, 'dropbox'))
+DROPBOX_PENDING_DIR = os.getenv('DROPBOX_PENDING_DIR',
+                                os.path.join(DROPBOX_STATE_DIR, 'pending'))
+# DASH records the dropbox batcher gave up on, one json document per line
+DROPBOX_UNSENT_FILE = os.getenv('DROPBOX_UNSENT_FILE',
+                                os.path.join(DROPBOX_STATE_DIR, 'unsent.jsonl'))
+# A pending record untouched this long belongs to a worker that is gone,
+# a live worker touches its records at least once a window
+DROPBOX_PENDING_STALE_SECS = float(os.getenv('DROPBOX_PENDING_STALE_SECS',
+                                             5 * DROPBOX_BATCH_WINDOW_SECS))
 jobCode = 'drsholding2alma'
 instance = os.getenv('INSTANCE', '')
 if (instance == 'prod'): # pragma: no cover
     instance = ''
 
-metsDmdSecNamespace = '{http://www.loc.gov/METS/}'
-metsDimNamespace = '{http://www.dspace.org/xmlns/dspace/dim}'
 
 yyyymmdd = get_date_time_stamp('day')
 yymmdd = yyyymmdd[2:]
@@ -67,14 +72,6 @@ reTheTitle = re.compile('"?(the) .*', re.IGNORECASE)
 reAnTitle = re.compile('"?(an) .*', re.IGNORECASE)
 reATitle = re.compile('"?(a) .*', re.IGNORECASE)
 
-# To wrap the xml records in a collection
-xmlStartCollection = """
-<collection xmlns="http://www.loc.gov/MARC21/slim"
-    xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"
-    xsi:schemaLocation="http://www.loc.gov/MARC21/slim http://www.loc.gov/standards/marcxml/schema/MARC21slim.xsd">
-"""
-
-xmlEndCollection = "</collection>"
 
 FEATURE_FLAGS = "feature_flags"
 ALMA_FEATURE_FORCE_UPDATE_FLAG = "alma_feature_force_update_flag"
@@ -82,6 +79,245 @@ ALMA_FEATURE_VERBOSE_FLAG = "alma_feature_verbose_flag"
 INTEGRATION_TEST = os.getenv('MONGO_DB_COLLECTION_ITEST', 'integration_test')
 ALMA_TEST_BATCH_NAME = os.getenv('ALMA_TEST_BATCH_NAME','proquest2023071720-993578-gsd')
 
+
+@tracer.start_as_current_span("send_collection_to_alma_dropbox")
+def send_collection(collectionKey, entries, notifier=None, verbose=False):
+    """
+    Writes MARCXML records to a collection file, sends it to the Alma
+    dropbox and then updates the mongo status of every record in it.
+
+    Args:
+        collectionKey (tuple): The (school, collection file prefix) key.
+        entries (list): The collection entries, dicts with pqid, batch,
+            school, marcXmlRecord and mongoutil keys.
+        notifier (notify): Job Monitor notifier. A new one is created
+            and reported if none is passed.
+        verbose (bool): Flag to enable verbose logging. Default is False.
+
+    Returns:
+        bool: True if the collection was sent, False otherwise.
+    """
+    current_span = trace.get_current_span()
+    logger = logging.getLogger('etd_alma_drs_holding')
+    reportNotifier = notifier is None
+    if reportNotifier:
+        notifier = get_notifier(jobCode)
+    school, collectionPrefix = collectionKey
+    pqids = [entry['pqid'] for entry in entries]
+    current_span.set_attribute("collection_size", len(entries))
+
+    # Serialize the collection to a spooled buffer and stream it up over
+    # the process's pooled sftp connection, renamed once complete
+    yyyymmddhhmmssml = get_date_time_stamp('millisecond')
+    xmlCollectionFile = f'{collectionPrefix}_{yyyymmddhhmmssml}.xml'
+    drsHoldingSent = False
+    targetFile = '/incoming/' + xmlCollectionFile
+    with collection_writer.spool_collection(
+            entry['marcXmlRecord'] for entry in entries) as xmlCollectionOut:
+        logger.debug('%d MARCXML records for %s added to collection file %s', len(entries), school, xmlCollectionFile)
+        current_span.add_event(f'{len(entries)} MARCXML records for {school} added to collection file')
+        xferError = sftp_pool.put_fileobj(dropboxServer, dropboxUser,
+                                          privateKey, xmlCollectionOut,
+                                          targetFile, dropboxPort)
+    if xferError:
+        notifier.log('fail', xferError, True)
+        current_span.set_status(Status(StatusCode.ERROR))
+        current_span.add_event(xferError)
+        logger.error(xferError)
+    else:
+        notifier.log('pass', f'{xmlCollectionFile} was sent to {dropboxUser}@{dropboxServer}:{targetFile}', verbose)
+        current_span.set_attribute("uploaded_identifier", ','.join(pqids))
+        current_span.set_attribute("uploaded_file", targetFile)
+        current_span.add_event(f'{xmlCollectionFile} was sent to {dropboxUser}@{dropboxServer}:{targetFile}')
+        logger.debug('uploaded proquest ids: %s', pqids)
+        logger.debug('uploaded file: %s', targetFile)
+        drsHoldingSent = True
+        for entry in entries:
+            entry['uploaded'] = True
+    logger.debug('sftp pool stats: %s', sftp_pool.stats())
+    if not drsHoldingSent:
+        if reportNotifier:
+            notifier.report('complete')
+        return False
+
+    # Only flip mongo statuses once the collection is in the dropbox
+    logger.debug('Updating mongo...')
+    updated = []
+    for entry in entries:
+        current_span.add_event(f'{entry["pqid"]} DRS holding was sent to Alma')
+        notifier.log('pass', f'{entry["pqid"]} DRS holding was sent to Alma', verbose)
+        if entry['mongoutil'] is None:
+            continue
+        try:
+            query = {mongo_util.FIELD_PQ_ID: entry['pqid'],
+                     mongo_util.FIELD_DIRECTORY_ID: entry['batch']}
+            entry['mongoutil'].update_status(
+                query, mongo_util.DRS_HOLDING_DROPBOX_STATUS)
+            updated.append(entry)
+            current_span.add_event(f'Status for Proquest id {entry["pqid"]} in {entry["batch"]} for school {school} updated in mongo')
+        except Exception as e:
+            logger.error(f"Error updating status for {entry['pqid']}: {e}")
+            notifier.log('fail', f'Could not update proquest id {entry["pqid"]} in {entry["batch"]} for school {school} in mongo', True)
+            current_span.set_status(Status(StatusCode.ERROR))
+            current_span.add_event(f'Could not update proquest id {entry["pqid"]} in {entry["batch"]} for school {school} in mongo')
+            current_span.record_exception(e)
+            drsHoldingSent = False
+    # These are the records' last writes, so the ones buffered in
+    # write-behind mode are written now, in one bulk write
+    if updated and not updated[0]['mongoutil'].flush_status_updates():
+        logger.error(f"Error writing the status updates of {xmlCollectionFile}")
+        notifier.log('fail', f'Could not update the status of the records in {xmlCollectionFile} in mongo', True)
+        current_span.set_status(Status(StatusCode.ERROR))
+        current_span.add_event(f'Could not update the status of the records in {xmlCollectionFile} in mongo')
+        drsHoldingSent = False
+        updated = []
+    for entry in updated:
+        entry['status_updated'] = True
+    if reportNotifier:
+        notifier.report('complete')
+    return drsHoldingSent
+
+
+def keep_unsent_records(collectionKey, entries, path=None):
+    """
+    Keeps the records of a collection the dropbox batcher gave up on in
+    DROPBOX_UNSENT_FILE and reports them to the Job Monitor. Records that
+    were uploaded only need their mongo status set, the others keep their
+    MARCXML so they can be sent again. Records whose status was updated
+    are left out.
+
+    Args:
+        collectionKey (tuple): The (school, collection file prefix) key.
+        entries (list): The collection entries.
+        path (str): The file to append to, DROPBOX_UNSENT_FILE if None.
+    """
+    school, collectionPrefix = collectionKey
+    unsent = SpillFile(path or DROPBOX_UNSENT_FILE)
+    os.makedirs(os.path.dirname(unsent.path) or '.', exist_ok=True)
+    notifier = get_notifier(jobCode)
+    for entry in entries:
+        if entry.get('status_updated'):
+            continue
+        uploaded = bool(entry.get('uploaded'))
+        record = {'pqid': entry['pqid'],
+                  'batch': entry['batch'],
+                  'school': school,
+                  'collection_prefix': collectionPrefix,
+                  'collection': entry.get('collection'),
+                  'uploaded': uploaded,
+                  'status': mongo_util.DRS_HOLDING_DROPBOX_STATUS}
+        if uploaded:
+            message = f'{entry["pqid"]} DRS holding was sent to Alma but its status was not updated in mongo'
+        else:
+            record['marcXmlRecord'] = entry['marcXmlRecord']
+            message = f'{entry["pqid"]} DRS holding was not sent to Alma'
+        unsent.append(record)
+        notifier.log('fail', f'{message}, kept in {unsent.path}')
+
+
+def replay_dropbox_records(include_unsent=True,
+                           stale_secs=DROPBOX_PENDING_STALE_SECS,
+                           journal=None, unsent_path=None,
+                           get_mongoutil=None, verbose=False):
+    """
+    Sends the DASH records that were left behind: the pending records of
+    a worker that died and, if include_unsent, the records the batcher
+    gave up on. Records that were uploaded only get their mongo status,
+    the others are sent again in one collection per school. Records that
+    fail again are kept in the unsent file.
+
+    Args:
+        include_unsent (bool): Also take the records of the unsent file.
+        stale_secs (float): Only take pending records untouched this long.
+        journal (PendingJournal): The dropbox batcher's by default.
+        unsent_path (str): DROPBOX_UNSENT_FILE by default.
+        get_mongoutil (callable): Returns the MongoUtil for a test
+            collection name, or for the records collection given None.
+
+    Returns:
+        Counter: The records 'sent', 'status_updated' and 'kept'.
+    """
+    logger = logging.getLogger('etd_alma_drs_holding')
+    journal = journal or dropbox_batcher.journal
+    unsent = SpillFile(unsent_path or DROPBOX_UNSENT_FILE)
+    mongoutils = {}
+
+    def mongoutil_for(record):
+        collection = record.get('collection')
+        if collection not in mongoutils:
+            mongoutils[collection] = (
+                get_mongoutil or mongo_util.collection_mongoutil)(collection)
+        return mongoutils[collection]
+
+    claims = journal.claim(stale_secs)
+    collections = {}
+    uploaded = []
+    for claim, key, record in claims:
+        collections.setdefault(tuple(key), {})[
+            (record['pqid'], record['batch'])] = record
+    for record in unsent.take() if include_unsent else []:
+        key = (record['school'], record['collection_prefix'])
+        if record.get('uploaded'):
+            uploaded.append((key, record))
+        else:
+            collections.setdefault(key, {})[
+                (record['pqid'], record['batch'])] = record
+
+    counts = Counter()
+    for key, record in uploaded:
+        query = {mongo_util.FIELD_PQ_ID: record['pqid'],
+                 mongo_util.FIELD_DIRECTORY_ID: record['batch']}
+        try:
+            mongoutil_for(record).update_status(query, record['status'],
+                                                durable=True)
+            counts['status_updated'] += 1
+        except Exception as e:
+            logger.error(f"Error updating status for {record['pqid']}: {e}")
+            keep_unsent_records(key, [dict(record, uploaded=True)],
+                                unsent.path)
+            counts['kept'] += 1
+    for key, records in collections.items():
+        entries = [{'pqid': record['pqid'],
+                    'batch': record['batch'],
+                    'school': key[0],
+                    'collection': record.get('collection'),
+                    'marcXmlRecord': record['marcXmlRecord'],
+                    'mongoutil': mongoutil_for(record)}
+                   for record in records.values()]
+        logger.info(f"Replaying {len(entries)} DASH records for the "
+                    f"{key[0]} dropbox collection")
+        if send_collection(key, entries, verbose=verbose):
+            counts['sent'] += len(entries)
+            continue
+        keep_unsent_records(key, entries, unsent.path)
+        for entry in entries:
+            counts['status_updated' if entry.get('status_updated')
+                   else 'kept'] += 1
+    # Only now that every record is sent or kept
+    for claim, key, record in claims:
+        journal.done(claim)
+    return counts
+
+
+def journal_record(entry):
+    """
+    Returns the part of a collection entry kept in the pending journal,
+    everything but its MongoUtil.
+    """
+    return {'pqid': entry['pqid'],
+            'batch': entry['batch'],
+            'school': entry['school'],
+            'collection': entry.get('collection'),
+            'marcXmlRecord': entry['marcXmlRecord']}
+
+
+# Collects records into shared collections when DROPBOX_BATCH_MODE is on,
+# each record is on disk in DROPBOX_PENDING_DIR until it is delivered
+dropbox_batcher = DropboxBatcher(send_collection,
+                                 on_drop=keep_unsent_records,
+                                 journal=PendingJournal(DROPBOX_PENDING_DIR),
+                                 to_record=journal_record)
+
 """
 This the worker class for the etd alma service.
 """
@@ -89,13 +325,21 @@ This the worker class for the etd alma service.
 
 class DRSHoldingByDropbox():
     
-    def __init__(self, pqid, object_urn, test_collection=None, unittesting=False):
+    def __init__(self, pqid, object_urn, test_collection=None, unittesting=False,
+                 record_context=None):
         configure_logger()
         self.logger = logging.getLogger('etd_alma_drs_holding')
 
         self.pqid = pqid
         self.object_urn = object_urn
         self.unittesting = unittesting
+        self.test_collection = test_collection
+        # Set when the upload failed, the task reschedules the record
+        self.retryable = False
+        # The Job Monitor notifier of this record, set when it is sent
+        self.notifyJM = None
+        # Loaded by the task, or on first use, saves repeat mongo lookups
+        self.record_context = record_context
         if not unittesting:
             self.mongoutil = MongoUtil()  # pragma: no cover, unit testing doesn't use mongo # noqa
             if test_collection is not None:  # pragma: no cover, only changes collection # noqa
@@ -151,51 +395,45 @@ class DRSHoldingByDropbox():
 	    """
         current_span = trace.get_current_span()
         current_span.add_event("sending drs holding to alma dropbox")
-        global notifyJM
-        wroteXmlRecords = False
 
 	    # Create a notify object, this will also set-up logging and
         # logFile  = f'{logDir}/{jobCode}.{yymmdd}.log'
-        notifyJM = notify('monitor', jobCode, None)
+        self.notifyJM = get_notifier(jobCode)
 		
         # Let the Job Monitor know that the job has started
-        notifyJM.log('pass', 'Create ETD Alma DRS Holding Record', verbose)
-        notifyJM.report('start')
+        self.notifyJM.log('pass', 'Create ETD Alma DRS Holding Record', verbose)
+        self.notifyJM.report('start')
 
-        mongo_record_for_pqid = self.___get_record_from_mongo()
+        record_context = self.___get_record_from_mongo()
 
-        # Start xml record collection output file
-        yyyymmddhhmmssml    = get_date_time_stamp('millisecond')
-        xmlCollectionFileName = f'AlmaDRSDark{instance.capitalize()}_{yyyymmddhhmmssml}.xml'
-        xmlCollectionFile = xmlCollectionFileName
+        # Records are collected per school into xml record collection
+        # files whose names start with this prefix
+        collectionPrefix = f'AlmaDRSDark{instance.capitalize()}'
         if integration_test:
-            xmlCollectionFile = f'AlmaDRSDarkTest{instance.capitalize()}_{yyyymmddhhmmssml}.xml'
+            collectionPrefix = f'AlmaDRSDarkTest{instance.capitalize()}'
             schoolMatch = re.match(r'proquest\d+-\d+-(\w+)', ALMA_TEST_BATCH_NAME)
             if schoolMatch:
                 school = schoolMatch.group(1)
         else:
-            school = mongo_record_for_pqid[mongo_util.FIELD_SCHOOL_ALMA_DROPBOX]
-        xmlCollectionOut = open(xmlCollectionFile, 'w')
-        xmlCollectionOut.write('<?xml version="1.0" encoding="UTF-8"?>\n')
-        xmlCollectionOut.write(f'{xmlStartCollection}\n')
+            school = record_context.school_alma_dropbox
 
         # Check to see if this was already processed by looking in Mongo
         # Do not re-run a processed batch unless forced #- test
         if (not integration_test):
             if ((not force) and self.__record_already_processed()):
-                notifyJM.log('fail', f'Holding record {self.pqid} has already been created. Use force flag to re-run.', True)
+                self.notifyJM.log('fail', f'Holding record {self.pqid} has already been created. Use force flag to re-run.', True)
                 current_span.set_status(Status(StatusCode.ERROR))
                 current_span.add_event(f'Holding record {self.pqid} has already been created. Use force flag to re-run.')
                 return False
 		# Let the Job Monitor know that the job has started
-        notifyJM.log('pass', f'Holding record creation for {self.pqid} for school {school} is beginning', verbose)
+        self.notifyJM.log('pass', f'Holding record creation for {self.pqid} for school {school} is beginning', verbose)
 
-        batch = mongo_record_for_pqid[mongo_util.FIELD_DIRECTORY_ID].strip()
+        batch = record_context.directory_id
 		
         # Check for mets file and mapfile
         metsFile = f'{dataDir}/in/{batch}/mets.xml'
         if not os.path.exists(metsFile):
-            notifyJM.log('fail', f"{metsFile} not found for {batch}", True)
+            self.notifyJM.log('fail', f"{metsFile} not found for {batch}", True)
             current_span.set_status(Status(StatusCode.ERROR))
             current_span.add_event(f'{metsFile} not found')
             current_span.add_event(f'skippping batch {batch} for school {school}')
@@ -208,192 +446,112 @@ class DRSHoldingByDropbox():
             marcXmlValues['proquestId'] = self.pqid
         if self.object_urn:
             marcXmlValues['object_urn'] = self.object_urn
-	
+
+        marcXmlRecord = False
         if marcXmlValues:
 	
             # Write marc xml record in batch directory
-            marcXmlRecord = False
             try:
                 batchOutDir = f'{dataDir}/out/{batch}'
                 marcXmlRecord = self.writeMarcXml(batch, batchOutDir, marcXmlValues, verbose)
-                self.logger.debug(f'Wrote DRS Holding MARCXML record for {batch} for {school}')
+                self.logger.debug('Wrote DRS Holding MARCXML record for %s for %s', batch, school)
                 current_span.add_event(f'Wrote DRS Holding MARCXML record for {batch} for {school}')
             except Exception as err:
                 self.logger.error(f"Writing DRS Holding MARCXML record for {batch} for {school} failed, skipping", exc_info=True)
-                notifyJM.log('fail', f"Writing DRS Holding MARCXML record for {batch} for {school} failed, skipping", True)
+                self.notifyJM.log('fail', f"Writing DRS Holding MARCXML record for {batch} for {school} failed, skipping", True)
                 current_span.set_status(Status(StatusCode.ERROR))
                 current_span.add_event(f'Writing DRS Holding MARCXML record for {batch} for {school} failed, skipping')
                 return False
 
-            # And then write xml record to collection file and update mongo
-            if marcXmlRecord:
-                xmlCollectionOut.write(marcXmlRecord)
-                self.logger.debug(f'MARCXML record for {batch} for {school} added to collection file')
-                current_span.add_event(f'MARCXML record for {batch} for {school} added to collection file')
-                wroteXmlRecords = True
-		
-        drsHoldingSent = False			
-        # If marcxml file was written successfully, finish xml records 
-	    # collection file and then send it to dropbox for Alma to load
-        if wroteXmlRecords:
-
-            xmlCollectionOut.write(f'{xmlEndCollection}\n')
-            xmlCollectionOut.close()
-
-            xfer = xfer_files(dropboxServer, dropboxUser, privateKey)
-	
-            if xfer.error:
-                notifyJM.log('fail', xfer.error, True)
-                self.logger.error(xfer.error)
-                current_span.set_status(Status(StatusCode.ERROR))
-                current_span.add_event(xfer.error)
-            else:
-                targetFile = '/incoming/' + os.path.basename(xmlCollectionFile)
-                xfer.put_file(xmlCollectionFile, targetFile)
-
-                if xfer.error:
-                    notifyJM.log('fail', xfer.error, True)
-                    current_span.set_status(Status(StatusCode.ERROR))
-                    current_span.add_event(xfer.error)
-                    self.logger.error(xfer.error)
-                else:
-                    notifyJM.log('pass', f'{xmlCollectionFile} was sent to {dropboxUser}@{dropboxServer}:{targetFile}', verbose)
-                    current_span.set_attribute("uploaded_identifier", self.pqid)
-                    current_span.set_attribute("uploaded_file", targetFile)
-                    current_span.add_event(f'{xmlCollectionFile} was sent to {dropboxUser}@{dropboxServer}:{targetFile}')
-                    self.logger.debug("uploaded proquest id: " + str(self.pqid))
-                    self.logger.debug("uploaded file: " + str(targetFile))
-                    current_span.add_event(f'{self.pqid} DRS holding was sent to Alma')
-                    self.logger.debug(f'{self.pqid} DRS holding was sent to Alma')
-                    notifyJM.log('pass', f'{self.pqid} DRS holding was sent to Alma', verbose)
-                    notifyJM.report('complete')
-                    current_span.add_event("completed")	
-                    drsHoldingSent = True
-                    # Update mongo
-                    self.logger.debug(f'Updating mongo...')
-                    if not self.unittesting:
-                        try:
-                            query = {mongo_util.FIELD_PQ_ID: self.pqid,
-                                     mongo_util.FIELD_DIRECTORY_ID: batch}
-                            self.mongoutil.update_status(
-                                query, mongo_util.DRS_HOLDING_DROPBOX_STATUS)
-                            current_span.add_event(f'Status for Proquest id {self.pqid} in {batch} for school {school} updated in mongo')
-                        except Exception as e:
-                            self.logger.error(f"Error updating status for {self.pqid}: {e}")
-                            current_span.set_status(Status(StatusCode.ERROR))
-                            current_span.add_event(f'Could not update proquest id {self.pqid} in {batch} for school {school} in mongo')
-                            current_span.record_exception(e)
-                            self.mongoutil.close_connection()
-                            xfer.close()
-                            return False
-                    os.remove(xmlCollectionFile)
-
-            xfer.close()     
-        else:
-            xmlCollectionOut.close()
-            os.remove(xmlCollectionFile)
-            notifyJM.log('pass', 'No DRS Holding to send to Alma', verbose)
+        if not marcXmlRecord:
+            self.notifyJM.log('pass', 'No DRS Holding to send to Alma', verbose)
             current_span.add_event("No DRS Holding to send to Alma")
             self.logger.debug("No DRS Holding to send to Alma")
+            return False
+
+        collectionKey = (school, collectionPrefix)
+        collectionEntry = {'pqid': self.pqid,
+                           'batch': batch,
+                           'school': school,
+                           'marcXmlRecord': marcXmlRecord,
+                           'collection': self.test_collection,
+                           'mongoutil': None if self.unittesting else self.mongoutil}
+
+        # In batch mode the record joins the shared collection for its
+        # school, mongo is updated once the collection has been uploaded.
+        # It is in the pending journal when add returns, so it is replayed
+        # if this worker dies before the collection is sent.
+        if DROPBOX_BATCH_MODE == 'on':
+            if not dropbox_batcher.add(collectionKey, collectionEntry):
+                self.notifyJM.log('pass', f'{self.pqid} DRS holding is already in the {school} collection', verbose)
+                return True
+            self.notifyJM.log('pass', f'{self.pqid} DRS holding was added to the {school} collection', verbose)
+            current_span.add_event(f'MARCXML record for {batch} for {school} added to collection for {collectionPrefix}')
+            self.logger.debug('MARCXML record for %s for %s added to collection for %s', batch, school, collectionPrefix)
+            return True
+
+        # Otherwise send a collection holding just this record to dropbox
+        drsHoldingSent = send_collection(collectionKey, [collectionEntry], self.notifyJM, verbose)
+        if drsHoldingSent:
+            self.notifyJM.report('complete')
+            current_span.add_event("completed")
+        elif not collectionEntry.get('uploaded'):
+            # Not in the dropbox yet, worth trying again later. A record
+            # that was uploaded is not retried, it would be sent twice.
+            self.retryable = True
 
-        
-	
         # Returns True if the DRS Holding was sent, False otherwise
         return drsHoldingSent
 	
-    @tracer.start_as_current_span("send_holding_to_alma_worker")
     def __record_already_processed(self): # pragma: no cover, not using for unit tests
         current_span = trace.get_current_span()
         current_span.add_event("verifying if DRS holding exists")
-        query = {mongo_util.FIELD_SUBMISSION_STATUS:
-                 mongo_util.DRS_HOLDING_DROPBOX_STATUS,
-				 mongo_util.FIELD_PQ_ID: self.pqid}
-        fields = {mongo_util.FIELD_PQ_ID: 1,
-                  mongo_util.FIELD_SCHOOL_ALMA_DROPBOX: 1,
-                  mongo_util.FIELD_SUBMISSION_STATUS: 1,
-                  mongo_util.FIELD_DIRECTORY_ID: 1}
-        self.logger.info("Starting poll for alma DRS holding")
-        matching_records = []
+        record_context = self.__get_record_context()
+        return record_context.already_processed(
+            mongo_util.DRS_HOLDING_DROPBOX_STATUS)
+
+    def __get_record_context(self): # pragma: no cover, not using for unit tests
+        # Loaded once per task, unless the task passed one in
+        if self.record_context is None:
+            self.record_context = load_record_context(
+                self.mongoutil, self.pqid, self.object_urn)
+        return self.record_context
 
-        try:
-            matching_records = self.mongoutil.query_records(query, fields)
-            self.logger.info(f"Found {len(matching_records)} \
-                             matching records")
-            self.logger.debug(f"Matching records: {matching_records}")
-        except Exception as e:
-            self.logger.error(f"Error querying records: {e}")
-            current_span.set_status(Status(StatusCode.ERROR))
-            current_span.add_event("Unable to query mongo for DRS holdings")
-            current_span.record_exception(e)
-            raise e
-        record_list = list(matching_records)
-        return len(record_list) > 0
-	
-    @tracer.start_as_current_span("send_holding_to_alma_worker")
     def ___get_record_from_mongo(self): # pragma: no cover, not using for unit tests
         current_span = trace.get_current_span()
-        current_span.add_event("getting data from mongo exists")
-        query = {mongo_util.FIELD_SUBMISSION_STATUS:
-                 mongo_util.ALMA_STATUS,
-				 mongo_util.FIELD_PQ_ID: self.pqid}
-        fields = {mongo_util.FIELD_PQ_ID: 1,
-                  mongo_util.FIELD_SCHOOL_ALMA_DROPBOX: 1,
-                  mongo_util.FIELD_SUBMISSION_STATUS: 1,
-                  mongo_util.FIELD_DIRECTORY_ID: 1}
-        self.logger.info("getting data from mongo exists")
-        matching_records = []
-
-        try:
-            matching_records = self.mongoutil.query_records(query, fields)
-            self.logger.info(f"Found {len(matching_records)} \
-                             matching records")
-            self.logger.debug(f"Matching records: {matching_records}")
-        except Exception as e:
-            self.logger.error(f"Error querying records: {e}")
-            current_span.set_status(Status(StatusCode.ERROR))
-            current_span.add_event("Unable to query mongo for DRS holdings")
-            current_span.record_exception(e)
-            raise e
-        record_list = list(matching_records)
-        if len(record_list) > 1:
-            self.logger.warn(f"Found {len(record_list)} for {self.pqid}")
-        if (len(record_list) == 0):
+        record_context = self.__get_record_context()
+        if not record_context.found:
             self.logger.error(f"Unable to find record for {self.pqid}")
             current_span.set_status(Status(StatusCode.ERROR))
             current_span.add_event("Unable to find record in mongo")
             raise Exception(f"Unable to find record for {self.pqid}")
-        return record_list[0]
+        return record_context
     
 
 	# Get data from mets file that's needed to write marc xml.
 	# The marcXmlValues dictionary is populated and returned.
     def getFromMets(self, metsFile, school):  # pragma: no cover
-        global notifyJM, jobCode
-        if notifyJM == False:
-            notifyJM = notify('monitor', jobCode, None)
+        if self.notifyJM is None:
+            self.notifyJM = get_notifier(jobCode)
         foundAll = True
         marcXmlValues = {}
 		
         marcXmlValues['school'] = school
 
-		# Load mets file, get the root node and then parse
-        self.__cleanMetsFile(metsFile)
-        metsTree   = etree.parse(metsFile)
-        rootMets   = metsTree.getroot()
-        rootDmdSec = rootMets.find(f'{metsDmdSecNamespace}dmdSec')
-        for dimField in rootDmdSec.iter(f'{metsDimNamespace}field'):
+		# Stream the fields of the first dmdSec, without control characters
+        for dimAttrib, dimText in mets_xml.read_dim_fields(metsFile):
 		
 			# Dc mdschema
-            if dimField.attrib['mdschema'] == 'dc':
+            if dimAttrib.get('mdschema') == 'dc':
 
 				# Date created
-                if dimField.attrib['element'] == 'date':
-                    if dimField.attrib['qualifier'] == 'created':
-                        marcXmlValues['dateCreated'] = dimField.text
+                if dimAttrib.get('element') == 'date':
+                    if dimAttrib.get('qualifier') == 'created':
+                        marcXmlValues['dateCreated'] = dimText
 		
 				# Title and title indicator 2
-                elif dimField.attrib['element'] == 'title':
-                    marcXmlValues['title'] = dimField.text
+                elif dimAttrib.get('element') == 'title':
+                    marcXmlValues['title'] = dimText
 					
                     if reTheTitle.match(marcXmlValues['title']):
                         marcXmlValues['titleIndicator2'] = '4'
@@ -407,7 +565,7 @@ class DRSHoldingByDropbox():
 		# Check that we found our needed values
         for var in ('dateCreated', 'title', 'school'):
             if var not in marcXmlValues:
-                notifyJM.log('fail', f'Failed to find {var} in {metsFile}', True)
+                self.notifyJM.log('fail', f'Failed to find {var} in {metsFile}', True)
                 foundAll = False
 				
         if foundAll:
@@ -417,74 +575,26 @@ class DRSHoldingByDropbox():
 
 	# Write marcxml using data passed in the marcXmlValues dictionary
     def writeMarcXml(self, batch, batchOutDir, marcXmlValues, verbose):  # pragma: no cover
-        global notifyJM, jobCode
-        if notifyJM == False:
-            notifyJM = notify('monitor', jobCode, None)
-        xmlRecordFile = f'{batchOutDir}/' + batch.replace('proquest', 'almadrsholding') + '.xml'
-
-		# Load template file and swapped in variables
-        marcXmlTree = etree.parse(almaMarcxmlTemplate)
-        rootRecord = marcXmlTree.getroot()
-        for child in rootRecord.iter('controlfield', 'subfield'):
-            # 008 controlfield
-            if child.tag == 'controlfield':
-                if child.attrib['tag'] == '008':
-                    childText = child.text.replace('YYMMDD', yymmdd)
-                    childText = childText.replace('DATE_CREATED_VALUE', marcXmlValues['dateCreated'])
-                    child.text = childText
-                    print(child.text)
-
-			# datafield/subfields
-            elif child.tag == 'subfield':
-                parent = child.getparent()
-                if parent.tag == 'datafield':
-					
-					# Datafield 035, Proquest ID
-                    if parent.attrib['tag'] == '035':
-                        if child.attrib['code'] == 'a':
-                            childText  = child.text.replace('PROQUEST_IDENTIFIER_VALUE', self.pqid)
-                            child.text = childText
-
-					# Datafield 245, title and title indicator 2
-                    elif parent.attrib['tag'] == '245':
-                        if child.attrib['code'] == 'a':
-                            childText  = child.text.replace('TITLE_VALUE', marcXmlValues['title'])
-                            child.text = childText
-                            parentInd2 = parent.attrib['ind2'].replace('TITLE_INDICATOR_2_VALUE', marcXmlValues['titleIndicator2'])
-                            parent.attrib['ind2'] = parentInd2
-
-					# Datafield 852
-                    elif parent.attrib['tag'] == '852':
-                        if child.attrib['code'] == 'z':
-                            childText  = child.text.replace('[DRS OBJECT URN]', self.object_urn)
-                            child.text = childText
-
-					# Datafield 909, proquest id
-                    elif parent.attrib['tag'] == '909':
-                        if child.attrib['code'] == 'k':
-                            childText  = child.text.replace('LIB_CODE_3_CHAR', schools[marcXmlValues['school']]['lib_code_3_char'].lower())
-                            child.text = childText
-		
-		# Write xml record out in batch directory
-        with open(xmlRecordFile, 'w') as xmlRecordOut:
-            xmlRecordOut.write('<?xml version="1.0" encoding="UTF-8"?>\n')
-            xmlRecordOut.write(f'{xmlStartCollection}\n')
-            marcXmlStr = etree.tostring(rootRecord, encoding='unicode')
-            xmlRecordOut.write(marcXmlStr)
-            xmlRecordOut.write(f'{xmlEndCollection}\n')
-			
-        notifyJM.log('pass', f'Wrote {xmlRecordFile}', verbose)
+        if self.notifyJM is None:
+            self.notifyJM = get_notifier(jobCode)
+		# Fill the compiled template, read once per process
+        marcXmlStr = marcxml_template.get_marcxml_template(
+            almaMarcxmlTemplate).render(
+                yymmdd=yymmdd,
+                date_created=marcXmlValues['dateCreated'],
+                proquest_id=self.pqid,
+                title=marcXmlValues['title'],
+                title_indicator_2=marcXmlValues['titleIndicator2'],
+                object_urn=self.object_urn,
+                lib_code=schools[marcXmlValues['school']]['lib_code_3_char'].lower())
+
+		# Keep a copy of the record in the batch directory if asked to,
+		# the dropbox collection is built from the returned string
+        if MARCXML_BATCH_COPY == 'on':
+            xmlRecordFile = f'{batchOutDir}/' + batch.replace('proquest', 'almadrsholding') + '.xml'
+            with open(xmlRecordFile, 'wb') as xmlRecordOut:
+                collection_writer.write_collection(xmlRecordOut, [marcXmlStr])
+            self.notifyJM.log('pass', f'Wrote {xmlRecordFile}', verbose)
 		
 		# And then return it to be collected with other processed records
         return marcXmlStr
-
-    def __cleanMetsFile(self, metsFile):
-        with open(metsFile, 'r') as metsFileIn:
-            metsFileContents = metsFileIn.readlines()
-
-		# Remove control characters
-        r = re.compile('[\u0000-\u0008\u000c\u000e-\u001f]')
-        with open(metsFile, 'w') as metsFileOut:
-            for line in metsFileContents:
-                line = r.sub('', line)			
-                metsFileOut.write(line)
@@ -0,0 +1,228 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+from etd.alma_client import AlmaClient
+
+"""
+In-process stand-in for the Alma SRU and bib holdings APIs, used to test
+and benchmark the holding pipelines offline. It serves the calls the
+pipelines make: SRU search by proquest id, holdings list, holding GET
+and holding PUT, with an optional per-request latency.
+"""
+
+SRU_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<searchRetrieveResponse xmlns="http://www.loc.gov/zing/srw/">
+<version>1.2</version>
+<numberOfRecords>{count}</numberOfRecords>
+<records>{records}</records>{next_position}
+</searchRetrieveResponse>"""
+
+SRU_RECORD_TEMPLATE = """<record>
+<recordSchema>marcxml</recordSchema>
+<recordPacking>xml</recordPacking>
+<recordData><record xmlns="http://www.loc.gov/MARC21/slim">
+<datafield ind1=" " ind2=" " tag="035">
+<subfield code="a">(ProQuestETD){pqid}</subfield>
+</datafield>
+</record></recordData>
+<recordIdentifier>{mms_id}</recordIdentifier>
+<recordPosition>{position}</recordPosition>
+</record>"""
+
+HOLDINGS_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<holdings total_record_count="{count}">{holdings}</holdings>"""
+
+HOLDINGS_ENTRY_TEMPLATE = """<holding>
+<holding_id>{holding_id}</holding_id>
+<library desc="{library}">{library}</library>
+<location desc="{location}">{location}</location>
+</holding>"""
+
+HOLDING_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<holding>
+<holding_id>{holding_id}</holding_id>
+<record>
+<leader>00367nx a22001331n 4500</leader>
+<controlfield tag="001">{holding_id}</controlfield>
+<datafield ind1=" " ind2=" " tag="035">
+<subfield code="a">(ProQuestETD){pqid}</subfield>
+</datafield>
+<datafield ind1="8" ind2=" " tag="852">
+<subfield code="b">NET</subfield>
+<subfield code="c">ETD</subfield>
+<subfield code="z">Deposit in process</subfield>
+</datafield>
+</record>
+</holding>"""
+
+
+class FakeAlma():
+
+    def __init__(self, latency=0.0, api_key="fake-api-key"):
+        """
+        Args:
+            latency (float): Seconds to wait before answering each request.
+            api_key (str): Key the holdings API calls must send.
+        """
+        self.latency = latency
+        self.api_key = api_key
+        self.mms_ids = {}
+        self.holdings = {}
+        self.holding_records = {}
+        self.requests = []
+        self.lock = threading.Lock()
+        self.server = None
+        self.thread = None
+
+    def add_record(self, pqid, mms_id, holding_id, library="HLS",
+                   location="NET", holding_xml=None):
+        """
+        Adds a bib for pqid with one holding.
+        """
+        self.mms_ids[pqid] = mms_id
+        self.holdings.setdefault(mms_id, []).append(
+            (holding_id, library, location))
+        if holding_xml is None:
+            holding_xml = HOLDING_TEMPLATE.format(holding_id=holding_id,
+                                                  pqid=pqid).encode('utf-8')
+        self.holding_records[(mms_id, holding_id)] = holding_xml
+
+    def start(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0),
+                                          self.__handler_class())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       kwargs={'poll_interval': 0.05},
+                                       daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    @property
+    def url(self):
+        host, port = self.server.server_address
+        return f'http://{host}:{port}'
+
+    @property
+    def sru_base(self):
+        return f'{self.url}/view/sru?version=1.2&operation=searchRetrieve' \
+               f'&recordSchema=marcxml&query=alma.local_field_035='
+
+    def client(self, pool_size=10):
+        """
+        Returns an AlmaClient pointed at this server.
+        """
+        return AlmaClient(api_base=self.url, api_key=self.api_key,
+                          sru_base=self.sru_base, pool_size=pool_size)
+
+    def request_count(self, method=None):
+        with self.lock:
+            return len([r for r in self.requests
+                        if method is None or r[0] == method])
+
+    def sru_response(self, pqids, start_record=1, maximum_records=10):
+        matches = [pqid for pqid in pqids if pqid in self.mms_ids]
+        page = matches[start_record - 1:start_record - 1 + maximum_records]
+        records = [SRU_RECORD_TEMPLATE.format(pqid=pqid,
+                                              mms_id=self.mms_ids[pqid],
+                                              position=start_record + i)
+                   for i, pqid in enumerate(page)]
+        next_position = ''
+        if start_record - 1 + len(page) < len(matches):
+            next_position = '\n<nextRecordPosition>{}</nextRecordPosition>' \
+                .format(start_record + len(page))
+        return SRU_TEMPLATE.format(count=len(matches),
+                                   records=''.join(records),
+                                   next_position=next_position)
+
+    def holdings_response(self, mms_id):
+        entries = [HOLDINGS_ENTRY_TEMPLATE.format(holding_id=holding_id,
+                                                  library=library,
+                                                  location=location)
+                   for holding_id, library, location
+                   in self.holdings.get(mms_id, [])]
+        return HOLDINGS_TEMPLATE.format(count=len(entries),
+                                        holdings=''.join(entries))
+
+    def handle(self, method, path, query, headers, body):
+        """
+        Returns (status, body) for a request.
+        """
+        with self.lock:
+            self.requests.append((method, path))
+        if self.latency:
+            time.sleep(self.latency)
+
+        if path.endswith('/sru'):
+            # one or more ORed index=pqid clauses
+            cql = query.get('query', [''])[0]
+            pqids = [clause.split('=')[-1].strip()
+                     for clause in cql.split(' or ')]
+            start_record = int(query.get('startRecord', ['1'])[0])
+            maximum_records = int(query.get('maximumRecords', ['10'])[0])
+            return 200, self.sru_response(pqids, start_record,
+                                          maximum_records).encode('utf-8')
+
+        if headers.get('Authorization') != f'apikey {self.api_key}':
+            return 401, b'<web_service_result>Unauthorized' \
+                        b'</web_service_result>'
+        parts = path.strip('/').split('/')
+        # almaws/v1/bibs/{mms_id}/holdings[/{holding_id}]
+        if parts[:3] != ['almaws', 'v1', 'bibs'] or len(parts) < 5:
+            return 404, b'<web_service_result>Not found</web_service_result>'
+        mms_id = parts[3]
+        if len(parts) == 5:
+            if mms_id not in self.holdings:
+                return 400, b'<web_service_result>Bib not found' \
+                            b'</web_service_result>'
+            return 200, self.holdings_response(mms_id).encode('utf-8')
+        key = (mms_id, parts[5])
+        if key not in self.holding_records:
+            return 400, b'<web_service_result>Holding not found' \
+                        b'</web_service_result>'
+        if method == 'PUT':
+            self.holding_records[key] = body
+        return 200, self.holding_records[key]
+
+    def __handler_class(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                self.__respond('GET')
+
+            def do_PUT(self):
+                self.__respond('PUT')
+
+            def log_message(self, format, *args):
+                pass
+
+            def __respond(self, method):
+                url = urlsplit(self.path)
+                length = int(self.headers.get('Content-Length', 0))
+                body = self.rfile.read(length) if length else b''
+                status, content = fake.handle(method, url.path,
+                                              parse_qs(url.query),
+                                              self.headers, body)
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/xml')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+        return Handler
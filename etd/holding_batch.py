@@ -0,0 +1,343 @@
+import os
+import json
+import logging
+from collections import Counter
+from opentelemetry import trace
+from opentelemetry.trace import Status
+from opentelemetry.trace import StatusCode
+from etd.dropbox_batcher import DropboxBatcher
+from etd.record_context import load_record_contexts
+from etd.task_retry import RetryableError
+import etd.task_retry as task_retry
+import etd.telemetry as telemetry
+
+"""
+Batches of add_holdings messages, run by the add_holdings_batch task so
+the per task setup (span, feature flag, mongo query, notifier) is paid
+once per batch instead of once per record. Producers can send their
+messages in chunks with send_batches(), or send them one at a time to
+the aggregate_holdings task, whose HoldingsAggregator gathers them into
+batches by size and time window. The aggregate_holdings task is acked
+once its message is gathered, so the aggregator keeps each message in
+HOLDINGS_PENDING_DIR until its batch is sent, and the messages left
+there by a worker that stopped are replayed.
+"""
+
+ADD_HOLDINGS_BATCH_TASK = \
+    'etd-alma-drs-holding-service.tasks.add_holdings_batch'
+HOLDINGS_BATCH_SIZE = int(os.getenv('HOLDINGS_BATCH_SIZE', 50))
+HOLDINGS_BATCH_WINDOW_SECS = float(os.getenv('HOLDINGS_BATCH_WINDOW_SECS',
+                                             5))
+HOLDINGS_PENDING_DIR = os.getenv(
+    'HOLDINGS_PENDING_DIR',
+    os.path.join(os.getenv('DATA_DIR') or
+                 os.getenv('LOGFILE_PATH', '/home/etdadm/logs/etd'),
+                 'holdings', 'pending'))
+# a pending message untouched this long was left by a worker that stopped
+HOLDINGS_PENDING_STALE_SECS = float(os.getenv(
+    'HOLDINGS_PENDING_STALE_SECS', max(60, 5 * HOLDINGS_BATCH_WINDOW_SECS)))
+
+# Per record outcomes of add_holdings_batch
+SENT = "sent"
+FAILED = "failed"
+NOT_FOUND = "not_found"
+INVALID = "invalid"
+RETRY_SCHEDULED = "retry_scheduled"
+RETRY_EXHAUSTED = "retry_exhausted"
+SKIPPED = "skipped"
+
+logger = logging.getLogger('etd_alma_drs_holding')
+tracer = telemetry.get_tracer(__name__)
+
+
+def invalid_reason(message):
+    """
+    Returns why a message cannot be run, or None if it can.
+    """
+    if not isinstance(message, dict):
+        return "Message is not an object"
+    if 'pqid' not in message:
+        return "Proquest ID is missing"
+    if 'object_urn' not in message:
+        return "Object URN is missing"
+    return None
+
+
+def record_outcome(message, outcome, detail=None):
+    """
+    Returns the outcome entry of a record for the batch result.
+    """
+    entry = {'pqid': message.get('pqid') if isinstance(message, dict)
+             else None,
+             'outcome': outcome}
+    if detail:
+        entry['detail'] = detail
+    return entry
+
+
+def outcome_counts(outcomes):
+    return Counter(entry['outcome'] for entry in outcomes)
+
+
+def send_record(send_holding, json_message, record_context,
+                schedule_retry):
+    """
+    Sends the holding of one record of a batch and returns its outcome,
+    recorded on the current span.
+
+    Args:
+        send_holding (callable): Called with the message and its record
+            context, returns True if the holding was sent and raises
+            RetryableError if it failed for a reason that may pass.
+        json_message (dict): The record's add_holdings message.
+        record_context (RecordContext): The record's context, None if it
+            was not loaded.
+        schedule_retry (callable): Called with the message and the
+            RetryableError, returns RETRY_SCHEDULED or RETRY_EXHAUSTED.
+
+    Returns:
+        str: The record's outcome.
+    """
+    current_span = trace.get_current_span()
+    pqid = json_message['pqid']
+    if record_context is None or not record_context.found:
+        logger.error(f"Unable to find record for {pqid}")
+        current_span.set_status(Status(StatusCode.ERROR))
+        current_span.add_event("Unable to find record in mongo")
+        return NOT_FOUND
+    current_span.set_attribute("in_dash", bool(record_context.in_dash))
+    try:
+        sent = send_holding(json_message, record_context)
+    except RetryableError as e:
+        return schedule_retry(json_message, e)
+    except Exception as e:
+        logger.error(f"Error sending DRS holding for {pqid}: {e}",
+                     exc_info=True)
+        current_span.set_status(Status(StatusCode.ERROR))
+        current_span.record_exception(e)
+        return FAILED
+    if not sent:
+        return FAILED
+    if task_retry.retry_state(json_message):
+        task_retry.record_outcome("recovered")
+        current_span.set_attribute("retry_outcome", "recovered")
+    return SENT
+
+
+def group_by_dash(entries, contexts):
+    """
+    Splits (index, message) entries by how their holdings are sent.
+
+    Args:
+        entries (list): (index, message) pairs.
+        contexts (dict): The record contexts by proquest id.
+
+    Returns:
+        dict: 'dash' (dropbox), 'api' and 'not_found' lists of entries,
+            in their original order.
+    """
+    groups = {'dash': [], 'api': [], 'not_found': []}
+    for index, message in entries:
+        context = contexts.get(message['pqid'])
+        if context is None or not context.found:
+            groups['not_found'].append((index, message))
+        elif context.in_dash:
+            groups['dash'].append((index, message))
+        else:
+            groups['api'].append((index, message))
+    return groups
+
+
+def send_holdings(json_messages, send_holding, schedule_retry,
+                  get_mongoutil, resolver):
+    """
+    Sends the holdings of a batch of messages, sharing the mongo query
+    and the mms id lookups across the batch. The mms ids of the records
+    sent by API are resolved with bulk SRU searches and handed to each
+    record, so none of them searches for its own.
+
+    Args:
+        send_holding (callable): Called as send_holding(message,
+            record_context, test_coll, mms_id), returns True if the
+            holding was sent and raises RetryableError if it failed for
+            a reason that may pass. mms_id is None for DASH records and
+            for records whose id was not resolved.
+        schedule_retry (callable): Called with the message and the
+            RetryableError, returns RETRY_SCHEDULED or RETRY_EXHAUSTED.
+        get_mongoutil (callable): Returns the MongoUtil for a test
+            collection name, or for the records collection given None.
+        resolver (SRUBatchResolver): Resolves the mms ids.
+
+    Returns:
+        list: {'pqid', 'outcome'} of each message, in order.
+    """
+    outcomes = [None] * len(json_messages)
+    # Integration test messages read the test collection
+    runs = {False: [], True: []}
+    for index, message in enumerate(json_messages):
+        reason = invalid_reason(message)
+        if reason:
+            logger.error(f"{reason}, cannot create DRS holding record "
+                         f"in Alma for {message}")
+            outcomes[index] = record_outcome(message, INVALID, reason)
+        else:
+            runs["integration_test" in message].append((index, message))
+
+    for integration_test, entries in runs.items():
+        if not entries:
+            continue
+        test_coll = None
+        if integration_test:
+            test_coll = os.getenv("MONGO_TEST_COLLECTION")
+        try:
+            contexts = load_record_contexts(
+                get_mongoutil(test_coll),
+                [message for index, message in entries])
+        except Exception as e:
+            logger.error(f"Error querying records: {e}", exc_info=True)
+            trace.get_current_span().record_exception(e)
+            for index, message in entries:
+                outcomes[index] = record_outcome(message, FAILED,
+                                                 "Unable to query mongo")
+            continue
+        groups = group_by_dash(entries, contexts)
+        mms_ids = {}
+        if groups['api']:
+            try:
+                mms_ids, _ = resolver.resolve(
+                    [message['pqid'] for index, message in groups['api']])
+            except Exception as e:
+                # Each record looks its mms id up itself
+                logger.warning(f"Bulk mms id lookup failed: {e}")
+        for group in ('dash', 'api', 'not_found'):
+            for index, message in groups[group]:
+                outcomes[index] = send_batch_record(
+                    send_holding, message, contexts.get(message['pqid']),
+                    test_coll, mms_ids.get(str(message['pqid'])),
+                    schedule_retry)
+    return outcomes
+
+
+def send_batch_record(send_holding, json_message, record_context,
+                      test_coll, mms_id, schedule_retry):
+    """
+    Sends the holding of one record of a batch in its own child span.
+
+    Returns:
+        dict: The record's {'pqid', 'outcome'}.
+    """
+    with tracer.start_as_current_span("ALMA DRS HOLDINGS - add_holding") \
+            as current_span:
+        current_span.set_attribute("identifier", json_message['pqid'])
+        outcome = send_record(
+            lambda message, context: send_holding(message, context,
+                                                  test_coll, mms_id),
+            json_message, record_context, schedule_retry)
+        current_span.set_attribute("outcome", outcome)
+        return record_outcome(json_message, outcome)
+
+
+def chunked(messages, size):
+    chunk = []
+    for message in messages:
+        chunk.append(message)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def send_batches(send_task, messages, batch_size=HOLDINGS_BATCH_SIZE,
+                 queue=None):
+    """
+    Sends messages as add_holdings_batch tasks of at most batch_size.
+
+    Args:
+        send_task (callable): The Celery app's send_task.
+        messages (iterable): add_holdings messages.
+        batch_size (int): The largest batch.
+        queue (str): The queue to send the batches to.
+
+    Returns:
+        int: The number of batches sent.
+    """
+    batches = 0
+    for chunk in chunked(messages, batch_size):
+        send_task(ADD_HOLDINGS_BATCH_TASK, args=[chunk], kwargs={},
+                  queue=queue)
+        batches += 1
+    return batches
+
+
+class HoldingsAggregator(DropboxBatcher):
+    """
+    Gathers single add_holdings messages, per queue, and sends them as
+    an add_holdings_batch task once HOLDINGS_BATCH_SIZE have gathered or
+    HOLDINGS_BATCH_WINDOW_SECS after the first arrived.
+    """
+
+    label = "holdings batch"
+    logger = logging.getLogger('etd_alma_drs_holding')
+
+    def __init__(self, send_task, max_records=HOLDINGS_BATCH_SIZE,
+                 window_secs=HOLDINGS_BATCH_WINDOW_SECS, journal=None):
+        """
+        Args:
+            send_task (callable): The Celery app's send_task.
+            max_records (int): Send a batch once it holds this many
+                messages.
+            window_secs (float): Send a batch this many seconds after its
+                first message arrived. 0 disables the time window.
+            journal (PendingJournal): Where pending messages are kept on
+                disk, None to keep them in memory only.
+        """
+        super().__init__(self.__send, max_records, window_secs,
+                         journal=journal)
+        self.send_task = send_task
+
+    def entry_id(self, message):
+        """
+        Identifies a message by its content, so only a redelivered copy
+        is dropped.
+        """
+        return json.dumps(message, sort_keys=True)
+
+    def add(self, message, queue=None):
+        super().add(queue, message)
+
+    def replay(self, stale_secs=HOLDINGS_PENDING_STALE_SECS):
+        """
+        Sends the messages a worker that stopped left in the journal, in
+        batches per queue. A batch that cannot be sent stays claimed and
+        is taken again once its claim is stale.
+
+        Returns:
+            int: The number of messages sent.
+        """
+        if self.journal is None:
+            return 0
+        queues = {}
+        for claim, queue, message in self.journal.claim(stale_secs):
+            queues.setdefault(queue, []).append((claim, message))
+        sent = 0
+        for queue, entries in queues.items():
+            for chunk in chunked(entries, self.max_records):
+                try:
+                    self.__send(queue, [message for claim, message in chunk])
+                except Exception as e:
+                    self.logger.error(f"Unable to replay a {self.label} "
+                                      f"for {queue}: {e}")
+                    continue
+                for claim, message in chunk:
+                    self.journal.done(claim)
+                sent += len(chunk)
+        return sent
+
+    def __send(self, queue, messages):
+        # One task per flush, a failed send has sent none of the messages
+        self.send_task(ADD_HOLDINGS_BATCH_TASK, args=[messages], kwargs={},
+                       queue=queue)
+        self.logger.debug("Sent a holdings batch of %d messages to %s",
+                          len(messages), queue)
+        return True
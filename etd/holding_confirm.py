@@ -0,0 +1,178 @@
+import os
+import abc
+import time
+import random
+import logging
+import threading
+import etd.holding_xml as holding_xml
+
+"""
+Strategies for confirming a DRS holding update in Alma after the PUT.
+
+- put_response: check 852$z in the PUT response, which Alma returns as
+  the updated holding. No extra API call.
+- full: read the holding back with a GET and check it.
+- sampled: full for ALMA_CONFIRM_SAMPLE_RATE of the records,
+  put_response for the rest.
+- deferred: put_response now, and the full read-back is queued on the
+  verification queue to run later.
+
+A PUT response that can not be read as a holding falls back to a full
+read-back. Each strategy keeps the latency it adds to a record.
+"""
+
+# put_response, full, sampled or deferred
+ALMA_CONFIRM_MODE = os.getenv('ALMA_CONFIRM_MODE', 'full')
+ALMA_CONFIRM_SAMPLE_RATE = float(os.getenv('ALMA_CONFIRM_SAMPLE_RATE', 0.1))
+ALMA_VERIFY_QUEUE_NAME = os.getenv('ALMA_VERIFY_QUEUE_NAME',
+                                   'etd_alma_drs_holding_verify')
+VERIFY_HOLDING_TASK = 'etd-alma-drs-holding-service.tasks.verify_holding'
+
+
+class ConfirmStrategy(abc.ABC):
+    """
+    Base strategy, keeps the count and latency of its confirms.
+    Subclasses decide how an update is confirmed in _confirm.
+    """
+
+    logger = logging.getLogger('etd_alma_drs_holding')
+    mode = None
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.confirms = 0
+        self.read_backs = 0
+        self.latency_secs_total = 0.0
+        self.latency_secs_max = 0.0
+
+    def confirm(self, urn, put_response, read_back, record=None):
+        """
+        Args:
+            urn (str): The urn the holding should now carry.
+            put_response (bytes): Body of the successful PUT.
+            read_back (callable): Reads the holding back from Alma and
+                returns True if it carries the urn.
+            record (dict): pqid, mms_id, holding_id and object_urn, for
+                a deferred read-back.
+
+        Returns:
+            tuple: (True if confirmed, seconds the confirm took)
+        """
+        start = time.monotonic()
+        confirmed = self._confirm(urn, put_response, read_back, record)
+        latency = time.monotonic() - start
+        with self.lock:
+            self.confirms += 1
+            self.latency_secs_total += latency
+            self.latency_secs_max = max(self.latency_secs_max, latency)
+        return confirmed, latency
+
+    def stats(self):
+        with self.lock:
+            return {'mode': self.mode,
+                    'confirms': self.confirms,
+                    'read_backs': self.read_backs,
+                    'latency_secs_total': self.latency_secs_total,
+                    'latency_secs_max': self.latency_secs_max,
+                    'latency_secs_avg': (self.latency_secs_total /
+                                         self.confirms
+                                         if self.confirms else 0.0)}
+
+    @abc.abstractmethod
+    def _confirm(self, urn, put_response, read_back, record):
+        """
+        Returns:
+            bool: True if the update is confirmed.
+        """
+
+    def _read_back(self, read_back):
+        with self.lock:
+            self.read_backs += 1
+        return read_back()
+
+    def _check_put_response(self, urn, put_response, read_back):
+        try:
+            statement = holding_xml.holding_urn_statement(put_response)
+        except Exception as e:
+            self.logger.warning(f"Unable to read the PUT response, reading "
+                                f"the holding back instead: {e}")
+            return self._read_back(read_back)
+        return statement == holding_xml.expected_urn_statement(urn)
+
+
+class PutResponseConfirm(ConfirmStrategy):
+    mode = 'put_response'
+
+    def _confirm(self, urn, put_response, read_back, record):
+        return self._check_put_response(urn, put_response, read_back)
+
+
+class FullConfirm(ConfirmStrategy):
+    mode = 'full'
+
+    def _confirm(self, urn, put_response, read_back, record):
+        return self._read_back(read_back)
+
+
+class SampledConfirm(ConfirmStrategy):
+    mode = 'sampled'
+
+    def __init__(self, rate=ALMA_CONFIRM_SAMPLE_RATE, sample=random.random):
+        super().__init__()
+        self.rate = rate
+        self.sample = sample
+
+    def _confirm(self, urn, put_response, read_back, record):
+        if self.sample() < self.rate:
+            return self._read_back(read_back)
+        return self._check_put_response(urn, put_response, read_back)
+
+
+class DeferredConfirm(ConfirmStrategy):
+    mode = 'deferred'
+
+    def __init__(self, enqueue=None):
+        """
+        Args:
+            enqueue (callable): Queues a record for a later read-back,
+                defaults to sending the verify_holding task.
+        """
+        super().__init__()
+        self.enqueue = enqueue or send_verify_task
+
+    def _confirm(self, urn, put_response, read_back, record):
+        if not self._check_put_response(urn, put_response, read_back):
+            return False
+        try:
+            self.enqueue(record)
+        except Exception as e:
+            self.logger.error(f"Unable to queue the holding read-back for "
+                              f"{record}: {e}")
+        return True
+
+
+def send_verify_task(record):  # pragma: no cover, needs a broker
+    from celery import current_app
+    current_app.send_task(VERIFY_HOLDING_TASK, args=[record],
+                          kwargs={}, queue=ALMA_VERIFY_QUEUE_NAME)
+
+
+STRATEGIES = {'put_response': PutResponseConfirm,
+              'full': FullConfirm,
+              'sampled': SampledConfirm,
+              'deferred': DeferredConfirm}
+
+_strategies = {}
+_strategies_lock = threading.Lock()
+
+
+def get_confirm_strategy(mode=None):
+    """
+    Returns this process's strategy for mode, ALMA_CONFIRM_MODE by
+    default, so its latency stats add up across records.
+    """
+    mode = mode or ALMA_CONFIRM_MODE
+    with _strategies_lock:
+        if mode not in _strategies:
+            _strategies[mode] = STRATEGIES[mode]()
+        return _strategies[mode]
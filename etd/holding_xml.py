@@ -0,0 +1,172 @@
+import re
+import math
+from io import BytesIO
+from lxml import etree
+
+"""
+Parsing and transform helpers for the Alma SRU, holdings list and
+holding record xml, shared by the sync and async holding pipelines.
+The XPath selectors are compiled once here, and the per-holding ones are
+relative, so a holdings list is read in one pass.
+"""
+
+SUBFIELD_Z_BASE = "Preservation master, "
+NAMESPACE_MAPPING = {'srw': 'http://www.loc.gov/zing/srw/',
+                     'marc': 'http://www.loc.gov/MARC21/slim',
+                     'mods': 'http://www.loc.gov/mods/v3'}
+MMSID_XPATH = "//srw:searchRetrieveResponse/srw:records/srw:record/" \
+              "srw:recordIdentifier"
+URN_XPATH = "//record/datafield[@tag='852']/subfield[@code='z']"
+SRU_RECORD_TAG = f"{{{NAMESPACE_MAPPING['srw']}}}record"
+SRU_RECORD_IDENTIFIER_TAG = \
+    f"{{{NAMESPACE_MAPPING['srw']}}}recordIdentifier"
+
+find_mms_ids = etree.XPath(MMSID_XPATH, namespaces=NAMESPACE_MAPPING)
+find_number_of_records = etree.XPath(
+    "number(/srw:searchRetrieveResponse/srw:numberOfRecords)",
+    namespaces=NAMESPACE_MAPPING)
+find_next_record_position = etree.XPath(
+    "number(/srw:searchRetrieveResponse/srw:nextRecordPosition)",
+    namespaces=NAMESPACE_MAPPING)
+find_sru_records = etree.XPath(
+    "/srw:searchRetrieveResponse/srw:records/srw:record",
+    namespaces=NAMESPACE_MAPPING)
+find_record_identifier = etree.XPath("string(srw:recordIdentifier)",
+                                     namespaces=NAMESPACE_MAPPING)
+find_035_a = etree.XPath(
+    "srw:recordData//marc:datafield[@tag='035']/marc:subfield[@code='a']",
+    namespaces=NAMESPACE_MAPPING)
+find_holdings = etree.XPath("//holding")
+find_library = etree.XPath("string(library)")
+find_location = etree.XPath("string(location)")
+find_holding_id = etree.XPath("string(holding_id)")
+find_urn_statements = etree.XPath(URN_XPATH)
+find_852_z = etree.XPath("//datafield[@tag='852']/subfield[@code='z']")
+
+
+def to_root(xml):
+    """
+    Returns the root element of xml given as bytes, a string, a tree or
+    an element.
+    """
+    if isinstance(xml, bytes):
+        return etree.fromstring(xml)
+    if isinstance(xml, str):
+        return etree.fromstring(xml.encode('utf-8'))
+    if isinstance(xml, etree._ElementTree):
+        return xml.getroot()
+    return xml
+
+
+def parse_mms_id(sru_xml):
+    """
+    Returns the mms id from an SRU searchRetrieve response, or None.
+    A response given as bytes or a string is parsed as a stream that
+    stops at the first recordIdentifier.
+    """
+    if isinstance(sru_xml, str):
+        sru_xml = sru_xml.encode('utf-8')
+    if isinstance(sru_xml, bytes):
+        for _, element in etree.iterparse(BytesIO(sru_xml),
+                                          tag=SRU_RECORD_IDENTIFIER_TAG):
+            if element.getparent().tag == SRU_RECORD_TAG:
+                return element.text
+        return None
+    identifiers = find_mms_ids(to_root(sru_xml))
+    if not identifiers:
+        return None
+    return identifiers[0].text
+
+
+def parse_sru_records(sru_xml):
+    """
+    Reads one page of an SRU searchRetrieve response.
+
+    Returns:
+        tuple: (numberOfRecords, list of (mms id, list of 035$a values),
+            nextRecordPosition or None)
+    """
+    root = to_root(sru_xml)
+    number_of_records = find_number_of_records(root)
+    next_position = find_next_record_position(root)
+    records = [(find_record_identifier(record),
+                [subfield.text or '' for subfield in find_035_a(record)])
+               for record in find_sru_records(root)]
+    return (0 if math.isnan(number_of_records) else int(number_of_records),
+            records,
+            None if math.isnan(next_position) else int(next_position))
+
+
+def proquest_id_from_035(value):
+    """
+    Returns the id in an 035$a value, without a (ProQuestETD) style
+    prefix.
+    """
+    return re.sub(r'^\(.*?\)', '', value).strip()
+
+
+def parse_drs_holding_id(holdings_xml):
+    """
+    Returns the id of the first holding whose library code is a 3-letter
+    code and whose location code is NET, or None.
+    """
+    for holding in find_holdings(to_root(holdings_xml)):
+        if len(find_library(holding)) == 3 and \
+                find_location(holding) == "NET":
+            return find_holding_id(holding)
+    return None
+
+
+def expected_urn_statement(urn):
+    return f'{SUBFIELD_Z_BASE}{urn}'
+
+
+def set_holding_urn(holding_xml, urn):
+    """
+    Sets every 852$z of a holding record to the preservation master
+    statement for urn.
+
+    Returns:
+        The root element of the updated holding.
+    """
+    root = to_root(holding_xml)
+    for subfield in find_852_z(root):
+        subfield.text = expected_urn_statement(urn)
+    return root
+
+
+def urn_statement_changes(holding_xml, urn):
+    """
+    Returns the 852$z values that set_holding_urn would change, or None
+    if the holding has no 852$z at all.
+    """
+    statements = [subfield.text for subfield in
+                  find_852_z(to_root(holding_xml))]
+    if not statements:
+        return None
+    expected = expected_urn_statement(urn)
+    return [statement for statement in statements if statement != expected]
+
+
+def holding_is_current(holding_xml, urn):
+    """
+    Returns True if every 852$z of the holding already carries the
+    preservation master statement for urn, so an update would be a no-op.
+    """
+    return urn_statement_changes(holding_xml, urn) == []
+
+
+def holding_urn_statement(holding_xml):
+    """
+    Returns the text of the holding's first 852$z, or None.
+    """
+    statements = find_urn_statements(to_root(holding_xml))
+    if not statements:
+        return None
+    return statements[0].text
+
+
+def holding_to_bytes(holding_xml):
+    holding = etree.tostring(to_root(holding_xml), encoding='unicode')
+    return ('<?xml version="1.0" encoding="UTF-8"?>\n' +
+            holding).encode('utf-8')
@@ -0,0 +1,436 @@
+import os
+import json
+import time
+import queue
+import fcntl
+import logging
+import threading
+import requests
+from collections import Counter
+from lib.ltstools import jobMonitor
+from lib.notify import notify
+
+"""
+Reports to the Job Monitor from a background thread, so its latency is
+never on the holding critical path.
+
+Each record gets a RecordNotifier with the log/report interface of
+lib.notify. Its messages go on a bounded queue, and are dropped (and
+counted) rather than block when the queue is full. The reporter thread
+coalesces them into one run per job code: a started report, a running
+report every JOB_MONITOR_FLUSH_SECS while records come in, and a
+completed report when the worker shuts down.
+
+A circuit breaker replaces the connection check before every post: after
+JOB_MONITOR_FAILURE_THRESHOLD failed posts the Job Monitor is not called
+for JOB_MONITOR_COOLDOWN_SECS. Reports that could not be posted are
+spilled to JOB_MONITOR_SPILL_FILE and posted again once it answers.
+"""
+
+# async, or sync to report every record with lib.notify as before
+JOB_MONITOR_MODE = os.getenv('JOB_MONITOR_MODE', 'async')
+JOB_MONITOR_QUEUE_SIZE = int(os.getenv('JOB_MONITOR_QUEUE_SIZE', 10000))
+JOB_MONITOR_FLUSH_SECS = float(os.getenv('JOB_MONITOR_FLUSH_SECS', 60))
+JOB_MONITOR_TIMEOUT_SECS = float(os.getenv('JOB_MONITOR_TIMEOUT_SECS', 5))
+JOB_MONITOR_FAILURE_THRESHOLD = int(
+    os.getenv('JOB_MONITOR_FAILURE_THRESHOLD', 3))
+JOB_MONITOR_COOLDOWN_SECS = float(os.getenv('JOB_MONITOR_COOLDOWN_SECS', 300))
+JOB_MONITOR_SPILL_FILE = os.getenv('JOB_MONITOR_SPILL_FILE',
+                                   '/tmp/etd_job_monitor_spill.jsonl')
+# fail and warn messages kept in one report, the rest are only counted
+JOB_MONITOR_MAX_MESSAGES = int(os.getenv('JOB_MONITOR_MAX_MESSAGES', 100))
+
+# The Job Monitor does not take a results message larger than this
+MAX_MESSAGE_SIZE = 65535
+_STOP = object()
+
+
+def status_code(stage, fails, warns):
+    """
+    Returns the Job Monitor status code for a report, as lib.notify does.
+    """
+    result = 'FAILED' if fails else 'WARNING' if warns else 'SUCCESS'
+    if stage == 'start':
+        return 'STARTED_' + result
+    if stage == 'running':
+        return {'SUCCESS': 'RUNNING',
+                'FAILED': 'RUNNING_ERROR'}.get(result, 'RUNNING_' + result)
+    return 'COMPLETED_' + result
+
+
+def post_status(job_code, code, message, run_id=None,
+                url=jobMonitor, timeout=JOB_MONITOR_TIMEOUT_SECS):
+    """
+    Posts a status to the Job Monitor.
+
+    Returns:
+        str: The run id of the job run.
+    """
+    notify_url = f'{url}/set_job_status/job_code/{job_code}' \
+                 f'/status_code/{code}'
+    if run_id:
+        notify_url += f'/run_id/{run_id}'
+    response = requests.post(notify_url, data=message, timeout=timeout)
+    if response.status_code != 200:
+        raise Exception(f"HTTP error {response.status_code} from the Job "
+                        f"Monitor: {response.text}")
+    return response.text.split(',')[0]
+
+
+class CircuitBreaker():
+    """
+    Opens after threshold failures in a row, then lets one call through
+    once cooldown seconds have passed.
+    """
+
+    def __init__(self, threshold=JOB_MONITOR_FAILURE_THRESHOLD,
+                 cooldown=JOB_MONITOR_COOLDOWN_SECS, clock=time.monotonic):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.clock = clock
+        self.failures = 0
+        self.opened_at = None
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def allow(self):
+        if self.opened_at is None:
+            return True
+        return self.clock() - self.opened_at >= self.cooldown
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failures >= self.threshold:
+            self.opened_at = self.clock()
+
+
+class SpillFile():
+    """
+    Reports that could not be posted, one json document per line. The
+    file is shared by the worker processes on a node, guarded by an flock.
+    """
+
+    def __init__(self, path=JOB_MONITOR_SPILL_FILE):
+        self.path = path
+
+    def append(self, report):
+        with open(self.path, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.write(json.dumps(report) + '\n')
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def take(self):
+        """
+        Empties the file and returns the reports that were in it.
+        """
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path, 'r+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                lines = f.read().splitlines()
+                f.seek(0)
+                f.truncate()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        return [json.loads(line) for line in lines if line.strip()]
+
+
+class RunSummary():
+    """
+    The records and messages of one job code since its last report.
+    """
+
+    def __init__(self, max_messages=JOB_MONITOR_MAX_MESSAGES):
+        self.max_messages = max_messages
+        self.counts = Counter()
+        self.messages = {'fail': [], 'warn': []}
+
+    def add(self, kind, value):
+        if kind == 'report':
+            self.counts[value] += 1
+            return
+        self.counts[kind] += 1
+        if kind in self.messages and \
+                len(self.messages[kind]) < self.max_messages:
+            self.messages[kind].append(value)
+
+    def render(self, dropped=0):
+        """
+        Returns the results message, which lists the fail and warn
+        messages and counts the rest.
+        """
+        counts = self.counts
+        message = (f"Records started: {counts['start']}, "
+                   f"completed: {counts['complete']}\n"
+                   f"Messages passed: {counts['pass']}, "
+                   f"warnings: {counts['warn']}, "
+                   f"failures: {counts['fail']}\n")
+        if dropped:
+            message += f"Messages dropped, the queue was full: {dropped}\n"
+        for kind, heading in (('fail', 'Failed'), ('warn', 'Warnings')):
+            if self.messages[kind]:
+                message += f"\n{heading}\n" + \
+                    '\n'.join(self.messages[kind]) + '\n'
+                omitted = counts[kind] - len(self.messages[kind])
+                if omitted:
+                    message += f"... and {omitted} more\n"
+        if len(message) > MAX_MESSAGE_SIZE:
+            message = message[:MAX_MESSAGE_SIZE - 20] + "\n... truncated\n"
+        return message
+
+
+class JobMonitorReporter():
+
+    logger = logging.getLogger('etd_alma_drs_holding')
+
+    def __init__(self, post=None, breaker=None, spill=None,
+                 queue_size=JOB_MONITOR_QUEUE_SIZE,
+                 flush_secs=JOB_MONITOR_FLUSH_SECS, clock=time.monotonic):
+        """
+        Args:
+            post (callable): Posts a report, called as post(job_code,
+                status_code, message, run_id) and returns the run id.
+                Defaults to post_status, or to logging the report if no
+                Job Monitor url is set.
+            breaker (CircuitBreaker): Skips posting while it is open.
+            spill (SpillFile): Keeps the reports that were not posted.
+            queue_size (int): Messages queued before they are dropped.
+            flush_secs (float): Seconds between running reports.
+        """
+        if post is None:
+            post = post_status if jobMonitor else self.__log_report
+        self.post = post
+        self.breaker = breaker or CircuitBreaker(clock=clock)
+        self.spill = spill or SpillFile()
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.flush_secs = flush_secs
+        self.clock = clock
+        self.lock = threading.RLock()
+        self.thread = None
+        self.summaries = {}
+        self.run_ids = {}
+        self.dropped = Counter()
+        self.stats = Counter()
+
+    def put(self, job_code, kind, value):
+        """
+        Queues a message without blocking.
+
+        Args:
+            kind (str): pass, warn or fail with the message as value, or
+                report with the stage as value.
+        """
+        self.__ensure_started()
+        try:
+            self.queue.put_nowait((job_code, kind, value))
+        except queue.Full:
+            with self.lock:
+                self.dropped[job_code] += 1
+
+    def drain(self):
+        """
+        Adds every queued message to the run summaries.
+        """
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                return
+            if item is not _STOP:
+                self.__add(item)
+
+    def flush(self, stage='running'):
+        """
+        Reports each job code that has new messages, and at 'complete'
+        closes every run that was started.
+        """
+        with self.lock:
+            job_codes = set(self.summaries) | set(self.dropped)
+            if stage == 'complete':
+                job_codes |= set(self.run_ids)
+            for job_code in sorted(job_codes):
+                summary = self.summaries.pop(job_code, RunSummary())
+                dropped = self.dropped.pop(job_code, 0)
+                report_stage = stage
+                if job_code not in self.run_ids and stage != 'complete':
+                    report_stage = 'start'
+                report = {'job_code': job_code,
+                          'status_code': status_code(
+                              report_stage, summary.counts['fail'],
+                              summary.counts['warn']),
+                          'message': summary.render(dropped),
+                          'run_id': self.run_ids.get(job_code)}
+                self.__send(report)
+                if stage == 'complete':
+                    self.run_ids.pop(job_code, None)
+
+    def run(self):
+        next_flush = self.clock() + self.flush_secs
+        while True:
+            timeout = max(0.0, next_flush - self.clock())
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+            if item is _STOP:
+                break
+            if item is not None:
+                self.__add(item)
+            if self.clock() >= next_flush:
+                self.__flush_safely('running')
+                next_flush = self.clock() + self.flush_secs
+        self.drain()
+        self.__flush_safely('complete')
+
+    def stop(self, timeout=JOB_MONITOR_TIMEOUT_SECS * 2):
+        """
+        Sends the completed reports and stops the thread. Used on worker
+        shutdown.
+        """
+        with self.lock:
+            thread = self.thread
+        if thread is None or not thread.is_alive():
+            self.drain()
+            self.__flush_safely('complete')
+            return
+        try:
+            self.queue.put(_STOP, timeout=timeout)
+        except queue.Full:
+            self.logger.warning("Job Monitor queue is full, its reports "
+                                "may not be sent")
+        thread.join(timeout)
+        if thread.is_alive():
+            self.logger.warning("Job Monitor reporter did not stop in "
+                                f"{timeout}s")
+
+    def replay_spilled(self):
+        """
+        Posts the spilled reports again, spilling any that fail.
+        """
+        reports = self.spill.take()
+        for i, report in enumerate(reports):
+            if not self.breaker.allow():
+                for remaining in reports[i:]:
+                    self.spill.append(remaining)
+                return
+            self.__post(report)
+
+    def __add(self, item):
+        job_code, kind, value = item
+        with self.lock:
+            self.summaries.setdefault(job_code, RunSummary()).add(kind, value)
+
+    def __send(self, report):
+        if self.__post(report) and os.path.exists(self.spill.path):
+            self.replay_spilled()
+
+    def __post(self, report):
+        if not self.breaker.allow():
+            self.__spill(report)
+            return False
+        try:
+            run_id = self.post(report['job_code'], report['status_code'],
+                               report['message'], report['run_id'])
+        except Exception as e:
+            self.breaker.record_failure()
+            self.logger.warning(f"Unable to report to the Job Monitor: {e}")
+            self.__spill(report)
+            return False
+        self.breaker.record_success()
+        self.stats['posted'] += 1
+        if run_id and report['status_code'].startswith('STARTED_'):
+            self.run_ids[report['job_code']] = run_id
+        return True
+
+    def __spill(self, report):
+        self.stats['spilled'] += 1
+        try:
+            self.spill.append(report)
+        except Exception as e:
+            self.logger.error(f"Unable to spill a Job Monitor report for "
+                              f"{report['job_code']}: {e}")
+
+    def __flush_safely(self, stage):
+        try:
+            self.flush(stage)
+        except Exception:
+            self.logger.error("Error reporting to the Job Monitor",
+                              exc_info=True)
+
+    def __ensure_started(self):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(
+                    target=self.run, name='job-monitor-reporter',
+                    daemon=True)
+                self.thread.start()
+
+    def __log_report(self, job_code, code, message, run_id):
+        self.logger.debug(f"No Job Monitor url, {job_code} {code}: "
+                          f"{message}")
+        return f'{job_code}-local'
+
+
+class RecordNotifier():
+    """
+    The log/report interface of lib.notify, queueing to the reporter.
+    """
+
+    def __init__(self, job_code, reporter):
+        self.jobCode = job_code
+        self.reporter = reporter
+
+    def log(self, type, message, echo=False):
+        if echo:
+            print(message)
+        self.reporter.put(self.jobCode, type, message)
+
+    def report(self, stage, echo=False, header=False):
+        self.reporter.put(self.jobCode, 'report', stage)
+        return stage != 'stopped'
+
+
+_reporter = None
+_reporter_pid = None
+_reporter_lock = threading.Lock()
+
+
+def get_job_monitor_reporter():
+    """
+    Returns this process's JobMonitorReporter, creating it on first use.
+    """
+    global _reporter, _reporter_pid
+    with _reporter_lock:
+        if _reporter is None or _reporter_pid != os.getpid():
+            _reporter = JobMonitorReporter()
+            _reporter_pid = os.getpid()
+        return _reporter
+
+
+def get_notifier(job_code):
+    """
+    Returns the notifier for one record, a RecordNotifier unless
+    JOB_MONITOR_MODE is sync.
+    """
+    if JOB_MONITOR_MODE == 'sync':  # pragma: no cover, posts per record
+        return notify('monitor', job_code, None)
+    return RecordNotifier(job_code, get_job_monitor_reporter())
+
+
+def shutdown():
+    """
+    Sends the completed reports of this process, if it reported anything.
+    """
+    with _reporter_lock:
+        reporter = _reporter if _reporter_pid == os.getpid() else None
+    if reporter is not None:
+        reporter.stop()
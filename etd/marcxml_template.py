@@ -0,0 +1,138 @@
+import re
+import threading
+from lxml import etree
+
+"""
+The DRS holding MARCXML record, rendered from a compiled template. The
+template is parsed once per process and serialized with a marker in
+each of its slots (the 008 dates, 035$a, 245$a and ind2, 852$z and
+909$k), which leaves the literal text between the slots. A record is
+then the literal text joined with the escaped values, the same string
+the template tree serializes to after the slots are replaced in it,
+without a disk read or a tree walk per record.
+"""
+
+# Marks a slot in the serialized template, a private use character is
+# valid xml and serialized as is
+SLOT_MARKER = '\ue000'
+# The characters lxml refuses to put in a tree
+INVALID_CHARACTERS = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]')
+
+# (controlfield or datafield tag, subfield code, placeholder, slot)
+TEXT_SLOTS = [('008', None, 'YYMMDD', 'yymmdd'),
+              ('008', None, 'DATE_CREATED_VALUE', 'date_created'),
+              ('035', 'a', 'PROQUEST_IDENTIFIER_VALUE', 'proquest_id'),
+              ('245', 'a', 'TITLE_VALUE', 'title'),
+              ('852', 'z', '[DRS OBJECT URN]', 'object_urn'),
+              ('909', 'k', 'LIB_CODE_3_CHAR', 'lib_code')]
+# (datafield tag, attribute, placeholder, slot)
+ATTRIBUTE_SLOTS = [('245', 'ind2', 'TITLE_INDICATOR_2_VALUE',
+                    'title_indicator_2')]
+
+_renderers = {}
+_renderers_lock = threading.Lock()
+
+
+def check_xml_compatible(value):
+    if INVALID_CHARACTERS.search(value):
+        raise ValueError("All strings must be XML compatible: Unicode or "
+                         "ASCII, no NULL bytes or control characters")
+
+
+def escape_text(value):
+    """
+    Escapes element text the way lxml serializes it.
+    """
+    check_xml_compatible(value)
+    return value.replace('&', '&amp;').replace('<', '&lt;') \
+        .replace('>', '&gt;').replace('\r', '&#13;')
+
+
+def escape_attribute(value):
+    """
+    Escapes an attribute value the way lxml serializes it.
+    """
+    check_xml_compatible(value)
+    return value.replace('&', '&amp;').replace('<', '&lt;') \
+        .replace('>', '&gt;').replace('"', '&quot;') \
+        .replace('\r', '&#13;').replace('\n', '&#10;') \
+        .replace('\t', '&#9;')
+
+
+class MarcXmlTemplate():
+    """
+    A MARCXML record template compiled into the literal text between
+    its slots.
+    """
+
+    def __init__(self, template_xml):
+        root = etree.fromstring(template_xml)
+        slots = []
+
+        def mark(text, placeholder, slot):
+            if text is None or placeholder not in text:
+                return text
+            slots.append(slot)
+            return text.replace(placeholder,
+                                f'{SLOT_MARKER}{len(slots) - 1}'
+                                f'{SLOT_MARKER}')
+
+        for child in root.iter('controlfield', 'subfield'):
+            parent = child.getparent()
+            if child.tag == 'controlfield':
+                tag, code = child.attrib.get('tag'), None
+            elif parent.tag == 'datafield':
+                tag, code = parent.attrib.get('tag'), child.attrib.get('code')
+            else:
+                continue
+            for slot_tag, slot_code, placeholder, slot in TEXT_SLOTS:
+                if tag == slot_tag and code == slot_code:
+                    child.text = mark(child.text, placeholder,
+                                      (slot, escape_text))
+            if child.tag == 'subfield':
+                for slot_tag, attribute, placeholder, slot in \
+                        ATTRIBUTE_SLOTS:
+                    if tag == slot_tag and code == 'a' and \
+                            attribute in parent.attrib:
+                        parent.attrib[attribute] = mark(
+                            parent.attrib[attribute], placeholder,
+                            (slot, escape_attribute))
+
+        pieces = etree.tostring(root, encoding='unicode').split(SLOT_MARKER)
+        # literal, slot index, literal, ..., literal
+        self.literals = pieces[0::2]
+        self.slots = [slots[int(index)] for index in pieces[1::2]]
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path, 'rb') as f:
+            return cls(f.read())
+
+    def render(self, **values):
+        """
+        Returns the record with the values in its slots.
+
+        Args:
+            values: yymmdd, date_created, proquest_id, title,
+                title_indicator_2, object_urn and lib_code, only the
+                slots the template has are required.
+        """
+        parts = [self.literals[0]]
+        for (slot, escape), literal in zip(self.slots, self.literals[1:]):
+            parts.append(escape(values[slot]))
+            parts.append(literal)
+        return ''.join(parts)
+
+
+def get_marcxml_template(path):
+    """
+    Returns the compiled template at path, it is read once per process.
+    """
+    renderer = _renderers.get(path)
+    if renderer is None:
+        with _renderers_lock:
+            renderer = _renderers.get(path)
+            if renderer is None:
+                renderer = MarcXmlTemplate.from_file(path)
+                _renderers[path] = renderer
+    return renderer
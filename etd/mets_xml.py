@@ -0,0 +1,67 @@
+import os
+import re
+from lxml import etree
+
+"""
+Streaming reads of the DSpace METS files in the dropbox path. The file is
+read in chunks, the control characters XML does not allow are removed
+from each chunk, and the chunks are fed to a pull parser. Parsing stops
+at the end of the first dmdSec, so the file list and structMap of a large
+ETD are never read, and the source file is never rewritten.
+"""
+
+METS_CHUNK_SIZE = int(os.getenv('METS_CHUNK_SIZE', 65536))
+
+METS_NAMESPACE = '{http://www.loc.gov/METS/}'
+DIM_NAMESPACE = '{http://www.dspace.org/xmlns/dspace/dim}'
+DMD_SEC_TAG = f'{METS_NAMESPACE}dmdSec'
+DIM_FIELD_TAG = f'{DIM_NAMESPACE}field'
+
+# The control characters XML does not allow, every one but tab, line
+# feed and carriage return. They are single bytes in UTF-8, so they can be
+# removed from any chunk without splitting a character.
+CONTROL_CHARACTERS = re.compile(b'[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+
+def sanitized_chunks(f, chunk_size=METS_CHUNK_SIZE):
+    """
+    Yields the chunks of a binary file without control characters.
+    """
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            return
+        yield CONTROL_CHARACTERS.sub(b'', chunk)
+
+
+def read_dim_fields(mets_file, chunk_size=METS_CHUNK_SIZE):
+    """
+    Returns the dim:field elements of the first dmdSec of a METS file.
+
+    Returns:
+        list: (attributes dict, text) of each field, in document order.
+    """
+    parser = etree.XMLPullParser(events=('start', 'end'))
+    fields = []
+    depth = 0
+    in_dmd_sec = False
+    with open(mets_file, 'rb') as f:
+        for chunk in sanitized_chunks(f, chunk_size):
+            parser.feed(chunk)
+            for event, element in parser.read_events():
+                if event == 'start':
+                    depth += 1
+                    if depth == 2 and element.tag == DMD_SEC_TAG:
+                        in_dmd_sec = True
+                    continue
+                depth -= 1
+                if in_dmd_sec and element.tag == DIM_FIELD_TAG:
+                    fields.append((dict(element.attrib), element.text))
+                    element.clear()
+                elif in_dmd_sec and depth == 1:
+                    # End of the first dmdSec, the rest is not needed
+                    return fields
+                elif depth == 1:
+                    element.clear()
+    parser.close()
+    return fields
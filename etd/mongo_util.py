@@ -1,6 +1,7 @@
 import pymongo
 import os
 import logging
+import threading
 
 
 FIELD_SUBMISSION_STATUS = "alma_submission_status"
@@ -12,13 +13,216 @@ DRS_HOLDING_DROPBOX_STATUS = "DRS_HOLDING_DROPBOX"
 DRS_HOLDING_API_STATUS = "DRS_HOLDING_API"
 ALMA_STATUS = "ALMA"
 
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", 10))
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", 0))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(
+    os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", 30000))
+MONGO_CONNECT_TIMEOUT_MS = int(os.getenv("MONGO_CONNECT_TIMEOUT_MS", 20000))
+MONGO_SOCKET_TIMEOUT_MS = int(os.getenv("MONGO_SOCKET_TIMEOUT_MS", 0))
+
+# on/off, buffers status updates and writes them with bulk_write
+MONGO_STATUS_WRITE_BEHIND = os.getenv("MONGO_STATUS_WRITE_BEHIND", "off")
+MONGO_STATUS_FLUSH_SIZE = int(os.getenv("MONGO_STATUS_FLUSH_SIZE", 100))
+MONGO_STATUS_FLUSH_SECS = float(os.getenv("MONGO_STATUS_FLUSH_SECS", 5))
+
+# Compound indexes behind the hot path queries. Status lookups filter on
+# status + proquest id, status updates on proquest id + directory id.
+REQUIRED_INDEXES = {
+    "alma_submission_status_proquest_id":
+        [(FIELD_SUBMISSION_STATUS, pymongo.ASCENDING),
+         (FIELD_PQ_ID, pymongo.ASCENDING)],
+    "proquest_id_directory_id":
+        [(FIELD_PQ_ID, pymongo.ASCENDING),
+         (FIELD_DIRECTORY_ID, pymongo.ASCENDING)]
+}
+
+# The queries the service runs, with sample values, for explain()
+CANNED_QUERIES = {
+    "record_context":
+        {FIELD_PQ_ID: "0",
+         FIELD_SUBMISSION_STATUS: {"$in": [ALMA_STATUS,
+                                           DRS_HOLDING_API_STATUS,
+                                           DRS_HOLDING_DROPBOX_STATUS]}},
+    "record_contexts":
+        {FIELD_PQ_ID: {"$in": ["0", "1"]},
+         FIELD_SUBMISSION_STATUS: {"$in": [ALMA_STATUS,
+                                           DRS_HOLDING_API_STATUS,
+                                           DRS_HOLDING_DROPBOX_STATUS]}},
+    "already_processed":
+        {FIELD_SUBMISSION_STATUS: DRS_HOLDING_API_STATUS,
+         FIELD_PQ_ID: "0"},
+    "update_status":
+        {FIELD_PQ_ID: "0", FIELD_DIRECTORY_ID: "proquest0-0-gsd"},
+    "sweep_candidates":
+        {FIELD_SUBMISSION_STATUS: ALMA_STATUS, FIELD_PQ_ID: {"$gt": "0"}},
+    "sweep_processed":
+        {FIELD_PQ_ID: {"$in": ["0", "1"]},
+         FIELD_SUBMISSION_STATUS: {"$in": [DRS_HOLDING_API_STATUS,
+                                           DRS_HOLDING_DROPBOX_STATUS]}}
+}
+
+# One client per worker process, shared by every MongoUtil
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """
+    Returns this process's MongoClient, creating it on first use.
+    A client inherited from a parent process is never reused.
+    """
+    global _client, _client_pid
+    with _client_lock:
+        if _client is None or _client_pid != os.getpid():
+            _client = pymongo.MongoClient(
+                os.getenv("MONGO_URL"),
+                maxPoolSize=MONGO_MAX_POOL_SIZE,
+                minPoolSize=MONGO_MIN_POOL_SIZE,
+                serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_TIMEOUT_MS,
+                connectTimeoutMS=MONGO_CONNECT_TIMEOUT_MS,
+                socketTimeoutMS=MONGO_SOCKET_TIMEOUT_MS or None,
+                connect=False)
+            _client_pid = os.getpid()
+        return _client
+
+
+def reset_client():
+    """
+    Forgets the current client so the next get_client() builds a new one.
+    Called in each worker process after it is forked.
+    """
+    global _client, _client_pid
+    with _client_lock:
+        _client = None
+        _client_pid = None
+
+
+def close_client():
+    """
+    Closes this process's client. Called on worker process shutdown.
+    """
+    global _client, _client_pid
+    with _client_lock:
+        if _client is not None and _client_pid == os.getpid():
+            _client.close()
+        _client = None
+        _client_pid = None
+
+
+def collscan_stages(plan):
+    """
+    Returns the COLLSCAN stages found anywhere in an explain() plan.
+    """
+    stages = []
+    if isinstance(plan, dict):
+        if plan.get("stage") == "COLLSCAN":
+            stages.append(plan)
+        for value in plan.values():
+            stages.extend(collscan_stages(value))
+    elif isinstance(plan, list):
+        for value in plan:
+            stages.extend(collscan_stages(value))
+    return stages
+
+
+class StatusWriteBehind():
+    """
+    Buffers status updates per collection and writes them as unordered
+    UpdateOne bulk writes once max_pending updates are waiting, after
+    flush_secs, or when flush() is called. Updates that fail to write
+    stay buffered and are retried by the next flush, so every update is
+    written at least once. A later status for the same query replaces
+    the buffered one.
+    """
+
+    logger = logging.getLogger('etd_alma_drs_holding')
+
+    def __init__(self, max_pending=MONGO_STATUS_FLUSH_SIZE,
+                 flush_secs=MONGO_STATUS_FLUSH_SECS):
+        self.max_pending = max_pending
+        self.flush_secs = flush_secs
+        self.pending = {}
+        self.timer = None
+        self.lock = threading.RLock()
+
+    def add(self, collection, query, status):
+        with self.lock:
+            self.__add(collection, query, status)
+            full = self.pending_count() >= self.max_pending
+            if not full:
+                self.__start_timer()
+        if full:
+            self.flush()
+
+    def pending_count(self):
+        with self.lock:
+            return sum(len(updates)
+                       for _, updates in self.pending.values())
+
+    def flush(self):
+        """
+        Writes every buffered update.
+
+        Returns:
+            bool: True if all of them were written.
+        """
+        with self.lock:
+            pending = self.pending
+            self.pending = {}
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+
+        written = True
+        for collection, updates in pending.values():
+            ops = [pymongo.UpdateOne(query,
+                                     {"$set": {FIELD_SUBMISSION_STATUS:
+                                               status}})
+                   for query, status in updates.values()]
+            try:
+                collection.bulk_write(ops, ordered=False)
+                self.logger.debug("Wrote %d status updates to %s",
+                                  len(ops), collection.full_name)
+            except Exception as e:
+                self.logger.error("Error writing {} status updates to {}, "
+                                  "they will be retried: {}".
+                                  format(len(ops), collection.full_name, e))
+                written = False
+                with self.lock:
+                    for key, (query, status) in updates.items():
+                        self.__add(collection, query, status, key,
+                                   replace=False)
+                    self.__start_timer()
+        return written
+
+    def __add(self, collection, query, status, key=None, replace=True):
+        if key is None:
+            key = tuple(sorted(query.items()))
+        _, updates = self.pending.setdefault(collection.full_name,
+                                             (collection, {}))
+        if replace or key not in updates:
+            updates[key] = (query, status)
+
+    def __start_timer(self):
+        if self.flush_secs <= 0 or self.timer is not None or \
+                not self.pending:
+            return
+        self.timer = threading.Timer(self.flush_secs, self.flush)
+        self.timer.daemon = True
+        self.timer.start()
+
+
+# Shared by every MongoUtil in this process
+status_writer = StatusWriteBehind()
+
 
 class MongoUtil():   # pragma: no cover, not used by unit tests
 
     logger = logging.getLogger('etd_alma_drs_holding')
 
     def __init__(self):
-        self.client = pymongo.MongoClient(os.getenv("MONGO_URL"))
+        self.client = get_client()
         self.db = self.client[os.getenv("MONGO_DB")]
         self.collection = self.db[os.getenv("MONGO_COLLECTION")]
 
@@ -28,27 +232,78 @@ class MongoUtil():   # pragma: no cover, not used by unit tests
     def insert_records(self, records):
         self.collection.insert_many(records)
 
-    def update_status(self, query, status):
+    def update_status(self, query, status, durable=False):
+        """
+        Updates the submission status of the record matching query. In
+        write-behind mode the update is buffered unless durable is set,
+        in which case buffered updates are flushed before it is written.
+        A caller that buffers a terminal status must flush_status_updates()
+        before reporting it written.
+        """
+        if MONGO_STATUS_WRITE_BEHIND == "on" and not durable:
+            self.logger.debug("Buffering status update for %s to %s",
+                              query, status)
+            status_writer.add(self.collection, query, status)
+            return
+        if durable:
+            status_writer.flush()
         statusupdate = {"$set": {FIELD_SUBMISSION_STATUS: status}}
-        self.logger.debug("Updating status for {} to {}".
-                          format(query, status))
+        self.logger.debug("Updating status for %s to %s", query, status)
         self.collection.update_one(query, statusupdate)
 
+    def flush_status_updates(self):
+        return status_writer.flush()
+
     def query_records(self, query={}, fields=None):
         if fields is not None:
             return list(self.collection.find(query, fields))
         else:  # pragma: no cover, not currently used by app
             return list(self.collection.find(query))
 
+    def find_records(self, query, fields, sort_field, batch_size):
+        """
+        Returns a cursor over the records matching query, sorted on
+        sort_field and read batch_size records per round trip.
+        """
+        return self.collection.find(query, fields) \
+            .sort(sort_field, pymongo.ASCENDING).batch_size(batch_size)
+
     def delete_records(self, query={}):
         self.collection.delete_many(query)
 
     def close_connection(self):
-        self.client.close()
+        # The client is shared by the whole process, it is closed
+        # by close_client() when the worker process shuts down
+        pass
+
+    def ensure_indexes(self):
+        """
+        Creates the required indexes. Indexes that already exist are left
+        alone, so this is safe to run on every startup.
+        """
+        for name, keys in REQUIRED_INDEXES.items():
+            self.logger.debug("Ensuring index %s on %s",
+                              name, self.collection.name)
+            self.collection.create_index(keys, name=name)
 
-    def __del__(self):
-        self.close_connection()
+    def explain_query(self, query):
+        """
+        Returns the winning plan mongo picks for a query.
+        """
+        explain = self.collection.find(query).explain()
+        return explain.get("queryPlanner", {}).get("winningPlan", explain)
 
     # we use this if we want to set to the test collection for testing
     def set_collection(self, collection):
         self.collection = collection
+
+
+def collection_mongoutil(collection=None):  # pragma: no cover, unit testing doesn't use mongo # noqa: E501
+    """
+    Returns a MongoUtil for a test collection name, or for the records
+    collection given None.
+    """
+    mongoutil = MongoUtil()
+    if collection is not None:
+        mongoutil.set_collection(mongoutil.db[collection])
+    return mongoutil
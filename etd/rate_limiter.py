@@ -0,0 +1,300 @@
+import os
+import fcntl
+import json
+import time
+import logging
+import threading
+from pymongo.errors import DuplicateKeyError
+
+"""
+Token bucket limiter for the Alma API. Alma enforces a requests-per-second
+threshold per institution, so the bucket state is shared by every worker
+process through a backend: memory (this process only), file (every
+process on one node, guarded by an flock) or mongo (every node).
+
+Callers reserve a token before each request. A reservation may take the
+bucket below zero, in which case the caller sleeps until its token would
+have been refilled, so waiting callers are spaced out at the quota rate
+instead of all retrying at once. A 429 pauses every caller for Alma's
+Retry-After, capped at ALMA_RATE_LIMIT_MAX_PENALTY_SECS since the pause
+is slept inside the task. Callers that must not wait, like the health
+check, use try_acquire().
+"""
+
+# requests per second, 0 turns the limiter off
+ALMA_RATE_LIMIT_RPS = float(os.getenv('ALMA_RATE_LIMIT_RPS', 0))
+ALMA_RATE_LIMIT_BURST = float(os.getenv('ALMA_RATE_LIMIT_BURST', 0))
+# memory, file or mongo
+ALMA_RATE_LIMIT_BACKEND = os.getenv('ALMA_RATE_LIMIT_BACKEND', 'file')
+ALMA_RATE_LIMIT_FILE = os.getenv('ALMA_RATE_LIMIT_FILE',
+                                 '/tmp/etd_alma_rate_limit')
+ALMA_RATE_LIMIT_COLLECTION = os.getenv('ALMA_RATE_LIMIT_COLLECTION',
+                                       'alma_rate_limit')
+ALMA_RATE_LIMIT_KEY = os.getenv('ALMA_RATE_LIMIT_KEY', 'alma')
+# seconds to pause every caller after Alma answers 429
+ALMA_RATE_LIMIT_PENALTY_SECS = float(
+    os.getenv('ALMA_RATE_LIMIT_PENALTY_SECS', 1))
+# the longest pause a 429's Retry-After can ask for
+ALMA_RATE_LIMIT_MAX_PENALTY_SECS = float(
+    os.getenv('ALMA_RATE_LIMIT_MAX_PENALTY_SECS', 30))
+
+
+def refill(state, rate, burst, now):
+    """
+    Returns the bucket state with the tokens refilled up to now.
+    State is a dict with tokens and ts, or None for a full bucket.
+    """
+    if state is None:
+        return {'tokens': burst, 'ts': now}
+    elapsed = max(0.0, now - state['ts'])
+    return {'tokens': min(burst, state['tokens'] + elapsed * rate),
+            'ts': max(now, state['ts'])}
+
+
+def reserve(state, rate, burst, now, tokens=1):
+    """
+    Takes tokens from the bucket.
+
+    Returns:
+        tuple: (new state, seconds to wait before using the tokens)
+    """
+    state = refill(state, rate, burst, now)
+    state['tokens'] -= tokens
+    wait = 0.0 if state['tokens'] >= 0 else -state['tokens'] / rate
+    return state, wait
+
+
+def take(state, rate, burst, now, tokens=1):
+    """
+    Takes tokens from the bucket only if they are there now.
+
+    Returns:
+        tuple: (new state, True if the tokens were taken)
+    """
+    state = refill(state, rate, burst, now)
+    if state['tokens'] < tokens:
+        return state, False
+    state['tokens'] -= tokens
+    return state, True
+
+
+def drain(state, rate, burst, now, secs):
+    """
+    Empties the bucket so the next token is available in secs.
+    """
+    state = refill(state, rate, burst, now)
+    state['tokens'] = min(state['tokens'], -secs * rate)
+    return state, 0.0
+
+
+class MemoryBackend():
+    """
+    Bucket state in this process only.
+    """
+
+    def __init__(self):
+        self.states = {}
+        self.lock = threading.Lock()
+
+    def update(self, key, fn):
+        with self.lock:
+            state, result = fn(self.states.get(key))
+            self.states[key] = state
+            return result
+
+
+class FileBackend():
+    """
+    Bucket state in a json file, updated under an exclusive flock, so it
+    is shared by every process on the node.
+    """
+
+    def __init__(self, path=ALMA_RATE_LIMIT_FILE):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def update(self, key, fn):
+        with self.lock, open(self.path, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                try:
+                    states = json.loads(f.read() or '{}')
+                except ValueError:
+                    states = {}
+                state, result = fn(states.get(key))
+                states[key] = state
+                f.seek(0)
+                f.truncate()
+                f.write(json.dumps(states))
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        return result
+
+
+class MongoBackend():
+    """
+    Bucket state in a mongo document, updated with compare-and-set on a
+    version field, so it is shared by every node.
+    """
+
+    def __init__(self, collection=None):
+        self.collection = collection
+
+    def __collection(self):
+        if self.collection is None:  # pragma: no cover, needs mongo
+            import etd.mongo_util as mongo_util
+            db = mongo_util.get_client()[os.getenv("MONGO_DB")]
+            self.collection = db[ALMA_RATE_LIMIT_COLLECTION]
+        return self.collection
+
+    def update(self, key, fn):
+        collection = self.__collection()
+        while True:
+            doc = collection.find_one({'_id': key})
+            state = None
+            if doc is not None:
+                state = {'tokens': doc['tokens'], 'ts': doc['ts']}
+            state, result = fn(state)
+            if doc is None:
+                try:
+                    collection.insert_one({'_id': key, 'version': 1,
+                                           **state})
+                    return result
+                except DuplicateKeyError:
+                    continue
+            updated = collection.update_one(
+                {'_id': key, 'version': doc['version']},
+                {'$set': state, '$inc': {'version': 1}})
+            if updated.modified_count == 1:
+                return result
+
+
+BACKENDS = {'memory': MemoryBackend,
+            'file': FileBackend,
+            'mongo': MongoBackend}
+
+
+class RateLimiter():
+
+    logger = logging.getLogger('etd_alma_drs_holding')
+
+    def __init__(self, rate=ALMA_RATE_LIMIT_RPS, burst=ALMA_RATE_LIMIT_BURST,
+                 backend=None, key=ALMA_RATE_LIMIT_KEY,
+                 max_penalty=ALMA_RATE_LIMIT_MAX_PENALTY_SECS,
+                 clock=time.time, sleep=time.sleep):
+        """
+        Args:
+            rate (float): Requests per second, 0 turns the limiter off.
+            burst (float): Bucket size, defaults to one second of rate.
+            backend: Where the bucket state is kept, defaults to the
+                ALMA_RATE_LIMIT_BACKEND one.
+            key (str): Name of the bucket in the backend.
+            max_penalty (float): The longest pause after a 429.
+        """
+        self.rate = rate
+        self.burst = burst or max(1.0, rate)
+        self.backend = backend or \
+            BACKENDS[ALMA_RATE_LIMIT_BACKEND]()
+        self.key = key
+        self.max_penalty = max_penalty
+        self.clock = clock
+        self.sleep = sleep
+        self.lock = threading.Lock()
+        self.acquired = 0
+        self.waited = 0
+        self.wait_secs_total = 0.0
+        self.wait_secs_max = 0.0
+        self.throttled = 0
+
+    @property
+    def enabled(self):
+        return self.rate > 0
+
+    def acquire(self, tokens=1):
+        """
+        Blocks until tokens may be used.
+
+        Returns:
+            float: Seconds waited.
+        """
+        if not self.enabled:
+            return 0.0
+        wait = self.backend.update(
+            self.key, lambda state: reserve(state, self.rate, self.burst,
+                                            self.clock(), tokens))
+        if wait > 0:
+            self.logger.debug("Waiting %.3fs for an Alma rate limit token",
+                              wait)
+            self.sleep(wait)
+        with self.lock:
+            self.acquired += tokens
+            if wait > 0:
+                self.waited += 1
+                self.wait_secs_total += wait
+                self.wait_secs_max = max(self.wait_secs_max, wait)
+        return wait
+
+    def try_acquire(self, tokens=1):
+        """
+        Takes tokens only if they may be used now, never waits.
+
+        Returns:
+            bool: True if the tokens were taken.
+        """
+        if not self.enabled:
+            return True
+        taken = self.backend.update(
+            self.key, lambda state: take(state, self.rate, self.burst,
+                                         self.clock(), tokens))
+        if taken:
+            with self.lock:
+                self.acquired += tokens
+        return taken
+
+    def throttle(self, secs=ALMA_RATE_LIMIT_PENALTY_SECS):
+        """
+        Called when Alma answers 429, holds back every caller for secs,
+        at most max_penalty.
+        """
+        with self.lock:
+            self.throttled += 1
+        if not self.enabled:
+            return
+        if secs > self.max_penalty:
+            self.logger.warning(f"Alma asked for a {secs}s pause, pausing "
+                                f"for {self.max_penalty}s")
+            secs = self.max_penalty
+        self.logger.warning(f"Alma rate limit hit, pausing requests "
+                            f"for {secs}s")
+        self.backend.update(
+            self.key, lambda state: drain(state, self.rate, self.burst,
+                                          self.clock(), secs))
+
+    def stats(self):
+        with self.lock:
+            return {'acquired': self.acquired,
+                    'waited': self.waited,
+                    'wait_secs_total': self.wait_secs_total,
+                    'wait_secs_max': self.wait_secs_max,
+                    'wait_secs_avg': (self.wait_secs_total / self.waited
+                                      if self.waited else 0.0),
+                    'throttled': self.throttled}
+
+
+_limiter = None
+_limiter_pid = None
+_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter():
+    """
+    Returns this process's RateLimiter, creating it on first use.
+    """
+    global _limiter, _limiter_pid
+    with _limiter_lock:
+        if _limiter is None or _limiter_pid != os.getpid():
+            _limiter = RateLimiter()
+            _limiter_pid = os.getpid()
+        return _limiter
@@ -0,0 +1,163 @@
+import logging
+import etd.mongo_util as mongo_util
+
+"""
+Everything the holding pipeline needs to know about a ProQuest record,
+fetched once at task entry and shared by DRSHoldingByAPI and
+DRSHoldingByDropbox, instead of each step querying mongo again.
+"""
+
+logger = logging.getLogger('etd_alma_drs_holding')
+
+CONTEXT_FIELDS = {mongo_util.FIELD_PQ_ID: 1,
+                  mongo_util.FIELD_IN_DASH: 1,
+                  mongo_util.FIELD_DIRECTORY_ID: 1,
+                  mongo_util.FIELD_SCHOOL_ALMA_DROPBOX: 1,
+                  mongo_util.FIELD_SUBMISSION_STATUS: 1}
+
+CONTEXT_STATUSES = [mongo_util.ALMA_STATUS,
+                    mongo_util.DRS_HOLDING_API_STATUS,
+                    mongo_util.DRS_HOLDING_DROPBOX_STATUS]
+
+
+class RecordContext():
+
+    def __init__(self, pqid, object_urn=None, in_dash=None,
+                 directory_id=None, school_alma_dropbox=None,
+                 statuses=None, from_mongo=False):
+        """
+        Args:
+            pqid (str): The proquest id.
+            object_urn (str): The DRS object urn.
+            in_dash (bool): True if the thesis is in DASH.
+            directory_id (str): The batch directory of the record waiting
+                at ALMA status.
+            school_alma_dropbox (str): The school's Alma dropbox code.
+            statuses (iterable): Submission statuses held by records
+                with this proquest id.
+            from_mongo (bool): True if the fields were read from mongo.
+        """
+        self.pqid = pqid
+        self.object_urn = object_urn
+        self.in_dash = in_dash
+        self.directory_id = directory_id
+        self.school_alma_dropbox = school_alma_dropbox
+        self.statuses = set(statuses or [])
+        self.from_mongo = from_mongo
+
+    @property
+    def found(self):
+        """
+        True if there is a record at ALMA status to work on.
+        """
+        return self.directory_id is not None
+
+    def already_processed(self, status):
+        """
+        True if a record for this proquest id already has the given
+        DRS holding status.
+        """
+        return status in self.statuses
+
+
+def record_context_from_message(message):
+    """
+    Builds a context from the fields carried in a task message.
+
+    Returns:
+        RecordContext, or None if the message does not carry indash,
+        directory_id, submission status and, for DASH records,
+        school_alma_dropbox. Without the status the "already processed"
+        check could not be made, so the context is read from mongo.
+    """
+    if (mongo_util.FIELD_IN_DASH not in message or
+            mongo_util.FIELD_SUBMISSION_STATUS not in message):
+        return None
+    directory_id = message.get(mongo_util.FIELD_DIRECTORY_ID)
+    if directory_id is None:
+        return None
+    in_dash = message[mongo_util.FIELD_IN_DASH]
+    if in_dash and mongo_util.FIELD_SCHOOL_ALMA_DROPBOX not in message:
+        return None
+    return RecordContext(message.get('pqid'),
+                         message.get('object_urn'),
+                         in_dash,
+                         directory_id.strip(),
+                         message.get(mongo_util.FIELD_SCHOOL_ALMA_DROPBOX),
+                         [message[mongo_util.FIELD_SUBMISSION_STATUS]])
+
+
+def load_record_context(mongoutil, pqid, object_urn=None, message=None):
+    """
+    Returns the context for pqid, read from the message when it carries
+    the needed fields, otherwise with a single mongo query.
+    """
+    if message is not None:
+        context = record_context_from_message(message)
+        if context is not None:
+            logger.debug("Using record context from message for %s", pqid)
+            return context
+
+    query = {mongo_util.FIELD_PQ_ID: pqid,
+             mongo_util.FIELD_SUBMISSION_STATUS: {"$in": CONTEXT_STATUSES}}
+    records = mongoutil.query_records(query, CONTEXT_FIELDS)
+    return record_context_from_records(pqid, object_urn, records)
+
+
+def load_record_contexts(mongoutil, messages):
+    """
+    Returns the contexts of a batch of task messages by proquest id.
+    Those carried by the messages are read from them, the rest with a
+    single $in query.
+    """
+    contexts = {}
+    missing = []
+    for message in messages:
+        context = record_context_from_message(message)
+        if context is not None:
+            contexts[message['pqid']] = context
+        else:
+            missing.append(message)
+    if not missing:
+        return contexts
+
+    pqids = list(dict.fromkeys(message['pqid'] for message in missing))
+    query = {mongo_util.FIELD_PQ_ID: {"$in": pqids},
+             mongo_util.FIELD_SUBMISSION_STATUS: {"$in": CONTEXT_STATUSES}}
+    records_by_pqid = {}
+    for record in mongoutil.query_records(query, CONTEXT_FIELDS):
+        records_by_pqid.setdefault(record.get(mongo_util.FIELD_PQ_ID),
+                                   []).append(record)
+    logger.debug("Loaded record contexts for %d proquest ids with one "
+                 "query", len(pqids))
+    for message in missing:
+        pqid = message['pqid']
+        contexts[pqid] = record_context_from_records(
+            pqid, message.get('object_urn'), records_by_pqid.get(pqid, []))
+    return contexts
+
+
+def record_context_from_records(pqid, object_urn, records):
+    """
+    Builds a context from the mongo records of a proquest id.
+    """
+    statuses = [record.get(mongo_util.FIELD_SUBMISSION_STATUS)
+                for record in records]
+    alma_records = [record for record in records
+                    if record.get(mongo_util.FIELD_SUBMISSION_STATUS) ==
+                    mongo_util.ALMA_STATUS]
+    logger.debug("Found %d records for %s", len(records), pqid)
+    if len(alma_records) > 1:
+        logger.warning(f"Found {len(alma_records)} for {pqid}")
+    if len(alma_records) == 0:
+        return RecordContext(pqid, object_urn, statuses=statuses,
+                             from_mongo=True)
+    record = alma_records[0]
+    directory_id = record.get(mongo_util.FIELD_DIRECTORY_ID)
+    if directory_id is not None:
+        directory_id = directory_id.strip()
+    return RecordContext(pqid, object_urn,
+                         record.get(mongo_util.FIELD_IN_DASH),
+                         directory_id,
+                         record.get(mongo_util.FIELD_SCHOOL_ALMA_DROPBOX),
+                         statuses, from_mongo=True)
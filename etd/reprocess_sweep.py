@@ -0,0 +1,325 @@
+import os
+import csv
+import json
+import time
+import logging
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import etd.mongo_util as mongo_util
+
+"""
+Reprocessing sweeps, for backfills after an Alma outage. Candidate
+records are streamed from mongo, by default every record at ALMA status,
+or from a manifest file of pqid and object_urn. They are handed in chunks
+to a pool of workers, which either run the holding pipeline in this
+process or queue add_holdings tasks. Progress is checkpointed to a file
+so an interrupted sweep resumes after the last chunk it finished, and the
+rate is reported as it goes. scripts/reprocess-sweep.py is the CLI.
+"""
+
+SWEEP_WORKERS = int(os.getenv('SWEEP_WORKERS', 4))
+# records handed to a worker at a time, and queued in one publish
+SWEEP_CHUNK_SIZE = int(os.getenv('SWEEP_CHUNK_SIZE', 25))
+# mongo cursor batch size
+SWEEP_BATCH_SIZE = int(os.getenv('SWEEP_BATCH_SIZE', 500))
+SWEEP_REPORT_SECS = float(os.getenv('SWEEP_REPORT_SECS', 10))
+SWEEP_CHECKPOINT_SECS = float(os.getenv('SWEEP_CHECKPOINT_SECS', 5))
+# the field of the mongo records that holds the DRS object urn
+SWEEP_OBJECT_URN_FIELD = os.getenv('SWEEP_OBJECT_URN_FIELD', 'object_urn')
+
+SWEEP_QUERY = {mongo_util.FIELD_SUBMISSION_STATUS: mongo_util.ALMA_STATUS}
+# the counts of the chunks' outcomes, the others are counted by the source
+OUTCOMES = ('ok', 'failed', 'skipped')
+DRS_HOLDING_STATUSES = [mongo_util.DRS_HOLDING_API_STATUS,
+                        mongo_util.DRS_HOLDING_DROPBOX_STATUS]
+
+logger = logging.getLogger('etd_alma_drs_holding')
+
+
+def mongo_candidates(mongoutil, query=None, after_pqid=None,
+                     batch_size=SWEEP_BATCH_SIZE, counts=None):
+    """
+    Yields the records matching query in proquest id order, skipping
+    those that already have a DRS holding status. Each cursor batch is
+    checked with one $in query.
+
+    Args:
+        mongoutil (MongoUtil): The collection to read.
+        query (dict): The candidate query, defaults to SWEEP_QUERY.
+        after_pqid (str): Only records after this proquest id, to
+            resume a sweep.
+        batch_size (int): The cursor batch size.
+        counts (Counter): Counts the records skipped as processed.
+    """
+    query = dict(SWEEP_QUERY if query is None else query)
+    if after_pqid is not None:
+        # The query may have a proquest id clause of its own
+        query = {"$and": [query,
+                          {mongo_util.FIELD_PQ_ID: {"$gt": after_pqid}}]}
+    fields = {mongo_util.FIELD_PQ_ID: 1, SWEEP_OBJECT_URN_FIELD: 1}
+    cursor = mongoutil.find_records(query, fields, mongo_util.FIELD_PQ_ID,
+                                    batch_size)
+    batch = []
+    for record in cursor:
+        batch.append(record)
+        if len(batch) >= batch_size:
+            yield from _unprocessed(mongoutil, batch, counts)
+            batch = []
+    yield from _unprocessed(mongoutil, batch, counts)
+
+
+def _unprocessed(mongoutil, records, counts):
+    if not records:
+        return
+    pqids = [record.get(mongo_util.FIELD_PQ_ID) for record in records]
+    processed = {record.get(mongo_util.FIELD_PQ_ID) for record in
+                 mongoutil.query_records(
+                     {mongo_util.FIELD_PQ_ID: {"$in": pqids},
+                      mongo_util.FIELD_SUBMISSION_STATUS:
+                          {"$in": DRS_HOLDING_STATUSES}},
+                     {mongo_util.FIELD_PQ_ID: 1})}
+    for record in records:
+        pqid = record.get(mongo_util.FIELD_PQ_ID)
+        if pqid in processed:
+            if counts is not None:
+                counts['already_processed'] += 1
+            continue
+        yield {'pqid': pqid,
+               'object_urn': record.get(SWEEP_OBJECT_URN_FIELD)}
+
+
+def manifest_candidates(path, skip=0):
+    """
+    Yields the records of a manifest, a .csv file with pqid and
+    object_urn columns or a file of JSON lines with those keys.
+
+    Args:
+        path (str): The manifest file.
+        skip (int): The number of records to skip, to resume a sweep.
+    """
+    with open(path, newline='') as f:
+        if path.lower().endswith('.csv'):
+            rows = csv.DictReader(f)
+        else:
+            rows = (json.loads(line) for line in f if line.strip())
+        for position, row in enumerate(rows):
+            if position < skip:
+                continue
+            yield {'pqid': row.get('pqid'),
+                   'object_urn': row.get('object_urn')}
+
+
+def holding_message(record):
+    """
+    Returns the add_holdings message for a candidate record.
+    """
+    return {'pqid': record['pqid'], 'object_urn': record['object_urn']}
+
+
+def run_each(process_record):
+    """
+    Returns a chunk processor that runs process_record on each record of
+    a chunk, a record that raises counts as failed.
+    """
+    def process(records):
+        outcomes = []
+        for record in records:
+            try:
+                outcomes.append(bool(process_record(record)))
+            except Exception:
+                logger.error(f"Sweep failed for {record['pqid']}",
+                             exc_info=True)
+                outcomes.append(False)
+        return outcomes
+    return process
+
+
+class Checkpoint():
+    """
+    The progress of a sweep over one source, kept in a JSON file that is
+    replaced whole on each save.
+    """
+
+    def __init__(self, path, source):
+        self.path = path
+        self.source = source
+
+    def load(self):
+        """
+        Returns the saved progress, or None if there is none. Raises
+        ValueError if it was saved by a sweep of another source.
+        """
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path) as f:
+            state = json.load(f)
+        if state.get('source') != self.source:
+            raise ValueError(f"{self.path} is the checkpoint of a sweep of "
+                             f"{state.get('source')}, not {self.source}")
+        return state
+
+    def save(self, position, last_pqid, counts):
+        state = {'source': self.source,
+                 'position': position,
+                 'last_pqid': last_pqid,
+                 'counts': dict(counts)}
+        temp_path = f'{self.path}.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(temp_path, self.path)
+
+
+class Sweep():
+    """
+    Runs candidate records through a chunk processor on a pool of worker
+    threads. The checkpoint only moves past a chunk once it and every
+    chunk before it are finished, so a resumed sweep never misses a
+    record, though it may repeat the chunks that were in flight. The
+    counts saved with it are those of the records up to its position,
+    so the repeated chunks are not counted twice.
+    """
+
+    def __init__(self, process, workers=SWEEP_WORKERS,
+                 chunk_size=SWEEP_CHUNK_SIZE, checkpoint=None, report=None,
+                 report_secs=SWEEP_REPORT_SECS,
+                 checkpoint_secs=SWEEP_CHECKPOINT_SECS,
+                 clock=time.monotonic):
+        """
+        Args:
+            process (callable): Called with a list of records, returns a
+                list of True or False outcomes, see run_each().
+            workers (int): The number of chunks processed at once.
+            chunk_size (int): The number of records in a chunk.
+            checkpoint (Checkpoint): Where progress is saved, if anywhere.
+            report (callable): Called with each progress line, defaults
+                to logging it.
+            report_secs (float): The time between progress lines.
+            checkpoint_secs (float): The time between checkpoint saves.
+        """
+        self.process = process
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.checkpoint = checkpoint
+        self.report = report or logger.info
+        self.report_secs = report_secs
+        self.checkpoint_secs = checkpoint_secs
+        self.clock = clock
+        self.counts = Counter()
+        self.position = 0
+        self.last_pqid = None
+
+    def run(self, candidates, resume=None):
+        """
+        Processes every candidate and returns the counts of outcomes.
+
+        Args:
+            candidates (iterable): Dicts with pqid and object_urn, in a
+                stable order.
+            resume (dict): The checkpoint state the candidates start
+                after.
+        """
+        resume = resume or {}
+        self.position = resume.get('position', 0)
+        self.last_pqid = resume.get('last_pqid')
+        self.counts.update(resume.get('counts', {}))
+        self.saved_counts = Counter(resume.get('counts', {}))
+        self.started = self.clock()
+        self.start_count = self.__processed()
+        self.last_report = self.last_save = self.started
+        self.finished = {}
+        self.next_index = 0
+        pending = {}
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            try:
+                for index, chunk in enumerate(self.__chunks(candidates)):
+                    while len(pending) >= self.workers * 2:
+                        self.__collect(pending)
+                    future = executor.submit(self.__process_chunk,
+                                             chunk['records'])
+                    pending[future] = (index, chunk)
+                while pending:
+                    self.__collect(pending)
+            except KeyboardInterrupt:
+                self.report("Interrupted, finishing the chunks in flight")
+                while pending:
+                    self.__collect(pending)
+                raise
+            finally:
+                self.__save()
+                self.report(self.progress())
+        return dict(self.counts)
+
+    def progress(self):
+        processed = self.__processed()
+        elapsed = max(self.clock() - self.started, 1e-9)
+        rate = (processed - self.start_count) / elapsed
+        return (f"{processed} records, {rate:.1f} records/sec, "
+                f"ok {self.counts['ok']}, failed {self.counts['failed']}, "
+                f"skipped {self.counts['skipped']}, checkpoint at "
+                f"{self.position} ({self.last_pqid})")
+
+    def __processed(self):
+        return self.counts['ok'] + self.counts['failed'] + \
+            self.counts['skipped']
+
+    def __chunks(self, candidates):
+        position = self.position
+        records = []
+        for record in candidates:
+            records.append(record)
+            position += 1
+            if len(records) >= self.chunk_size:
+                yield self.__chunk(records, position)
+                records = []
+        if records:
+            yield self.__chunk(records, position)
+
+    def __chunk(self, records, position):
+        # What the source counted up to the chunk's last record
+        counted = {key: value for key, value in self.counts.items()
+                   if key not in OUTCOMES}
+        return {'records': records, 'position': position,
+                'last_pqid': records[-1]['pqid'], 'counted': counted}
+
+    def __process_chunk(self, records):
+        valid = [record for record in records
+                 if record.get('pqid') and record.get('object_urn')]
+        outcomes = []
+        if valid:
+            try:
+                outcomes = self.process(valid)
+            except Exception:
+                logger.error(f"Sweep failed for a chunk of {len(valid)} "
+                             f"records", exc_info=True)
+                outcomes = [False] * len(valid)
+        ok = len([outcome for outcome in outcomes if outcome])
+        return ok, len(valid) - ok, len(records) - len(valid)
+
+    def __collect(self, pending):
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            index, chunk = pending.pop(future)
+            outcomes = dict(zip(OUTCOMES, future.result()))
+            self.counts.update(outcomes)
+            self.finished[index] = (chunk, outcomes)
+        # Move the checkpoint over the finished chunks with no gap
+        while self.next_index in self.finished:
+            chunk, outcomes = self.finished.pop(self.next_index)
+            self.position = chunk['position']
+            self.last_pqid = chunk['last_pqid']
+            self.saved_counts.update(outcomes)
+            for key, value in chunk['counted'].items():
+                self.saved_counts[key] = value
+            self.next_index += 1
+        now = self.clock()
+        if now - self.last_save >= self.checkpoint_secs:
+            self.__save()
+        if now - self.last_report >= self.report_secs:
+            self.last_report = now
+            self.report(self.progress())
+
+    def __save(self):
+        self.last_save = self.clock()
+        if self.checkpoint is not None:
+            self.checkpoint.save(self.position, self.last_pqid,
+                                 self.saved_counts)
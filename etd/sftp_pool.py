@@ -0,0 +1,226 @@
+import os
+import logging
+import threading
+import time
+import paramiko
+from .xfer_files import xfer_files
+
+"""
+Process-wide pool of sftp connections keyed by (server, user, port).
+Connections are kept open between uploads, checked for liveness before
+reuse and reconnected transparently when they have gone stale. A
+connection is checked out by one upload at a time, concurrent uploads
+to a server each get their own.
+"""
+
+SFTP_KEEPALIVE_SECS = int(os.getenv('SFTP_KEEPALIVE_SECS', 30))
+SFTP_LIVENESS_CHECK_SECS = float(os.getenv('SFTP_LIVENESS_CHECK_SECS', 60))
+# streamed uploads are written under this suffix and then renamed
+SFTP_PARTIAL_SUFFIX = os.getenv('SFTP_PARTIAL_SUFFIX', '.part')
+
+
+# tried in turn on a private key file
+KEY_CLASSES = (paramiko.Ed25519Key, paramiko.ECDSAKey, paramiko.RSAKey)
+
+
+def load_private_key(privateKey):
+    """
+    Parses an Ed25519, ECDSA or RSA private key file.
+    """
+    path = os.path.expanduser(privateKey)
+    error = None
+    for key_class in KEY_CLASSES:
+        try:
+            return key_class.from_private_key_file(path)
+        except paramiko.SSHException as e:
+            error = e
+    raise error
+
+
+class SFTPPool():
+
+    logger = logging.getLogger('etd_alma_drs_holding')
+
+    def __init__(self, connect=xfer_files, load_key=load_private_key,
+                 keepalive_secs=SFTP_KEEPALIVE_SECS,
+                 liveness_check_secs=SFTP_LIVENESS_CHECK_SECS):
+        """
+        Args:
+            connect (callable): Builds a connection, called as
+                connect(remoteSite, remoteUser, privateKey, sshPort=port).
+                Defaults to xfer_files.
+            load_key (callable): Parses a private key path into a key.
+            keepalive_secs (int): Ssh keepalive interval, 0 disables it.
+            liveness_check_secs (float): Probe the sftp channel before
+                reusing a connection that has been idle this long.
+        """
+        self.connect = connect
+        self.load_key = load_key
+        self.keepalive_secs = keepalive_secs
+        self.liveness_check_secs = liveness_check_secs
+        # (connection, last used) of the idle connections of each server
+        self.idle = {}
+        # server of each checked out connection, by id
+        self.borrowed = {}
+        self.private_keys = {}
+        self.hits = 0
+        self.misses = 0
+        self.reconnects = 0
+        self.pid = os.getpid()
+        self.lock = threading.RLock()
+
+    def checkout(self, remoteSite, remoteUser, privateKey, sshPort=22):
+        """
+        Takes a live connection for (remoteSite, remoteUser, sshPort) for
+        the caller's use alone, opening one if none is idle. The caller
+        should check the connection's error attribute, must not close
+        it, and must hand it back with checkin().
+        """
+        key = (remoteSite, remoteUser, sshPort)
+        while True:
+            with self.lock:
+                self.__check_fork()
+                idle = self.idle.get(key)
+                if not idle:
+                    self.misses += 1
+                    break
+                conn, last_used = idle.pop()
+            idle_secs = time.monotonic() - last_used
+            if conn.is_alive(probe=idle_secs >= self.liveness_check_secs):
+                with self.lock:
+                    self.hits += 1
+                    self.borrowed[id(conn)] = key
+                return conn
+            self.logger.info(f"Reconnecting stale sftp connection to "
+                             f"{remoteUser}@{remoteSite}:{sshPort}")
+            with self.lock:
+                self.reconnects += 1
+            self.__close(key, conn)
+
+        conn = self.connect(remoteSite, remoteUser,
+                            self.__private_key(privateKey),
+                            sshPort=sshPort)
+        if conn.error:
+            return conn
+        if self.keepalive_secs > 0:
+            conn.set_keepalive(self.keepalive_secs)
+        with self.lock:
+            self.borrowed[id(conn)] = key
+        return conn
+
+    def checkin(self, conn):
+        """
+        Hands a checked out connection back to the pool. A connection
+        that failed is closed instead.
+        """
+        with self.lock:
+            key = self.borrowed.pop(id(conn), None)
+            if key is None:
+                return
+            if not conn.error and self.pid == os.getpid():
+                self.idle.setdefault(key, []).append((conn,
+                                                      time.monotonic()))
+                return
+        self.__close(key, conn)
+
+    def put_file(self, remoteSite, remoteUser, privateKey, localFile,
+                 remoteFile, sshPort=22):
+        """
+        Uploads localFile over a pooled connection. A failed upload on a
+        reused connection is retried once on a fresh connection.
+
+        Returns:
+            False if the file was sent, otherwise the error message.
+        """
+        return self.__put(remoteSite, remoteUser, privateKey, sshPort,
+                          lambda conn: conn.put_file(localFile, remoteFile))
+
+    def put_fileobj(self, remoteSite, remoteUser, privateKey, fileObj,
+                    remoteFile, sshPort=22):
+        """
+        Uploads an open binary file over a pooled connection. It is
+        written under remoteFile plus SFTP_PARTIAL_SUFFIX and renamed
+        when complete, so remoteFile only ever holds a whole file. A
+        failed upload is retried once on a fresh connection from the
+        same position in fileObj.
+
+        Returns:
+            False if the file was sent, otherwise the error message.
+        """
+        tempFile = f'{remoteFile}{SFTP_PARTIAL_SUFFIX}'
+        start = fileObj.tell()
+
+        def put(conn):
+            fileObj.seek(start)
+            conn.put_fileobj(fileObj, tempFile, remoteFile)
+        return self.__put(remoteSite, remoteUser, privateKey, sshPort, put)
+
+    def discard(self, remoteSite, remoteUser, sshPort=22):
+        """
+        Closes and forgets the idle connections for a server.
+        """
+        key = (remoteSite, remoteUser, sshPort)
+        with self.lock:
+            idle = self.idle.pop(key, [])
+        for conn, last_used in idle:
+            self.__close(key, conn)
+
+    def close_all(self):
+        with self.lock:
+            keys = list(self.idle.keys())
+        for key in keys:
+            self.discard(*key)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'reconnects': self.reconnects,
+                'hit_ratio': self.hits / lookups if lookups else 0.0}
+
+    def __put(self, remoteSite, remoteUser, privateKey, sshPort, put):
+        for _ in range(2):
+            conn = self.checkout(remoteSite, remoteUser, privateKey, sshPort)
+            if conn.error:
+                return conn.error
+            try:
+                put(conn)
+            finally:
+                # a failed connection is closed, the retry opens a new one
+                self.checkin(conn)
+            if not conn.error:
+                return False
+        return conn.error
+
+    def __close(self, key, conn):
+        try:
+            conn.close()
+        except Exception:  # pragma: no cover
+            self.logger.debug(f"Error closing sftp connection {key}",
+                              exc_info=True)
+
+    def __private_key(self, privateKey):
+        # Parse each key file once per process
+        if not privateKey or not isinstance(privateKey, str):
+            return privateKey
+        with self.lock:
+            if privateKey not in self.private_keys:
+                try:
+                    self.private_keys[privateKey] = \
+                        self.load_key(privateKey)
+                except Exception as e:
+                    self.logger.error(f"Unable to load private key "
+                                      f"{privateKey}: {e}")
+                    return privateKey
+            return self.private_keys[privateKey]
+
+    def __check_fork(self):
+        # A forked child must not share its parent's ssh sockets
+        if self.pid != os.getpid():  # pragma: no cover
+            self.idle = {}
+            self.borrowed = {}
+            self.pid = os.getpid()
+
+
+# Shared by every upload in this process
+sftp_pool = SFTPPool()
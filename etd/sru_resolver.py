@@ -0,0 +1,95 @@
+import os
+import logging
+from etd.alma_client import get_alma_client
+import etd.alma_cache as alma_cache
+import etd.holding_xml as holding_xml
+
+"""
+Resolves many proquest ids to mms ids with a handful of SRU searches.
+The ids are ORed together into one CQL query per batch, and each query
+is paged through with startRecord and maximumRecords.
+"""
+
+# proquest ids ORed into one SRU query
+ALMA_SRU_BATCH_SIZE = int(os.getenv('ALMA_SRU_BATCH_SIZE', 25))
+# records asked for per SRU page, Alma allows at most 50
+ALMA_SRU_PAGE_SIZE = int(os.getenv('ALMA_SRU_PAGE_SIZE', 50))
+
+
+class SRUBatchResolver():
+
+    logger = logging.getLogger('etd_alma_drs_holding')
+
+    def __init__(self, alma_client=None, batch_size=ALMA_SRU_BATCH_SIZE,
+                 page_size=ALMA_SRU_PAGE_SIZE, id_cache=None):
+        """
+        Args:
+            alma_client (AlmaClient): Defaults to the process's client.
+            batch_size (int): Proquest ids per SRU query.
+            page_size (int): maximumRecords per SRU page.
+            id_cache (AlmaIdCache): If set, cached ids are not searched
+                for and resolved ids are added to it.
+        """
+        self.alma_client = alma_client or get_alma_client()
+        self.batch_size = batch_size
+        self.page_size = page_size
+        self.id_cache = id_cache
+        self.searches = 0
+
+    def resolve(self, pqids):
+        """
+        Returns:
+            tuple: (dict of proquest id to mms id, list of the proquest
+                ids that were not found)
+        """
+        mms_ids = {}
+        pending = []
+        for pqid in dict.fromkeys(str(pqid) for pqid in pqids):
+            cached = None
+            if self.id_cache is not None:
+                cached = self.id_cache.get(alma_cache.MMS_ID, pqid)
+            if cached is not None:
+                mms_ids[pqid] = cached
+            else:
+                pending.append(pqid)
+
+        for i in range(0, len(pending), self.batch_size):
+            batch = pending[i:i + self.batch_size]
+            try:
+                found = self.__search(batch)
+            except Exception as e:
+                self.logger.error(f"Error resolving mms ids for {batch}: {e}")
+                continue
+            for pqid, mms_id in found.items():
+                mms_ids[pqid] = mms_id
+                if self.id_cache is not None:
+                    self.id_cache.set(alma_cache.MMS_ID, pqid, mms_id)
+
+        missing = [pqid for pqid in pending if pqid not in mms_ids]
+        self.logger.debug(f"Resolved {len(mms_ids)} mms ids with "
+                          f"{self.searches} SRU searches, "
+                          f"{len(missing)} missing")
+        return mms_ids, missing
+
+    def __search(self, batch):
+        wanted = set(batch)
+        found = {}
+        start_record = 1
+        while True:
+            r = self.alma_client.sru_search(batch, start_record,
+                                            self.page_size)
+            self.searches += 1
+            if r.status_code != 200:
+                raise Exception(f"HTTP error {r.status_code} from SRU")
+            total, records, next_position = \
+                holding_xml.parse_sru_records(r.content)
+            for mms_id, values in records:
+                for value in values:
+                    pqid = holding_xml.proquest_id_from_035(value)
+                    if pqid in wanted and pqid not in found:
+                        found[pqid] = mms_id
+            start_record += len(records)
+            if next_position is not None:
+                start_record = next_position
+            if not records or start_record > total:
+                return found
@@ -0,0 +1,86 @@
+import os
+import time
+import random
+import threading
+import requests
+from collections import Counter
+
+"""
+Retry policy for the add_holdings task. A record that fails for a
+reason that may pass (Alma or sftp unavailable, a 429 or 5xx) is not
+retried inside the running task. The task is rescheduled through Celery
+with an exponential backoff and jitter, so the worker goes on with other
+records while it waits. The retry state travels in the message.
+"""
+
+MAX_RETRIES = int(os.getenv('MAX_RETRIES', 3))
+# backoff of the first retry, doubled for each retry after it
+DELAY_SECS = float(os.getenv('DELAY_SECS', 60))
+RETRY_MAX_DELAY_SECS = float(os.getenv('RETRY_MAX_DELAY_SECS', 900))
+# share of each delay that is randomized, 0 to 1
+RETRY_JITTER = float(os.getenv('RETRY_JITTER', 0.5))
+
+RETRY_STATE = "retry_state"
+
+# Retry outcomes in this process: scheduled, exhausted, recovered
+retry_outcomes = Counter()
+_outcomes_lock = threading.Lock()
+
+
+class RetryableError(Exception):
+    """
+    Raised when a record failed for a reason that may pass, so the task
+    should be run again later.
+    """
+
+
+def backoff_countdown(retries, base=DELAY_SECS, cap=RETRY_MAX_DELAY_SECS,
+                      jitter=RETRY_JITTER, rand=random.random):
+    """
+    Returns the seconds to wait before retry number retries + 1.
+    """
+    delay = min(cap, base * (2 ** retries))
+    return delay * (1 - jitter) + delay * jitter * rand()
+
+
+def retry_state(message):
+    """
+    Returns the retry state carried in a message, empty for a first try.
+    """
+    return message.get(RETRY_STATE) or {}
+
+
+def next_retry_message(message, error, now=None):
+    """
+    Returns a copy of message carrying the state for its next retry.
+    """
+    state = retry_state(message)
+    now = time.time() if now is None else now
+    next_state = {'count': state.get('count', 0) + 1,
+                  'first_failed_at': state.get('first_failed_at', now),
+                  'last_failed_at': now,
+                  'last_error': str(error)[:500]}
+    return dict(message, **{RETRY_STATE: next_state})
+
+
+def record_outcome(outcome):
+    with _outcomes_lock:
+        retry_outcomes[outcome] += 1
+
+
+def is_transient_status(status_code):
+    """
+    Returns True for HTTP statuses worth retrying later.
+    """
+    return status_code == 429 or status_code >= 500
+
+
+def is_transient_error(error):
+    """
+    Returns True for errors worth retrying later: connection errors,
+    timeouts and HTTP errors with a transient status.
+    """
+    if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+        return True
+    response = getattr(error, 'response', None)
+    return response is not None and is_transient_status(response.status_code)
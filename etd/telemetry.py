@@ -0,0 +1,96 @@
+import os
+import logging
+import threading
+from contextlib import contextmanager
+from opentelemetry import trace
+
+"""
+Tracing setup shared by the tasks and the holding modules. The tracer
+provider, OTLP exporter and batch span processor are created once per
+process, when the first span is started, so importing a module does not
+set up the gRPC exporter or start an export thread. TRACING=off never
+creates them, and spans are no-ops. Sampling and span limits are set in
+etd.trace_sampling.
+"""
+
+# on/off
+TRACING = os.getenv('TRACING', 'on')
+JAEGER_NAME = os.getenv('JAEGER_NAME')
+JAEGER_SERVICE_NAME = os.getenv('JAEGER_SERVICE_NAME')
+
+_provider = None
+_provider_pid = None
+_provider_lock = threading.Lock()
+
+
+def tracing_enabled():
+    return TRACING != "off"
+
+
+def _create_provider():  # pragma: no cover, starts the otlp exporter
+    from opentelemetry.sdk.resources import Resource, SERVICE_NAME
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import BatchSpanProcessor
+    from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import (
+        OTLPSpanExporter)
+    from etd.trace_sampling import (RatioSampler, TailSamplingProcessor,
+                                    span_limits)
+    resource = Resource(attributes={SERVICE_NAME: JAEGER_SERVICE_NAME})
+    provider = TracerProvider(resource=resource, sampler=RatioSampler(),
+                              span_limits=span_limits())
+    otlp_exporter = OTLPSpanExporter(endpoint=JAEGER_NAME, insecure=True)
+    provider.add_span_processor(
+        TailSamplingProcessor(BatchSpanProcessor(otlp_exporter)))
+    return provider
+
+
+def get_tracer_provider():
+    """
+    Returns this process's tracer provider, creating it and making it
+    the global provider on first use. With tracing off it is the no-op
+    provider.
+    """
+    global _provider, _provider_pid
+    if not tracing_enabled():
+        return trace.NoOpTracerProvider()
+    if _provider is not None and _provider_pid == os.getpid():
+        return _provider
+    with _provider_lock:
+        if _provider is None or _provider_pid != os.getpid():
+            provider = _create_provider()
+            if _provider is None:
+                trace.set_tracer_provider(provider)
+            _provider = provider
+            _provider_pid = os.getpid()
+            logging.getLogger('etd_alma_drs_holding').debug(
+                f"Tracer provider created in process {_provider_pid}")
+        return _provider
+
+
+class LazyTracer():
+    """
+    Tracer for one module that only sets up the provider when it starts
+    a span. Can be used as a decorator, like the sdk tracer.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    @contextmanager
+    def start_as_current_span(self, name, *args, **kwargs):
+        tracer = get_tracer_provider().get_tracer(self.name)
+        with tracer.start_as_current_span(name, *args, **kwargs) as span:
+            yield span
+
+
+def get_tracer(name):
+    return LazyTracer(name)
+
+
+def shutdown():
+    """
+    Exports the spans still buffered in this process.
+    """
+    provider = _provider if _provider_pid == os.getpid() else None
+    if provider is not None:
+        provider.shutdown()
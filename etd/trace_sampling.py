@@ -0,0 +1,186 @@
+import os
+import logging
+import threading
+from collections import Counter, OrderedDict
+from opentelemetry.sdk.trace import SpanLimits
+from opentelemetry.sdk.trace.export import SpanProcessor
+from opentelemetry.sdk.trace.sampling import (Decision, ParentBased,
+                                              Sampler, SamplingResult,
+                                              TraceIdRatioBased)
+from opentelemetry.trace import SpanContext, StatusCode, TraceFlags
+
+"""
+Sampling and payload limits for the spans of the workers.
+
+Records are head sampled at TRACE_SAMPLE_RATIO, following the sampling
+decision of the producer when the message carries a traceparent. With
+TRACE_TAIL_SAMPLING on, the records that were not sampled are still
+recorded in memory and their spans are held until the record's root span
+ends. They are exported if a span failed or the record took longer than
+TRACE_SLOW_SECS, and dropped otherwise, so failures keep full detail.
+Every record is then recorded, so the ratio only cuts what is exported,
+not the cost of recording spans. It is off by default.
+
+Spans keep at most TRACE_MAX_EVENTS events and attribute values of at most
+TRACE_MAX_ATTRIBUTE_LENGTH characters. TRACE_DROP_EVENTS_ON_SUCCESS drops
+the events of the spans that did not fail before they are exported.
+"""
+
+TRACE_SAMPLE_RATIO = float(os.getenv('TRACE_SAMPLE_RATIO', 1.0))
+# on/off
+TRACE_TAIL_SAMPLING = os.getenv('TRACE_TAIL_SAMPLING', 'off')
+TRACE_SLOW_SECS = float(os.getenv('TRACE_SLOW_SECS', 30))
+TRACE_MAX_EVENTS = int(os.getenv('TRACE_MAX_EVENTS', 32))
+TRACE_MAX_ATTRIBUTE_LENGTH = int(os.getenv('TRACE_MAX_ATTRIBUTE_LENGTH',
+                                           1024))
+# on/off
+TRACE_DROP_EVENTS_ON_SUCCESS = os.getenv('TRACE_DROP_EVENTS_ON_SUCCESS',
+                                         'off')
+# unsampled records held for tail sampling, the oldest are dropped
+TRACE_MAX_PENDING_TRACES = int(os.getenv('TRACE_MAX_PENDING_TRACES', 1000))
+
+
+def span_limits(max_events=TRACE_MAX_EVENTS,
+                max_attribute_length=TRACE_MAX_ATTRIBUTE_LENGTH):
+    return SpanLimits(max_events=max_events,
+                      max_attribute_length=max_attribute_length)
+
+
+def failed(span):
+    return span.status.status_code == StatusCode.ERROR
+
+
+def duration_secs(span):
+    return (span.end_time - span.start_time) / 1e9
+
+
+class RatioSampler(Sampler):
+    """
+    Parent based, trace id ratio sampler. With record_unsampled set the
+    traces it does not sample are recorded, so they can be promoted by
+    the TailSamplingProcessor, instead of dropped.
+    """
+
+    def __init__(self, ratio=TRACE_SAMPLE_RATIO,
+                 record_unsampled=(TRACE_TAIL_SAMPLING == "on")):
+        self.ratio = ratio
+        self.record_unsampled = record_unsampled
+        self.delegate = ParentBased(TraceIdRatioBased(ratio))
+
+    def should_sample(self, parent_context, trace_id, name, kind=None,
+                      attributes=None, links=None, trace_state=None):
+        result = self.delegate.should_sample(
+            parent_context, trace_id, name, kind, attributes, links,
+            trace_state)
+        if result.decision == Decision.DROP and self.record_unsampled:
+            return SamplingResult(Decision.RECORD_ONLY, result.attributes,
+                                  result.trace_state)
+        return result
+
+    def get_description(self):
+        return f"RatioSampler{{{self.ratio}}}"
+
+
+class ExportedSpan():
+    """
+    A finished span as it is handed to the exporter, marked sampled
+    and without its events if asked to.
+    """
+
+    def __init__(self, span, sampled=False, drop_events=False):
+        self._span = span
+        self._sampled = sampled
+        self._drop_events = drop_events
+
+    @property
+    def context(self):
+        context = self._span.context
+        if not self._sampled:
+            return context
+        return SpanContext(context.trace_id, context.span_id,
+                           context.is_remote,
+                           TraceFlags(TraceFlags.SAMPLED),
+                           context.trace_state)
+
+    @property
+    def events(self):
+        return () if self._drop_events else self._span.events
+
+    @property
+    def dropped_events(self):
+        if self._drop_events:
+            return self._span.dropped_events + len(self._span.events)
+        return self._span.dropped_events
+
+    def __getattr__(self, name):
+        return getattr(self._span, name)
+
+
+class TailSamplingProcessor(SpanProcessor):
+    """
+    Hands sampled spans to the export processor. The spans of unsampled
+    traces are held until the local root span ends, and exported only
+    if one of them failed or the root took longer than slow_secs.
+    """
+
+    logger = logging.getLogger('etd_alma_drs_holding')
+
+    def __init__(self, delegate, slow_secs=TRACE_SLOW_SECS,
+                 drop_events_on_success=(TRACE_DROP_EVENTS_ON_SUCCESS ==
+                                         "on"),
+                 max_pending_traces=TRACE_MAX_PENDING_TRACES):
+        self.delegate = delegate
+        self.slow_secs = slow_secs
+        self.drop_events_on_success = drop_events_on_success
+        self.max_pending_traces = max_pending_traces
+        self.pending = OrderedDict()
+        self.lock = threading.Lock()
+        self.counts = Counter()
+
+    def on_start(self, span, parent_context=None):
+        self.delegate.on_start(span, parent_context=parent_context)
+
+    def on_end(self, span):
+        if span.context.trace_flags.sampled:
+            self.counts['sampled'] += 1
+            self.delegate.on_end(self.__exported(span))
+            return
+
+        trace_id = span.context.trace_id
+        with self.lock:
+            self.pending.setdefault(trace_id, []).append(span)
+            self.pending.move_to_end(trace_id)
+            while len(self.pending) > self.max_pending_traces:
+                self.pending.popitem(last=False)
+                self.counts['evicted'] += 1
+            if span.parent is not None and not span.parent.is_remote:
+                return
+            spans = self.pending.pop(trace_id)
+
+        if any(failed(s) for s in spans):
+            self.counts['promoted_failed'] += 1
+        elif duration_secs(span) >= self.slow_secs:
+            self.counts['promoted_slow'] += 1
+        else:
+            self.counts['dropped'] += 1
+            return
+        for s in spans:
+            self.delegate.on_end(self.__exported(s, sampled=True))
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counts, pending=len(self.pending))
+
+    def shutdown(self):
+        self.logger.debug(f"Trace sampling stats: {self.stats()}")
+        self.delegate.shutdown()
+
+    def force_flush(self, timeout_millis=30000):
+        return self.delegate.force_flush(timeout_millis)
+
+    def __exported(self, span, sampled=False):
+        drop_events = (self.drop_events_on_success and span.events and
+                       not failed(span))
+        if not sampled and not drop_events:
+            return span
+        return ExportedSpan(span, sampled, drop_events)
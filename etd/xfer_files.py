@@ -1,15 +1,19 @@
 # flake8: noqa
 # Use this class to transfer files using sftp.
-# Multiple attempts are made for sftp operations if needed.
-# A 10 second delay is used to start with between tries.
+# Operations are tried once and report failures in self.error. Retries
+# are made by the sftp pool on a fresh connection and by rescheduling
+# the task, not by waiting here.
 #
 # TME  08/19/19  Initial version
 # TME  08/29/19  Added get_file()
 # TME  10/06/20  Now extending pysftp.Connection(). Removed the connect
 #                and disconnect routines. Added put_dir().
 
+import logging
+import paramiko
 from pysftp import Connection
-from retrying import retry
+
+logger = logging.getLogger('etd_alma_drs_holding')
 
 
 class xfer_files(Connection):  # pragma: no cover
@@ -50,9 +54,14 @@ class xfer_files(Connection):  # pragma: no cover
             print(self.error)
             return None
 
+    # pysftp only takes RSA key objects, any parsed paramiko key will do
+    def _set_authentication(self, password, private_key, private_key_pass):
+        if password is None and isinstance(private_key, paramiko.PKey):
+            self._tconnect['pkey'] = private_key
+            return
+        super()._set_authentication(password, private_key, private_key_pass)
+
     # Sftp get file from remote system.
-    @retry(stop_max_attempt_number=3, wait_exponential_multiplier=10000,
-           wait_exponential_max=100000)
     def get_file(self, remoteFile, localFile):
         try:
             self.get(remoteFile, localFile)
@@ -63,8 +72,6 @@ class xfer_files(Connection):  # pragma: no cover
             return None
 
     # Sftp put file to remote system.
-    @retry(stop_max_attempt_number=3, wait_exponential_multiplier=10000,
-           wait_exponential_max=100000)
     def put_file(self, localFile, remoteFile):
         try:
             self.put(localFile, remoteFile)
@@ -74,9 +81,26 @@ class xfer_files(Connection):  # pragma: no cover
                 (localFile, self.remoteUser, self.remoteSite, remoteFile)
             return None
 
+    # Sftp put an open binary file to remote system. It is written to
+    # tempFile and renamed to remoteFile once complete, so a reader of
+    # remoteFile never sees a partial upload.
+    def put_fileobj(self, fileObj, tempFile, remoteFile):
+        try:
+            self.putfo(fileObj, tempFile)
+            self.rename(tempFile, remoteFile)
+            self.error = False
+        except Exception:
+            self.error = 'Failed to send %s to %s@%s:%s' % \
+                (getattr(fileObj, 'name', 'stream'), self.remoteUser,
+                 self.remoteSite, remoteFile)
+            try:
+                self.remove(tempFile)
+            except Exception as e:
+                logger.warning('Unable to remove partial upload %s@%s:%s: %s' %
+                               (self.remoteUser, self.remoteSite, tempFile, e))
+            return None
+
     # Sftp put a directory recursively to a remote system.
-    @retry(stop_max_attempt_number=3, wait_exponential_multiplier=10000,
-           wait_exponential_max=100000)
     def put_dir(self, localDir, remoteDir, permissions=False):
 
         # Make directory. Set permissions if requested.
@@ -105,3 +129,22 @@ class xfer_files(Connection):  # pragma: no cover
             self.error = 'Failed to copy %s to %s@%s:%s' % \
                 (localDir, self.remoteUser, self.remoteSite, remoteDir)
             return None
+
+    # Check that the ssh transport is still up. With probe, also make a
+    # round trip on the sftp channel to catch connections the server dropped.
+    def is_alive(self, probe=False):
+        if self.error or self._transport is None:
+            return False
+        if not self._transport.is_active():
+            return False
+        if probe:
+            try:
+                self.pwd
+            except Exception:
+                return False
+        return True
+
+    # Send ssh keepalive packets so idle pooled connections stay open.
+    def set_keepalive(self, interval):
+        if self._transport is not None:
+            self._transport.set_keepalive(interval)
@@ -0,0 +1,32 @@
+import os
+import sys
+import time
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from etd.fake_alma import FakeAlma  # noqa: E402
+from etd.drs_holding_async import AsyncAlmaClient  # noqa: E402
+from etd.drs_holding_async import AsyncDRSHoldingPipeline  # noqa: E402
+# Runs the async holding pipeline against the in-process fake Alma at
+# several concurrency levels and prints records per second.
+# usage: python3 scripts/benchmark-async.py [records] [latency_secs]
+
+count = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.05
+
+with FakeAlma(latency=latency) as alma:
+    records = []
+    for i in range(count):
+        pqid = str(10000000 + i)
+        alma.add_record(pqid, f"99{i:08d}", f"22{i:08d}")
+        records.append({"pqid": pqid,
+                        "object_urn": f"URN-3:HUL.DRS.OBJECT:{i}"})
+    for concurrency in (1, 4, 8, 16):
+        client = AsyncAlmaClient(alma.client(pool_size=concurrency),
+                                 concurrency=concurrency)
+        pipeline = AsyncDRSHoldingPipeline(client, concurrency=concurrency)
+        start = time.monotonic()
+        outcomes = pipeline.run(records)
+        elapsed = time.monotonic() - start
+        client.close()
+        sent = len([o for o in outcomes.values() if o])
+        print(f"concurrency {concurrency}: {sent}/{count} records in "
+              f"{elapsed:.2f}s, {count / elapsed:.1f} records/sec")
@@ -0,0 +1,81 @@
+import os
+import re
+import sys
+import subprocess
+# Measures the cold start of a worker module: how long its import and
+# its first span take, the slowest packages each of them loads (from
+# python -X importtime), and the threads running after each.
+# usage: python3 scripts/benchmark-startup.py [module ...]
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+MODULES = sys.argv[1:] or ['tasks.tasks', 'etd.drs_holding_by_api',
+                           'etd.drs_holding_by_dropbox']
+
+PROBE = """
+import os, sys, threading, time
+start = time.perf_counter()
+import {module}
+imported = time.perf_counter()
+threads = [threading.active_count()]
+sys.stderr.write('first span\\n')
+try:
+    from etd.telemetry import get_tracer
+except ImportError:
+    # trees before etd.telemetry set their providers up at import
+    from opentelemetry.trace import get_tracer
+with get_tracer('benchmark').start_as_current_span('startup'):
+    pass
+spanned = time.perf_counter()
+threads.append(threading.active_count())
+print(imported - start, spanned - imported, *threads, flush=True)
+# skip the exit time span export, there may be no collector to take it
+os._exit(0)
+"""
+LINE = re.compile(r'import time:\s+\d+ \|\s+(\d+) \| ( *)(\S+)')
+
+
+def slowest_imports(lines, count=5):
+    imports = {}
+    for line in lines:
+        match = LINE.match(line)
+        # top level imports only, their time includes what they import
+        if match and not match.group(2):
+            imports[match.group(3)] = int(match.group(1))
+    return sorted(imports.items(), key=lambda i: -i[1])[:count]
+
+
+def measure(module):
+    env = dict(os.environ,
+               PYTHONPATH=os.pathsep.join([ROOT, f'{ROOT}/tasks']))
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c',
+         PROBE.format(module=module)],
+        cwd=ROOT, env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        return None, result.stderr
+    import_secs, span_secs, import_threads, span_threads = \
+        result.stdout.split()[-4:]
+    lines = result.stderr.splitlines()
+    split = lines.index('first span')
+    return {'import_ms': float(import_secs) * 1000,
+            'span_ms': float(span_secs) * 1000,
+            'import_threads': import_threads,
+            'span_threads': span_threads,
+            'import_slowest': slowest_imports(lines[:split]),
+            'span_slowest': slowest_imports(lines[split + 1:])}, None
+
+
+for module in MODULES:
+    stats, error = measure(module)
+    if stats is None:
+        print(f"{module}: failed\n{error[-2000:]}")
+        continue
+    print(f"{module}\n"
+          f"  import     {stats['import_ms']:8.1f}ms, "
+          f"{stats['import_threads']} threads")
+    for name, usecs in stats['import_slowest']:
+        print(f"    {usecs / 1000:8.1f}ms  {name}")
+    print(f"  first span {stats['span_ms']:8.1f}ms, "
+          f"{stats['span_threads']} threads")
+    for name, usecs in stats['span_slowest']:
+        print(f"    {usecs / 1000:8.1f}ms  {name}")
@@ -0,0 +1,37 @@
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from etd.mongo_util import MongoUtil  # noqa: E402
+import etd.mongo_util as mongo_util  # noqa: E402
+# Runs explain() on each query the service makes and fails if any of
+# them would scan the whole collection.
+# usage: python3 scripts/check-indexes.py [--create] [--test-collection]
+
+mongoutil = MongoUtil()
+if "--test-collection" in sys.argv:
+    mongoutil.set_collection(
+        mongoutil.db[os.getenv("MONGO_TEST_COLLECTION")])
+if "--create" in sys.argv:
+    mongoutil.ensure_indexes()
+
+failed = False
+for name, query in mongo_util.CANNED_QUERIES.items():
+    try:
+        plan = mongoutil.explain_query(query)
+    except Exception as e:
+        print(f"{name}: explain failed: {e}")
+        failed = True
+        continue
+    if mongo_util.collscan_stages(plan):
+        print(f"{name}: COLLSCAN on {mongoutil.collection.name} "
+              f"for {query}")
+        failed = True
+    else:
+        print(f"{name}: ok ({plan.get('stage')})")
+
+if failed:
+    print("index check FAILED, run with --create to build the "
+          "missing indexes")
+    sys.exit(1)
+print("index check passed")
+sys.exit(0)
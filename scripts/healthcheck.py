@@ -4,6 +4,8 @@ import time
 from pathlib import Path
 import requests
 from requests.packages import urllib3
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import etd.rate_limiter as rate_limiter  # noqa: E402
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 # heartbeat script for docker/k8s
 
@@ -16,16 +18,40 @@ JOBMON_URL = os.getenv("jobMonitor")
 INSTANCE = os.getenv("INSTANCE", "dev")
 
 
-# check alma
-try:
-    # need verify false b/c using selfsigned certs
-    r = requests.get(ALMA_HEALTHCHECK_URL, verify=False)
-    if (r.status_code != 200):
+def alma_token():
+    """
+    True if the probe may call alma now. It takes an alma rate limit
+    token without waiting, and only from a bucket on this node, so the
+    probe never blocks on the limiter or depends on mongo. With the mongo
+    backend the probe keeps its own bucket in the node's rate limit file,
+    each probe is a new process so a bucket in memory would always be
+    full.
+    """
+    try:
+        if rate_limiter.ALMA_RATE_LIMIT_BACKEND == "mongo":
+            limiter = rate_limiter.RateLimiter(
+                backend=rate_limiter.FileBackend(),
+                key=f"{rate_limiter.ALMA_RATE_LIMIT_KEY}-healthcheck")
+        else:
+            limiter = rate_limiter.get_rate_limiter()
+        return limiter.try_acquire()
+    except Exception:
+        return True
+
+
+# check alma, skipped when the alma rate limit has no token to spare
+if not alma_token():
+    print("alma healthcheck skipped, alma rate limit reached")
+else:
+    try:
+        # need verify false b/c using selfsigned certs
+        r = requests.get(ALMA_HEALTHCHECK_URL, verify=False)
+        if (r.status_code != 200):
+            print("alma healthcheck failed")
+            sys.exit(1)
+    except Exception:
         print("alma healthcheck failed")
         sys.exit(1)
-except Exception:
-    print("alma healthcheck failed")
-    sys.exit(1)
 
 # check jobmon if prod
 if INSTANCE == "prod":
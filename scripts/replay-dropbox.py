@@ -0,0 +1,27 @@
+import os
+import sys
+import argparse
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import etd.drs_holding_by_dropbox as drs_holding_by_dropbox  # noqa: E402
+# Sends the DASH records the dropbox batcher left behind: the pending
+# records of workers that stopped before their collection was sent, and
+# the records kept in the unsent file. Uploaded records only get their
+# mongo status. Records that fail again go back to the unsent file.
+# usage: python3 scripts/replay-dropbox.py [--pending-only]
+#            [--stale-secs N]
+
+parser = argparse.ArgumentParser(
+    description="Send the DASH records left behind by the dropbox batcher")
+parser.add_argument('--pending-only', action='store_true',
+                    help="leave the unsent file alone")
+parser.add_argument('--stale-secs', type=float,
+                    default=drs_holding_by_dropbox.DROPBOX_PENDING_STALE_SECS,
+                    help="only take pending records untouched this long")
+args = parser.parse_args()
+
+counts = drs_holding_by_dropbox.replay_dropbox_records(
+    include_unsent=not args.pending_only, stale_secs=args.stale_secs,
+    verbose=True)
+print(f"sent: {counts['sent']}, status updated: "
+      f"{counts['status_updated']}, kept as unsent: {counts['kept']}")
+sys.exit(1 if counts['kept'] else 0)
@@ -0,0 +1,118 @@
+import os
+import sys
+import json
+import argparse
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import etd.reprocess_sweep as reprocess_sweep  # noqa: E402
+# Sends the DRS holdings of many records again, after an Alma outage for
+# instance. Candidates are the records at ALMA status in mongo, or the
+# pqid and object_urn rows of a manifest (.csv or JSON lines). They are
+# run in this process or queued as add_holdings tasks, with progress
+# checkpointed so a sweep that is stopped resumes where it left off.
+# usage: python3 scripts/reprocess-sweep.py [--manifest FILE]
+#            [--query JSON] [--mode inprocess|celery] [--batch-task]
+#            [--workers N]
+#            [--chunk-size N] [--batch-size N] [--checkpoint FILE]
+#            [--restart] [--test-collection]
+
+ADD_HOLDINGS_TASK = 'etd-alma-drs-holding-service.tasks.add_holdings'
+
+parser = argparse.ArgumentParser(
+    description="Reprocess DRS holdings for many records")
+parser.add_argument('--manifest',
+                    help="a .csv or JSON lines file of pqid, object_urn, "
+                         "instead of querying mongo")
+parser.add_argument('--query', type=json.loads,
+                    help="the mongo candidate query, as JSON, defaults to "
+                         "the records at ALMA status")
+parser.add_argument('--mode', choices=['inprocess', 'celery'],
+                    default='inprocess',
+                    help="run the pipeline here, or queue add_holdings "
+                         "tasks")
+parser.add_argument('--batch-task', action='store_true',
+                    help="in celery mode, queue each chunk as one "
+                         "add_holdings_batch task")
+parser.add_argument('--workers', type=int,
+                    default=reprocess_sweep.SWEEP_WORKERS)
+parser.add_argument('--chunk-size', type=int,
+                    default=reprocess_sweep.SWEEP_CHUNK_SIZE)
+parser.add_argument('--batch-size', type=int,
+                    default=reprocess_sweep.SWEEP_BATCH_SIZE,
+                    help="the mongo cursor batch size")
+parser.add_argument('--checkpoint', default='reprocess-sweep.json')
+parser.add_argument('--restart', action='store_true',
+                    help="ignore the checkpoint and start from the "
+                         "beginning")
+parser.add_argument('--test-collection', action='store_true')
+args = parser.parse_args()
+
+if args.manifest:
+    source = f"manifest:{os.path.abspath(args.manifest)}"
+else:
+    source = f"mongo:{json.dumps(args.query, sort_keys=True)}"
+checkpoint = reprocess_sweep.Checkpoint(args.checkpoint, source)
+resume = None if args.restart else checkpoint.load()
+if resume:
+    print(f"Resuming after record {resume['position']} "
+          f"({resume['last_pqid']})")
+
+if args.mode == 'celery':
+    from celery import Celery, group
+    import etd.holding_batch as holding_batch
+    app = Celery('tasks')
+    app.config_from_object('celeryconfig')
+    queue = os.getenv("CONSUME_QUEUE_NAME")
+
+    def process(records):
+        messages = [reprocess_sweep.holding_message(record)
+                    for record in records]
+        if args.batch_task:
+            # One add_holdings_batch task for the whole chunk
+            holding_batch.send_batches(app.send_task, messages,
+                                       len(messages), queue)
+            return [True] * len(records)
+        # One publish for the whole chunk
+        group(app.signature(ADD_HOLDINGS_TASK,
+                            args=[message], queue=queue)
+              for message in messages).apply_async()
+        return [True] * len(records)
+else:
+    import tasks.tasks as tasks
+
+    def process_record(record):
+        message = reprocess_sweep.holding_message(record)
+        if args.test_collection:
+            message['integration_test'] = True
+        return tasks.create_drs_holding_record_in_alma(message)
+    process = reprocess_sweep.run_each(process_record)
+
+sweep = reprocess_sweep.Sweep(process, workers=args.workers,
+                              chunk_size=args.chunk_size,
+                              checkpoint=checkpoint, report=print)
+if args.manifest:
+    candidates = reprocess_sweep.manifest_candidates(
+        args.manifest, skip=(resume or {}).get('position', 0))
+else:
+    from etd.mongo_util import MongoUtil
+    mongoutil = MongoUtil()
+    if args.test_collection:
+        mongoutil.set_collection(
+            mongoutil.db[os.getenv("MONGO_TEST_COLLECTION")])
+    candidates = reprocess_sweep.mongo_candidates(
+        mongoutil, args.query, (resume or {}).get('last_pqid'),
+        args.batch_size, sweep.counts)
+
+try:
+    counts = sweep.run(candidates, resume)
+except KeyboardInterrupt:
+    print(f"Stopped, rerun to resume from {args.checkpoint}")
+    sys.exit(130)
+finally:
+    if args.mode == 'inprocess':
+        # Send what the pipeline still holds, as a worker does on shutdown
+        tasks.dropbox_batcher.flush_all()
+        tasks.sftp_pool.close_all()
+        tasks.job_monitor.shutdown()
+        tasks.telemetry.shutdown()
+        tasks.mongo_util.status_writer.flush()
+print(f"Sweep complete: {counts}")
@@ -2,26 +2,38 @@ from celery import Celery
 from celery import bootsteps
 from celery.signals import worker_ready
 from celery.signals import worker_shutdown
+from celery.signals import worker_process_init
+from celery.signals import worker_process_shutdown
 from pathlib import Path
 import os
+import time
 import logging
+import threading
 import etd
 import json
 from opentelemetry import trace
-from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import (
-        OTLPSpanExporter)
-from opentelemetry.sdk.resources import Resource
-from opentelemetry.sdk.trace import TracerProvider
-from opentelemetry.sdk.trace.export import BatchSpanProcessor
-from opentelemetry.sdk.resources import SERVICE_NAME
 from opentelemetry.trace.propagation.tracecontext \
     import TraceContextTextMapPropagator
 from opentelemetry.trace import Status
 from opentelemetry.trace import StatusCode
+import etd.telemetry as telemetry
 from etd.drs_holding_by_dropbox import DRSHoldingByDropbox
+from etd.drs_holding_by_dropbox import dropbox_batcher
+from etd.drs_holding_by_dropbox import replay_dropbox_records
+from etd.drs_holding_by_dropbox import DROPBOX_PENDING_STALE_SECS
+from etd.dropbox_batcher import PendingJournal
+from etd.sftp_pool import sftp_pool
 from etd.drs_holding_by_api import DRSHoldingByAPI
+from etd.drs_holding_by_api import outcome_counts
 from etd.mongo_util import MongoUtil
+from etd.record_context import load_record_context
+from etd.alma_cache import get_alma_id_cache
+from etd.sru_resolver import SRUBatchResolver
+from etd.task_retry import RetryableError
+import etd.task_retry as task_retry
+import etd.job_monitor as job_monitor
 import etd.mongo_util as mongo_util
+import etd.holding_batch as holding_batch
 import traceback
 
 app = Celery()
@@ -32,17 +44,13 @@ logger = logging.getLogger('etd_alma_drs_holding')
 FEATURE_FLAGS = "feature_flags"
 DRS_HOLDING_FEATURE_FLAG = "drs_holding_record_feature_flag"
 
-# tracing setup
-JAEGER_NAME = os.getenv('JAEGER_NAME')
-JAEGER_SERVICE_NAME = os.getenv('JAEGER_SERVICE_NAME')
+# tracing setup, the provider is created on the first span
+tracer = telemetry.get_tracer(__name__)
 
-resource = Resource(attributes={SERVICE_NAME: JAEGER_SERVICE_NAME})
-provider = TracerProvider(resource=resource)
-otlp_exporter = OTLPSpanExporter(endpoint=JAEGER_NAME, insecure=True)
-span_processor = BatchSpanProcessor(otlp_exporter)
-provider.add_span_processor(span_processor)
-trace.set_tracer_provider(provider)
-tracer = trace.get_tracer(__name__)
+# Gathers the messages sent to aggregate_holdings into batches
+holdings_aggregator = holding_batch.HoldingsAggregator(
+    app.send_task,
+    journal=PendingJournal(holding_batch.HOLDINGS_PENDING_DIR))
 
 # heartbeat setup
 # code is from
@@ -53,6 +61,9 @@ update_interval = float(os.getenv("HEALTHCHECK_UPDATE_INTERVAL", 15.0))
 HEARTBEAT_FILE = Path(hbeat_path)
 READINESS_FILE = Path(ready_path)
 UPDATE_INTERVAL = update_interval  # touch file every 15 seconds
+# how often the dropbox records left by a stopped worker are looked for
+DROPBOX_REPLAY_INTERVAL_SECS = float(os.getenv(
+    "DROPBOX_REPLAY_INTERVAL_SECS", DROPBOX_PENDING_STALE_SECS))
 
 
 class LivenessProbe(bootsteps.StartStopStep):
@@ -77,20 +88,96 @@ class LivenessProbe(bootsteps.StartStopStep):
 
 @worker_ready.connect
 def worker_ready(**_):  # pragma: no cover
+    if os.getenv("MONGO_ENSURE_INDEXES", "true") == "true":
+        try:
+            MongoUtil().ensure_indexes()
+            id_cache = get_alma_id_cache()
+            if id_cache is not None and id_cache.l2 is not None:
+                id_cache.l2.ensure_indexes()
+        except Exception as e:
+            logger.error(f"Unable to ensure mongo indexes: {e}")
+    threading.Thread(target=replay_pending, daemon=True).start()
     READINESS_FILE.touch()
 
 
+def replay_pending():  # pragma: no cover, runs for the life of the worker
+    """
+    Sends the DASH records left behind by a worker that stopped, the
+    unsent ones once at start and the stale pending ones every
+    DROPBOX_REPLAY_INTERVAL_SECS, and the add_holdings messages its
+    holdings aggregator had not sent yet.
+    """
+    include_unsent = True
+    while True:
+        try:
+            counts = replay_dropbox_records(include_unsent)
+            if counts:
+                logger.info(f"Replayed dropbox records: {dict(counts)}")
+        except Exception as e:
+            logger.error(f"Unable to replay dropbox records: {e}",
+                         exc_info=True)
+        try:
+            replayed = holdings_aggregator.replay()
+            if replayed:
+                logger.info(f"Replayed {replayed} add_holdings messages")
+        except Exception as e:
+            logger.error(f"Unable to replay add_holdings messages: {e}",
+                         exc_info=True)
+        include_unsent = False
+        time.sleep(DROPBOX_REPLAY_INTERVAL_SECS)
+
+
 @worker_shutdown.connect
 def worker_shutdown(**_):  # pragma: no cover
     READINESS_FILE.unlink(missing_ok=True)
+    # Solo and thread pools run tasks in the main process
+    holdings_aggregator.flush_all()
+    dropbox_batcher.flush_all()
+    sftp_pool.close_all()
+    # Send the completed Job Monitor reports of this process
+    job_monitor.shutdown()
+    telemetry.shutdown()
+    mongo_util.status_writer.flush()
+    mongo_util.close_client()
+    # Write the queued log records
+    etd.stop_logger()
+
+
+@worker_process_init.connect
+def worker_process_init(**_):  # pragma: no cover
+    # Each forked child builds its own mongo client on first use
+    mongo_util.reset_client()
+    # and its own log writer thread
+    etd.configure_logger()
+
+
+@worker_process_shutdown.connect
+def worker_process_shutdown(**_):  # pragma: no cover
+    # Send the aggregated messages and any DASH holdings still waiting
+    # in a dropbox collection
+    holdings_aggregator.flush_all()
+    dropbox_batcher.flush_all()
+    id_cache = get_alma_id_cache()
+    if id_cache is not None:
+        logger.info(f"Alma id cache stats: {id_cache.stats()}")
+    logger.info(f"DRS holding outcomes: {dict(outcome_counts)}")
+    logger.info(f"Retry outcomes: {dict(task_retry.retry_outcomes)}")
+    sftp_pool.close_all()
+    # Send the completed Job Monitor reports of this process
+    job_monitor.shutdown()
+    telemetry.shutdown()
+    mongo_util.status_writer.flush()
+    mongo_util.close_client()
+    # Write the queued log records
+    etd.stop_logger()
 
 
 app.steps["worker"].add(LivenessProbe)
 
 
-@app.task(serializer='json',
+@app.task(bind=True, serializer='json',
           name='etd-alma-drs-holding-service.tasks.add_holdings')
-def add_holdings(json_message):
+def add_holdings(self, json_message):
 
     ctx = None
     if "traceparent" in json_message:  # pragma: no cover, tracing is not being tested # noqa: E501
@@ -99,13 +186,15 @@ def add_holdings(json_message):
     with tracer.start_as_current_span("ALMA DRS HOLDINGS - add_holdings",
                                       context=ctx) \
             as current_span:
-        logger.debug("message")
-        logger.debug(json_message)
-        current_span.add_event(json.dumps(json_message))
+        logger.debug("message: %s", json_message)
+        if current_span.is_recording():
+            # an attribute, so it is capped at TRACE_MAX_ATTRIBUTE_LENGTH
+            current_span.add_event("message received",
+                                   {"message": json.dumps(json_message)})
         if 'pqid' in json_message:
             proquest_identifier = json_message['pqid']
             current_span.set_attribute("identifier", proquest_identifier)
-            logger.debug("processing id: " + str(proquest_identifier))
+            logger.debug("processing id: %s", proquest_identifier)
 
         feature_flag = os.getenv("DRS_HOLDING_RECORD_FEATURE_FLAG", "off")
         if feature_flag == "on":  # pragma: no cover, unit test should not create an Alma holding record # noqa: E501
@@ -136,72 +225,208 @@ def add_holdings(json_message):
                 return
 
             # Create the DRS holding record in Alma
-            create_drs_holding_record_in_alma(json_message)
+            try:
+                sent = create_drs_holding_record_in_alma(json_message)
+            except RetryableError as e:
+                schedule_retry(self, json_message, e)
+                return
+            if sent and task_retry.retry_state(json_message):
+                task_retry.record_outcome("recovered")
+                current_span.set_attribute("retry_outcome", "recovered")
         else:
             # No feature flags so do hello world for now
             return invoke_hello_world(json_message)
 
 
+def schedule_retry(task, json_message, error):
+    """
+    Reschedules add_holdings for a message with an exponential backoff,
+    or gives up once MAX_RETRIES retries have been made. Raises celery's
+    Retry when a retry is scheduled.
+    """
+    retry = next_retry(json_message, error)
+    if retry is None:
+        return
+    message, countdown = retry
+    raise task.retry(args=[message], countdown=countdown,
+                     max_retries=None, exc=error)
+
+
+def next_retry(json_message, error):
+    """
+    Returns the message and countdown of the next retry of a message
+    that failed with error, or None once MAX_RETRIES retries have been
+    made. The outcome is counted and recorded on the current span.
+    """
+    current_span = trace.get_current_span()
+    pqid = json_message.get('pqid')
+    message = task_retry.next_retry_message(json_message, error)
+    retries = message[task_retry.RETRY_STATE]['count']
+    current_span.set_attribute("retry_count", retries)
+    if retries > task_retry.MAX_RETRIES:
+        task_retry.record_outcome("exhausted")
+        current_span.set_attribute("retry_outcome", "exhausted")
+        current_span.set_status(Status(StatusCode.ERROR))
+        current_span.add_event(f"Giving up on {pqid} after "
+                               f"{task_retry.MAX_RETRIES} retries: {error}")
+        logger.error(f"Giving up on {pqid} after "
+                     f"{task_retry.MAX_RETRIES} retries: {error}")
+        return None
+    countdown = task_retry.backoff_countdown(retries - 1)
+    task_retry.record_outcome("scheduled")
+    current_span.set_attribute("retry_outcome", "scheduled")
+    current_span.add_event(f"Retry {retries} of {pqid} in "
+                           f"{countdown:.0f}s: {error}")
+    logger.info(f"Retry {retries} of {pqid} in {countdown:.0f}s: {error}")
+    return message, countdown
+
+
+@app.task(bind=True, serializer='json',
+          name=holding_batch.ADD_HOLDINGS_BATCH_TASK)
+def add_holdings_batch(self, json_messages):
+    """
+    Runs a batch of add_holdings messages. The feature flag is read, the
+    record contexts are loaded with one mongo query and the mms ids of
+    the records sent by API are resolved in bulk once for the batch.
+    Each record is traced as a child span of the batch span, and a record
+    that fails for a reason that may pass is retried on its own as an
+    add_holdings task.
+
+    Returns:
+        list: {'pqid', 'outcome'} of each message, in order.
+    """
+    with tracer.start_as_current_span(
+            "ALMA DRS HOLDINGS - add_holdings_batch") as current_span:
+        current_span.set_attribute("batch_size", len(json_messages))
+        logger.debug("batch of %d messages", len(json_messages))
+        feature_flag = os.getenv("DRS_HOLDING_RECORD_FEATURE_FLAG", "off")
+        if feature_flag == "on":  # pragma: no cover, unit test should not create an Alma holding record # noqa: E501
+            outcomes = create_drs_holding_records_in_alma(json_messages)
+            counts = holding_batch.outcome_counts(outcomes)
+            for outcome, count in counts.items():
+                current_span.set_attribute(f"{outcome}_count", count)
+            if counts[holding_batch.SENT] != len(outcomes):
+                current_span.set_status(Status(StatusCode.ERROR))
+            logger.info(f"Holdings batch outcomes: {dict(counts)}")
+            return outcomes
+        current_span.add_event("Feature flag is off, skipping batch")
+        return [holding_batch.record_outcome(message, holding_batch.SKIPPED)
+                for message in json_messages]
+
+
+@app.task(serializer='json',
+          name='etd-alma-drs-holding-service.tasks.aggregate_holdings')
+def aggregate_holdings(json_message):  # pragma: no cover, sends to the broker # noqa: E501
+    """
+    Adds a single add_holdings message to this process's aggregator,
+    which sends it on in an add_holdings_batch task.
+    """
+    holdings_aggregator.add(json_message, os.getenv("CONSUME_QUEUE_NAME"))
+
+
+def create_drs_holding_records_in_alma(json_messages):  # pragma: no cover, not sending to alma in unit tests # noqa: E501
+    """
+    Sends the holdings of a batch of messages, sharing the mongo query
+    and the mms id lookups across the batch.
+
+    Returns:
+        list: {'pqid', 'outcome'} of each message, in order.
+    """
+    return holding_batch.send_holdings(
+        json_messages, send_drs_holding, schedule_record_retry,
+        mongo_util.collection_mongoutil,
+        SRUBatchResolver(id_cache=get_alma_id_cache()))
+
+
+def schedule_record_retry(json_message, error):  # pragma: no cover, sends to the broker # noqa: E501
+    """
+    Reschedules one record of a batch as its own add_holdings task.
+    """
+    retry = next_retry(json_message, error)
+    if retry is None:
+        return holding_batch.RETRY_EXHAUSTED
+    message, countdown = retry
+    add_holdings.apply_async(args=[message], countdown=countdown,
+                             queue=os.getenv("CONSUME_QUEUE_NAME"))
+    return holding_batch.RETRY_SCHEDULED
+
+
+@app.task(serializer='json',
+          name='etd-alma-drs-holding-service.tasks.resolve_mms_ids')
+def resolve_mms_ids(json_message):  # pragma: no cover, not calling alma in unit tests # noqa: E501
+    """
+    Resolves a batch of proquest ids to mms ids with bulk SRU searches.
+    With the alma id cache on, the add_holdings tasks queued for them
+    then skip their own SRU search.
+    """
+    pqids = json_message.get('pqids', [])
+    with tracer.start_as_current_span("ALMA DRS HOLDINGS - resolve_mms_ids") \
+            as current_span:
+        current_span.set_attribute("pqid_count", len(pqids))
+        resolver = SRUBatchResolver(id_cache=get_alma_id_cache())
+        mms_ids, missing = resolver.resolve(pqids)
+        current_span.set_attribute("resolved_count", len(mms_ids))
+        current_span.set_attribute("sru_searches", resolver.searches)
+        if missing:
+            current_span.add_event(f"No mms id found for {missing}")
+            logger.warning(f"No mms id found for {missing}")
+        return {"mms_ids": mms_ids, "missing": missing}
+
+
+@app.task(serializer='json',
+          name='etd-alma-drs-holding-service.tasks.verify_holding')
+def verify_holding(record):  # pragma: no cover, not calling alma in unit tests # noqa: E501
+    """
+    Deferred read-back of an updated DRS holding, queued by the deferred
+    confirm mode on the verification queue.
+    """
+    pqid = record['pqid']
+    with tracer.start_as_current_span("ALMA DRS HOLDINGS - verify_holding") \
+            as current_span:
+        current_span.set_attribute("identifier", pqid)
+        drs_holding = DRSHoldingByAPI(pqid, record['object_urn'],
+                                      in_memory=True)
+        confirmed = drs_holding.confirm_new_drs_holding(
+            pqid, record['mms_id'], record['holding_id'],
+            record['object_urn'])
+        if not confirmed:
+            drs_holding.dump_artifacts()
+            current_span.set_status(Status(StatusCode.ERROR))
+            current_span.add_event(f"Deferred confirm of DRS holding "
+                                   f"failed for pqid {pqid}")
+            logger.error(f"Deferred confirm of DRS holding failed for "
+                         f"pqid {pqid}")
+        return confirmed
+
+
 def create_drs_holding_record_in_alma(json_message):  # pragma: no cover, not sending to alma in unit tests # noqa: E501
+    """
+    Returns True if the holding was sent. Raises RetryableError if it
+    failed for a reason that may pass.
+    """
     current_span = trace.get_current_span()
+    sent = False
     pqid = json_message['pqid']
     object_urn = json_message['object_urn']
     mongoutil = MongoUtil()
-    logger.debug("JSON Message: {}".format(json_message))
+    logger.debug("JSON Message: %s", json_message)
+    test_coll = None
     if "integration_test" in json_message:  # pragma: no cover, only changes collection # noqa
-        logger.debug("Setting Mongo Collection to {}".
-                     format(os.getenv("MONGO_TEST_COLLECTION")))
-        mongoutil.set_collection(mongoutil.db[os.getenv("MONGO_TEST_COLLECTION")])  # noqa
-    query = {mongo_util.FIELD_SUBMISSION_STATUS:
-             mongo_util.ALMA_STATUS,
-             mongo_util.FIELD_PQ_ID: pqid}
-    fields = {mongo_util.FIELD_PQ_ID: 1,
-              mongo_util.FIELD_IN_DASH: 1}
+        test_coll = os.getenv("MONGO_TEST_COLLECTION")
+        logger.debug("Setting Mongo Collection to %s", test_coll)
+        mongoutil.set_collection(mongoutil.db[test_coll])
     try:
-        matching_records = mongoutil.query_records(query, fields)
-        record_list = list(matching_records)
-        logger.debug("RECORD LIST:")
-        logger.debug(record_list)
-        if len(record_list) > 1:
-            logger.warn(f"Found {len(record_list)} for {pqid}")
-        if (len(record_list) == 0):
+        # One read for the whole pipeline, none if the message carries it
+        record_context = load_record_context(mongoutil, pqid, object_urn,
+                                             json_message)
+        if not record_context.found:
             logger.error(f"Unable to find record for {pqid}")
             current_span.set_status(Status(StatusCode.ERROR))
             current_span.add_event("Unable to find record in mongo")
             return
-        in_dash = record_list[0][mongo_util.FIELD_IN_DASH]
-        logger.debug(record_list)
-        if in_dash:
-            current_span.add_event(f"{pqid} is in DASH. Creating DRS Holding \
-                                    record in Alma by dropbox")
-            logger.info(f"{pqid} is in DASH. Creating DRS Holding \
-                                    record in Alma by dropbox")
-            # Create the DRS holding record in Alma
-            test_coll = None
-            if "integration_test" in json_message:  # pragma: no cover, only changes collection # noqa
-                test_coll = os.getenv("MONGO_TEST_COLLECTION")
-            drs_holding = DRSHoldingByDropbox(pqid, object_urn, test_coll)
-            sent = drs_holding.send_to_alma(json_message)
-            if not sent:
-                current_span.set_status(Status(StatusCode.ERROR))
-                current_span.add_event("Unable to create DRS holding record \
-                                        in Alma by dropbox")
-                logger.error("Unable to create DRS holding record \
-                                        in Alma by dropbox")
-        else:
-            current_span.add_event(f"{pqid} is NOT in DASH. Updating \
-                                    DRS Holding record in Alma by API")
-            logger.info(f"{pqid} is NOT in DASH. Updating \
-                                    DRS Holding record in Alma by API")
-            # Create the DRS holding record in Alma
-            drs_holding = DRSHoldingByAPI(pqid, object_urn)
-            sent = drs_holding.send_to_alma(json_message)
-            if not sent:
-                current_span.set_status(Status(StatusCode.ERROR))
-                current_span.add_event("Unable to create DRS holding record \
-                                        in Alma by API")
-                logger.error("Unable to create DRS holding record \
-                                        in Alma by API")
+        sent = send_drs_holding(json_message, record_context, test_coll)
+    except RetryableError:
+        raise
     except Exception as e:
         logger.error(f"Error querying records: {e}")
         exception_msg = traceback.format_exc()
@@ -210,6 +435,55 @@ def create_drs_holding_record_in_alma(json_message):  # pragma: no cover, not se
         current_span.add_event(f"Unable to query mongo for DRS  \
                                holdings for pqid {pqid}")
         current_span.record_exception(e)
+    return sent
+
+
+def send_drs_holding(json_message, record_context, test_coll=None, mms_id=None):  # pragma: no cover, not sending to alma in unit tests # noqa: E501
+    """
+    Sends the holding of a record found in mongo, by dropbox if it is in
+    DASH and by API otherwise, with the mms id resolved for its batch if
+    it has one. Returns True if it was sent, raises RetryableError if it
+    failed for a reason that may pass.
+    """
+    current_span = trace.get_current_span()
+    pqid = json_message['pqid']
+    object_urn = json_message['object_urn']
+    if record_context.in_dash:
+        current_span.add_event(f"{pqid} is in DASH. Creating DRS Holding \
+                                record in Alma by dropbox")
+        logger.info(f"{pqid} is in DASH. Creating DRS Holding \
+                                record in Alma by dropbox")
+        # Create the DRS holding record in Alma
+        drs_holding = DRSHoldingByDropbox(pqid, object_urn, test_coll,
+                                          record_context=record_context)
+        sent = drs_holding.send_to_alma(json_message)
+        if not sent:
+            current_span.set_status(Status(StatusCode.ERROR))
+            current_span.add_event("Unable to create DRS holding record \
+                                    in Alma by dropbox")
+            logger.error("Unable to create DRS holding record \
+                                    in Alma by dropbox")
+            if drs_holding.retryable:
+                raise RetryableError(f"Dropbox upload failed for {pqid}")
+    else:
+        current_span.add_event(f"{pqid} is NOT in DASH. Updating \
+                                DRS Holding record in Alma by API")
+        logger.info(f"{pqid} is NOT in DASH. Updating \
+                                DRS Holding record in Alma by API")
+        # Create the DRS holding record in Alma
+        drs_holding = DRSHoldingByAPI(pqid, object_urn,
+                                      record_context=record_context,
+                                      mms_id=mms_id)
+        sent = drs_holding.send_to_alma(json_message)
+        if not sent:
+            current_span.set_status(Status(StatusCode.ERROR))
+            current_span.add_event("Unable to create DRS holding record \
+                                    in Alma by API")
+            logger.error("Unable to create DRS holding record \
+                                    in Alma by API")
+            if drs_holding.retryable:
+                raise RetryableError(f"Alma update failed for {pqid}")
+    return sent
 
 
 def invoke_hello_world(json_message):
@@ -226,8 +500,8 @@ def invoke_hello_world(json_message):
         # to allow the pipeline to continue
         new_message = {"hello": "from etd-alma-drs-holding-service"}
         if FEATURE_FLAGS in json_message:
-            logger.debug("FEATURE FLAGS FOUND")
-            logger.debug(json_message[FEATURE_FLAGS])
+            logger.debug("FEATURE FLAGS FOUND: %s",
+                         json_message[FEATURE_FLAGS])
             new_message[FEATURE_FLAGS] = json_message[FEATURE_FLAGS]
             current_span.add_event("FEATURE FLAGS FOUND")
             current_span.add_event(json.dumps(json_message[FEATURE_FLAGS]))
@@ -236,7 +510,7 @@ def invoke_hello_world(json_message):
             proquest_identifier = json_message['pqid']
             new_message["pqid"] = proquest_identifier
             current_span.set_attribute("identifier", proquest_identifier)
-            logger.debug("processing id: " + str(proquest_identifier))
+            logger.debug("processing id: %s", proquest_identifier)
 
         # If only unit testing, return the message and
         # do not trigger the next task.
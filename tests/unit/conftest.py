@@ -0,0 +1,151 @@
+import os
+import socket
+import threading
+import paramiko
+import pytest
+import etd.telemetry as telemetry
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+from opentelemetry.sdk.trace.export.in_memory_span_exporter import (
+    InMemorySpanExporter)
+
+# The unit tests keep their spans in memory, so they never need an OTLP
+# collector or wait on its retries when the interpreter exits
+span_exporter = InMemorySpanExporter()
+
+
+def create_provider():
+    provider = TracerProvider()
+    provider.add_span_processor(SimpleSpanProcessor(span_exporter))
+    return provider
+
+
+@pytest.fixture(autouse=True)
+def in_memory_tracing(monkeypatch):
+    monkeypatch.setattr(telemetry, "_create_provider", create_provider)
+    yield span_exporter
+    span_exporter.clear()
+
+
+class LocalSFTPHandler(paramiko.SFTPServerInterface):
+    """
+    Serves the paths under root, enough for an upload and rename.
+    """
+
+    def __init__(self, server, root):
+        super().__init__(server)
+        self.root = root
+
+    def canonicalize(self, path):
+        return os.path.normpath('/' + path)
+
+    def open(self, path, flags, attr):
+        try:
+            fd = os.open(self.__local(path), flags, 0o644)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        handle = paramiko.SFTPHandle(flags)
+        handle.writefile = os.fdopen(fd, 'wb')
+        return handle
+
+    def stat(self, path):
+        return paramiko.SFTPAttributes.from_stat(os.stat(self.__local(path)))
+
+    def remove(self, path):
+        try:
+            os.remove(self.__local(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def rename(self, oldpath, newpath):
+        os.rename(self.__local(oldpath), self.__local(newpath))
+        return paramiko.SFTP_OK
+
+    def __local(self, path):
+        return os.path.join(self.root, path.lstrip('/'))
+
+
+class LocalSFTPServer(paramiko.ServerInterface):
+    """
+    An sftp server on a localhost port that takes one user key, so the
+    pool can be run against real ssh connections.
+    """
+
+    def __init__(self, root, host_key, user_key):
+        self.root = root
+        self.host_key = host_key
+        self.user_key = user_key
+        self.transports = []
+        self.keepalives = 0
+        self.sock = socket.socket()
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen()
+        self.port = self.sock.getsockname()[1]
+        self.thread = threading.Thread(target=self.__serve, daemon=True)
+        self.thread.start()
+
+    def check_auth_publickey(self, username, key):
+        if key == self.user_key:
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def get_allowed_auths(self, username):
+        return 'publickey'
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+    def check_global_request(self, kind, msg):
+        if kind == 'keepalive@lag.net':
+            self.keepalives += 1
+        return False
+
+    def drop_connections(self):
+        for transport in self.transports:
+            transport.close()
+
+    def stop(self):
+        # wakes the accept() in the serving thread
+        self.sock.shutdown(socket.SHUT_RDWR)
+        self.sock.close()
+        self.thread.join()
+        self.drop_connections()
+
+    def __serve(self):
+        while True:
+            try:
+                client, _ = self.sock.accept()
+            except OSError:
+                return
+            transport = paramiko.Transport(client)
+            transport.add_server_key(self.host_key)
+            transport.set_subsystem_handler('sftp', paramiko.SFTPServer,
+                                            LocalSFTPHandler, self.root)
+            transport.start_server(server=self)
+            self.transports.append(transport)
+
+
+@pytest.fixture(scope="session")
+def ssh_keys():
+    return paramiko.RSAKey.generate(2048), paramiko.RSAKey.generate(2048)
+
+
+@pytest.fixture
+def sftp_server(tmp_path, monkeypatch, ssh_keys):
+    """
+    A local sftp server serving tmp_path/root, trusted by pysftp through
+    a known_hosts file in a temporary home directory.
+    """
+    host_key, user_key = ssh_keys
+    root = tmp_path / "root"
+    (root / "incoming").mkdir(parents=True)
+    home = tmp_path / "home"
+    (home / ".ssh").mkdir(parents=True)
+    (home / ".ssh" / "known_hosts").write_text(
+        f"127.0.0.1 {host_key.get_name()} {host_key.get_base64()}\n")
+    user_key.write_private_key_file(str(home / ".ssh" / "id_rsa"))
+    monkeypatch.setenv("HOME", str(home))
+    server = LocalSFTPServer(str(root), host_key, user_key)
+    yield server
+    server.stop()
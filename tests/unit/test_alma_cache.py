@@ -0,0 +1,179 @@
+from etd.alma_cache import LRUCache, AlmaIdCache, MongoCacheStore
+from etd.alma_cache import MMS_ID, HOLDING_ID, holding_not_found
+from etd.alma_cache import get_alma_id_cache
+from etd.drs_holding_by_api import DRSHoldingByAPI
+from etd.fake_alma import FakeAlma
+import etd.alma_cache as alma_cache
+from datetime import datetime, timedelta
+
+
+class FakeClock():
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeResponse():
+
+    def __init__(self, status_code, text):
+        self.status_code = status_code
+        self.text = text
+
+
+class FakeCollection():
+    """
+    Stands in for the mongo cache collection.
+    """
+
+    def __init__(self):
+        self.docs = {}
+        self.indexes = []
+
+    def find_one(self, query):
+        doc = self.docs.get(query['_id'])
+        if doc is None or doc['expires_at'] <= query['expires_at']['$gt']:
+            return None
+        return doc
+
+    def update_one(self, query, update, upsert=False):
+        self.docs.setdefault(query['_id'], {}).update(update['$set'])
+
+    def delete_one(self, query):
+        self.docs.pop(query['_id'], None)
+
+    def create_index(self, key, **kwargs):
+        self.indexes.append((key, kwargs))
+
+
+class BrokenStore():
+
+    def get(self, key):
+        raise Exception("mongo is down")
+
+    set = delete = get
+
+
+class TestAlmaCache():
+
+    def test_lru_cache(self):
+        """
+        Test that the least recently used and expired entries are dropped.
+        """
+        clock = FakeClock()
+        cache = LRUCache(max_size=2, ttl=10, clock=clock)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        assert cache.get("a") == 1
+        cache.set("c", 3)
+        assert cache.get("b") is None
+        assert len(cache) == 2
+        clock.now = 10
+        assert cache.get("a") is None
+        cache.delete("c")
+        assert len(cache) == 0
+
+    def test_two_levels(self):
+        """
+        Test that L2 fills L1, invalidation clears both, and the hit
+        ratio is counted.
+        """
+        collection = FakeCollection()
+        store = MongoCacheStore(collection, ttl=60)
+        cache = AlmaIdCache(LRUCache(), store)
+        assert cache.get(MMS_ID, "123") is None
+        cache.set(MMS_ID, "123", "991")
+        assert cache.get(MMS_ID, "123") == "991"
+
+        # a new worker only has the shared level
+        other = AlmaIdCache(LRUCache(), store)
+        assert other.get(MMS_ID, "123") == "991"
+        assert other.get(MMS_ID, "123") == "991"
+        assert other.stats() == {'l1_hits': 1, 'l2_hits': 1, 'misses': 0,
+                                 'invalidations': 0, 'hit_ratio': 1.0}
+
+        other.invalidate(MMS_ID, "123")
+        assert other.get(MMS_ID, "123") is None
+        assert cache.l1.get("mms_id:123") == "991"
+        assert cache.stats()['hit_ratio'] == 0.5
+
+        expired = datetime.utcnow() - timedelta(seconds=1)
+        collection.docs["holding_id:991"] = {'value': "221",
+                                             'expires_at': expired}
+        assert cache.get(HOLDING_ID, "991") is None
+
+        store.ensure_indexes()
+        ttl_index = ('expires_at', {'expireAfterSeconds': 0,
+                                    'name': 'expires_at_ttl'})
+        assert collection.indexes == [ttl_index]
+        assert AlmaIdCache().stats()['hit_ratio'] == 0.0
+
+    def test_broken_l2(self):
+        """
+        Test that an unreachable L2 only costs cache misses.
+        """
+        cache = AlmaIdCache(LRUCache(), BrokenStore())
+        cache.set(MMS_ID, "123", "991")
+        assert cache.get(MMS_ID, "123") == "991"
+        cache.invalidate(MMS_ID, "123")
+        assert cache.get(MMS_ID, "123") is None
+
+    def test_holding_not_found(self):
+        """
+        Test which Alma errors mean a cached id is stale.
+        """
+        assert holding_not_found(FakeResponse(
+            400, "<web_service_result>Holding not found"))
+        assert holding_not_found(FakeResponse(
+            400, "Input parameters mmsId 991, holding ID 221 are not "
+                 "valid."))
+        assert not holding_not_found(FakeResponse(400, "Bad xml"))
+        assert not holding_not_found(FakeResponse(500, "not found"))
+
+    def test_shared_cache(self, monkeypatch):
+        """
+        Test that the process cache is only built when turned on.
+        """
+        assert get_alma_id_cache() is None
+        monkeypatch.setattr(alma_cache, "ALMA_ID_CACHE", "on")
+        monkeypatch.setattr(alma_cache, "ALMA_ID_CACHE_L2", "off")
+        monkeypatch.setattr(alma_cache, "_cache", None)
+        cache = get_alma_id_cache()
+        assert cache is get_alma_id_cache()
+        assert cache.l2 is None
+
+    def test_cached_lookups(self, tmp_path):
+        """
+        Test that a record seen before skips the SRU and holdings list
+        calls, and that a missing holding invalidates its ids.
+        """
+        pqid = "28542882"
+        object_urn = "URN-3:HUL.DRS.OBJECT:12345678"
+        cache = AlmaIdCache(LRUCache())
+        with FakeAlma() as alma:
+            alma.add_record(pqid, "991", "221")
+            for _ in range(2):
+                drs_holding = DRSHoldingByAPI(pqid, object_urn, True,
+                                              alt_output_dir=str(tmp_path),
+                                              in_memory=True)
+                drs_holding.alma_client = alma.client()
+                drs_holding.id_cache = cache
+                mms_id = drs_holding.get_mms_id(pqid)
+                holding_id = drs_holding.get_drs_holding_id_by_mms_id(mms_id)
+                assert drs_holding.get_drs_holding(mms_id, holding_id)
+                drs_holding.alma_client.close()
+            assert alma.request_count() == 4
+            assert cache.stats()['hit_ratio'] == 0.5
+
+            # the holding was replaced in Alma
+            del alma.holding_records[("991", "221")]
+            drs_holding.alma_client = alma.client()
+            assert not drs_holding.get_drs_holding(mms_id, holding_id)
+            drs_holding.id_cache = None
+            assert not drs_holding.get_drs_holding(mms_id, holding_id)
+            drs_holding.alma_client.close()
+        assert drs_holding.stale_ids
+        assert cache.get(MMS_ID, pqid) is None
+        assert cache.get(HOLDING_ID, "991") is None
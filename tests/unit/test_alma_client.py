@@ -0,0 +1,37 @@
+from etd.alma_client import AlmaClient, get_alma_client
+import requests_mock
+
+
+class TestAlmaClient():
+
+    def test_api_key_in_header(self):
+        """
+        Test that the API key is sent as a header and not in the url.
+        """
+        client = AlmaClient(api_base="https://alma.example.edu",
+                            api_key="secret",
+                            sru_base="https://alma.example.edu/sru?q=")
+        holding_url = client.holding_url("991", "221")
+        assert holding_url == \
+            "https://alma.example.edu/almaws/v1/bibs/991/holdings/221"
+        with requests_mock.Mocker() as m:
+            m.get(holding_url, text="<holding/>")
+            m.put(holding_url, text="<holding/>")
+            m.get("https://alma.example.edu/sru?q=555", text="<sru/>")
+            assert client.get(holding_url).status_code == 200
+            client.put(holding_url, b"<holding/>",
+                       {'Content-Type': 'application/xml'})
+            client.sru_get("555")
+            get, put, sru = m.request_history
+        assert "secret" not in get.url
+        assert get.headers["Authorization"] == "apikey secret"
+        assert put.headers["Content-Type"] == "application/xml"
+        assert put.headers["Authorization"] == "apikey secret"
+        assert "Authorization" not in sru.headers
+        client.close()
+
+    def test_shared_client(self):
+        """
+        Test that a process shares one Alma client.
+        """
+        assert get_alma_client() is get_alma_client()
@@ -0,0 +1,52 @@
+import io
+import pytest
+from lxml import etree
+from etd.collection_writer import spool_collection, write_collection
+
+RECORD = '<record><datafield tag="245"><subfield code="a">Café &amp; ' \
+         'Tea</subfield></datafield></record>'
+
+
+class TestCollectionWriter():
+
+    def test_write_collection(self):
+        """
+        Test that records are written as one UTF-8 collection document.
+        """
+        out = io.BytesIO()
+        assert write_collection(out, [RECORD, RECORD]) == 2
+        collection = etree.fromstring(out.getvalue())
+        assert collection.tag == '{http://www.loc.gov/MARC21/slim}collection'
+        assert len(collection) == 2
+        assert collection[0].findtext('.//{*}subfield') == 'Café & Tea'
+        assert out.getvalue().startswith(
+            b'<?xml version="1.0" encoding="UTF-8"?>\n\n<collection ')
+        assert out.getvalue().endswith(b'</record></collection>\n')
+
+    def test_spool_stays_in_memory(self):
+        """
+        Test that a small collection is spooled in memory and rewound.
+        """
+        with spool_collection([RECORD], max_bytes=1024 * 1024) as f:
+            assert not f._rolled
+            assert f.tell() == 0
+            assert RECORD.encode('utf-8') in f.read()
+
+    def test_spool_rolls_to_disk(self):
+        """
+        Test that a large collection moves to a temporary file, and can be
+        read back in chunks.
+        """
+        records = (RECORD for _ in range(1000))
+        with spool_collection(records, max_bytes=4096) as f:
+            assert f._rolled
+            chunks = iter(lambda: f.read(32768), b'')
+            collection = etree.fromstring(b''.join(chunks))
+            assert len(collection) == 1000
+
+    def test_spool_is_closed_on_error(self):
+        """
+        Test that a record that cannot be written closes the buffer.
+        """
+        with pytest.raises(AttributeError):
+            spool_collection([RECORD, None])
@@ -0,0 +1,110 @@
+import etd
+import logging
+import queue
+
+
+class ListHandler(logging.Handler):
+
+    def __init__(self):
+        super().__init__()
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(self.format(record))
+
+
+def queue_handlers(logger):
+    return [handler for handler in logger.handlers
+            if isinstance(handler, etd.DroppingQueueHandler)]
+
+
+class TestConfigureLogger():
+
+    def test_configure_once(self, monkeypatch):
+        """
+        Test that configuring again does not add handlers, and that
+        records are written by the listener thread.
+        """
+        monkeypatch.setenv("APP_LOG_LEVEL", "DEBUG")
+        etd.stop_logger()
+        written = ListHandler()
+        logger = etd.configure_logger([written])
+        etd.configure_logger([ListHandler()])
+        etd.configure_logger()
+        assert len(queue_handlers(logger)) == 1
+        logger.debug("Found %d records for %s", 2, "28542882")
+        etd.stop_logger()
+        assert written.messages == ["Found 2 records for 28542882"]
+        assert queue_handlers(logger) == []
+        etd.stop_logger()
+
+    def test_configure_after_fork(self, monkeypatch):
+        """
+        Test that a forked process replaces the handler it inherited.
+        """
+        etd.stop_logger()
+        logger = etd.configure_logger([ListHandler()])
+        inherited = etd._listener
+        monkeypatch.setattr(etd, "_listener_pid", -1)
+        etd.stop_logger()
+        written = ListHandler()
+        etd.configure_logger([written])
+        inherited.stop()
+        assert len(queue_handlers(logger)) == 1
+        logger.warning("written by the new listener")
+        etd.stop_logger()
+        assert written.messages == ["written by the new listener"]
+
+    def test_full_queue_drops(self):
+        """
+        Test that low records are dropped at once when the queue is full,
+        that warnings wait for room first, and that the drops are logged
+        through the queue.
+        """
+        now = [0.0]
+        log_queue = queue.Queue(maxsize=1)
+        full = etd.DroppingQueueHandler(log_queue, block_secs=0.01,
+                                        report_secs=60,
+                                        clock=lambda: now[0])
+
+        def record(level, msg):
+            return logging.LogRecord("etd_alma_drs_holding", level,
+                                     __file__, 1, msg, None, None)
+
+        full.handle(record(logging.INFO, "kept"))
+        full.handle(record(logging.DEBUG, "dropped"))
+        full.handle(record(logging.ERROR, "dropped after a wait"))
+        assert full.dropped == 2
+        assert log_queue.get_nowait().getMessage() == "kept"
+
+        now[0] = 30
+        full.handle(record(logging.INFO, "before the report is due"))
+        assert log_queue.get_nowait().getMessage() == \
+            "before the report is due"
+        now[0] = 60
+        full.handle(record(logging.INFO, "report is due"))
+        assert log_queue.get_nowait().getMessage() == "report is due"
+        # no room for the report, it is made with the next one
+        assert full.unreported == 2
+
+        now[0] = 120
+        log_queue = full.queue = queue.Queue()
+        full.handle(record(logging.INFO, "room"))
+        assert [log_queue.get_nowait().getMessage() for i in range(2)] == \
+            ["room", "2 log records were dropped, the log queue was full"]
+        assert full.unreported == 0 and full.dropped == 2
+
+    def test_drops_are_written_at_stop(self):
+        """
+        Test that the drops not yet reported are written by the listener
+        when it stops, not by logging's last resort handler.
+        """
+        etd.stop_logger()
+        written = ListHandler()
+        logger = etd.configure_logger([written])
+        handler = queue_handlers(logger)[0]
+        with handler.lock:
+            handler.dropped = handler.unreported = 3
+        etd.stop_logger()
+        assert written.messages == \
+            ["3 log records were dropped, the log queue was full"]
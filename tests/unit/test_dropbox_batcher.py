@@ -0,0 +1,226 @@
+from etd.dropbox_batcher import DropboxBatcher, PendingJournal
+import os
+import time
+import pytest
+
+
+class TestDropboxBatcher():
+
+    def test_flush_on_size(self):
+        """
+        Test that a collection is flushed once it reaches max_records.
+        """
+        flushed = []
+        batcher = DropboxBatcher(lambda key, entries:
+                                 flushed.append((key, entries)) or True,
+                                 max_records=2, window_secs=0)
+        batcher.add(("gsd", "AlmaDRSDark"), {"pqid": "1"})
+        assert flushed == []
+        assert batcher.pending_count(("gsd", "AlmaDRSDark")) == 1
+        batcher.add(("dce", "AlmaDRSDark"), {"pqid": "2"})
+        batcher.add(("gsd", "AlmaDRSDark"), {"pqid": "3"})
+        assert flushed == [(("gsd", "AlmaDRSDark"),
+                            [{"pqid": "1"}, {"pqid": "3"}])]
+        assert batcher.pending_count() == 1
+
+    def test_flush_on_window(self):
+        """
+        Test that a collection is flushed when its time window ends.
+        """
+        flushed = []
+        batcher = DropboxBatcher(lambda key, entries:
+                                 flushed.append(key) or True,
+                                 max_records=10, window_secs=0.05)
+        batcher.add("gsd", {"pqid": "1"})
+        batcher.add("gsd", {"pqid": "2"})
+        for _ in range(100):
+            if flushed:
+                break
+            time.sleep(0.01)
+        assert flushed == ["gsd"]
+        assert batcher.pending_count() == 0
+
+    def test_failed_flush_requeues(self):
+        """
+        Test that records stay pending when a flush fails and are dropped
+        by a shutdown flush that does not requeue.
+        """
+        def failing_flush(key, entries):
+            raise Exception("dropbox is down")
+
+        batcher = DropboxBatcher(failing_flush, max_records=1, window_secs=0)
+        batcher.add("gsd", {"pqid": "1"})
+        assert batcher.pending_count("gsd") == 1
+        assert not batcher.flush_all()
+        assert batcher.pending_count() == 0
+        assert batcher.flush("gsd")
+
+    def test_uploaded_records_are_not_requeued(self):
+        """
+        Test that the records of a failed flush that were uploaded are
+        handed to on_drop instead of being sent again, and that a
+        shutdown flush hands over the records it gives up on.
+        """
+        flushes = []
+        dropped = []
+
+        def flush(key, entries):
+            flushes.append([entry["pqid"] for entry in entries])
+            # uploaded, then the status update of record 2 failed
+            for entry in entries:
+                entry["uploaded"] = entry["pqid"] == "2"
+            return False
+
+        batcher = DropboxBatcher(flush, max_records=10, window_secs=0,
+                                 on_drop=lambda key, entries:
+                                 dropped.append((key, entries)))
+        batcher.add("gsd", {"pqid": "1"})
+        batcher.add("gsd", {"pqid": "2"})
+        assert not batcher.flush("gsd")
+        assert dropped == [("gsd", [{"pqid": "2", "uploaded": True}])]
+        assert batcher.pending_count("gsd") == 1
+
+        assert not batcher.flush_all()
+        assert flushes == [["1", "2"], ["1"]]
+        assert dropped[1] == ("gsd", [{"pqid": "1", "uploaded": False}])
+        assert batcher.pending_count() == 0
+
+        def failing_drop(key, entries):
+            raise OSError("disk full")
+        batcher.on_drop = failing_drop
+        batcher.add("gsd", {"pqid": "3"})
+        assert not batcher.flush_all()
+
+    def test_attempts_are_capped(self):
+        """
+        Test that a record is handed to on_drop once it has been part of
+        max_attempts failed flushes, instead of being requeued forever.
+        """
+        flushes = []
+        dropped = []
+
+        def flush(key, entries):
+            flushes.append([entry["pqid"] for entry in entries])
+            return False
+
+        batcher = DropboxBatcher(flush, max_records=10, window_secs=0,
+                                 on_drop=lambda key, entries:
+                                 dropped.extend(entries),
+                                 max_attempts=2)
+        batcher.add("gsd", {"pqid": "1"})
+        assert not batcher.flush("gsd")
+        batcher.add("gsd", {"pqid": "2"})
+        assert not batcher.flush("gsd")
+        assert dropped == [{"pqid": "1"}]
+        assert batcher.pending_count("gsd") == 1
+        assert not batcher.flush("gsd")
+        assert dropped == [{"pqid": "1"}, {"pqid": "2"}]
+        assert flushes == [["1"], ["1", "2"], ["2"]]
+        assert batcher.pending_count() == 0
+        assert batcher.attempts == {}
+
+        batcher.flush_fn = lambda key, entries: True
+        batcher.add("gsd", {"pqid": "3"})
+        assert batcher.flush("gsd")
+        assert batcher.attempts == {}
+
+    def test_duplicates_are_not_added(self):
+        """
+        Test that a record already pending or being flushed, like one of
+        a redelivered message, is not added to a collection again.
+        """
+        flushed = []
+        batcher = DropboxBatcher(lambda key, entries: True, max_records=10,
+                                 window_secs=0)
+
+        def flush(key, entries):
+            # redelivered while its collection is being uploaded
+            flushed.append(batcher.add(key, {"pqid": "1", "batch": "b1"}))
+            return True
+
+        assert batcher.add("gsd", {"pqid": "1", "batch": "b1"})
+        assert not batcher.add("gsd", {"pqid": "1", "batch": "b1"})
+        assert batcher.add("gsd", {"pqid": "1", "batch": "b2"})
+        assert batcher.pending_count("gsd") == 2
+        batcher.flush_fn = flush
+        assert batcher.flush("gsd")
+        assert flushed == [False]
+        assert batcher.add("gsd", {"pqid": "1", "batch": "b1"})
+        # entries without a pqid are told apart by identity
+        entry = object()
+        assert batcher.add("gsd", entry)
+        assert not batcher.add("gsd", entry)
+        assert batcher.add("gsd", object())
+
+    def test_journal(self, tmp_path):
+        """
+        Test that pending records are on disk from add until they are
+        delivered or kept, and left there when they could not be kept.
+        """
+        journal = PendingJournal(str(tmp_path / "pending"))
+        results = [False, True]
+        batcher = DropboxBatcher(lambda key, entries: results.pop(0),
+                                 max_records=10, window_secs=0,
+                                 journal=journal,
+                                 to_record=lambda entry: entry["pqid"])
+        batcher.add(("gsd", "AlmaDRSDark"), {"pqid": "1"})
+        assert journal.claim(3600) == []
+        claims = journal.claim(0)
+        # keys come back as json lists
+        assert [(key, record) for claim, key, record in claims] == \
+            [(["gsd", "AlmaDRSDark"], "1")]
+        journal.done(claims[0][0])
+        assert os.listdir(tmp_path / "pending") == []
+
+        batcher.add(("gsd", "AlmaDRSDark"), {"pqid": "2"})
+        batcher.add(("gsd", "AlmaDRSDark"), {"pqid": "3"})
+        assert not batcher.flush(("gsd", "AlmaDRSDark"))
+        assert len(os.listdir(tmp_path / "pending")) == 2
+        assert batcher.flush(("gsd", "AlmaDRSDark"))
+        assert os.listdir(tmp_path / "pending") == []
+
+        def failing_drop(key, entries):
+            raise OSError("disk full")
+        batcher.flush_fn = lambda key, entries: False
+        batcher.on_drop = failing_drop
+        batcher.add("gsd", {"pqid": "4"})
+        assert not batcher.flush_all()
+        # left for the replay
+        assert len(os.listdir(tmp_path / "pending")) == 1
+        batcher.on_drop = lambda key, entries: None
+        batcher.add("gsd", {"pqid": "5"})
+        assert not batcher.flush_all()
+        assert len(os.listdir(tmp_path / "pending")) == 1
+
+    def test_journal_claims(self, tmp_path, monkeypatch):
+        """
+        Test that a stale record is claimed by one caller only, that an
+        unreleased claim becomes stale in turn, and that a journal that
+        can not be written fails the add.
+        """
+        journal = PendingJournal(str(tmp_path / "pending"))
+        journal.add(["1", "b1"], "gsd", {"pqid": "1"})
+        journal.touch(["1", "b1"])
+        journal.touch(["2", "b2"])
+        journal.remove(["2", "b2"])
+        (tmp_path / "pending" / "bad.json").write_text("{")
+        (tmp_path / "pending" / "x.json.1.tmp").write_text("{")
+        claims = journal.claim(0)
+        assert [record for claim, key, record in claims] == [{"pqid": "1"}]
+        assert journal.claim(3600) == []
+        assert len(journal.claim(0)) == 1
+
+        def claimed_by_another(src, dst):
+            raise FileNotFoundError(src)
+        with monkeypatch.context() as m:
+            m.setattr(os, "rename", claimed_by_another)
+            assert journal.claim(0) == []
+
+        assert PendingJournal(str(tmp_path / "none")).claim(0) == []
+        (tmp_path / "file").write_text("")
+        batcher = DropboxBatcher(lambda key, entries: True,
+                                 journal=PendingJournal(
+                                     str(tmp_path / "file")))
+        with pytest.raises(OSError):
+            batcher.add("gsd", {"pqid": "1"})
+        assert batcher.attempts == {}
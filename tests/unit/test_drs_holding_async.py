@@ -0,0 +1,255 @@
+import threading
+from etd.drs_holding_async import AsyncAlmaClient, AsyncDRSHoldingPipeline
+from etd.fake_alma import FakeAlma
+from etd.alma_cache import AlmaIdCache
+from etd.holding_confirm import FullConfirm, PutResponseConfirm
+import etd.alma_cache as alma_cache
+import etd.holding_xml as holding_xml
+
+
+class FakeMongoUtil():
+
+    def __init__(self):
+        self.updates = []
+        self.threads = set()
+
+    def update_status(self, query, status, durable=False):
+        self.threads.add(threading.current_thread())
+        self.updates.append((query, status, durable))
+
+
+class TestAsyncDRSHoldingPipeline():
+
+    def test_process_records(self):
+        """
+        Test that holdings for many pqids are updated and confirmed
+        concurrently against the fake Alma server.
+        """
+        with FakeAlma() as alma:
+            records = []
+            for i in range(6):
+                pqid = f"5555000{i}"
+                alma.add_record(pqid, f"9915{i}", f"2226{i}")
+                records.append({"pqid": pqid,
+                                "object_urn": f"URN-3:HUL.DRS.OBJECT:{i}",
+                                "directory_id": f"proquest{i}-0-gsas"})
+            del records[0]["directory_id"]
+            alma.add_record("77777777", "99177", "22677", location="GEN")
+            records.append({"pqid": "77777777",
+                            "object_urn": "URN-3:HUL.DRS.OBJECT:7"})
+            records.append({"pqid": "88888888",
+                            "object_urn": "URN-3:HUL.DRS.OBJECT:8"})
+
+            mongoutil = FakeMongoUtil()
+            client = AsyncAlmaClient(alma.client(), concurrency=3)
+            pipeline = AsyncDRSHoldingPipeline(
+                client, concurrency=3, mongoutil=mongoutil,
+                confirm_strategy=FullConfirm())
+            outcomes = pipeline.run(records)
+            client.close()
+
+            assert outcomes.pop("77777777") is False
+            assert outcomes.pop("88888888") is False
+            assert all(outcomes.values())
+            assert len(mongoutil.updates) == 5
+            assert all(durable for _, _, durable in mongoutil.updates)
+            # written off the event loop's thread
+            assert threading.main_thread() not in mongoutil.threads
+            assert alma.request_count("PUT") == 6
+            holding = alma.holding_records[("99153", "22263")]
+            assert holding_xml.holding_urn_statement(holding) == \
+                "Preservation master, URN-3:HUL.DRS.OBJECT:3"
+
+    def test_alma_errors(self):
+        """
+        Test that Alma errors fail the record without raising.
+        """
+        with FakeAlma() as alma:
+            alma.add_record("55550000", "99150", "22260")
+            client = alma.client()
+            client.api_key = "wrong-key"
+            pipeline = AsyncDRSHoldingPipeline(AsyncAlmaClient(client, 2))
+            assert pipeline.run([{"pqid": "55550000",
+                                  "object_urn": "URN"}]) == \
+                {"55550000": False}
+            client.sru_base = "http://127.0.0.1:1/sru?query="
+            assert pipeline.run([{"pqid": "55550000",
+                                  "object_urn": "URN"}]) == \
+                {"55550000": False}
+
+    def test_failed_steps(self):
+        """
+        Test that a failure at any step of the pipeline fails the record.
+        """
+        class FailingAlma(FakeAlma):
+            def __init__(self, fail_request):
+                super().__init__()
+                self.fail_request = fail_request
+
+            def handle(self, method, path, query, headers, body):
+                if self.request_count() == self.fail_request:
+                    self.requests.append((method, path))
+                    return 500, b'<web_service_result/>'
+                if method == 'PUT' and self.fail_request == 5:
+                    body = self.holding_records[("99150", "22260")]
+                return super().handle(method, path, query, headers, body)
+
+        # SRU, holdings list, holding GET, PUT, confirm GET, mismatch
+        for fail_request in range(6):
+            with FailingAlma(fail_request) as alma:
+                alma.add_record("55550000", "99150", "22260")
+                pipeline = AsyncDRSHoldingPipeline(
+                    AsyncAlmaClient(alma.client(), 1), 1, FakeMongoUtil(),
+                    confirm_strategy=FullConfirm())
+                assert pipeline.run([{"pqid": "55550000",
+                                      "object_urn": "URN"}]) == \
+                    {"55550000": False}
+
+        with FakeAlma() as alma:
+            alma.add_record("55550000", "99150", "22260")
+            alma.holdings["99150"] = []
+            pipeline = AsyncDRSHoldingPipeline(
+                AsyncAlmaClient(alma.client(), 1), 1, FakeMongoUtil())
+            assert pipeline.run([{"pqid": "55550000",
+                                  "object_urn": "URN"}]) == \
+                {"55550000": False}
+
+    def test_noop(self):
+        """
+        Test that a holding that already carries the urn is not PUT again.
+        """
+        with FakeAlma() as alma:
+            alma.add_record("55550000", "99150", "22260")
+            records = [{"pqid": "55550000", "object_urn": "URN"}]
+            client = AsyncAlmaClient(alma.client(), 1)
+            pipeline = AsyncDRSHoldingPipeline(client, 1)
+            assert pipeline.run(records) == {"55550000": True}
+            # a redelivered message
+            assert pipeline.run(records) == {"55550000": True}
+            client.close()
+            assert alma.request_count("PUT") == 1
+            assert pipeline.outcomes == {"updated": 1, "noop": 1}
+
+    def test_confirm_mode(self):
+        """
+        Test that the configured confirm strategy is used, so the
+        put_response mode confirms without reading the holding back.
+        """
+        with FakeAlma() as alma:
+            alma.add_record("55550000", "99150", "22260")
+            client = AsyncAlmaClient(alma.client(), 1)
+            strategy = PutResponseConfirm()
+            pipeline = AsyncDRSHoldingPipeline(client, 1,
+                                               confirm_strategy=strategy)
+            assert pipeline.run([{"pqid": "55550000",
+                                  "object_urn": "URN"}]) == \
+                {"55550000": True}
+            client.close()
+            # SRU, holdings list, holding GET and PUT, no read-back
+            assert alma.request_count() == 4
+            assert strategy.stats()["confirms"] == 1
+            assert strategy.stats()["read_backs"] == 0
+
+    def test_id_cache(self):
+        """
+        Test that cached ids skip the SRU and holdings list lookups, and
+        that stale ones are dropped and looked up in Alma again.
+        """
+        with FakeAlma() as alma:
+            alma.add_record("55550000", "99150", "22260")
+            alma.add_record("55550001", "99151", "22261")
+            id_cache = AlmaIdCache()
+            client = AsyncAlmaClient(alma.client(), 2)
+            pipeline = AsyncDRSHoldingPipeline(
+                client, 2, confirm_strategy=PutResponseConfirm(),
+                id_cache=id_cache)
+            assert pipeline.run([{"pqid": "55550000",
+                                  "object_urn": "URN"}]) == \
+                {"55550000": True}
+            assert id_cache.get(alma_cache.MMS_ID, "55550000") == "99150"
+            assert id_cache.get(alma_cache.HOLDING_ID, "99150") == "22260"
+
+            requests = alma.request_count()
+            assert pipeline.run([{"pqid": "55550000",
+                                  "object_urn": "URN-2"}]) == \
+                {"55550000": True}
+            # holding GET and PUT only
+            assert alma.request_count() - requests == 2
+
+            # a holding that was replaced in Alma
+            id_cache.set(alma_cache.HOLDING_ID, "99151", "22999")
+            assert pipeline.run([{"pqid": "55550001",
+                                  "object_urn": "URN"}]) == \
+                {"55550001": True}
+            assert id_cache.get(alma_cache.HOLDING_ID, "99151") == "22261"
+            assert id_cache.stats()["invalidations"] == 2
+
+            # and one that is gone for good
+            del alma.holding_records[("99151", "22261")]
+            assert pipeline.run([{"pqid": "55550001",
+                                  "object_urn": "URN-2"}]) == \
+                {"55550001": False}
+            assert id_cache.get(alma_cache.HOLDING_ID, "99151") is None
+            client.close()
+
+    def test_put_not_found(self):
+        """
+        Test that a PUT to a holding Alma does not have drops its ids
+        from the cache.
+        """
+        class GoneAlma(FakeAlma):
+            def handle(self, method, path, query, headers, body):
+                if method == 'PUT':
+                    return 400, b'<web_service_result>Holding not found' \
+                                b'</web_service_result>'
+                return super().handle(method, path, query, headers, body)
+
+        with GoneAlma() as alma:
+            alma.add_record("55550000", "99150", "22260")
+            id_cache = AlmaIdCache()
+            pipeline = AsyncDRSHoldingPipeline(
+                AsyncAlmaClient(alma.client(), 1), 1, id_cache=id_cache)
+            assert pipeline.run([{"pqid": "55550000",
+                                  "object_urn": "URN"}]) == \
+                {"55550000": False}
+            assert id_cache.get(alma_cache.MMS_ID, "55550000") is None
+            assert id_cache.stats()["invalidations"] == 2
+
+            pipeline.id_cache = None
+            assert pipeline.run([{"pqid": "55550000",
+                                  "object_urn": "URN"}]) == \
+                {"55550000": False}
+
+    def test_failed_status_update(self):
+        """
+        Test that a failed status write is logged and does not fail the
+        other records.
+        """
+        class FailingMongoUtil(FakeMongoUtil):
+            def update_status(self, query, status, durable=False):
+                raise Exception("mongo is down")
+
+        with FakeAlma() as alma:
+            alma.add_record("55550000", "99150", "22260")
+            alma.add_record("55550001", "99151", "22261")
+            pipeline = AsyncDRSHoldingPipeline(
+                AsyncAlmaClient(alma.client(), 2), 2, FailingMongoUtil())
+            assert pipeline.run([{"pqid": "55550000", "object_urn": "URN",
+                                  "directory_id": "proquest0-0-gsas"},
+                                 {"pqid": "55550001",
+                                  "object_urn": "URN"}]) == \
+                {"55550000": True, "55550001": True}
+
+    def test_fake_alma_errors(self):
+        """
+        Test the fake Alma server's error responses.
+        """
+        alma = FakeAlma(latency=0.001)
+        alma.add_record("55550000", "99150", "22260")
+        headers = {"Authorization": f"apikey {alma.api_key}"}
+        assert alma.handle("GET", "/almaws/v1/users", {}, headers,
+                           b"")[0] == 404
+        assert alma.handle("GET", "/almaws/v1/bibs/99/holdings", {},
+                           headers, b"")[0] == 400
+        assert alma.handle("GET", "/almaws/v1/bibs/99150/holdings/1", {},
+                           headers, b"")[0] == 400
@@ -1,5 +1,12 @@
+import requests
+import requests_mock
 from etd.drs_holding_by_api import DRSHoldingByAPI
+from etd.alma_client import AlmaClient
+from etd.fake_alma import FakeAlma
+from etd.record_context import RecordContext
+import etd.holding_xml as holding_xml
 import lxml.etree as ET
+import os
 
 
 class TestDRSHoldingByAPI():
@@ -34,3 +41,139 @@ class TestDRSHoldingByAPI():
         drs_holding = DRSHoldingByAPI(pqid, object_urn, True)
         process_retval = drs_holding.process_record_for_alma()
         assert not process_retval
+
+    def test_in_memory_pipeline(self, tmp_path):
+        """
+        Test that in memory mode runs every step without writing files,
+        and writes the artifacts when asked to.
+        """
+        pqid = "28542882"
+        object_urn = "URN-3:HUL.DRS.OBJECT:12345678"
+        output_dir = str(tmp_path / "holdings")
+        with FakeAlma() as alma:
+            alma.add_record(pqid, "99157250983303941", "222633019090003941")
+            drs_holding = DRSHoldingByAPI(pqid, object_urn, True,
+                                          alt_output_dir=output_dir,
+                                          in_memory=True)
+            drs_holding.alma_client = alma.client()
+            mms_id = drs_holding.get_mms_id(pqid)
+            holding_id = drs_holding.get_drs_holding_id_by_mms_id(mms_id)
+            assert drs_holding.get_drs_holding(mms_id, holding_id)
+            assert drs_holding.transform_drs_holding(
+                output_dir, object_urn, holding=drs_holding.holding_record)
+            assert drs_holding.upload_new_drs_holding(
+                pqid, mms_id, holding_id, data=drs_holding.updated_holding)
+            assert drs_holding.confirm_new_drs_holding(pqid, mms_id,
+                                                       holding_id, object_urn)
+            drs_holding.alma_client.close()
+
+            file_dir = str(tmp_path / "file-holdings")
+            file_holding = DRSHoldingByAPI(pqid, object_urn, True,
+                                           alt_output_dir=file_dir,
+                                           in_memory=False)
+            file_holding.alma_client = alma.client()
+            assert file_holding.get_mms_id(pqid) == mms_id
+            assert os.listdir(file_dir) == ["sru.xml"]
+            file_holding.alma_client.close()
+        assert not os.path.exists(output_dir)
+        assert holding_xml.holding_urn_statement(
+            drs_holding.updated_holding) == \
+            f'Preservation master, {object_urn}'
+
+        drs_holding.dump_artifacts()
+        assert sorted(os.listdir(output_dir)) == \
+            ["holding.xml", "holdings.xml", "src_marc.xml", "sru.xml",
+             "updated_holding.xml"]
+        drs_holding.dump_artifacts()
+
+    def test_transient_errors_are_retryable(self):
+        """
+        Test that a 5xx or 429 from Alma marks the record for a retry
+        and a 400 does not.
+        """
+        pqid = "28542882"
+        object_urn = "URN-3:HUL.DRS.OBJECT:12345678"
+        with requests_mock.Mocker() as m:
+            m.get(requests_mock.ANY, status_code=400, text="Bad request")
+            drs_holding = DRSHoldingByAPI(pqid, object_urn, True)
+            drs_holding.alma_client = AlmaClient(
+                api_base="https://alma.example.edu", api_key="secret")
+            assert not drs_holding.get_drs_holding_id_by_mms_id("99123")
+            assert not drs_holding.retryable
+
+            m.get(requests_mock.ANY, status_code=503, text="Unavailable")
+            assert not drs_holding.get_drs_holding_id_by_mms_id("99123")
+            assert drs_holding.retryable
+
+    def test_only_transport_errors_are_retryable(self):
+        """
+        Test that an exception fails the record for good unless it is a
+        transport error.
+        """
+        pqid = "28542882"
+        object_urn = "URN-3:HUL.DRS.OBJECT:12345678"
+        context = RecordContext(pqid, object_urn, in_dash=False,
+                                directory_id="batch1")
+        for error, retryable in ((requests.ConnectionError, True),
+                                 (requests.ConnectTimeout, True),
+                                 (ValueError, False)):
+            with requests_mock.Mocker() as m:
+                m.get(requests_mock.ANY, exc=error)
+                drs_holding = DRSHoldingByAPI(pqid, object_urn, True,
+                                              record_context=context,
+                                              in_memory=True)
+                drs_holding.alma_client = AlmaClient(
+                    api_base="https://alma.example.edu", api_key="secret",
+                    sru_base="https://alma.example.edu/sru?query=")
+                assert drs_holding.send_to_alma_worker() is False
+                assert drs_holding.retryable is retryable
+
+    def test_send_to_alma_worker(self, tmp_path):
+        """
+        Test that the worker returns True once the holding is updated
+        and confirmed, and False when it fails.
+        """
+        pqid = "28542882"
+        object_urn = "URN-3:HUL.DRS.OBJECT:12345678"
+        context = RecordContext(pqid, object_urn, in_dash=False,
+                                directory_id="batch1")
+        with FakeAlma() as alma:
+            alma.add_record(pqid, "99157250983303941", "222633019090003941")
+            drs_holding = DRSHoldingByAPI(pqid, object_urn, True,
+                                          alt_output_dir=str(tmp_path),
+                                          record_context=context,
+                                          in_memory=True)
+            drs_holding.alma_client = alma.client()
+            assert drs_holding.send_to_alma_worker() is True
+            assert drs_holding.outcome == "updated"
+            drs_holding.alma_client.close()
+
+            missing = DRSHoldingByAPI("1", object_urn, True,
+                                      alt_output_dir=str(tmp_path),
+                                      record_context=context,
+                                      in_memory=True)
+            missing.alma_client = alma.client()
+            assert missing.send_to_alma_worker() is False
+            missing.alma_client.close()
+
+    def test_resolved_mms_id(self, tmp_path):
+        """
+        Test that an mms id resolved for the batch saves the SRU search.
+        """
+        pqid = "28542882"
+        object_urn = "URN-3:HUL.DRS.OBJECT:12345678"
+        context = RecordContext(pqid, object_urn, in_dash=False,
+                                directory_id="batch1")
+        with FakeAlma() as alma:
+            alma.add_record(pqid, "99157250983303941", "222633019090003941")
+            drs_holding = DRSHoldingByAPI(pqid, object_urn, True,
+                                          alt_output_dir=str(tmp_path),
+                                          record_context=context,
+                                          in_memory=True,
+                                          mms_id="99157250983303941")
+            drs_holding.alma_client = alma.client()
+            assert drs_holding.send_to_alma_worker() is True
+            assert alma.request_count("GET") == 3
+            assert [path for method, path in alma.requests
+                    if "sru" in path] == []
+            drs_holding.alma_client.close()
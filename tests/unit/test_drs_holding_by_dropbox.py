@@ -1,6 +1,10 @@
+from etd import drs_holding_by_dropbox
 from etd.drs_holding_by_dropbox import DRSHoldingByDropbox
 import lxml.etree as ET
 import os.path
+import json
+import pytest
+from etd.dropbox_batcher import PendingJournal
 
 
 class TestDRSHoldingByDropbox():
@@ -67,3 +71,278 @@ class TestDRSHoldingByDropbox():
         assert doc.xpath(libcodeXPath, namespaces=namespace_mapping)[0] \
             .text == "netdes"
         os.remove(marcFile)
+
+    def test_writeMarcXml_without_batch_copy(self, monkeypatch, tmp_path):
+        """
+        Test that with MARCXML_BATCH_COPY off the record is returned and
+        no copy is written to the batch directory.
+        """
+        monkeypatch.setattr(drs_holding_by_dropbox, 'MARCXML_BATCH_COPY',
+                            'off')
+        drs_holding = DRSHoldingByDropbox('1234567890',
+                                          'URN-3:HUL.DRS.OBJECT:12345678',
+                                          None,
+                                          True)
+        marcXmlValues = {'titleIndicator2': '0',
+                         'title': "Naming Expeditor",
+                         'dateCreated': "2023-05",
+                         'school': "gsd"}
+        record = drs_holding.writeMarcXml("proquest2023071720-993578-gsd",
+                                          str(tmp_path), marcXmlValues, False)
+        assert ET.fromstring(record).findtext(
+            "datafield[@tag='245']/subfield[@code='a']") == \
+            "Naming Expeditor"
+        assert list(tmp_path.iterdir()) == []
+
+    def test_keep_unsent_records(self, monkeypatch, tmp_path):
+        """
+        Test that records the batcher gave up on are kept in the unsent
+        file and reported to the Job Monitor, without the records whose
+        status was updated.
+        """
+        failures = []
+
+        class Notifier():
+            def log(self, type, message, echo=False):
+                failures.append((type, message))
+        monkeypatch.setattr(drs_holding_by_dropbox, 'get_notifier',
+                            lambda job_code: Notifier())
+        path = str(tmp_path / "unsent.jsonl")
+        entries = [{'pqid': '1', 'batch': 'b1', 'marcXmlRecord': '<r/>',
+                    'uploaded': True, 'status_updated': True},
+                   {'pqid': '2', 'batch': 'b2', 'marcXmlRecord': '<r/>',
+                    'uploaded': True},
+                   {'pqid': '3', 'batch': 'b3', 'marcXmlRecord': '<r/>'}]
+        drs_holding_by_dropbox.keep_unsent_records(('gsd', 'AlmaDRSDark'),
+                                                   entries, path)
+        with open(path) as f:
+            kept = [json.loads(line) for line in f]
+        assert [record['pqid'] for record in kept] == ['2', '3']
+        assert kept[0]['uploaded'] and 'marcXmlRecord' not in kept[0]
+        assert kept[1]['marcXmlRecord'] == '<r/>'
+        assert kept[1]['school'] == 'gsd'
+        assert [type for type, message in failures] == ['fail', 'fail']
+        assert "status was not updated" in failures[0][1]
+
+    def test_journal_record(self):
+        """
+        Test that pending records are journaled without their MongoUtil.
+        """
+        entry = {'pqid': '1', 'batch': 'b1', 'school': 'gsd',
+                 'marcXmlRecord': '<r/>', 'collection': None,
+                 'mongoutil': object()}
+        batcher = drs_holding_by_dropbox.dropbox_batcher
+        assert batcher.to_record is drs_holding_by_dropbox.journal_record
+        assert json.loads(json.dumps(batcher.to_record(entry))) == \
+            {'pqid': '1', 'batch': 'b1', 'school': 'gsd',
+             'collection': None, 'marcXmlRecord': '<r/>'}
+
+    def test_replay_dropbox_records(self, monkeypatch, tmp_path):
+        """
+        Test that the pending records of a dead worker and the unsent
+        records are sent again, that uploaded ones only get their status,
+        and that records that fail again are kept.
+        """
+        class FakeMongoUtil():
+            def __init__(self, collection, fail=False):
+                self.collection = collection
+                self.fail = fail
+                self.updates = []
+
+            def update_status(self, query, status, durable=False):
+                if self.fail:
+                    raise Exception("mongo is down")
+                self.updates.append((query, status, durable))
+
+        class Notifier():
+            def log(self, type, message, echo=False):
+                pass
+        monkeypatch.setattr(drs_holding_by_dropbox, 'get_notifier',
+                            lambda job_code: Notifier())
+        sent = []
+        results = [True]
+
+        def send_collection(key, entries, notifier=None, verbose=False):
+            sent.append((key, [entry['pqid'] for entry in entries],
+                         {entry['mongoutil'].collection
+                          for entry in entries}))
+            return results.pop(0)
+        monkeypatch.setattr(drs_holding_by_dropbox, 'send_collection',
+                            send_collection)
+
+        journal = PendingJournal(str(tmp_path / "pending"))
+        journal.add(['1', 'b1'], ['gsd', 'AlmaDRSDark'],
+                    {'pqid': '1', 'batch': 'b1', 'school': 'gsd',
+                     'collection': None, 'marcXmlRecord': '<r/>'})
+        path = str(tmp_path / "state" / "unsent.jsonl")
+        drs_holding_by_dropbox.keep_unsent_records(
+            ('gsd', 'AlmaDRSDark'),
+            [{'pqid': '1', 'batch': 'b1', 'marcXmlRecord': '<r/>'},
+             {'pqid': '2', 'batch': 'b2', 'marcXmlRecord': '<r/>'},
+             {'pqid': '3', 'batch': 'b3', 'uploaded': True,
+              'collection': 'itest'}], path)
+        mongoutils = {}
+
+        def get_mongoutil(collection):
+            mongoutils[collection] = FakeMongoUtil(collection)
+            return mongoutils[collection]
+
+        counts = drs_holding_by_dropbox.replay_dropbox_records(
+            stale_secs=0, journal=journal, unsent_path=path,
+            get_mongoutil=get_mongoutil)
+        assert counts == {'sent': 2, 'status_updated': 1}
+        assert sent == [(('gsd', 'AlmaDRSDark'), ['1', '2'], {None})]
+        assert mongoutils['itest'].updates == [
+            ({'proquest_id': '3', 'directory_id': 'b3'},
+             drs_holding_by_dropbox.mongo_util.DRS_HOLDING_DROPBOX_STATUS,
+             True)]
+        assert os.listdir(tmp_path / "pending") == []
+        assert drs_holding_by_dropbox.SpillFile(path).take() == []
+
+        # the dropbox and mongo are still down
+        drs_holding_by_dropbox.keep_unsent_records(
+            ('gsd', 'AlmaDRSDark'),
+            [{'pqid': '2', 'batch': 'b2', 'marcXmlRecord': '<r/>'},
+             {'pqid': '3', 'batch': 'b3', 'uploaded': True}], path)
+        journal.add(['1', 'b1'], ['gsd', 'AlmaDRSDark'],
+                    {'pqid': '1', 'batch': 'b1', 'school': 'gsd',
+                     'marcXmlRecord': '<r/>'})
+        results.append(False)
+        counts = drs_holding_by_dropbox.replay_dropbox_records(
+            include_unsent=False, stale_secs=3600, journal=journal,
+            unsent_path=path,
+            get_mongoutil=lambda collection: FakeMongoUtil(collection,
+                                                           True))
+        assert counts == {}
+        counts = drs_holding_by_dropbox.replay_dropbox_records(
+            stale_secs=0, journal=journal, unsent_path=path,
+            get_mongoutil=lambda collection: FakeMongoUtil(collection,
+                                                           True))
+        assert counts == {'kept': 3}
+        kept = drs_holding_by_dropbox.SpillFile(path).take()
+        assert sorted((record['pqid'], record['uploaded'])
+                      for record in kept) == \
+            [('1', False), ('2', False), ('3', True)]
+        assert os.listdir(tmp_path / "pending") == []
+
+
+class FakeStatusMongoUtil():
+    """
+    Records status writes, like a MongoUtil in write-behind mode.
+    """
+
+    def __init__(self, fail_pqids=(), flush_ok=True):
+        self.fail_pqids = fail_pqids
+        self.flush_ok = flush_ok
+        self.updates = []
+        self.flushes = 0
+
+    def update_status(self, query, status, durable=False):
+        if query['proquest_id'] in self.fail_pqids:
+            raise Exception("mongo is down")
+        self.updates.append((query['proquest_id'], status))
+
+    def flush_status_updates(self):
+        self.flushes += 1
+        return self.flush_ok
+
+
+class TestSendCollection():
+    """
+    send_collection against a local sftp server.
+    """
+
+    @pytest.fixture(autouse=True)
+    def dropbox(self, sftp_server, monkeypatch):
+        messages = []
+
+        class Notifier():
+            def log(self, type, message, echo=False):
+                messages.append((type, message))
+
+            def report(self, status):
+                messages.append(('report', status))
+        monkeypatch.setattr(drs_holding_by_dropbox, 'dropboxServer',
+                            '127.0.0.1')
+        monkeypatch.setattr(drs_holding_by_dropbox, 'dropboxUser', 'etd')
+        monkeypatch.setattr(drs_holding_by_dropbox, 'dropboxPort',
+                            sftp_server.port)
+        monkeypatch.setattr(drs_holding_by_dropbox, 'privateKey',
+                            '~/.ssh/id_rsa')
+        monkeypatch.setattr(drs_holding_by_dropbox, 'get_notifier',
+                            lambda job_code: Notifier())
+        self.incoming = os.path.join(sftp_server.root, "incoming")
+        self.messages = messages
+        yield
+        drs_holding_by_dropbox.sftp_pool.close_all()
+
+    def entries(self, mongoutil):
+        return [{'pqid': pqid, 'batch': f'b{pqid}', 'school': 'gsd',
+                 'marcXmlRecord': f'<record><controlfield tag="001">'
+                                  f'{pqid}</controlfield></record>',
+                 'mongoutil': mongoutil}
+                for pqid in ('1', '2')]
+
+    def test_upload(self):
+        """
+        Test that the collection lands in the dropbox whole, and that
+        the status of every record is written and flushed.
+        """
+        mongoutil = FakeStatusMongoUtil()
+        entries = self.entries(mongoutil)
+        entries.append(dict(entries[0], pqid='3', mongoutil=None))
+        assert drs_holding_by_dropbox.send_collection(
+            ('gsd', 'AlmaDRSDark'), entries)
+        names = os.listdir(self.incoming)
+        assert len(names) == 1
+        assert names[0].startswith('AlmaDRSDark_')
+        assert names[0].endswith('.xml')
+        doc = ET.parse(os.path.join(self.incoming, names[0]))
+        assert [record.text for record in doc.iter('{*}controlfield')] == \
+            ['1', '2', '1']
+        assert mongoutil.updates == [
+            ('1', drs_holding_by_dropbox.mongo_util.
+             DRS_HOLDING_DROPBOX_STATUS),
+            ('2', drs_holding_by_dropbox.mongo_util.
+             DRS_HOLDING_DROPBOX_STATUS)]
+        assert mongoutil.flushes == 1
+        assert [entry.get('status_updated') for entry in entries] == \
+            [True, True, None]
+        assert all(entry['uploaded'] for entry in entries)
+        assert self.messages[-1] == ('report', 'complete')
+
+    def test_failed_upload(self):
+        """
+        Test that a collection the dropbox refuses is reported, and that
+        its records are not marked uploaded or updated in mongo.
+        """
+        os.rmdir(self.incoming)
+        mongoutil = FakeStatusMongoUtil()
+        entries = self.entries(mongoutil)
+        assert not drs_holding_by_dropbox.send_collection(
+            ('gsd', 'AlmaDRSDark'), entries)
+        assert not any(entry.get('uploaded') for entry in entries)
+        assert mongoutil.updates == []
+        assert self.messages[0][0] == 'fail'
+        assert self.messages[-1] == ('report', 'complete')
+
+    def test_failed_status_flush(self):
+        """
+        Test that an uploaded collection whose status writes fail is
+        reported as not sent, with no record marked as updated.
+        """
+        mongoutil = FakeStatusMongoUtil(flush_ok=False)
+        entries = self.entries(mongoutil)
+        assert not drs_holding_by_dropbox.send_collection(
+            ('gsd', 'AlmaDRSDark'), entries)
+        assert len(os.listdir(self.incoming)) == 1
+        assert all(entry['uploaded'] for entry in entries)
+        assert not any(entry.get('status_updated') for entry in entries)
+
+        mongoutil = FakeStatusMongoUtil(fail_pqids=('1',))
+        entries = self.entries(mongoutil)
+        assert not drs_holding_by_dropbox.send_collection(
+            ('gsd', 'AlmaDRSDark'), entries,
+            notifier=drs_holding_by_dropbox.get_notifier('test'))
+        assert [entry.get('status_updated') for entry in entries] == \
+            [None, True]
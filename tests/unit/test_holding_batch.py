@@ -0,0 +1,310 @@
+import etd.holding_batch as holding_batch
+from etd.holding_batch import (HoldingsAggregator, group_by_dash,
+                               invalid_reason, outcome_counts,
+                               record_outcome, send_batches, send_holdings,
+                               send_record)
+from etd.dropbox_batcher import PendingJournal
+from etd.record_context import RecordContext
+from etd.task_retry import RetryableError
+import etd.task_retry as task_retry
+
+
+class FakeApp():
+    """
+    Records the tasks sent, like Celery's send_task.
+    """
+
+    def __init__(self, fail=False):
+        self.sent = []
+        self.fail = fail
+
+    def send_task(self, name, args=None, kwargs=None, queue=None):
+        if self.fail:
+            raise ConnectionError("broker is down")
+        self.sent.append((name, args, queue))
+
+
+class FakeMongoUtil():
+    """
+    Returns the records of a collection, like MongoUtil.query_records.
+    """
+
+    def __init__(self, records, fail=False):
+        self.records = records
+        self.fail = fail
+        self.queries = []
+
+    def query_records(self, query={}, fields=None):
+        if self.fail:
+            raise Exception("mongo is down")
+        self.queries.append(query)
+        return self.records
+
+
+class FakeResolver():
+    """
+    Resolves proquest ids like SRUBatchResolver.
+    """
+
+    def __init__(self, mms_ids, fail=False):
+        self.mms_ids = mms_ids
+        self.fail = fail
+        self.resolved = []
+
+    def resolve(self, pqids):
+        if self.fail:
+            raise Exception("SRU is down")
+        self.resolved.append(list(pqids))
+        found = {pqid: self.mms_ids[pqid] for pqid in pqids
+                 if pqid in self.mms_ids}
+        return found, [pqid for pqid in pqids if pqid not in found]
+
+
+def mongo_record(pqid, in_dash):
+    record = {'proquest_id': pqid, 'alma_submission_status': 'ALMA',
+              'directory_id': f'b{pqid}', 'indash': in_dash}
+    if in_dash:
+        record['school_alma_dropbox'] = 'gsd'
+    return record
+
+
+def messages(count):
+    return [{'pqid': str(i), 'object_urn': f'URN-3:HUL.DRS.OBJECT:{i}'}
+            for i in range(count)]
+
+
+class TestHoldingBatch():
+
+    def test_invalid_reason(self):
+        """
+        Test that messages without a pqid or urn are refused.
+        """
+        assert invalid_reason(messages(1)[0]) is None
+        assert invalid_reason({'object_urn': 'URN'}) == \
+            "Proquest ID is missing"
+        assert invalid_reason({'pqid': '1'}) == "Object URN is missing"
+        assert invalid_reason("1") == "Message is not an object"
+
+    def test_outcomes(self):
+        """
+        Test the per record outcome entries and their counts.
+        """
+        outcomes = [record_outcome({'pqid': '1'}, holding_batch.SENT),
+                    record_outcome({'pqid': '2'}, holding_batch.INVALID,
+                                   "Object URN is missing"),
+                    record_outcome("2", holding_batch.INVALID)]
+        assert outcomes[0] == {'pqid': '1', 'outcome': 'sent'}
+        assert outcomes[1]['detail'] == "Object URN is missing"
+        assert outcomes[2]['pqid'] is None
+        assert outcome_counts(outcomes) == {'sent': 1, 'invalid': 2}
+
+    def test_group_by_dash(self):
+        """
+        Test that a batch is split into dropbox, API and not found records
+        in their original order.
+        """
+        contexts = {
+            '0': RecordContext('0', in_dash=True, directory_id='b0'),
+            '1': RecordContext('1', in_dash=False, directory_id='b1'),
+            '2': RecordContext('2'),
+            '4': RecordContext('4', in_dash=True, directory_id='b4')}
+        entries = list(enumerate(messages(5)))
+        groups = group_by_dash(entries, contexts)
+        assert [index for index, message in groups['dash']] == [0, 4]
+        assert [index for index, message in groups['api']] == [1]
+        assert [index for index, message in groups['not_found']] == [2, 3]
+
+    def test_send_record(self):
+        """
+        Test that the holding worker's result and errors map to the
+        record's outcome.
+        """
+        context = RecordContext('0', in_dash=False, directory_id='b0')
+        retries = []
+
+        def schedule_retry(message, error):
+            retries.append((message['pqid'], str(error)))
+            return holding_batch.RETRY_SCHEDULED
+
+        def worker(result):
+            def send_holding(message, record_context):
+                assert record_context is context
+                if isinstance(result, Exception):
+                    raise result
+                return result
+            return send_holding
+
+        message = messages(1)[0]
+        assert send_record(worker(True), message, context,
+                           schedule_retry) == holding_batch.SENT
+        assert send_record(worker(False), message, context,
+                           schedule_retry) == holding_batch.FAILED
+        assert send_record(worker(Exception("bad xml")), message, context,
+                           schedule_retry) == holding_batch.FAILED
+        assert send_record(worker(RetryableError("Alma is down")), message,
+                           context, schedule_retry) == \
+            holding_batch.RETRY_SCHEDULED
+        assert retries == [('0', "Alma is down")]
+        assert send_record(worker(True), message, None, schedule_retry) == \
+            holding_batch.NOT_FOUND
+        assert send_record(worker(True), message, RecordContext('0'),
+                           schedule_retry) == holding_batch.NOT_FOUND
+
+        recovered = task_retry.retry_outcomes['recovered']
+        retried = task_retry.next_retry_message(message, "Alma is down")
+        assert send_record(worker(True), retried, context,
+                           schedule_retry) == holding_batch.SENT
+        assert task_retry.retry_outcomes['recovered'] == recovered + 1
+
+    def test_send_batches(self):
+        """
+        Test that producers send messages in chunks of the batch size.
+        """
+        app = FakeApp()
+        assert send_batches(app.send_task, iter(messages(5)), 2,
+                            "etd_queue") == 3
+        assert [len(args[0]) for name, args, queue in app.sent] == [2, 2, 1]
+        assert {name for name, args, queue in app.sent} == \
+            {holding_batch.ADD_HOLDINGS_BATCH_TASK}
+        assert app.sent[0][2] == "etd_queue"
+
+    def test_aggregator(self):
+        """
+        Test that single messages are sent as a batch per queue when the
+        batch is full or flushed.
+        """
+        app = FakeApp()
+        aggregator = HoldingsAggregator(app.send_task, max_records=3,
+                                        window_secs=0)
+        for message in messages(4):
+            aggregator.add(message, "etd_queue")
+        aggregator.add(messages(1)[0], "other_queue")
+        assert [(len(args[0]), queue) for name, args, queue in app.sent] \
+            == [(3, "etd_queue")]
+        assert aggregator.pending_count() == 2
+
+        assert aggregator.flush_all()
+        assert sorted((len(args[0]), queue)
+                      for name, args, queue in app.sent[1:]) == \
+            [(1, "etd_queue"), (1, "other_queue")]
+
+    def test_aggregator_keeps_messages_the_broker_refused(self):
+        """
+        Test that a batch that could not be sent is kept for the next
+        flush.
+        """
+        app = FakeApp(fail=True)
+        aggregator = HoldingsAggregator(app.send_task, max_records=2,
+                                        window_secs=0)
+        aggregator.add(messages(1)[0], "etd_queue")
+        assert not aggregator.flush("etd_queue")
+        assert aggregator.pending_count("etd_queue") == 1
+        app.fail = False
+        assert aggregator.flush("etd_queue")
+        assert len(app.sent) == 1
+
+    def test_send_holdings(self, monkeypatch):
+        """
+        Test that a batch is loaded with one query per collection, that
+        the mms ids of its API records are resolved in one call and
+        handed to each record, and that every message gets its outcome.
+        """
+        monkeypatch.setenv("MONGO_TEST_COLLECTION", "test_records")
+        batch = messages(5) + [{'pqid': '9'},
+                               dict(messages(1)[0], pqid='5',
+                                    integration_test=True)]
+        mongoutils = {
+            None: FakeMongoUtil([mongo_record('0', True),
+                                 mongo_record('1', False),
+                                 mongo_record('2', False),
+                                 mongo_record('4', False)]),
+            'test_records': FakeMongoUtil([mongo_record('5', False)])}
+        resolver = FakeResolver({'1': '991', '2': '992', '5': '995'})
+        sent = []
+
+        def send_holding(message, record_context, test_coll, mms_id):
+            sent.append((message['pqid'], test_coll, mms_id))
+            if message['pqid'] == '4':
+                raise RetryableError("Alma is down")
+            return True
+
+        outcomes = send_holdings(
+            batch, send_holding,
+            lambda message, error: holding_batch.RETRY_SCHEDULED,
+            mongoutils.get, resolver)
+        assert [entry['outcome'] for entry in outcomes] == \
+            ['sent', 'sent', 'sent', 'not_found', 'retry_scheduled',
+             'invalid', 'sent']
+        assert sent == [('0', None, None), ('1', None, '991'),
+                        ('2', None, '992'), ('4', None, None),
+                        ('5', 'test_records', '995')]
+        assert resolver.resolved == [['1', '2', '4'], ['5']]
+        assert [len(mongoutil.queries)
+                for mongoutil in mongoutils.values()] == [1, 1]
+
+    def test_send_holdings_failures(self):
+        """
+        Test that a batch mongo could not be queried for fails, and that
+        records still go out when their mms ids could not be resolved.
+        """
+        outcomes = send_holdings(
+            messages(2), None, None,
+            lambda collection: FakeMongoUtil([], fail=True), None)
+        assert [entry['outcome'] for entry in outcomes] == \
+            ['failed', 'failed']
+        assert outcomes[0]['detail'] == "Unable to query mongo"
+
+        sent = []
+        outcomes = send_holdings(
+            messages(1), lambda *args: sent.append(args) or True, None,
+            lambda collection: FakeMongoUtil([mongo_record('0', False)]),
+            FakeResolver({}, fail=True))
+        assert [entry['outcome'] for entry in outcomes] == ['sent']
+        assert sent[0][3] is None
+
+    def test_aggregator_sends_once_per_flush(self):
+        """
+        Test that a flush is one send, even with requeued messages, and
+        that a redelivered copy of a pending message is not added again.
+        """
+        app = FakeApp(fail=True)
+        aggregator = HoldingsAggregator(app.send_task, max_records=2,
+                                        window_secs=0)
+        aggregator.add(messages(1)[0], "etd_queue")
+        aggregator.add(messages(1)[0], "etd_queue")
+        assert aggregator.pending_count("etd_queue") == 1
+        assert not aggregator.flush("etd_queue")
+        app.fail = False
+        for message in messages(3)[1:]:
+            aggregator.add(message, "etd_queue")
+        assert [[message['pqid'] for message in args[0]]
+                for name, args, queue in app.sent] == [['0', '1']]
+        assert aggregator.flush_all()
+        assert len(app.sent) == 2
+
+    def test_aggregator_replay(self, tmp_path):
+        """
+        Test that the messages a stopped worker left in the journal are
+        sent by the next one, and kept if the broker refuses them.
+        """
+        journal = PendingJournal(str(tmp_path / "pending"))
+        stopped = HoldingsAggregator(FakeApp().send_task, window_secs=0,
+                                     journal=journal)
+        for message in messages(3):
+            stopped.add(message, "etd_queue")
+        assert len(list((tmp_path / "pending").iterdir())) == 3
+
+        app = FakeApp(fail=True)
+        aggregator = HoldingsAggregator(app.send_task, max_records=2,
+                                        window_secs=0, journal=journal)
+        assert aggregator.replay(stale_secs=0) == 0
+        app.fail = False
+        assert aggregator.replay(stale_secs=0) == 3
+        assert sorted(len(args[0]) for name, args, queue in app.sent) == \
+            [1, 2]
+        assert list((tmp_path / "pending").iterdir()) == []
+        assert HoldingsAggregator(app.send_task).replay() == 0
+
+        aggregator.add(messages(1)[0], "etd_queue")
+        assert aggregator.flush_all()
+        assert list((tmp_path / "pending").iterdir()) == []
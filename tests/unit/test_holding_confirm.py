@@ -0,0 +1,125 @@
+from etd.holding_confirm import ConfirmStrategy, PutResponseConfirm
+from etd.holding_confirm import FullConfirm
+from etd.holding_confirm import SampledConfirm, DeferredConfirm
+from etd.holding_confirm import get_confirm_strategy
+from etd.drs_holding_by_api import DRSHoldingByAPI
+from etd.fake_alma import FakeAlma
+import etd.holding_xml as holding_xml
+import pytest
+
+URN = "URN-3:HUL.DRS.OBJECT:12345678"
+
+
+class ReadBack():
+
+    def __init__(self, result=True):
+        self.result = result
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        return self.result
+
+
+def updated_holding(urn=URN):
+    holding = holding_xml.set_holding_urn(
+        open("./tests/data/unit/holding.xml", "rb").read(), urn)
+    return holding_xml.holding_to_bytes(holding)
+
+
+class TestHoldingConfirm():
+
+    def test_strategy_is_abstract(self):
+        """
+        Test that a strategy has to say how it confirms.
+        """
+        with pytest.raises(TypeError):
+            ConfirmStrategy()
+
+    def test_put_response(self):
+        """
+        Test confirming from the PUT response, falling back to a read-back
+        when the response is not a holding.
+        """
+        strategy = PutResponseConfirm()
+        read_back = ReadBack()
+        assert strategy.confirm(URN, updated_holding(), read_back)[0]
+        assert not strategy.confirm(URN, updated_holding("URN-3:OTHER"),
+                                    read_back)[0]
+        assert read_back.calls == 0
+        assert strategy.confirm(URN, b"", read_back)[0]
+        assert read_back.calls == 1
+        stats = strategy.stats()
+        assert stats['mode'] == 'put_response'
+        assert stats['confirms'] == 3 and stats['read_backs'] == 1
+        assert stats['latency_secs_max'] >= stats['latency_secs_avg'] > 0
+
+    def test_full_and_sampled(self):
+        """
+        Test that full always reads back and sampled reads back at its
+        rate.
+        """
+        read_back = ReadBack(False)
+        assert not FullConfirm().confirm(URN, updated_holding(),
+                                         read_back)[0]
+        assert read_back.calls == 1
+
+        samples = iter([0.05, 0.5, 0.95])
+        strategy = SampledConfirm(rate=0.1, sample=lambda: next(samples))
+        read_back = ReadBack()
+        for _ in range(3):
+            assert strategy.confirm(URN, updated_holding(), read_back)[0]
+        assert read_back.calls == 1
+        assert FullConfirm().stats()['latency_secs_avg'] == 0.0
+
+    def test_deferred(self):
+        """
+        Test that the deferred mode queues a read-back of confirmed
+        holdings only.
+        """
+        queued = []
+        strategy = DeferredConfirm(queued.append)
+        record = {"pqid": "28542882", "mms_id": "991", "holding_id": "221",
+                  "object_urn": URN}
+        read_back = ReadBack()
+        assert strategy.confirm(URN, updated_holding(), read_back, record)[0]
+        assert not strategy.confirm(URN, updated_holding("URN-3:OTHER"),
+                                    read_back, record)[0]
+        assert queued == [record]
+
+        def broken_queue(record):
+            raise Exception("broker is down")
+        strategy = DeferredConfirm(broken_queue)
+        assert strategy.confirm(URN, updated_holding(), read_back, record)[0]
+        assert read_back.calls == 0
+
+    def test_shared_strategy(self):
+        """
+        Test that a process shares one strategy per mode.
+        """
+        assert get_confirm_strategy() is get_confirm_strategy("full")
+        assert get_confirm_strategy("deferred").mode == "deferred"
+
+    def test_confirm_holding_update(self, tmp_path):
+        """
+        Test that the put_response mode confirms without another GET.
+        """
+        pqid = "28542882"
+        with FakeAlma() as alma:
+            alma.add_record(pqid, "991", "221")
+            drs_holding = DRSHoldingByAPI(pqid, URN, True,
+                                          alt_output_dir=str(tmp_path),
+                                          in_memory=True)
+            drs_holding.alma_client = alma.client()
+            drs_holding.confirm_strategy = PutResponseConfirm()
+            assert drs_holding.upload_new_drs_holding(
+                pqid, "991", "221", data=updated_holding())
+            assert drs_holding.confirm_holding_update(pqid, "991", "221",
+                                                      URN)
+            assert alma.request_count("GET") == 0
+
+            drs_holding.confirm_strategy = FullConfirm()
+            assert drs_holding.confirm_holding_update(pqid, "991", "221",
+                                                      URN)
+            assert alma.request_count("GET") == 1
+            drs_holding.alma_client.close()
@@ -0,0 +1,87 @@
+import etd.holding_xml as holding_xml
+import lxml.etree as ET
+
+
+class TestHoldingXml():
+
+    def test_parse_drs_holding_id(self):
+        """
+        Test that the DRS holding is picked per holding, not from the
+        first holding in the list.
+        """
+        holdings = b"""<holdings total_record_count="3">
+        <holding><holding_id>1</holding_id>
+          <library>WIDENER</library><location>NET</location></holding>
+        <holding><holding_id>2</holding_id>
+          <library>HLS</library><location>GEN</location></holding>
+        <holding><holding_id>3</holding_id>
+          <library>HLS</library><location>NET</location></holding>
+        </holdings>"""
+        assert holding_xml.parse_drs_holding_id(holdings) == "3"
+        assert holding_xml.parse_drs_holding_id(b"<holdings/>") is None
+
+    def test_parse_many_holdings(self):
+        """
+        Test that a bib with many holdings resolves to the matching one,
+        wherever it is in the list.
+        """
+        entries = [f"<holding><holding_id>{i}</holding_id>"
+                   f"<library>WIDENER</library><location>GEN</location>"
+                   f"</holding>" for i in range(60)]
+        entries.append("<holding><holding_id>60</holding_id>"
+                       "<library>HLS</library><location>NET</location>"
+                       "</holding>")
+        holdings = "<holdings>" + "".join(entries) + "</holdings>"
+        assert holding_xml.parse_drs_holding_id(holdings) == "60"
+
+    def test_parse_mms_id(self):
+        """
+        Test reading the mms id from an SRU response.
+        """
+        sru = """<searchRetrieveResponse
+          xmlns="http://www.loc.gov/zing/srw/"><records><record>
+          <recordIdentifier>99157250983303941</recordIdentifier>
+          </record></records></searchRetrieveResponse>"""
+        assert holding_xml.parse_mms_id(sru) == "99157250983303941"
+        assert holding_xml.parse_mms_id(sru.encode('utf-8')) == \
+            "99157250983303941"
+        assert holding_xml.parse_mms_id(ET.fromstring(sru)) == \
+            "99157250983303941"
+        # a recordIdentifier outside an SRU record is not the mms id
+        assert holding_xml.parse_mms_id(
+            b'<searchRetrieveResponse xmlns="http://www.loc.gov/zing/srw/">'
+            b'<recordIdentifier>1</recordIdentifier>'
+            b'</searchRetrieveResponse>') is None
+        assert holding_xml.parse_mms_id(
+            ET.ElementTree(ET.fromstring(
+                b'<searchRetrieveResponse '
+                b'xmlns="http://www.loc.gov/zing/srw/"/>'))) is None
+
+    def test_set_holding_urn(self):
+        """
+        Test setting and reading back the 852$z statement.
+        """
+        holding = ET.parse("./tests/data/unit/holding.xml")
+        urn = "URN-3:HUL.DRS.OBJECT:12345678"
+        root = holding_xml.set_holding_urn(holding, urn)
+        updated = holding_xml.holding_to_bytes(root)
+        assert updated.startswith(b'<?xml version="1.0" encoding="UTF-8"?>')
+        assert holding_xml.holding_urn_statement(updated) == \
+            holding_xml.expected_urn_statement(urn)
+        assert holding_xml.holding_urn_statement(b"<holding/>") is None
+
+    def test_holding_is_current(self):
+        """
+        Test the diff of the 852$z statements against the target urn.
+        """
+        urn = "URN-3:HUL.DRS.OBJECT:12345678"
+        holding = ET.parse("./tests/data/unit/holding.xml")
+        assert not holding_xml.holding_is_current(holding, urn)
+        assert len(holding_xml.urn_statement_changes(holding, urn)) == 1
+        updated = holding_xml.holding_to_bytes(
+            holding_xml.set_holding_urn(holding, urn))
+        assert holding_xml.urn_statement_changes(updated, urn) == []
+        assert holding_xml.holding_is_current(updated, urn)
+        assert not holding_xml.holding_is_current(updated, "URN-3:OTHER")
+        assert holding_xml.urn_statement_changes(b"<holding/>", urn) is None
+        assert not holding_xml.holding_is_current(b"<holding/>", urn)
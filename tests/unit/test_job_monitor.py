@@ -0,0 +1,254 @@
+import etd.job_monitor as job_monitor
+from etd.job_monitor import (CircuitBreaker, JobMonitorReporter,
+                             RecordNotifier, RunSummary, SpillFile)
+import requests_mock
+import pytest
+import threading
+import time
+
+
+class FakeClock():
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeJobMonitor():
+
+    def __init__(self):
+        self.posts = []
+        self.down = False
+
+    def __call__(self, job_code, code, message, run_id):
+        if self.down:
+            raise Exception("Job Monitor is down")
+        self.posts.append((job_code, code, message, run_id))
+        return f'run-{len(self.posts)}'
+
+
+class TestJobMonitor():
+
+    def test_status_code(self):
+        """
+        Test that status codes follow the ones lib.notify reports.
+        """
+        assert job_monitor.status_code('start', 0, 0) == 'STARTED_SUCCESS'
+        assert job_monitor.status_code('running', 0, 0) == 'RUNNING'
+        assert job_monitor.status_code('running', 1, 0) == 'RUNNING_ERROR'
+        assert job_monitor.status_code('running', 0, 1) == 'RUNNING_WARNING'
+        assert job_monitor.status_code('complete', 1, 1) == \
+            'COMPLETED_FAILED'
+
+    def test_post_status(self):
+        """
+        Test posting a status and reading back the run id.
+        """
+        url = "https://jobmon.example.edu"
+        with requests_mock.Mocker() as m:
+            m.post(f"{url}/set_job_status/job_code/job/status_code/RUNNING"
+                   f"/run_id/42", text="42,ok")
+            assert job_monitor.post_status("job", "RUNNING", "m", "42",
+                                           url=url) == "42"
+            m.post(requests_mock.ANY, status_code=500, text="error")
+            with pytest.raises(Exception):
+                job_monitor.post_status("job", "RUNNING", "m", url=url)
+
+    def test_circuit_breaker(self):
+        """
+        Test that the breaker opens after the threshold and lets a call
+        through after the cooldown.
+        """
+        clock = FakeClock()
+        breaker = CircuitBreaker(threshold=2, cooldown=10, clock=clock)
+        breaker.record_failure()
+        assert breaker.allow() and not breaker.is_open
+        breaker.record_failure()
+        assert breaker.is_open and not breaker.allow()
+        clock.now = 10
+        assert breaker.allow()
+        breaker.record_success()
+        assert not breaker.is_open
+
+    def test_run_summary(self):
+        """
+        Test that pass messages are counted and fail and warn messages
+        are listed up to the limit.
+        """
+        summary = RunSummary(max_messages=1)
+        summary.add('report', 'start')
+        summary.add('pass', 'ok')
+        summary.add('fail', 'first failure')
+        summary.add('fail', 'second failure')
+        summary.add('warn', 'a warning')
+        message = summary.render(dropped=3)
+        assert "Records started: 1, completed: 0" in message
+        assert "failures: 2" in message
+        assert "first failure\n... and 1 more" in message
+        assert "second failure" not in message
+        assert "Warnings\na warning" in message
+        assert "dropped, the queue was full: 3" in message
+        summary.add('fail', 'x' * job_monitor.MAX_MESSAGE_SIZE)
+        summary.max_messages = 2
+        summary.add('fail', 'x' * job_monitor.MAX_MESSAGE_SIZE)
+        assert len(summary.render()) <= job_monitor.MAX_MESSAGE_SIZE
+
+    def test_coalesced_reports(self, tmp_path):
+        """
+        Test that record messages are coalesced into one run per job code.
+        """
+        fake = FakeJobMonitor()
+        reporter = JobMonitorReporter(
+            post=fake, spill=SpillFile(str(tmp_path / "spill.jsonl")))
+        notifier = RecordNotifier("drsholding2alma", reporter)
+        for pqid in ("1", "2"):
+            notifier.log('pass', 'Update ETD Alma DRS Holding Record')
+            assert notifier.report('start')
+            notifier.log('pass', f'{pqid} DRS holding was updated')
+            notifier.report('complete')
+        notifier.log('fail', 'Error getting mms id for pqid: 3')
+        assert not notifier.report('stopped')
+        reporter.drain()
+        reporter.flush()
+        assert len(fake.posts) == 1
+        job_code, code, message, run_id = fake.posts[0]
+        assert (job_code, code, run_id) == \
+            ("drsholding2alma", "STARTED_FAILED", None)
+        assert "Records started: 2, completed: 2" in message
+        assert "Error getting mms id for pqid: 3" in message
+
+        reporter.flush()
+        assert len(fake.posts) == 1
+        notifier.log('pass', 'more')
+        reporter.drain()
+        reporter.flush()
+        assert fake.posts[1][1:] == ("RUNNING", fake.posts[1][2], "run-1")
+        reporter.stop()
+        assert fake.posts[2][1] == "COMPLETED_SUCCESS"
+        assert fake.posts[2][3] == "run-1"
+        assert reporter.run_ids == {}
+        assert reporter.stats['posted'] == 3
+
+    def test_spill_and_replay(self, tmp_path):
+        """
+        Test that reports are spilled while the Job Monitor is down and
+        posted once it answers again.
+        """
+        clock = FakeClock()
+        fake = FakeJobMonitor()
+        spill = SpillFile(str(tmp_path / "spill.jsonl"))
+        reporter = JobMonitorReporter(
+            post=fake, spill=spill, clock=clock,
+            breaker=CircuitBreaker(threshold=1, cooldown=60, clock=clock))
+        fake.down = True
+        reporter.put("job", 'fail', 'first')
+        reporter.drain()
+        reporter.flush()
+        assert reporter.breaker.is_open
+        reporter.put("job", 'pass', 'second')
+        reporter.drain()
+        reporter.flush()
+        assert fake.posts == []
+        assert reporter.stats['spilled'] == 2
+
+        fake.down = False
+        clock.now = 60
+        reporter.put("job", 'pass', 'third')
+        reporter.drain()
+        reporter.flush()
+        assert [post[1] for post in fake.posts] == \
+            ["STARTED_SUCCESS", "STARTED_FAILED", "STARTED_SUCCESS"]
+        assert spill.take() == []
+
+        fake.down = True
+        reporter.put("job", 'pass', 'fourth')
+        reporter.put("job", 'pass', 'fifth')
+        reporter.drain()
+        reporter.flush()
+        spill.append({'job_code': "job", 'status_code': "RUNNING",
+                      'message': "spilled", 'run_id': None})
+        reporter.replay_spilled()
+        assert len(spill.take()) == 2
+
+    def test_dropped_messages(self, tmp_path):
+        """
+        Test that a full queue drops messages instead of blocking.
+        """
+        fake = FakeJobMonitor()
+        reporter = JobMonitorReporter(
+            post=fake, spill=SpillFile(str(tmp_path / "spill.jsonl")),
+            queue_size=1)
+        busy = threading.Event()
+        reporter.thread = threading.Thread(target=busy.wait)
+        reporter.thread.start()
+        reporter.put("job", 'pass', 'queued')
+        reporter.put("job", 'pass', 'dropped')
+        busy.set()
+        reporter.thread.join()
+        reporter.drain()
+        reporter.flush()
+        assert "passed: 1" in fake.posts[0][2]
+        assert "Messages dropped, the queue was full: 1" in fake.posts[0][2]
+
+    def test_reporter_thread(self, tmp_path):
+        """
+        Test that the thread sends running reports and completes the run
+        when it is stopped.
+        """
+        fake = FakeJobMonitor()
+        reporter = JobMonitorReporter(
+            post=fake, spill=SpillFile(str(tmp_path / "spill.jsonl")),
+            flush_secs=0.01)
+        notifier = RecordNotifier("job", reporter)
+        notifier.log('pass', 'started', echo=True)
+        for _ in range(100):
+            if fake.posts:
+                break
+            time.sleep(0.01)
+        assert fake.posts[0][1] == "STARTED_SUCCESS"
+        notifier.log('warn', 'careful')
+        reporter.stop()
+        assert not reporter.thread.is_alive()
+        assert fake.posts[-1][1].startswith("COMPLETED_")
+        assert "careful" in "".join(post[2] for post in fake.posts)
+
+    def test_stop_errors(self, tmp_path):
+        """
+        Test that post, spill and flush errors and a stuck thread are
+        logged and do not stop the worker from shutting down.
+        """
+        def broken(*args):
+            raise Exception("broken")
+        spill = SpillFile(str(tmp_path / "missing" / "spill.jsonl"))
+        assert spill.take() == []
+        reporter = JobMonitorReporter(post=broken, spill=spill,
+                                      queue_size=1)
+        reporter.run_ids["job"] = "run-1"
+        reporter.stop()
+        assert reporter.stats['spilled'] == 1
+        reporter.flush = broken
+        reporter.stop()
+
+        stuck = threading.Event()
+        reporter.thread = threading.Thread(target=stuck.wait)
+        reporter.thread.start()
+        reporter.queue.put_nowait(("job", 'pass', 'queued'))
+        reporter.stop(timeout=0.01)
+        assert reporter.thread.is_alive()
+        stuck.set()
+
+    def test_get_notifier(self, monkeypatch):
+        """
+        Test that each process gets one reporter and that it logs its
+        reports when no Job Monitor url is set.
+        """
+        monkeypatch.setattr(job_monitor, "_reporter", None)
+        notifier = job_monitor.get_notifier("job")
+        assert notifier.reporter is job_monitor.get_job_monitor_reporter()
+        notifier.log('pass', 'logged')
+        job_monitor.shutdown()
+        assert notifier.reporter.stats['posted'] == 1
+        monkeypatch.setattr(job_monitor, "_reporter_pid", -1)
+        job_monitor.shutdown()
@@ -0,0 +1,105 @@
+import pytest
+from etd import marcxml_template
+from etd.marcxml_template import MarcXmlTemplate, get_marcxml_template
+
+TEMPLATE = "./templates/alma_marcxml_drsholding_template.xml"
+# Written by the tree walk writeMarcXml used before the template was
+# compiled, the rendered records must match them byte for byte
+GOLDEN = "./tests/data/unit/marcxml_drsholding.xml"
+GOLDEN_ESCAPED = "./tests/data/unit/marcxml_drsholding_escaped.xml"
+
+VALUES = {'yymmdd': '230717',
+          'date_created': '2023-05',
+          'proquest_id': '1234567890',
+          'title': "Naming Expeditor: Reimagining Institutional Naming "
+                   "System at Harvard",
+          'title_indicator_2': '0',
+          'object_urn': 'URN-3:HUL.DRS.OBJECT:12345678',
+          'lib_code': 'des'}
+
+
+def read_golden(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+class TestMarcXmlTemplate():
+
+    def test_render_matches_golden(self):
+        """
+        Test that a record is the same bytes the tree walk wrote.
+        """
+        template = MarcXmlTemplate.from_file(TEMPLATE)
+        assert template.render(**VALUES).encode('utf-8') == \
+            read_golden(GOLDEN)
+
+    def test_render_escapes_like_lxml(self):
+        """
+        Test that markup, quotes, whitespace and non ascii values are
+        escaped as lxml serialized them.
+        """
+        template = MarcXmlTemplate.from_file(TEMPLATE)
+        values = dict(VALUES,
+                      title="Tom & Jerry <\"Cats\"> 'n' mice\r\n\tCafé "
+                            "\U0001F600 ]]>",
+                      title_indicator_2=' "&<\t\n\r',
+                      object_urn='URN-3:HUL.DRS.OBJECT:1&2')
+        assert template.render(**values).encode('utf-8') == \
+            read_golden(GOLDEN_ESCAPED)
+
+    def test_slots(self):
+        """
+        Test that the template compiles to its seven slots.
+        """
+        template = MarcXmlTemplate.from_file(TEMPLATE)
+        assert [slot for slot, escape in template.slots] == \
+            ['yymmdd', 'date_created', 'proquest_id', 'title_indicator_2',
+             'title', 'object_urn', 'lib_code']
+        assert len(template.literals) == len(template.slots) + 1
+
+    def test_control_characters_are_rejected(self):
+        """
+        Test that values lxml would not put in a tree raise ValueError.
+        """
+        template = MarcXmlTemplate.from_file(TEMPLATE)
+        with pytest.raises(ValueError):
+            template.render(**dict(VALUES, title="bad\x0bvalue"))
+        with pytest.raises(ValueError):
+            template.render(**dict(VALUES, title_indicator_2="\x00"))
+
+    def test_only_slots_are_replaced(self):
+        """
+        Test that placeholders outside their field are left as they are.
+        """
+        template = MarcXmlTemplate(
+            b'<record><controlfield tag="001">YYMMDD</controlfield>'
+            b'<controlfield tag="008">YYMMDD</controlfield>'
+            b'<holding><subfield code="a">TITLE_VALUE</subfield></holding>'
+            b'<datafield tag="245" ind2="TITLE_INDICATOR_2_VALUE">'
+            b'<subfield code="b">TITLE_VALUE</subfield></datafield>'
+            b'</record>')
+        assert template.render(yymmdd='&') == \
+            '<record><controlfield tag="001">YYMMDD</controlfield>' \
+            '<controlfield tag="008">&amp;</controlfield>' \
+            '<holding><subfield code="a">TITLE_VALUE</subfield></holding>' \
+            '<datafield tag="245" ind2="TITLE_INDICATOR_2_VALUE">' \
+            '<subfield code="b">TITLE_VALUE</subfield></datafield>' \
+            '</record>'
+
+    def test_template_is_read_once(self, monkeypatch):
+        """
+        Test that the template is compiled on first use and then reused.
+        """
+        monkeypatch.setattr(marcxml_template, '_renderers', {})
+        reads = []
+        from_file = MarcXmlTemplate.from_file.__func__
+
+        def counting_from_file(cls, path):
+            reads.append(path)
+            return from_file(cls, path)
+        monkeypatch.setattr(MarcXmlTemplate, 'from_file',
+                            classmethod(counting_from_file))
+
+        template = get_marcxml_template(TEMPLATE)
+        assert get_marcxml_template(TEMPLATE) is template
+        assert reads == [TEMPLATE]
@@ -0,0 +1,63 @@
+from etd import mets_xml
+import io
+
+METS = (b'<?xml version="1.0" encoding="UTF-8"?>\n'
+        b'<mets xmlns="http://www.loc.gov/METS/">\n'
+        b'  <metsHdr><agent><name>ETD Administrator</name></agent>'
+        b'</metsHdr>\n'
+        b'  <dmdSec ID="dmd-1"><mdWrap><xmlData '
+        b'xmlns:dim="http://www.dspace.org/xmlns/dspace/dim"><dim:dim>\n'
+        b'    <dim:field mdschema="dc" element="title">The \x0bTitle\x1f'
+        b'</dim:field>\n'
+        b'    <dim:field mdschema="dc" element="date" qualifier="created">'
+        b'2023-05</dim:field>\n'
+        b'  </dim:dim></xmlData></mdWrap></dmdSec>\n'
+        b'  <dmdSec ID="dmd-2"><dim:field '
+        b'xmlns:dim="http://www.dspace.org/xmlns/dspace/dim" '
+        b'element="title">Second</dim:field></dmdSec>\n'
+        b'  <fileSec> not well formed <<<\n')
+
+
+class TestMetsXml():
+
+    def test_sanitized_chunks(self):
+        """
+        Test that control characters are removed from every chunk.
+        """
+        chunks = list(mets_xml.sanitized_chunks(
+            io.BytesIO(b'a\x00b\x0bc\td\ne\x1f\r'), chunk_size=3))
+        assert b''.join(chunks) == b'abc\td\ne\r'
+
+    def test_read_dim_fields(self, tmp_path):
+        """
+        Test that the fields of the first dmdSec are read, that parsing
+        stops after it, and that the source file is not rewritten.
+        """
+        mets_file = tmp_path / "mets.xml"
+        mets_file.write_bytes(METS)
+        for chunk_size in (7, mets_xml.METS_CHUNK_SIZE):
+            fields = mets_xml.read_dim_fields(str(mets_file), chunk_size)
+            assert fields == [
+                ({'mdschema': 'dc', 'element': 'title'}, 'The Title'),
+                ({'mdschema': 'dc', 'element': 'date',
+                  'qualifier': 'created'}, '2023-05')]
+        assert mets_file.read_bytes() == METS
+
+    def test_no_dmd_sec(self, tmp_path):
+        """
+        Test a METS file without a dmdSec.
+        """
+        mets_file = tmp_path / "mets.xml"
+        mets_file.write_bytes(b'<mets xmlns="http://www.loc.gov/METS/">'
+                              b'<metsHdr/></mets>')
+        assert mets_xml.read_dim_fields(str(mets_file)) == []
+
+    def test_sample_mets(self):
+        """
+        Test reading the sample METS file.
+        """
+        fields = mets_xml.read_dim_fields("./tests/data/samplemets.xml")
+        titles = [text for attrib, text in fields
+                  if attrib.get('element') == 'title']
+        assert titles == ["Naming Expeditor: Reimagining Institutional "
+                          "Naming System at Harvard"]
@@ -0,0 +1,92 @@
+import etd.mongo_util as mongo_util
+import time
+
+
+class TestMongoUtil():
+
+    def test_shared_client(self):
+        """
+        Test that the process shares one lazily created mongo client.
+        """
+        mongo_util.reset_client()
+        client = mongo_util.get_client()
+        assert mongo_util.get_client() is client
+        assert client.max_pool_size == mongo_util.MONGO_MAX_POOL_SIZE
+
+        mongo_util.reset_client()
+        new_client = mongo_util.get_client()
+        assert new_client is not client
+
+        mongo_util.close_client()
+        assert mongo_util.get_client() is not new_client
+        mongo_util.close_client()
+
+    def test_collscan_stages(self):
+        """
+        Test that collection scans are found anywhere in a query plan.
+        """
+        index_plan = {"stage": "FETCH",
+                      "inputStage": {"stage": "IXSCAN",
+                                     "indexName": "proquest_id_directory_id"}}
+        assert mongo_util.collscan_stages(index_plan) == []
+        collscan_plan = {"stage": "SUBPLAN",
+                         "inputStages": [index_plan,
+                                         {"stage": "COLLSCAN",
+                                          "direction": "forward"}]}
+        assert len(mongo_util.collscan_stages(collscan_plan)) == 1
+
+    def test_status_write_behind(self):
+        """
+        Test that status updates are buffered, coalesced and bulk written,
+        and that failed writes are retried.
+        """
+        class FakeCollection():
+            full_name = "etd.test"
+
+            def __init__(self):
+                self.writes = []
+                self.fail = False
+
+            def bulk_write(self, ops, ordered=True):
+                if self.fail:
+                    raise Exception("not primary")
+                self.writes.append((ops, ordered))
+
+        collection = FakeCollection()
+        writer = mongo_util.StatusWriteBehind(max_pending=3, flush_secs=0)
+        writer.add(collection, {"proquest_id": "1"}, "ALMA")
+        writer.add(collection, {"proquest_id": "1"}, "DRS_HOLDING_API")
+        writer.add(collection, {"proquest_id": "2"}, "DRS_HOLDING_API")
+        assert collection.writes == []
+        assert writer.pending_count() == 2
+
+        collection.fail = True
+        assert not writer.flush()
+        assert writer.pending_count() == 2
+        collection.fail = False
+        writer.add(collection, {"proquest_id": "3"}, "DRS_HOLDING_API")
+        ops, ordered = collection.writes[0]
+        assert not ordered
+        assert len(ops) == 3
+        assert writer.pending_count() == 0
+
+    def test_status_write_behind_timer(self):
+        """
+        Test that buffered status updates are flushed after flush_secs.
+        """
+        class FakeCollection():
+            full_name = "etd.test"
+            writes = []
+
+            def bulk_write(self, ops, ordered=True):
+                self.writes.append(ops)
+
+        collection = FakeCollection()
+        writer = mongo_util.StatusWriteBehind(max_pending=10,
+                                              flush_secs=0.05)
+        writer.add(collection, {"proquest_id": "1"}, "DRS_HOLDING_API")
+        for _ in range(100):
+            if collection.writes:
+                break
+            time.sleep(0.01)
+        assert len(collection.writes) == 1
@@ -0,0 +1,195 @@
+from etd.rate_limiter import RateLimiter, MemoryBackend, FileBackend
+from etd.rate_limiter import MongoBackend, get_rate_limiter
+from etd.alma_client import AlmaClient
+from pymongo.errors import DuplicateKeyError
+import requests_mock
+
+
+class FakeClock():
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, secs):
+        self.sleeps.append(secs)
+
+
+class FakeResult():
+
+    def __init__(self, modified_count):
+        self.modified_count = modified_count
+
+
+class FakeCollection():
+    """
+    Stands in for a mongo collection. The first insert and the first
+    update lose the race to another process.
+    """
+
+    def __init__(self):
+        self.docs = {}
+        self.lost_insert = False
+        self.lost_update = False
+
+    def find_one(self, query):
+        doc = self.docs.get(query['_id'])
+        return dict(doc) if doc else None
+
+    def insert_one(self, doc):
+        if not self.lost_insert:
+            self.lost_insert = True
+            self.docs[doc['_id']] = {'_id': doc['_id'], 'version': 1,
+                                     'tokens': 0.0, 'ts': doc['ts']}
+            raise DuplicateKeyError("duplicate key")
+        self.docs[doc['_id']] = dict(doc)
+
+    def update_one(self, query, update):
+        doc = self.docs[query['_id']]
+        if not self.lost_update:
+            self.lost_update = True
+            doc['version'] += 1
+        if doc['version'] != query['version']:
+            return FakeResult(0)
+        doc.update(update['$set'])
+        doc['version'] += update['$inc']['version']
+        return FakeResult(1)
+
+
+class TestRateLimiter():
+
+    def test_token_bucket(self):
+        """
+        Test that requests beyond the burst are spaced at the rate.
+        """
+        clock = FakeClock()
+        limiter = RateLimiter(rate=10, burst=2, backend=MemoryBackend(),
+                              clock=clock, sleep=clock.sleep)
+        waits = [limiter.acquire() for _ in range(5)]
+        assert waits[:2] == [0.0, 0.0]
+        assert [round(w, 3) for w in waits[2:]] == [0.1, 0.2, 0.3]
+        stats = limiter.stats()
+        assert stats['acquired'] == 5
+        assert stats['waited'] == 3
+        assert round(stats['wait_secs_max'], 3) == 0.3
+        assert round(stats['wait_secs_avg'], 3) == 0.2
+
+        # a 429 holds back the next caller for the penalty
+        limiter.throttle(2)
+        assert round(limiter.acquire(), 3) == 2.1
+        assert limiter.stats()['throttled'] == 1
+
+    def test_try_acquire(self):
+        """
+        Test that try_acquire takes a token only when one is there, and
+        never sleeps.
+        """
+        clock = FakeClock()
+        limiter = RateLimiter(rate=10, burst=1, backend=MemoryBackend(),
+                              clock=clock, sleep=clock.sleep)
+        assert limiter.try_acquire()
+        assert not limiter.try_acquire()
+        clock.now += 0.1
+        assert limiter.try_acquire()
+        limiter.throttle(5)
+        clock.now += 1
+        assert not limiter.try_acquire()
+        assert clock.sleeps == []
+        assert limiter.stats()['acquired'] == 2
+        assert RateLimiter(rate=0, backend=MemoryBackend()).try_acquire()
+
+    def test_disabled(self):
+        """
+        Test that a rate of 0 never waits.
+        """
+        limiter = RateLimiter(rate=0, backend=MemoryBackend())
+        assert limiter.acquire() == 0.0
+        limiter.throttle()
+        assert limiter.stats() == {'acquired': 0, 'waited': 0,
+                                   'wait_secs_total': 0.0,
+                                   'wait_secs_max': 0.0,
+                                   'wait_secs_avg': 0.0,
+                                   'throttled': 1}
+        assert get_rate_limiter() is get_rate_limiter()
+
+    def test_file_backend(self, tmp_path):
+        """
+        Test that limiters on the same file share one bucket.
+        """
+        path = str(tmp_path / "rate_limit")
+        clock = FakeClock()
+        first = RateLimiter(rate=10, burst=1, backend=FileBackend(path),
+                            clock=clock, sleep=lambda secs: None)
+        second = RateLimiter(rate=10, burst=1, backend=FileBackend(path),
+                             clock=clock, sleep=lambda secs: None)
+        assert first.acquire() == 0.0
+        assert round(second.acquire(), 3) == 0.1
+
+        with open(path, 'w') as f:
+            f.write("not json")
+        assert first.acquire() == 0.0
+
+    def test_mongo_backend(self):
+        """
+        Test that the mongo backend retries lost compare-and-set races.
+        """
+        collection = FakeCollection()
+        clock = FakeClock()
+        first = RateLimiter(rate=10, burst=1,
+                            backend=MongoBackend(collection),
+                            clock=clock, sleep=lambda secs: None)
+        second = RateLimiter(rate=10, burst=1,
+                             backend=MongoBackend(collection),
+                             clock=clock, sleep=lambda secs: None)
+        # the racing insert left an empty bucket
+        assert round(first.acquire(), 3) == 0.1
+        assert round(second.acquire(), 3) == 0.2
+        assert collection.docs['alma']['version'] == 4
+
+        collection = FakeCollection()
+        collection.lost_insert = True
+        limiter = RateLimiter(rate=10, burst=1,
+                              backend=MongoBackend(collection),
+                              clock=clock, sleep=lambda secs: None)
+        assert limiter.acquire() == 0.0
+        assert collection.docs['alma']['tokens'] == 0.0
+
+    def test_alma_client_limited(self):
+        """
+        Test that Alma calls take a token and a 429 throttles the bucket.
+        """
+        clock = FakeClock()
+        limiter = RateLimiter(rate=5, burst=1, backend=MemoryBackend(),
+                              clock=clock, sleep=clock.sleep)
+        client = AlmaClient(api_base="https://alma.example.edu",
+                            api_key="secret",
+                            sru_base="https://alma.example.edu/sru?q=",
+                            limiter=limiter)
+        holding_url = client.holding_url("991", "221")
+        with requests_mock.Mocker() as m:
+            m.get(holding_url, [{'status_code': 429,
+                                 'headers': {'Retry-After': '3'}},
+                                {'status_code': 429},
+                                {'text': "<holding/>"}])
+            assert client.get(holding_url).status_code == 429
+            assert client.get(holding_url).status_code == 429
+            assert client.get(holding_url).status_code == 200
+        # the second 429 falls inside the first penalty
+        assert [round(s, 3) for s in clock.sleeps] == [3.2, 3.4]
+        assert limiter.stats()['throttled'] == 2
+
+        # a Retry-After beyond the cap pauses for the cap
+        limiter.max_penalty = 10
+        clock.now += 10
+        clock.sleeps = []
+        with requests_mock.Mocker() as m:
+            m.get(holding_url, [{'status_code': 429,
+                                 'headers': {'Retry-After': '86400'}},
+                                {'text': "<holding/>"}])
+            assert client.get(holding_url).status_code == 429
+            assert client.get(holding_url).status_code == 200
+        assert len(clock.sleeps) == 1 and 10 <= clock.sleeps[0] < 11
+        client.close()
@@ -0,0 +1,147 @@
+from etd.record_context import load_record_context, load_record_contexts
+import etd.mongo_util as mongo_util
+
+
+class FakeMongoUtil():
+
+    def __init__(self, records):
+        self.records = records
+        self.queries = []
+
+    def query_records(self, query={}, fields=None):
+        self.queries.append(query)
+        return self.records
+
+
+class TestRecordContext():
+
+    def test_load_from_mongo(self):
+        """
+        Test that one query loads everything the pipeline needs.
+        """
+        mongoutil = FakeMongoUtil([
+            {"proquest_id": "12345678",
+             "alma_submission_status": "DRS_HOLDING_DROPBOX",
+             "directory_id": "proquest1234-0000-gsd"},
+            {"proquest_id": "12345678",
+             "alma_submission_status": "ALMA",
+             "school_alma_dropbox": "gsd",
+             "directory_id": " proquest1234-5678-gsd ",
+             "indash": True},
+            {"proquest_id": "12345678",
+             "alma_submission_status": "ALMA",
+             "directory_id": "proquest1234-9999-gsd"}])
+        context = load_record_context(mongoutil, "12345678")
+        assert len(mongoutil.queries) == 1
+        assert context.found
+        assert context.from_mongo
+        assert context.in_dash
+        assert context.directory_id == "proquest1234-5678-gsd"
+        assert context.school_alma_dropbox == "gsd"
+        assert context.already_processed(
+            mongo_util.DRS_HOLDING_DROPBOX_STATUS)
+        assert not context.already_processed(
+            mongo_util.DRS_HOLDING_API_STATUS)
+
+    def test_not_found(self):
+        """
+        Test a proquest id with no record at ALMA status.
+        """
+        context = load_record_context(FakeMongoUtil([]), "12345678")
+        assert not context.found
+        context = load_record_context(FakeMongoUtil([
+            {"alma_submission_status": "ALMA", "indash": False}]),
+            "12345678")
+        assert not context.found
+
+    def test_load_from_message(self):
+        """
+        Test that a message carrying the record fields skips mongo.
+        """
+        mongoutil = FakeMongoUtil([])
+        message = {"pqid": "12345678",
+                   "object_urn": "URN-3:HUL.DRS.OBJECT:12345678",
+                   "indash": True,
+                   "directory_id": "proquest1234-5678-gsd",
+                   "school_alma_dropbox": "gsd",
+                   "alma_submission_status": "ALMA"}
+        context = load_record_context(mongoutil, "12345678",
+                                      message=message)
+        assert mongoutil.queries == []
+        assert context.found
+        assert not context.from_mongo
+        assert context.school_alma_dropbox == "gsd"
+
+        del message["school_alma_dropbox"]
+        load_record_context(mongoutil, "12345678", message=message)
+        del message["indash"]
+        load_record_context(mongoutil, "12345678", message=message)
+        assert len(mongoutil.queries) == 2
+
+    def test_message_without_status_reads_mongo(self):
+        """
+        Test that a message without the submission status, or with a null
+        directory id, is looked up in mongo, so a processed record is
+        still found.
+        """
+        mongoutil = FakeMongoUtil([
+            {"proquest_id": "12345678", "alma_submission_status": "ALMA",
+             "directory_id": "proquest1234-5678-gsd", "indash": False},
+            {"proquest_id": "12345678",
+             "alma_submission_status": "DRS_HOLDING_API",
+             "directory_id": "proquest1234-0000-gsd"}])
+        message = {"pqid": "12345678",
+                   "object_urn": "URN-3:HUL.DRS.OBJECT:12345678",
+                   "indash": False,
+                   "directory_id": "proquest1234-5678-gsd"}
+        context = load_record_context(mongoutil, "12345678",
+                                      message=message)
+        assert len(mongoutil.queries) == 1
+        assert context.from_mongo
+        assert context.already_processed(mongo_util.DRS_HOLDING_API_STATUS)
+
+        message.update(directory_id=None, alma_submission_status="ALMA")
+        context = load_record_context(mongoutil, "12345678",
+                                      message=message)
+        assert len(mongoutil.queries) == 2
+        assert context.directory_id == "proquest1234-5678-gsd"
+
+    def test_load_batch_with_one_query(self):
+        """
+        Test that the contexts of a batch are loaded with one $in query,
+        skipping the messages that carry their fields.
+        """
+        mongoutil = FakeMongoUtil([
+            {"proquest_id": "1", "alma_submission_status": "ALMA",
+             "directory_id": "proquest1-1-gsd", "indash": False},
+            {"proquest_id": "2", "alma_submission_status": "ALMA",
+             "directory_id": "proquest2-2-gsd", "indash": True,
+             "school_alma_dropbox": "gsd"},
+            {"proquest_id": "2",
+             "alma_submission_status": "DRS_HOLDING_DROPBOX",
+             "directory_id": "proquest2-0-gsd"}])
+        messages = [{"pqid": "1", "object_urn": "URN-1"},
+                    {"pqid": "2", "object_urn": "URN-2"},
+                    {"pqid": "3", "object_urn": "URN-3"},
+                    {"pqid": "1", "object_urn": "URN-1"},
+                    {"pqid": "4", "object_urn": "URN-4", "indash": False,
+                     "directory_id": "proquest4-4-gsd",
+                     "alma_submission_status": "ALMA"}]
+        contexts = load_record_contexts(mongoutil, messages)
+        assert mongoutil.queries == [
+            {"proquest_id": {"$in": ["1", "2", "3"]},
+             "alma_submission_status":
+                 {"$in": ["ALMA", "DRS_HOLDING_API",
+                          "DRS_HOLDING_DROPBOX"]}}]
+        assert sorted(contexts) == ["1", "2", "3", "4"]
+        assert not contexts["1"].in_dash
+        assert contexts["2"].in_dash
+        assert contexts["2"].object_urn == "URN-2"
+        assert contexts["2"].already_processed(
+            mongo_util.DRS_HOLDING_DROPBOX_STATUS)
+        assert not contexts["3"].found
+        assert not contexts["4"].from_mongo
+
+        mongoutil = FakeMongoUtil([])
+        assert list(load_record_contexts(mongoutil, messages[4:])) == ["4"]
+        assert mongoutil.queries == []
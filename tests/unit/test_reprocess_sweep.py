@@ -0,0 +1,304 @@
+import json
+from collections import Counter
+import threading
+import pytest
+import etd.drs_holding_by_api as drs_holding_by_api
+import etd.mongo_util as mongo_util
+from etd.drs_holding_by_api import DRSHoldingByAPI
+from etd.fake_alma import FakeAlma
+from etd.record_context import RecordContext
+from etd.reprocess_sweep import (Checkpoint, Sweep, holding_message,
+                                 manifest_candidates, mongo_candidates,
+                                 run_each)
+
+
+class FakeMongoUtil():
+    """
+    Stands in for MongoUtil, with the records at ALMA status and the
+    proquest ids that already have a DRS holding status.
+    """
+
+    def __init__(self, records, processed=()):
+        self.records = records
+        self.processed = set(processed)
+        self.finds = []
+        self.processed_queries = []
+
+    def find_records(self, query, fields, sort_field, batch_size):
+        self.finds.append((query, fields, sort_field, batch_size))
+        records = self.records
+        for clause in query.get("$and", [query]):
+            pqid = clause.get(mongo_util.FIELD_PQ_ID, {})
+            records = [r for r in records
+                       if r[mongo_util.FIELD_PQ_ID] > pqid.get("$gt", "")
+                       and r[mongo_util.FIELD_PQ_ID] < pqid.get("$lt", "~")]
+        return iter(sorted(records,
+                           key=lambda r: r[mongo_util.FIELD_PQ_ID]))
+
+    def query_records(self, query, fields):
+        pqids = query[mongo_util.FIELD_PQ_ID]["$in"]
+        self.processed_queries.append(pqids)
+        return [{mongo_util.FIELD_PQ_ID: pqid} for pqid in pqids
+                if pqid in self.processed]
+
+
+def records(count):
+    return [{'pqid': f'{i:04d}', 'object_urn': f'URN-3:HUL.DRS.OBJECT:{i}'}
+            for i in range(count)]
+
+
+class RecordingNotifier():
+    """
+    Keeps the Job Monitor messages of one record.
+    """
+
+    def __init__(self):
+        self.messages = []
+
+    def log(self, type, message, echo=False):
+        self.messages.append(message)
+
+    def report(self, stage, echo=False, header=False):
+        self.messages.append(stage)
+
+
+class TestReprocessSweep():
+
+    def test_manifest_candidates(self, tmp_path):
+        """
+        Test that csv and JSON lines manifests are read, and that resumed
+        reads skip the records already swept.
+        """
+        csv_manifest = tmp_path / "manifest.csv"
+        csv_manifest.write_text("pqid,object_urn\n1,URN-1\n2,URN-2\n3,\n")
+        assert list(manifest_candidates(str(csv_manifest), skip=1)) == \
+            [{'pqid': '2', 'object_urn': 'URN-2'},
+             {'pqid': '3', 'object_urn': ''}]
+
+        jsonl_manifest = tmp_path / "manifest.jsonl"
+        jsonl_manifest.write_text('{"pqid": "1", "object_urn": "URN-1"}\n'
+                                  '\n{"pqid": "2"}\n')
+        assert list(manifest_candidates(str(jsonl_manifest))) == \
+            [{'pqid': '1', 'object_urn': 'URN-1'},
+             {'pqid': '2', 'object_urn': None}]
+
+    def test_mongo_candidates(self):
+        """
+        Test that mongo candidates are read in proquest id order, after
+        the resume point, without the records already processed.
+        """
+        mongoutil = FakeMongoUtil(
+            [{mongo_util.FIELD_PQ_ID: pqid, 'object_urn': f'URN-{pqid}'}
+             for pqid in ['5', '1', '4', '3', '2']],
+            processed=['3'])
+        counts = {'already_processed': 0}
+        candidates = mongo_candidates(mongoutil, after_pqid='1',
+                                      batch_size=2, counts=counts)
+        assert list(candidates) == [{'pqid': '2', 'object_urn': 'URN-2'},
+                                    {'pqid': '4', 'object_urn': 'URN-4'},
+                                    {'pqid': '5', 'object_urn': 'URN-5'}]
+        assert counts['already_processed'] == 1
+        query, fields, sort_field, batch_size = mongoutil.finds[0]
+        assert query == {"$and": [
+            {mongo_util.FIELD_SUBMISSION_STATUS: mongo_util.ALMA_STATUS},
+            {mongo_util.FIELD_PQ_ID: {"$gt": "1"}}]}
+        assert sort_field == mongo_util.FIELD_PQ_ID
+        assert batch_size == 2
+        assert mongoutil.processed_queries == [['2', '3'], ['4', '5']]
+
+        assert list(mongo_candidates(FakeMongoUtil([]), query={})) == []
+
+        # a resumed sweep keeps the query's own proquest id clause
+        candidates = mongo_candidates(
+            mongoutil, query={mongo_util.FIELD_PQ_ID: {"$lt": "5"}},
+            after_pqid='2')
+        assert [record['pqid'] for record in candidates] == ['4']
+
+    def test_run_each(self):
+        """
+        Test that a record that raises counts as failed.
+        """
+        def process_record(record):
+            if record['pqid'] == '0001':
+                raise Exception("Alma is down")
+            return True
+        assert run_each(process_record)(records(3)) == [True, False, True]
+        assert holding_message(dict(records(1)[0], extra=1)) == \
+            records(1)[0]
+
+    def test_checkpoint(self, tmp_path):
+        """
+        Test that a checkpoint is saved and loaded, and refused for a
+        sweep of another source.
+        """
+        path = str(tmp_path / "sweep.json")
+        checkpoint = Checkpoint(path, "manifest:/data/a.csv")
+        assert checkpoint.load() is None
+        checkpoint.save(50, '0049', {'ok': 50})
+        assert checkpoint.load() == {'source': "manifest:/data/a.csv",
+                                     'position': 50, 'last_pqid': '0049',
+                                     'counts': {'ok': 50}}
+        with pytest.raises(ValueError):
+            Checkpoint(path, "mongo:null").load()
+
+    def test_sweep_checkpoints_finished_chunks_in_order(self, tmp_path):
+        """
+        Test that the checkpoint does not move past a slow chunk while
+        later chunks finish.
+        """
+        first_chunk = threading.Event()
+        saved = []
+
+        class RecordingCheckpoint(Checkpoint):
+            def save(self, position, last_pqid, counts):
+                saved.append((position, last_pqid))
+                # a later chunk finished first, let the first one end
+                if position == 0:
+                    first_chunk.set()
+                super().save(position, last_pqid, counts)
+
+        def process(records):
+            if records[0]['pqid'] == '0000':
+                first_chunk.wait(5)
+            return [True] * len(records)
+
+        checkpoint = RecordingCheckpoint(str(tmp_path / "sweep.json"),
+                                         "test")
+        sweep = Sweep(process, workers=2, chunk_size=2,
+                      checkpoint=checkpoint, report=lambda line: None,
+                      checkpoint_secs=0)
+        assert sweep.run(iter(records(7))) == {'ok': 7, 'failed': 0,
+                                               'skipped': 0}
+        assert first_chunk.is_set()
+        positions = [position for position, last_pqid in saved]
+        assert positions[0] == 0
+        assert positions == sorted(positions)
+        assert saved[-1] == (7, '0006')
+        assert checkpoint.load()['position'] == 7
+
+    def test_sweep_outcomes_and_reports(self):
+        """
+        Test that records without an urn are skipped, a chunk that raises
+        fails its records and progress is reported with the rate.
+        """
+        ticks = iter(range(100))
+        lines = []
+
+        def process(records):
+            if records[0]['pqid'] == '0002':
+                raise Exception("broker is down")
+            return [record['pqid'] != '0001' for record in records]
+
+        candidates = records(4) + [{'pqid': '0004', 'object_urn': None}]
+        sweep = Sweep(process, workers=1, chunk_size=2, report=lines.append,
+                      report_secs=1, clock=lambda: next(ticks))
+        counts = sweep.run(candidates, resume={'position': 10,
+                                               'last_pqid': '0000',
+                                               'counts': {'ok': 10}})
+        assert counts == {'ok': 11, 'failed': 3, 'skipped': 1}
+        assert sweep.position == 15
+        assert lines[-1].startswith("15 records, ")
+        assert "records/sec" in lines[-1]
+        assert "checkpoint at 15 (0004)" in lines[-1]
+
+    def test_checkpoint_counts_stop_at_its_position(self, tmp_path):
+        """
+        Test that the counts saved with the checkpoint leave out chunks
+        finished after a slow one, so a resumed sweep counts them once.
+        """
+        first_chunk = threading.Event()
+        saved = []
+        counts = Counter()
+
+        class RecordingCheckpoint(Checkpoint):
+            def save(self, position, last_pqid, counts):
+                saved.append((position, dict(counts)))
+                if position == 0:
+                    first_chunk.set()
+                super().save(position, last_pqid, counts)
+
+        def process(records):
+            if records[0]['pqid'] == '0000':
+                first_chunk.wait(5)
+            return [True] * len(records)
+
+        def candidates():
+            for record in records(6):
+                counts['already_processed'] += 1
+                yield record
+
+        sweep = Sweep(process, workers=2, chunk_size=2,
+                      checkpoint=RecordingCheckpoint(
+                          str(tmp_path / "sweep.json"), "test"),
+                      report=lambda line: None, checkpoint_secs=0)
+        sweep.counts = counts
+        sweep.run(candidates())
+        for position, saved_counts in saved:
+            assert saved_counts.get('ok', 0) == position
+            assert saved_counts.get('already_processed', 0) == position
+        assert saved[0] == (0, {})
+        assert saved[-1][0] == 6
+
+    def test_sweep_interrupted(self, tmp_path):
+        """
+        Test that an interrupted sweep finishes the chunks in flight and
+        saves its checkpoint before stopping.
+        """
+        def candidates():
+            yield from records(4)
+            raise KeyboardInterrupt()
+
+        path = str(tmp_path / "sweep.json")
+        lines = []
+        sweep = Sweep(lambda chunk: [True] * len(chunk), workers=2,
+                      chunk_size=2, checkpoint=Checkpoint(path, "test"),
+                      report=lines.append)
+        with pytest.raises(KeyboardInterrupt):
+            sweep.run(candidates())
+        with open(path) as f:
+            assert json.load(f)['position'] == 4
+        assert lines[0] == "Interrupted, finishing the chunks in flight"
+
+    def test_sweep_runs_the_holding_pipeline(self, tmp_path, monkeypatch):
+        """
+        Test that an in process sweep on several threads counts the
+        records the pipeline updated as ok, and that each record reports
+        to its own Job Monitor notifier.
+        """
+        notifiers = []
+
+        def get_notifier(job_code):
+            notifiers.append(RecordingNotifier())
+            return notifiers[-1]
+        monkeypatch.setattr(drs_holding_by_api, "get_notifier",
+                            get_notifier)
+        candidates = records(8)
+        with FakeAlma(latency=0.01) as alma:
+            for i, record in enumerate(candidates[:6]):
+                alma.add_record(record['pqid'], f'99{i}', f'22{i}')
+
+            def process_record(record):
+                context = RecordContext(record['pqid'],
+                                        record['object_urn'],
+                                        in_dash=False, directory_id='b1')
+                drs_holding = DRSHoldingByAPI(
+                    record['pqid'], record['object_urn'], True,
+                    alt_output_dir=str(tmp_path / record['pqid']),
+                    record_context=context, in_memory=True)
+                drs_holding.alma_client = alma.client()
+                try:
+                    return drs_holding.send_to_alma(
+                        holding_message(record))
+                finally:
+                    drs_holding.alma_client.close()
+
+            sweep = Sweep(run_each(process_record), workers=4, chunk_size=1,
+                          report=lambda line: None)
+            assert sweep.run(candidates) == {'ok': 6, 'failed': 2,
+                                             'skipped': 0}
+        assert len(notifiers) == 8
+        for notifier in notifiers:
+            pqids = {record['pqid'] for record in candidates
+                     if any(record['pqid'] in message
+                            for message in notifier.messages)}
+            assert len(pqids) == 1
@@ -0,0 +1,336 @@
+import io
+import os
+import time
+import logging
+import threading
+import paramiko
+from etd.sftp_pool import SFTPPool, load_private_key
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ed25519
+import pytest
+
+
+class FakeConnection():
+    """
+    Stands in for an xfer_files connection to a local sftp server.
+    """
+    uploads = []
+
+    def __init__(self, remoteSite, remoteUser, privateKey, sshPort=22):
+        self.remoteSite = remoteSite
+        self.privateKey = privateKey
+        self.error = False if remoteSite != "badhost" else "Key login failed"
+        self.alive = True
+        self.fail_puts = 1 if remoteSite == "flakyhost" else 0
+        self.keepalive = None
+        self.closed = False
+
+    def is_alive(self, probe=False):
+        return self.alive
+
+    def set_keepalive(self, interval):
+        self.keepalive = interval
+
+    def put_file(self, localFile, remoteFile):
+        if self.fail_puts:
+            self.fail_puts -= 1
+            self.error = "Failed to send"
+            return None
+        self.error = False
+        self.uploads.append((self, localFile, remoteFile))
+
+    def put_fileobj(self, fileObj, tempFile, remoteFile):
+        if self.fail_puts:
+            # fail part way through the stream
+            fileObj.read(4)
+            self.fail_puts -= 1
+            self.error = "Failed to send"
+            return None
+        self.error = False
+        self.uploads.append((self, fileObj.read(), tempFile, remoteFile))
+
+    def close(self):
+        self.closed = True
+
+
+class TestSFTPPool():
+
+    def test_reuse_and_counters(self):
+        """
+        Test that connections are reused per (server, user, port) and that
+        the private key is parsed once.
+        """
+        loaded = []
+        pool = SFTPPool(connect=FakeConnection,
+                        load_key=lambda path: loaded.append(path) or "KEY",
+                        keepalive_secs=30)
+        conn = pool.checkout("dropbox", "etd", "/keys/id_rsa")
+        assert conn.keepalive == 30
+        assert conn.privateKey == "KEY"
+        pool.checkin(conn)
+        assert pool.checkout("dropbox", "etd", "/keys/id_rsa") is conn
+        other = pool.checkout("dropbox", "etd", "/keys/id_rsa", 2222)
+        assert other is not conn
+        assert loaded == ["/keys/id_rsa"]
+        assert pool.stats() == {'hits': 1, 'misses': 2, 'reconnects': 0,
+                                'hit_ratio': 1 / 3}
+
+    def test_checkout_is_exclusive(self):
+        """
+        Test that a checked out connection is not handed to another
+        borrower until it is checked in, and that only known connections
+        without an error are taken back.
+        """
+        pool = SFTPPool(connect=FakeConnection, load_key=lambda path: path)
+        first = pool.checkout("dropbox", "etd", None)
+        second = pool.checkout("dropbox", "etd", None)
+        assert second is not first
+        pool.checkin(first)
+        assert pool.checkout("dropbox", "etd", None) is first
+        second.error = "Failed to send"
+        pool.checkin(second)
+        assert second.closed
+        pool.checkin(FakeConnection("dropbox", "etd", None))
+        pool.checkin(first)
+        pool.checkin(first)
+        assert pool.idle[("dropbox", "etd", 22)] == \
+            [(first, pool.idle[("dropbox", "etd", 22)][0][1])]
+        pool.close_all()
+        assert first.closed and pool.idle == {}
+
+    def test_stale_connection_reconnects(self):
+        """
+        Test that a dead connection is replaced and a failed upload is
+        retried on a fresh connection.
+        """
+        pool = SFTPPool(connect=FakeConnection, load_key=lambda path: path)
+        conn = pool.checkout("dropbox", "etd", "/keys/id_rsa")
+        pool.checkin(conn)
+        conn.alive = False
+        fresh = pool.checkout("dropbox", "etd", "/keys/id_rsa")
+        assert fresh is not conn
+        assert conn.closed
+        assert pool.stats()['reconnects'] == 1
+
+        fresh.fail_puts = 1
+        pool.checkin(fresh)
+        assert not pool.put_file("dropbox", "etd", "/keys/id_rsa",
+                                 "local.xml", "/incoming/local.xml")
+        assert fresh.closed
+        assert FakeConnection.uploads[-1][0] is not fresh
+        pool.close_all()
+        assert pool.stats()['misses'] == 3
+
+    def test_login_failure_is_not_pooled(self):
+        """
+        Test that a connection that failed to log in is not kept.
+        """
+        def bad_key(path):
+            raise Exception("not a key")
+
+        pool = SFTPPool(connect=FakeConnection, load_key=bad_key,
+                        keepalive_secs=0)
+        assert pool.put_file("badhost", "etd", "/keys/id_rsa",
+                             "local.xml", "/incoming/local.xml") == \
+            "Key login failed"
+        assert pool.idle == {} and pool.borrowed == {}
+
+        assert pool.put_file("flakyhost", "etd", None, "local.xml",
+                             "/incoming/local.xml") == "Failed to send"
+
+    def test_put_fileobj_is_renamed_and_rewound(self):
+        """
+        Test that a stream is sent under a temporary name for the rename,
+        and sent whole again from its start after a failed attempt.
+        """
+        pool = SFTPPool(connect=FakeConnection, load_key=lambda path: path)
+        conn = pool.checkout("dropbox", "etd", None)
+        conn.fail_puts = 1
+        pool.checkin(conn)
+        stream = io.BytesIO(b'<?xml?><collection/>')
+        stream.seek(7)
+        assert not pool.put_fileobj("dropbox", "etd", None, stream,
+                                    "/incoming/AlmaDRSDark_1.xml")
+        conn, data, tempFile, remoteFile = FakeConnection.uploads[-1]
+        assert data == b'<collection/>'
+        assert tempFile == "/incoming/AlmaDRSDark_1.xml.part"
+        assert remoteFile == "/incoming/AlmaDRSDark_1.xml"
+        assert pool.stats()['misses'] == 2
+
+
+class TestSFTPPoolServer():
+    """
+    The pool against a local sftp server, over real ssh connections.
+    """
+
+    def idle(self, pool, server):
+        [(conn, last_used)] = pool.idle[("127.0.0.1", "etd", server.port)]
+        return conn
+
+    def put(self, pool, server, data, name="AlmaDRSDark_1.xml"):
+        return pool.put_fileobj("127.0.0.1", "etd", "~/.ssh/id_rsa",
+                                io.BytesIO(data), f"/incoming/{name}",
+                                server.port)
+
+    def test_put_fileobj_renames_the_part_file(self, sftp_server):
+        """
+        Test that a stream is uploaded under the .part name and renamed,
+        leaving only the whole file.
+        """
+        pool = SFTPPool()
+        assert not self.put(pool, sftp_server, b'<collection/>')
+        incoming = os.path.join(sftp_server.root, "incoming")
+        assert os.listdir(incoming) == ["AlmaDRSDark_1.xml"]
+        with open(os.path.join(incoming, "AlmaDRSDark_1.xml"), "rb") as f:
+            assert f.read() == b'<collection/>'
+        assert not self.put(pool, sftp_server, b'<collection/>',
+                            "AlmaDRSDark_2.xml")
+        assert pool.stats()['hits'] == 1
+        pool.close_all()
+
+    def test_failed_upload_is_logged(self, sftp_server, caplog):
+        """
+        Test that an upload the server refuses is reported, and that the
+        .part file that could not be removed is logged.
+        """
+        pool = SFTPPool()
+        with caplog.at_level(logging.WARNING,
+                             logger="etd_alma_drs_holding"):
+            error = pool.put_fileobj("127.0.0.1", "etd", "~/.ssh/id_rsa",
+                                     io.BytesIO(b'<collection/>'),
+                                     "/missing/AlmaDRSDark_1.xml",
+                                     sftp_server.port)
+        assert error.startswith("Failed to send stream to etd@127.0.0.1")
+        assert "Unable to remove partial upload " \
+            "etd@127.0.0.1:/missing/AlmaDRSDark_1.xml.part" in caplog.text
+        # retried once on a fresh connection
+        assert pool.stats()['misses'] == 2
+
+        # uploaded, but the rename is refused
+        incoming = os.path.join(sftp_server.root, "incoming")
+        os.mkdir(os.path.join(incoming, "AlmaDRSDark_1.xml"))
+        os.mkdir(os.path.join(incoming, "AlmaDRSDark_1.xml", "taken"))
+        assert self.put(pool, sftp_server, b'<collection/>')
+        assert os.listdir(incoming) == ["AlmaDRSDark_1.xml"]
+        pool.close_all()
+
+    def test_concurrent_uploads(self, sftp_server):
+        """
+        Test that uploads from several threads each get a connection of
+        their own and all land whole.
+        """
+        pool = SFTPPool()
+        errors = []
+        threads = [threading.Thread(target=lambda i=i: errors.append(
+            self.put(pool, sftp_server, b'<collection/>' * 1000,
+                     f"AlmaDRSDark_{i}.xml"))) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert errors == [False] * 4
+        incoming = os.path.join(sftp_server.root, "incoming")
+        assert sorted(os.listdir(incoming)) == \
+            [f"AlmaDRSDark_{i}.xml" for i in range(4)]
+        assert len(pool.idle[("127.0.0.1", "etd", sftp_server.port)]) == \
+            pool.stats()['misses']
+        pool.close_all()
+
+    def test_wrong_key_is_refused(self, sftp_server, tmp_path):
+        """
+        Test that a key the server does not take fails the login and is
+        not pooled.
+        """
+        paramiko.RSAKey.generate(2048).write_private_key_file(
+            str(tmp_path / "other_rsa"))
+        pool = SFTPPool()
+        error = pool.put_fileobj("127.0.0.1", "etd",
+                                 str(tmp_path / "other_rsa"),
+                                 io.BytesIO(b'<collection/>'),
+                                 "/incoming/AlmaDRSDark_1.xml",
+                                 sftp_server.port)
+        assert error.startswith("Key login failed: etd@127.0.0.1")
+        assert pool.idle == {}
+
+    def test_dropped_connection_reconnects(self, sftp_server):
+        """
+        Test that a connection the server closed is found dead and
+        replaced before the next upload.
+        """
+        pool = SFTPPool()
+        assert not self.put(pool, sftp_server, b'<collection/>')
+        conn = self.idle(pool, sftp_server)
+        assert conn.is_alive(probe=True)
+        sftp_server.drop_connections()
+        for _ in range(100):
+            if not conn.is_alive():
+                break
+            time.sleep(0.01)
+        assert not conn.is_alive()
+        assert not self.put(pool, sftp_server, b'<collection/>',
+                            "AlmaDRSDark_2.xml")
+        assert pool.stats()['reconnects'] == 1
+        pool.close_all()
+
+    def test_probe_finds_a_closed_channel(self, sftp_server):
+        """
+        Test that an idle connection whose sftp channel is gone, though
+        its ssh transport is up, is caught by the probe and replaced.
+        """
+        pool = SFTPPool(liveness_check_secs=0)
+        assert not self.put(pool, sftp_server, b'<collection/>')
+        conn = self.idle(pool, sftp_server)
+        conn._sftp.close()
+        assert conn.is_alive()
+        assert not conn.is_alive(probe=True)
+        assert not self.put(pool, sftp_server, b'<collection/>',
+                            "AlmaDRSDark_2.xml")
+        assert self.idle(pool, sftp_server) is not conn
+        assert pool.stats()['reconnects'] == 1
+        pool.close_all()
+
+    def test_keepalive(self, sftp_server):
+        """
+        Test that pooled connections send ssh keepalives while idle.
+        """
+        pool = SFTPPool(keepalive_secs=0.2)
+        assert not self.put(pool, sftp_server, b'<collection/>')
+        for _ in range(100):
+            if sftp_server.keepalives:
+                break
+            time.sleep(0.02)
+        assert sftp_server.keepalives > 0
+        pool.close_all()
+
+    @pytest.mark.parametrize("key_type", ["ecdsa", "ed25519"])
+    def test_other_key_types(self, sftp_server, tmp_path, key_type):
+        """
+        Test that ECDSA and Ed25519 key files are loaded and log in.
+        """
+        path = str(tmp_path / f"id_{key_type}")
+        if key_type == "ecdsa":
+            paramiko.ECDSAKey.generate().write_private_key_file(path)
+        else:
+            with open(path, "wb") as f:
+                f.write(ed25519.Ed25519PrivateKey.generate().private_bytes(
+                    serialization.Encoding.PEM,
+                    serialization.PrivateFormat.OpenSSH,
+                    serialization.NoEncryption()))
+        key = load_private_key(path)
+        assert key.get_name().startswith(
+            {"ecdsa": "ecdsa-sha2", "ed25519": "ssh-ed25519"}[key_type])
+        sftp_server.user_key = key
+        pool = SFTPPool()
+        assert not pool.put_fileobj("127.0.0.1", "etd", path,
+                                    io.BytesIO(b'<collection/>'),
+                                    "/incoming/AlmaDRSDark_1.xml",
+                                    sftp_server.port)
+        pool.close_all()
+
+    def test_unreadable_key(self, tmp_path):
+        """
+        Test that a file that is no key of any type is refused.
+        """
+        (tmp_path / "id_rsa").write_text("not a key\n")
+        with pytest.raises(paramiko.SSHException):
+            load_private_key(str(tmp_path / "id_rsa"))
@@ -0,0 +1,87 @@
+from etd.sru_resolver import SRUBatchResolver
+from etd.drs_holding_async import AsyncAlmaClient, AsyncDRSHoldingPipeline
+from etd.alma_cache import AlmaIdCache, LRUCache, MMS_ID
+from etd.alma_client import AlmaClient
+from etd.fake_alma import FakeAlma
+import etd.holding_xml as holding_xml
+import requests_mock
+import pytest
+
+
+class TestSRUBatchResolver():
+
+    def test_resolve(self):
+        """
+        Test that pqids are resolved with ORed, paged SRU searches and
+        the ids Alma does not have are reported as missing.
+        """
+        with FakeAlma() as alma:
+            pqids = []
+            for i in range(60):
+                pqid = str(30000000 + i)
+                alma.add_record(pqid, f"99{i}", f"22{i}")
+                pqids.append(pqid)
+            pqids += ["40000001", "40000002", pqids[0]]
+            cache = AlmaIdCache(LRUCache())
+            resolver = SRUBatchResolver(alma.client(), batch_size=25,
+                                        page_size=10, id_cache=cache)
+            mms_ids, missing = resolver.resolve(pqids)
+            assert len(mms_ids) == 60
+            assert mms_ids["30000042"] == "9942"
+            assert missing == ["40000001", "40000002"]
+            # 25 + 25 + 12 pqids, pages of 10 records
+            assert resolver.searches == 7
+            assert alma.request_count() == 7
+            assert cache.get(MMS_ID, "30000059") == "9959"
+
+            again = SRUBatchResolver(alma.client(), id_cache=cache)
+            mms_ids, missing = again.resolve(pqids[:60])
+            assert len(mms_ids) == 60 and missing == []
+            assert again.searches == 0
+
+    def test_errors(self):
+        """
+        Test that a failed search leaves its batch unresolved.
+        """
+        client = AlmaClient(api_base="https://alma.example.edu",
+                            api_key="secret",
+                            sru_base="https://alma.example.edu/sru?"
+                                     "query=alma.local_field_035=")
+        resolver = SRUBatchResolver(client, batch_size=2)
+        with requests_mock.Mocker() as m:
+            m.get(requests_mock.ANY, status_code=500)
+            assert resolver.resolve(["1", "2", "3"]) == ({}, ["1", "2", "3"])
+        assert resolver.searches == 2
+        assert "query=alma.local_field_035%3D1%20or%20" \
+               "alma.local_field_035%3D2&startRecord=1&maximumRecords=50" \
+               in client.sru_search_url(["1", "2"])
+
+        client.sru_base = "https://alma.example.edu/sru"
+        with pytest.raises(ValueError):
+            client.sru_search_url(["1"])
+        assert holding_xml.parse_sru_records(b"<empty/>") == (0, [], None)
+
+    def test_async_prefetch(self):
+        """
+        Test that the async pipeline resolves its mms ids in one search.
+        """
+        with FakeAlma() as alma:
+            records = []
+            for i in range(5):
+                pqid = str(30000000 + i)
+                alma.add_record(pqid, f"99{i}", f"22{i}")
+                records.append({"pqid": pqid,
+                                "object_urn": f"URN-3:HUL.DRS.OBJECT:{i}"})
+            records.append({"pqid": "40000001",
+                            "object_urn": "URN-3:HUL.DRS.OBJECT:9"})
+            client = AsyncAlmaClient(alma.client(), concurrency=2)
+            pipeline = AsyncDRSHoldingPipeline(
+                client, concurrency=2,
+                resolver=SRUBatchResolver(client.client))
+            outcomes = pipeline.run(records)
+            client.close()
+            assert outcomes.pop("40000001") is False
+            assert all(outcomes.values())
+            # one bulk search, then one search for the missing pqid
+            assert len([r for r in alma.requests
+                        if r[1].endswith('/sru')]) == 2
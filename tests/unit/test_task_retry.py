@@ -0,0 +1,66 @@
+import etd.task_retry as task_retry
+import requests
+
+
+class TestTaskRetry():
+
+    def test_backoff_countdown(self):
+        """
+        Test that the backoff doubles, is capped and is jittered.
+        """
+        assert task_retry.backoff_countdown(0, base=60, cap=900, jitter=0,
+                                            rand=lambda: 0.7) == 60
+        assert task_retry.backoff_countdown(2, base=60, cap=900, jitter=0,
+                                            rand=lambda: 0.7) == 240
+        assert task_retry.backoff_countdown(10, base=60, cap=900, jitter=0,
+                                            rand=lambda: 0.7) == 900
+        assert task_retry.backoff_countdown(1, base=60, cap=900, jitter=0.5,
+                                            rand=lambda: 0.0) == 60
+        assert task_retry.backoff_countdown(1, base=60, cap=900, jitter=0.5,
+                                            rand=lambda: 1.0) == 120
+
+    def test_retry_state(self):
+        """
+        Test that the retry state is carried in the message.
+        """
+        message = {"pqid": "28542882", "object_urn": "URN"}
+        assert task_retry.retry_state(message) == {}
+        first = task_retry.next_retry_message(message, Exception("down"),
+                                              now=100)
+        assert "retry_state" not in message
+        assert first["pqid"] == "28542882"
+        second = task_retry.next_retry_message(first, "still down", now=160)
+        assert task_retry.retry_state(second) == {
+            'count': 2, 'first_failed_at': 100, 'last_failed_at': 160,
+            'last_error': "still down"}
+        assert task_retry.next_retry_message(
+            message, "x")["retry_state"]["last_failed_at"] > 0
+
+    def test_outcomes(self):
+        """
+        Test counting retry outcomes and picking transient statuses.
+        """
+        before = task_retry.retry_outcomes["scheduled"]
+        task_retry.record_outcome("scheduled")
+        assert task_retry.retry_outcomes["scheduled"] == before + 1
+        assert task_retry.is_transient_status(429)
+        assert task_retry.is_transient_status(503)
+        assert not task_retry.is_transient_status(400)
+
+    def test_transient_errors(self):
+        """
+        Test that only transport errors and transient statuses are worth
+        a retry.
+        """
+        def http_error(status_code):
+            response = requests.Response()
+            response.status_code = status_code
+            return requests.HTTPError(response=response)
+
+        assert task_retry.is_transient_error(requests.ConnectionError())
+        assert task_retry.is_transient_error(requests.ReadTimeout())
+        assert task_retry.is_transient_error(http_error(503))
+        assert task_retry.is_transient_error(http_error(429))
+        assert not task_retry.is_transient_error(http_error(400))
+        assert not task_retry.is_transient_error(requests.HTTPError())
+        assert not task_retry.is_transient_error(ValueError("bad xml"))
@@ -0,0 +1,49 @@
+import etd.telemetry as telemetry
+from opentelemetry import trace
+from opentelemetry.sdk.trace import TracerProvider
+
+
+class TestTelemetry():
+
+    def test_provider_created_once(self, monkeypatch):
+        """
+        Test that the provider is created on the first span and reused,
+        and created again in a forked process.
+        """
+        monkeypatch.setattr(telemetry, "_provider", None)
+        monkeypatch.setattr(telemetry, "_provider_pid", None)
+        created = []
+
+        def create():
+            created.append(TracerProvider())
+            return created[-1]
+
+        tracer = telemetry.get_tracer(__name__)
+        assert created == []
+        monkeypatch.setattr(telemetry, "_create_provider", create)
+        with tracer.start_as_current_span("first") as span:
+            assert span.is_recording()
+            assert trace.get_current_span() is span
+        with tracer.start_as_current_span("second"):
+            pass
+        assert len(created) == 1
+
+        monkeypatch.setattr(telemetry, "_provider_pid", -1)
+        assert telemetry.get_tracer_provider() is created[1]
+        telemetry.shutdown()
+        monkeypatch.setattr(telemetry, "_provider_pid", -1)
+        telemetry.shutdown()
+
+    def test_tracing_off(self, monkeypatch):
+        """
+        Test that no provider is created when tracing is off.
+        """
+        monkeypatch.setattr(telemetry, "TRACING", "off")
+        monkeypatch.setattr(telemetry, "_provider", None)
+        assert not telemetry.tracing_enabled()
+        assert isinstance(telemetry.get_tracer_provider(),
+                          trace.NoOpTracerProvider)
+        with telemetry.get_tracer(__name__).start_as_current_span(
+                "off") as span:
+            assert not span.is_recording()
+        assert telemetry._provider is None
@@ -0,0 +1,134 @@
+from etd.trace_sampling import (ExportedSpan, RatioSampler,
+                                TailSamplingProcessor, span_limits)
+from opentelemetry import trace
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+from opentelemetry.sdk.trace.export.in_memory_span_exporter import (
+    InMemorySpanExporter)
+from opentelemetry.trace import Status, StatusCode
+
+
+def make_tracer(ratio, slow_secs=30, drop_events_on_success=False,
+                max_pending_traces=100, record_unsampled=True,
+                max_events=32):
+    exporter = InMemorySpanExporter()
+    processor = TailSamplingProcessor(
+        SimpleSpanProcessor(exporter), slow_secs=slow_secs,
+        drop_events_on_success=drop_events_on_success,
+        max_pending_traces=max_pending_traces)
+    provider = TracerProvider(
+        sampler=RatioSampler(ratio, record_unsampled=record_unsampled),
+        span_limits=span_limits(max_events=max_events,
+                                max_attribute_length=10))
+    provider.add_span_processor(processor)
+    return provider.get_tracer(__name__), exporter, processor
+
+
+def names(exporter):
+    return sorted(span.name for span in exporter.get_finished_spans())
+
+
+class TestTraceSampling():
+
+    def test_sampled_records(self):
+        """
+        Test that sampled records are exported with their limits applied.
+        """
+        tracer, exporter, processor = make_tracer(1.0, max_events=2)
+        with tracer.start_as_current_span("record") as span:
+            span.set_attribute("message", "x" * 100)
+            for i in range(5):
+                span.add_event(f"event {i}")
+            with tracer.start_as_current_span("step"):
+                pass
+        assert names(exporter) == ["record", "step"]
+        record = [s for s in exporter.get_finished_spans()
+                  if s.name == "record"][0]
+        assert record.attributes["message"] == "x" * 10
+        assert len(record.events) == 2
+        assert processor.stats()['sampled'] == 2
+        assert RatioSampler(0.5).get_description() == "RatioSampler{0.5}"
+
+    def test_unsampled_records(self):
+        """
+        Test that unsampled records are dropped unless they fail or are
+        slow, in which case every span of the record is exported.
+        """
+        tracer, exporter, processor = make_tracer(0.0)
+        with tracer.start_as_current_span("ok") as span:
+            assert span.is_recording()
+            with tracer.start_as_current_span("ok step"):
+                pass
+        assert names(exporter) == []
+
+        with tracer.start_as_current_span("failed record"):
+            with tracer.start_as_current_span("failed step") as step:
+                step.add_event("why it failed")
+                step.set_status(Status(StatusCode.ERROR))
+        assert names(exporter) == ["failed record", "failed step"]
+        failed_step = exporter.get_finished_spans()[0]
+        assert [e.name for e in failed_step.events] == ["why it failed"]
+        assert failed_step.dropped_events == 0
+
+        slow, exporter, processor = make_tracer(0.0, slow_secs=0)
+        with slow.start_as_current_span("slow record"):
+            pass
+        assert names(exporter) == ["slow record"]
+        assert exporter.get_finished_spans()[0].context.trace_flags.sampled
+        assert processor.stats() == {'promoted_slow': 1, 'pending': 0}
+
+        tracer, exporter, processor = make_tracer(0.0,
+                                                  record_unsampled=False)
+        with tracer.start_as_current_span("not recorded") as span:
+            assert not span.is_recording()
+
+    def test_parent_based(self):
+        """
+        Test that a record follows the sampling decision of its producer.
+        """
+        tracer, exporter, processor = make_tracer(1.0)
+        context = trace.set_span_in_context(trace.NonRecordingSpan(
+            trace.SpanContext(1, 2, is_remote=True,
+                              trace_flags=trace.TraceFlags(0))))
+        with tracer.start_as_current_span("consumer", context=context):
+            pass
+        assert names(exporter) == []
+        assert processor.stats()['dropped'] == 1
+
+    def test_pending_traces_bounded(self):
+        """
+        Test that the oldest unfinished records are dropped when too many
+        are held.
+        """
+        tracer, exporter, processor = make_tracer(0.0, max_pending_traces=1)
+        first = tracer.start_span("first record")
+        first_step = tracer.start_span(
+            "first step", context=trace.set_span_in_context(first))
+        first_step.end()
+        second = tracer.start_span("second record")
+        second_step = tracer.start_span(
+            "second step", context=trace.set_span_in_context(second))
+        second_step.end()
+        assert processor.stats() == {'evicted': 1, 'pending': 1}
+        processor.force_flush()
+        processor.shutdown()
+
+    def test_drop_events_on_success(self):
+        """
+        Test that events are dropped from successful spans only.
+        """
+        tracer, exporter, processor = make_tracer(
+            1.0, drop_events_on_success=True)
+        with tracer.start_as_current_span("record") as span:
+            span.add_event("verbose")
+            with tracer.start_as_current_span("failed step") as step:
+                step.add_event("what failed")
+                step.set_status(Status(StatusCode.ERROR))
+        spans = {s.name: s for s in exporter.get_finished_spans()}
+        assert isinstance(spans["record"], ExportedSpan)
+        assert spans["record"].events == ()
+        assert spans["record"].dropped_events == 1
+        assert spans["record"].name == "record"
+        assert [e.name for e in spans["failed step"].events] == \
+            ["what failed"]
+        assert spans["failed step"].dropped_events == 0